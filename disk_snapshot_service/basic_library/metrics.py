@@ -0,0 +1,153 @@
+"""服务内部的统计数据，以 Prometheus 文本格式输出，参考 ice_service.metrics_exporter
+
+    1. Histogram 记录耗时等数值的分布，observe 仅在锁内累加计数，可以在热点路径中调用
+    2. MetricWriter 按 Prometheus 文本格式（version 0.0.4）生成输出，同名指标的 HELP 与 TYPE 仅输出一次
+"""
+import bisect
+import threading
+import typing
+
+# 单位秒，覆盖锁等待与 Op 调用的常见耗时
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """数值分布的直方图"""
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # 最后一个为超出所有上限的数量
+        self._sum = 0.0
+        self._locker = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._locker:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self) -> typing.Tuple[typing.List[typing.Tuple[float, int]], float, int]:
+        """返回 ([(上限, 不超过上限的累计数量), ...], 总和, 总数量)"""
+        with self._locker:
+            counts, total_sum = list(self._counts), self._sum
+        cumulative, result = 0, list()
+        for upper, count in zip(self.buckets, counts):
+            cumulative += count
+            result.append((upper, cumulative))
+        return result, total_sum, cumulative + counts[-1]
+
+
+class HistogramFamily(object):
+    """按一个标签的取值区分的一组直方图，例如按 Op 调用名区分的耗时"""
+
+    def __init__(self, label: str, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.label = label
+        self.buckets = buckets
+        self._histograms: typing.Dict[str, Histogram] = dict()
+        self._locker = threading.Lock()
+
+    def labels(self, value: str) -> Histogram:
+        histogram = self._histograms.get(value)
+        if histogram is None:
+            with self._locker:
+                histogram = self._histograms.setdefault(value, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, value: str, number: float):
+        self.labels(value).observe(number)
+
+    def items(self) -> typing.List[typing.Tuple[str, Histogram]]:
+        with self._locker:
+            return sorted(self._histograms.items())
+
+
+class CounterFamily(object):
+    """按一个标签的取值区分的一组计数器"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self._counts: typing.Dict[str, int] = dict()
+        self._locker = threading.Lock()
+
+    def inc(self, value: str, number=1):
+        with self._locker:
+            self._counts[value] = self._counts.get(value, 0) + number
+
+    def items(self) -> typing.List[typing.Tuple[str, int]]:
+        with self._locker:
+            return sorted(self._counts.items())
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels: typing.Dict[str, typing.Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class MetricWriter(object):
+    """生成 Prometheus 文本格式的输出"""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._lines: typing.List[str] = list()
+        self._declared: typing.Set[str] = set()
+
+    def _declare(self, name: str, metric_type: str, help_text: str):
+        if name in self._declared:
+            return
+        self._declared.add(name)
+        self._lines.append(f'# HELP {name} {help_text}')
+        self._lines.append(f'# TYPE {name} {metric_type}')
+
+    def _sample(self, name: str, value, labels: dict = None):
+        self._lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+    def gauge(self, name: str, help_text: str, value, labels: dict = None):
+        name = self.prefix + name
+        self._declare(name, 'gauge', help_text)
+        self._sample(name, value, labels)
+
+    def counter(self, name: str, help_text: str, value, labels: dict = None):
+        name = self.prefix + name
+        self._declare(name, 'counter', help_text)
+        self._sample(name, value, labels)
+
+    def histogram(self, name: str, help_text: str, histogram: Histogram, labels: dict = None):
+        name = self.prefix + name
+        self._declare(name, 'histogram', help_text)
+        labels = labels or dict()
+        buckets, total_sum, total_count = histogram.snapshot()
+        for upper, count in buckets:
+            self._sample(f'{name}_bucket', count, dict(labels, le=_format_value(float(upper))))
+        self._sample(f'{name}_bucket', total_count, dict(labels, le='+Inf'))
+        self._sample(f'{name}_sum', total_sum, labels)
+        self._sample(f'{name}_count', total_count, labels)
+
+    def histogram_family(self, name: str, help_text: str, family: HistogramFamily):
+        for value, histogram in family.items():
+            self.histogram(name, help_text, histogram, {family.label: value})
+
+    def counter_family(self, name: str, help_text: str, family: CounterFamily):
+        for value, count in family.items():
+            self.counter(name, help_text, count, {family.label: value})
+
+    def text(self) -> str:
+        return '\n'.join(self._lines) + '\n'
@@ -0,0 +1,109 @@
+"""异步日志
+
+logging.ini 配置的 RotatingFileHandler 在调用线程中同步格式化与写入文件，高调用频率时日志 I/O 成为延迟的主要部分
+start() 将 root logger 的 handler 替换为 QueueHandler ，由 QueueListener 线程格式化并写入原有的 handler
+    1. 参数均为基本类型时，消息在 QueueListener 线程中格式化（延迟格式化），调用线程仅构造 LogRecord
+       参数包含其他对象（例如数据库对象、句柄对象）时，在调用线程中格式化，避免在其他线程访问会变化的对象
+    2. 队列满时丢弃 INFO 及以下级别的日志并计数，WARNING 及以上级别的日志等待写入
+"""
+import atexit
+import decimal
+import logging
+import logging.handlers
+import queue
+import threading
+import typing
+
+LAZY_ARG_TYPES = (str, int, float, bool, type(None), decimal.Decimal,)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, queue_obj: queue.Queue):
+        super(LazyQueueHandler, self).__init__(queue_obj)
+        self.dropped = 0
+
+    @staticmethod
+    def _is_lazy_args(args) -> bool:
+        if isinstance(args, dict):
+            args = args.values()
+        return all(isinstance(arg, LAZY_ARG_TYPES) for arg in args)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args and not self._is_lazy_args(record.args):
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncLogging(object):
+
+    def __init__(self, logger: logging.Logger, max_queue=65536):
+        self.logger = logger
+        self.handlers: typing.List[logging.Handler] = list(logger.handlers)
+        self.queue_handler = LazyQueueHandler(queue.Queue(max_queue))
+        self.listener = logging.handlers.QueueListener(
+            self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+
+    def __str__(self):
+        return (f'async_logging:<{len(self.handlers)} handlers,{self.queue_handler.queue.qsize()} queued,'
+                f'{self.queue_handler.dropped} dropped>')
+
+    def to_dict(self) -> dict:
+        return {
+            'handlers': len(self.handlers),
+            'queued': self.queue_handler.queue.qsize(),
+            'dropped': self.queue_handler.dropped,
+        }
+
+    def start(self):
+        self.listener.start()
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.queue_handler)
+
+    def stop(self):
+        """恢复原有的 handler ，并写入队列中剩余的日志"""
+        self.logger.removeHandler(self.queue_handler)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        self.listener.stop()
+
+
+_async_logging: AsyncLogging = None
+_async_logging_locker = threading.Lock()
+
+
+def get_async_logging() -> typing.Union[AsyncLogging, None]:
+    """没有启用异步日志时返回 None"""
+    return _async_logging
+
+
+def start(logger: logging.Logger = None, max_queue=65536) -> AsyncLogging:
+    """将 logger （默认为 root logger）的 handler 改为异步写入，进程退出时写入剩余的日志"""
+    global _async_logging
+
+    with _async_logging_locker:
+        assert _async_logging is None, ('重复启用异步日志', f'started {_async_logging}', 0)
+        _async_logging = AsyncLogging(logger or logging.getLogger(), max_queue)
+        _async_logging.start()
+    atexit.register(stop)
+    return _async_logging
+
+
+def stop():
+    global _async_logging
+
+    with _async_logging_locker:
+        async_logging, _async_logging = _async_logging, None
+    if async_logging:
+        atexit.unregister(stop)
+        async_logging.stop()
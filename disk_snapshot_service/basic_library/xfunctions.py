@@ -1,11 +1,9 @@
+import datetime
 import decimal
 import threading
 import time
 import typing
 
-import arrow
-from dateutil import tz
-
 
 def convert_timestamp_float_to_decimal(timestamp: float) -> decimal.Decimal:
     return decimal.Decimal(round(timestamp, 6))
@@ -20,11 +18,15 @@ def current_timestamp_float() -> float:
 
 
 def humanize_timestamp(timestamp: typing.Union[decimal.Decimal, None], empty_str='') -> str:
-    """格式化时间戳为人可读的描述"""
+    """格式化时间戳为人可读的描述
+
+    :remark:
+        日志中频繁调用，使用 datetime 格式化为本地时间，格式与 arrow 的 YYYY-MM-DD HH:mm:ss.SSSSSS 相同
+    """
     if not timestamp:
         return empty_str
 
-    return arrow.Arrow.fromtimestamp(timestamp, tz.tzlocal()).format('YYYY-MM-DD HH:mm:ss.SSSSSS')
+    return datetime.datetime.fromtimestamp(float(timestamp)).strftime('%Y-%m-%d %H:%M:%S.%f')
 
 
 UNIQUE_NUMBER_STORAGE_CHAIN = 0
@@ -0,0 +1,300 @@
+"""快照存储回收逻辑模拟器
+
+在 sqlite 中构造合成的快照存储树，使用模拟的 DiskSnapshotAction 执行 StorageCollection，直到没有可执行的回收作业
+统计回收轮数、数据库查询次数、存储锁持有时间、模拟搬迁的数据量与耗时，可作为回收规划逻辑变更的回归基准
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.collection_simulator --shape qcow_chain --nodes 2000 --output result.json
+    python -m benchmark.collection_simulator --shape cdp_runs --baseline result.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import random
+import sys
+import time
+import typing
+from unittest import mock
+
+import sqlalchemy
+
+from business_logic import locker_manager as lm
+from business_logic import storage_action as action
+from business_logic import storage_reference_manager as srm
+from data_access import models as m
+from data_access import session as s
+from data_access import storage as da_storage
+from service_logic import storage_collection as sc
+
+GiB = 1024 * 1024 * 1024
+TREE_IDENT = 'simulated_tree'
+
+
+class SimulationStats(object):
+    """模拟结果"""
+
+    def __init__(self, shape: str, nodes: int):
+        self.shape = shape
+        self.nodes = nodes
+        self.rounds = 0
+        self.db_queries = 0
+        self.lock_acquired = 0
+        self.lock_wait_seconds = 0.0
+        self.lock_hold_seconds = 0.0
+        self.lock_hold_max_seconds = 0.0
+        self.bytes_moved = 0
+        self.files_removed = 0
+        self.snapshots_deleted = 0
+        self.hash_merged = 0
+        self.storages_remaining = 0
+        self.recycling_remaining = 0
+        self.wall_seconds = 0.0
+        self.reached_fixed_point = False
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class FakeDiskSnapshotAction(object):
+    """模拟底层镜像服务，仅统计数据量，不产生实际IO"""
+
+    def __init__(self, stats: SimulationStats):
+        self.stats = stats
+
+    def move_data(self, *args):
+        begin_bytes, end_bytes = args[-2:]
+        self.stats.bytes_moved += end_bytes - begin_bytes
+
+    def merge_qcow_hash(self, *args):
+        _ = args
+        self.stats.hash_merged += 1
+        return list()
+
+    def delete_qcow_snapshot(self, file_path, snapshot_name):
+        _ = file_path
+        _ = snapshot_name
+        self.stats.snapshots_deleted += 1
+
+    def remove_file(self, file_path):
+        _ = file_path
+        self.stats.files_removed += 1
+        return True
+
+    @contextlib.contextmanager
+    def patch(self):
+        cls = action.DiskSnapshotAction
+        with mock.patch.object(cls, 'merge_cdp_to_qcow', self.move_data), \
+                mock.patch.object(cls, 'move_data_from_qcow', self.move_data), \
+                mock.patch.object(cls, 'merge_qcow_hash', self.merge_qcow_hash), \
+                mock.patch.object(cls, 'delete_qcow_snapshot', self.delete_qcow_snapshot), \
+                mock.patch.object(cls, 'remove_cdp_file', self.remove_file), \
+                mock.patch.object(cls, 'remove_qcow_file', self.remove_file), \
+                mock.patch.object(sc.rt.PathInMount, 'is_in_not_mount', return_value=False):
+            yield
+
+
+@contextlib.contextmanager
+def _trace_storage_locker(stats: SimulationStats):
+    """统计存储锁的等待时间与持有时间（仅统计最外层的获取与释放）"""
+
+    raw_acquire = lm.LockWithTrace.acquire
+    raw_release = lm.LockWithTrace.release
+    acquired_time = dict()
+
+    def acquire(locker, trace):
+        begin = time.perf_counter()
+        result = raw_acquire(locker, trace)
+        if locker.name == 'storage' and len(locker._current_trace) == 1:
+            now = time.perf_counter()
+            acquired_time[locker.name] = now
+            stats.lock_acquired += 1
+            stats.lock_wait_seconds += now - begin
+        return result
+
+    def release(locker):
+        if locker.name == 'storage' and len(locker._current_trace) == 1:
+            hold = time.perf_counter() - acquired_time.pop(locker.name)
+            stats.lock_hold_seconds += hold
+            stats.lock_hold_max_seconds = max(stats.lock_hold_max_seconds, hold)
+        raw_release(locker)
+
+    with mock.patch.object(lm.LockWithTrace, 'acquire', acquire), \
+            mock.patch.object(lm.LockWithTrace, 'release', release):
+        yield
+
+
+@contextlib.contextmanager
+def _bind_database(db_url: str, stats: SimulationStats):
+    with s.local_database(db_url) as engine:
+        m.Base.metadata.drop_all(engine)
+        m.Base.metadata.create_all(engine)
+
+        def _count_query(*args):
+            _ = args
+            stats.db_queries += 1
+
+        srm._storage_reference_manager = None
+        try:
+            yield engine, _count_query
+        finally:
+            s.session_maker.remove()
+            srm._storage_reference_manager = None
+
+
+class TreeBuilder(object):
+    """构造合成的快照存储树
+
+    形状：
+        qcow_chain : 长qcow链，每 snapshots_per_file 个快照点使用一个新文件
+        cdp_runs   : qcow 与连续的 CDP 交替出现
+        fan_out    : 根节点下有多个分支（保留策略产生的扇出）
+        dedup_root : 根节点带有文件级去重
+    """
+
+    SHAPES = ('qcow_chain', 'cdp_runs', 'fan_out', 'dedup_root',)
+
+    def __init__(self, rng: random.Random, recycling_ratio: float, disk_bytes: int, snapshots_per_file: int):
+        self.rng = rng
+        self.recycling_ratio = recycling_ratio
+        self.disk_bytes = disk_bytes
+        self.snapshots_per_file = snapshots_per_file
+        self.count = 0
+
+    def _new_ident(self) -> str:
+        return '%032x' % self.rng.getrandbits(128)
+
+    def _new_path(self, suffix) -> str:
+        return f'/simulated/{self._new_ident()}.{suffix}'
+
+    def _random_status(self):
+        if self.rng.random() < self.recycling_ratio:
+            return m.SnapshotStorage.STATUS_RECYCLING
+        return m.SnapshotStorage.STATUS_STORAGE
+
+    def _add(self, parent_ident, storage_type, status, image_path, file_level_deduplication=None) -> str:
+        ident = self._new_ident()
+        obj = da_storage.create_obj(
+            ident, parent_ident, None, storage_type, self.disk_bytes, status, image_path, TREE_IDENT)
+        if file_level_deduplication:
+            obj.file_level_deduplication = True
+        self.count += 1
+        return ident
+
+    def _add_qcow_chain(self, parent_ident, nodes, keep_last=True) -> str:
+        image_path = self._new_path('qcow')
+        for i in range(nodes):
+            if i and i % self.snapshots_per_file == 0:
+                image_path = self._new_path('qcow')
+            last = i == nodes - 1
+            status = m.SnapshotStorage.STATUS_STORAGE if (last and keep_last) else self._random_status()
+            parent_ident = self._add(parent_ident, m.SnapshotStorage.TYPE_QCOW, status, image_path)
+        return parent_ident
+
+    def build(self, shape, nodes):
+        getattr(self, f'_build_{shape}')(nodes)
+        s.get_scoped_session().flush()
+
+    def _build_qcow_chain(self, nodes):
+        root = self._add(None, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_STORAGE, self._new_path('qcow'))
+        self._add_qcow_chain(root, nodes - 1)
+
+    def _build_cdp_runs(self, nodes, cdp_run=6):
+        parent = self._add(None, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_STORAGE,
+                           self._new_path('qcow'))
+        while self.count < nodes:
+            for _ in range(min(cdp_run, nodes - self.count)):
+                parent = self._add(parent, m.SnapshotStorage.TYPE_CDP, self._random_status(), self._new_path('cdp'))
+            if self.count < nodes:
+                parent = self._add(parent, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_STORAGE,
+                                   self._new_path('qcow'))
+
+    def _build_fan_out(self, nodes, branch_nodes=10):
+        root = self._add(None, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_STORAGE, self._new_path('qcow'))
+        while self.count < nodes:
+            self._add_qcow_chain(root, min(branch_nodes, nodes - self.count), keep_last=False)
+
+    def _build_dedup_root(self, nodes):
+        root = self._add(None, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_RECYCLING,
+                         self._new_path('qcow'), file_level_deduplication=True)
+        self._add_qcow_chain(root, nodes - 1)
+
+
+def simulate(shape: str, nodes: int, recycling_ratio=0.7, seed=0, disk_bytes=64 * GiB, snapshots_per_file=8,
+             db_url='sqlite://', max_rounds=100000) -> SimulationStats:
+    """构造快照存储树，执行回收逻辑直至没有可执行的回收作业"""
+
+    assert shape in TreeBuilder.SHAPES, f'invalid shape {shape}'
+    stats = SimulationStats(shape, nodes)
+    fake_action = FakeDiskSnapshotAction(stats)
+
+    with _bind_database(db_url, stats) as (engine, count_query):
+        with s.transaction():
+            TreeBuilder(random.Random(seed), recycling_ratio, disk_bytes, snapshots_per_file).build(shape, nodes)
+
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_query)
+        begin = time.perf_counter()
+        with fake_action.patch(), _trace_storage_locker(stats):
+            collection = sc.StorageCollection(TREE_IDENT)
+            while stats.rounds < max_rounds:
+                stats.rounds += 1
+                if not collection.collect():
+                    stats.reached_fixed_point = True
+                    break
+        stats.wall_seconds = time.perf_counter() - begin
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', count_query)
+
+        with s.readonly():
+            remaining = da_storage.query_valid_objs(TREE_IDENT)
+            stats.storages_remaining = len(remaining)
+            stats.recycling_remaining = sum(1 for o in remaining if o.status == m.SnapshotStorage.STATUS_RECYCLING)
+
+    return stats
+
+
+def _compare(result: dict, baseline: dict) -> typing.List[str]:
+    lines = list()
+    for key in ('rounds', 'db_queries', 'lock_hold_seconds', 'lock_hold_max_seconds', 'bytes_moved',
+                'wall_seconds', 'recycling_remaining',):
+        old, new = baseline.get(key), result[key]
+        if old:
+            lines.append(f'{key:24}{old:>16.6g}{new:>16.6g}{(new - old) / old * 100:>+10.1f}%')
+        else:
+            lines.append(f'{key:24}{str(old):>16}{new:>16.6g}')
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='StorageCollection simulator')
+    parser.add_argument('--shape', choices=TreeBuilder.SHAPES, default='qcow_chain')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--recycling-ratio', type=float, default=0.7)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--snapshots-per-file', type=int, default=8)
+    parser.add_argument('--disk-gib', type=int, default=64)
+    parser.add_argument('--db-url', default='sqlite://', help='sqlite:// (in memory) or sqlite:////path/to/file.db')
+    parser.add_argument('--max-rounds', type=int, default=100000)
+    parser.add_argument('--output', help='write result as json')
+    parser.add_argument('--baseline', help='compare with a previous json result')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    result = simulate(args.shape, args.nodes, args.recycling_ratio, args.seed, args.disk_gib * GiB,
+                      args.snapshots_per_file, args.db_url, args.max_rounds).to_dict()
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print('\n'.join(_compare(result, json.load(f))))
+
+    return 0 if result['reached_fixed_point'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""数据块hash去重索引基准
+
+生成多个合成的hash文件（相邻文件之间有 overlap 比例的重复数据块），逐个加入 DedupIndex
+测量加入索引的耗时、索引的磁盘占用、堆内存峰值，以及不同批量大小下批量查找的延迟
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.dedup_index_benchmark --files 16 --disk-gib 64 --work-dir /tmp/dedup_bench
+    python -m benchmark.dedup_index_benchmark --batch-sizes 1024 65536 --output result.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from business_logic import dedup_index
+from business_logic import hash_file
+
+GiB = 1024 * 1024 * 1024
+
+
+def _generate_files(work_dir, files, count, density, overlap, seed):
+    rng = np.random.default_rng(seed)
+    paths = list()
+    previous = None
+    for i in range(files):
+        records = rng.integers(1, 2 ** 32, (count, hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)
+        if previous is not None:
+            same = rng.random(count) < overlap
+            records[same] = previous[same]
+        records[rng.random(count) >= density] = 0
+        path = os.path.join(work_dir, f'{i}.hash')
+        hash_file.write_records(path, [records])
+        paths.append(path)
+        previous = records
+    return paths
+
+
+def _percentile_ms(values, percentile):
+    return round(float(np.percentile(values, percentile)) * 1000, 3)
+
+
+def run(work_dir, files=8, disk_bytes=16 * GiB, density=0.5, overlap=0.3, batch_sizes=(1024, 65536), rounds=20,
+        seed=0) -> dict:
+    count = hash_file.records_count(disk_bytes)
+    paths = _generate_files(work_dir, files, count, density, overlap, seed)
+
+    index = dedup_index.DedupIndex(os.path.join(work_dir, 'index'))
+    tracemalloc.start()
+    add_seconds = list()
+    for hash_id, path in enumerate(paths, 1):
+        begin = time.monotonic()
+        index.add_hash_file(hash_id, path)
+        add_seconds.append(time.monotonic() - begin)
+    _, add_heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = np.random.default_rng(seed + 1)
+    lookup = dict()
+    for batch_size in batch_sizes:
+        tracemalloc.start()
+        latencies = list()
+        found = 0
+        for _ in range(rounds):
+            keys = hash_file.open_records(paths[rng.integers(len(paths))])
+            keys = np.array(keys[rng.integers(0, count, batch_size)])
+            begin = time.monotonic()
+            found += index.lookup(keys).found_count
+            latencies.append(time.monotonic() - begin)
+        _, heap_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lookup[str(batch_size)] = {
+            'p50_ms': _percentile_ms(latencies, 50),
+            'p99_ms': _percentile_ms(latencies, 99),
+            'keys_per_second': round(batch_size * rounds / sum(latencies)),
+            'hit_ratio': round(found / (batch_size * rounds), 3),
+            'heap_peak_mib': round(heap_peak / 1024 / 1024, 1),
+        }
+
+    return {
+        'files': files,
+        'disk_gib': round(disk_bytes / GiB, 3),
+        'records_per_file': count,
+        'index_records': index.records_count,
+        'index_runs': len(index._runs),
+        'index_mib': round(index.disk_bytes / 1024 / 1024, 1),
+        'index_bytes_per_record': round(index.disk_bytes / max(index.records_count, 1), 1),
+        'add_seconds_per_file': round(sum(add_seconds) / len(add_seconds), 3),
+        'add_max_seconds': round(max(add_seconds), 3),
+        'add_heap_peak_mib': round(add_heap_peak / 1024 / 1024, 1),
+        'lookup': lookup,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='dedup index benchmark')
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--disk-gib', type=int, default=16)
+    parser.add_argument('--density', type=float, default=0.5)
+    parser.add_argument('--overlap', type=float, default=0.3)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1024, 65536])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='directory for synthetic files, removed after benchmark')
+    parser.add_argument('--output', help='write result as json')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+
+    work_dir = tempfile.mkdtemp(prefix='dedup_bench_', dir=args.work_dir)
+    try:
+        result = run(work_dir, args.files, args.disk_gib * GiB, args.density, args.overlap, args.batch_sizes,
+                     args.rounds, args.seed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""hash文件叠加基准
+
+生成合成的被合并快照点hash文件与子快照点增量hash文件，测量 hash_file.overlay 的耗时、吞吐量与堆内存峰值
+默认使用 1TB 磁盘对应的记录数量（64KB 数据块，约 16M 条记录，单个文件约 320MB）
+同时在少量记录上执行逐条记录的 Python 循环实现，估算矢量化实现的加速比
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.hash_merge_benchmark --disk-gib 1024 --work-dir /tmp/hash_bench
+    python -m benchmark.hash_merge_benchmark --disk-gib 64 --chunk-records 262144 --output result.json
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from business_logic import hash_file
+
+GiB = 1024 * 1024 * 1024
+
+
+def _generate(path: str, count: int, density: float, seed: int, chunk_records: int):
+    """生成 count 条记录的hash文件，其中 density 比例的记录非零"""
+    rng = np.random.default_rng(seed)
+
+    def _chunks():
+        for begin in range(0, count, chunk_records):
+            size = min(chunk_records, count - begin)
+            records = rng.integers(1, 2 ** 32, (size, hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)
+            records[rng.random(size) >= density] = 0
+            yield records
+
+    hash_file.write_records(path, _chunks())
+
+
+def _overlay_by_loop(base_path: str, increment_path: str, count: int) -> int:
+    """逐条记录处理的实现，作为对比基准"""
+    with open(base_path, 'rb') as f:
+        base = f.read(count * hash_file.RECORD_BYTES)
+    with open(increment_path, 'rb') as f:
+        increment = f.read(count * hash_file.RECORD_BYTES)
+
+    empty = bytes(hash_file.RECORD_BYTES)
+    merged = bytearray()
+    filled = 0
+    for i in range(count):
+        record = increment[i * hash_file.RECORD_BYTES:(i + 1) * hash_file.RECORD_BYTES]
+        if record == empty:
+            record = base[i * hash_file.RECORD_BYTES:(i + 1) * hash_file.RECORD_BYTES]
+            filled += record != empty
+        merged += record
+    with open(increment_path, 'wb') as f:
+        f.write(merged)
+    return filled
+
+
+def _max_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(disk_bytes: int, work_dir: str, base_density=0.6, increment_density=0.05, chunk_records=None,
+        loop_records=200000, seed=0) -> dict:
+    chunk_records = chunk_records or hash_file.CHUNK_RECORDS
+    count = hash_file.records_count(disk_bytes)
+    base_path = os.path.join(work_dir, 'base.hash')
+    increment_path = os.path.join(work_dir, 'increment.hash')
+
+    begin = time.monotonic()
+    _generate(base_path, count, base_density, seed, chunk_records)
+    _generate(increment_path, count, increment_density, seed + 1, chunk_records)
+    generate_seconds = time.monotonic() - begin
+
+    tracemalloc.start()
+    begin = time.monotonic()
+    filled = hash_file.overlay(base_path, increment_path, count, chunk_records)
+    overlay_seconds = time.monotonic() - begin
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 逐条记录的实现仅在少量记录上执行
+    loop_count = min(loop_records, count)
+    _generate(base_path, loop_count, base_density, seed, chunk_records)
+    _generate(increment_path, loop_count, increment_density, seed + 1, chunk_records)
+    begin = time.monotonic()
+    _overlay_by_loop(base_path, increment_path, loop_count)
+    loop_seconds = time.monotonic() - begin
+
+    records_per_second = count / max(overlay_seconds, 1e-9)
+    loop_records_per_second = loop_count / max(loop_seconds, 1e-9)
+    return {
+        'disk_gib': round(disk_bytes / GiB, 3),
+        'records': count,
+        'file_mib': round(count * hash_file.RECORD_BYTES / 1024 / 1024, 1),
+        'chunk_records': chunk_records,
+        'filled_records': filled,
+        'generate_seconds': round(generate_seconds, 3),
+        'overlay_seconds': round(overlay_seconds, 3),
+        'overlay_mib_per_second': round(records_per_second * hash_file.RECORD_BYTES * 2 / 1024 / 1024, 1),
+        'overlay_records_per_second': round(records_per_second),
+        'heap_peak_mib': round(heap_peak / 1024 / 1024, 1),
+        'max_rss_mib': round(_max_rss_bytes() / 1024 / 1024, 1),  # 含内存映射文件的页面，可被系统回收
+        'loop_records': loop_count,
+        'loop_records_per_second': round(loop_records_per_second),
+        'speedup': round(records_per_second / loop_records_per_second, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='hash file overlay benchmark')
+    parser.add_argument('--disk-gib', type=int, default=1024)
+    parser.add_argument('--base-density', type=float, default=0.6)
+    parser.add_argument('--increment-density', type=float, default=0.05)
+    parser.add_argument('--chunk-records', type=int, default=hash_file.CHUNK_RECORDS)
+    parser.add_argument('--loop-records', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='directory for synthetic hash files, removed after benchmark')
+    parser.add_argument('--output', help='write result as json')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+
+    work_dir = tempfile.mkdtemp(prefix='hash_bench_', dir=args.work_dir)
+    try:
+        result = run(args.disk_gib * GiB, work_dir, args.base_density, args.increment_density, args.chunk_records,
+                     args.loop_records, args.seed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""对比同步日志与异步日志下 Op 的吞吐量
+
+使用 logging.ini 的配置（日志目录替换为临时目录），通过 rpc_load_generator 的 local 传输方式驱动 Op，依次运行
+    sync   : logging.ini 的 RotatingFileHandler 同步写入，日志策略 *=full （改动前的行为）
+    async  : queue_logging 异步写入，日志策略 *=full
+    policy : queue_logging 异步写入，使用 --policy 指定的日志策略
+每种方式输出每秒 RPC 调用数、每秒操作数、p99 延迟与写入的日志字节数
+sqlite 上端到端的吞吐量波动较大，同时统计调用线程中记录 Op 日志（一对输入输出 json ）的耗时，不包含数据库与业务逻辑
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.logging_benchmark --operations 2000 --concurrency 16
+    python -m benchmark.logging_benchmark --modes sync policy --policy "*=brief:0.1;create_snapshot=full"
+"""
+import argparse
+import contextlib
+import json
+import logging
+import logging.config
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from basic_library import queue_logging
+from benchmark import rpc_load_generator as load
+from ice_service import op_log_policy
+
+MODES = ('sync', 'async', 'policy',)
+LOG_DIR = '/var/log/aio/'
+DEFAULT_POLICY = '*=brief:0.1;logger:business_logic.locker_manager=INFO;logger:data_access.session=INFO'
+
+
+@contextlib.contextmanager
+def _logging_ini(log_dir):
+    """加载 logging.ini ，日志写入 log_dir ，退出时恢复原有的 root logger"""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logging.ini')) as f:
+        content = f.read().replace(LOG_DIR, log_dir.rstrip('/') + '/')
+    config_path = os.path.join(log_dir, 'logging.ini')
+    with open(config_path, 'w') as f:
+        f.write(content)
+    logging.config.fileConfig(config_path, disable_existing_loggers=False)
+    try:
+        yield
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+
+
+def _log_bytes(log_dir) -> int:
+    return sum(os.path.getsize(os.path.join(log_dir, name)) for name in os.listdir(log_dir) if '.log' in name)
+
+
+def _emit_op_logs(calls, concurrency) -> float:
+    """模拟 Op 的日志调用，返回每秒调用数"""
+    from ice_service import service
+
+    logger, in_json, out_json = logging.getLogger(service.__name__), '{"params": "%s"}' % ('x' * 512), '{}'
+    log_policy = op_log_policy.get_op_log_policy()
+
+    def _worker():
+        for index in range(calls // concurrency):
+            log_level = log_policy.sample('open_snapshot')
+            if log_level == op_log_policy.LEVEL_FULL:
+                logger.info('Op [%s] %s : %s', index, 'open_snapshot', in_json)
+                logger.info('Op [%s] %s : %s', index, 'open_snapshot', out_json)
+            elif log_level == op_log_policy.LEVEL_BRIEF:
+                logger.info('Op [%s] %s : %s bytes in %.6fs', index, 'open_snapshot', len(out_json), 0.001)
+
+    threads = [threading.Thread(target=_worker) for _ in range(concurrency)]
+    begin = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return calls / (time.monotonic() - begin)
+
+
+def run_mode(mode, policy, operations, concurrency, emit_calls, seed=0) -> dict:
+    with tempfile.TemporaryDirectory(prefix='dss_logging_') as log_dir, _logging_ini(log_dir):
+        op_log_policy.configure(policy if mode == 'policy' else op_log_policy.DEFAULT_SPEC)
+        async_logging = None if mode == 'sync' else queue_logging.start()
+        try:
+            result = load.run(load.LocalTransport(seed=seed), concurrency=concurrency, operations=operations,
+                              seed=seed)
+            emit_calls_per_second = _emit_op_logs(emit_calls, concurrency)
+        finally:
+            queue_logging.stop()
+            op_log_policy.configure()
+        rpc_calls = sum(v['calls'] for k, v in result['calls'].items() if not k.startswith('op.'))
+        return {
+            'mode': mode,
+            'policy': policy if mode == 'policy' else op_log_policy.DEFAULT_SPEC,
+            'calls_per_second': round(rpc_calls / result['wall_seconds'], 1),
+            'operations_per_second': result['operations_per_second'],
+            'p99_ms': {k: v['p99_ms'] for k, v in result['calls'].items() if not k.startswith('op.')},
+            'log_only_calls_per_second': round(emit_calls_per_second, 1),
+            'log_bytes': _log_bytes(log_dir),
+            'dropped': async_logging.queue_handler.dropped if async_logging else 0,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Op throughput with sync and async logging')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--policy', default=DEFAULT_POLICY, help='log policy of policy mode')
+    parser.add_argument('--operations', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--log-calls', type=int, default=20000, help='simulated Op calls of log only measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write result as json')
+    args = parser.parse_args(argv)
+
+    results = [run_mode(mode, args.policy, args.operations, args.concurrency, args.log_calls, args.seed)
+               for mode in args.modes]
+    print(json.dumps(results, indent=2))
+
+    baseline = results[0]
+    print(f'{"mode":10}{"calls/s":>12}{"change":>10}{"log only/s":>14}{"change":>10}{"log bytes":>14}')
+    for result in results:
+        changes = [(result[k] - baseline[k]) / baseline[k] * 100 if baseline[k] else 0
+                   for k in ('calls_per_second', 'log_only_calls_per_second',)]
+        print(f'{result["mode"]:10}{result["calls_per_second"]:>12.1f}{changes[0]:>+9.1f}%'
+              f'{result["log_only_calls_per_second"]:>14.1f}{changes[1]:>+9.1f}%{result["log_bytes"]:>14}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""回放记录的 Op 调用，对比延迟
+
+读取 ice_service.op_recorder 记录的调用，按原始的时间间隔（可缩放）或尽可能快地重新发出
+    1. 日志令牌与操作句柄替换为新的值，同一个原始值总是替换为同一个新值，可以对同一个实例重复回放
+       快照存储的 ident 默认同样替换；回放到包含原始数据的实例时使用 --keep-idents
+    2. 使用相同日志令牌、句柄或快照存储的调用按记录的顺序依次执行，其余调用并发执行
+统计每种调用在记录与回放中的延迟分位数、逐个调用的延迟差值，以及结果（成功或失败）与记录不一致的调用数量
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.op_replayer /var/log/dss_ops.jsonl.gz --speed 1 --output replay.json
+    python -m benchmark.op_replayer ops.jsonl --speed 0 --concurrency 32 --baseline replay.json
+    python -m benchmark.op_replayer ops.jsonl --transport ice --proxy "dss : tcp -h 127.0.0.1 -p 21120"
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import sys
+import threading
+import time
+import typing
+import uuid
+
+import numpy as np
+
+from benchmark import rpc_load_generator as load
+from ice_service import op_recorder
+
+TOKEN_FIELDS = ('journal_token', 'handle',)
+IDENT_FIELDS = ('new_ident', 'parent_ident', 'storage_ident',)
+IDENT_LIST_FIELDS = ('idents',)
+
+
+class Remapper(object):
+    """将原始的令牌、句柄与快照存储替换为新的值"""
+
+    def __init__(self, remap_idents=True):
+        self.remap_idents = remap_idents
+        self._locker = threading.Lock()
+        self._mapping: typing.Dict[str, str] = dict()
+
+    def _remap_value(self, value):
+        if value is None:
+            return None
+        with self._locker:
+            if value not in self._mapping:
+                self._mapping[value] = uuid.uuid4().hex
+            return self._mapping[value]
+
+    def remap(self, params: dict) -> dict:
+        params = dict(params)
+        for field in TOKEN_FIELDS + (IDENT_FIELDS if self.remap_idents else tuple()):
+            if field in params:
+                params[field] = self._remap_value(params[field])
+        if self.remap_idents:
+            for field in IDENT_LIST_FIELDS:
+                if field in params:
+                    params[field] = [self._remap_value(v) for v in params[field]]
+        return params
+
+
+class DependencyTracker(object):
+    """使用相同值的调用需要依次执行
+
+    :remark:
+        日志令牌与句柄关联到其对应的快照存储，例如 create_snapshot 仅包含日志令牌与句柄，
+        需要与创建该快照存储的日志、以该快照存储为父节点的日志、关闭该句柄的调用依次执行
+    """
+
+    def __init__(self):
+        self._aliases: typing.Dict[str, str] = dict()  # 日志令牌或句柄 -> 快照存储
+
+    def keys(self, params: dict) -> typing.Set[str]:
+        keys = {params[field] for field in TOKEN_FIELDS + IDENT_FIELDS if params.get(field)}
+        for field in IDENT_LIST_FIELDS:
+            keys.update(params.get(field) or list())
+
+        storage_ident = params.get('new_ident') or params.get('storage_ident') or self._aliases.get(
+            params.get('journal_token'))
+        if storage_ident:
+            for field in TOKEN_FIELDS:
+                if params.get(field):
+                    self._aliases[params[field]] = storage_ident
+        keys.update(self._aliases[k] for k in list(keys) if k in self._aliases)
+        return keys
+
+
+class Replayer(object):
+
+    def __init__(self, transport, records: typing.List[dict], speed=1.0, concurrency=64, remap_idents=True):
+        """
+        :param speed: 回放速度相对原始速度的倍数，0 表示尽可能快
+        :param concurrency: 同时执行的调用数量上限
+        """
+        self.transport = transport
+        self.records = sorted(records, key=lambda r: (r['t'], r['i'],))
+        self.speed = speed
+        self.concurrency = concurrency
+        self.remapper = Remapper(remap_idents)
+        self.recorded = load.LatencyRecorder()
+        self.replayed = load.LatencyRecorder()
+        self._locker = threading.Lock()
+        self._deltas: typing.Dict[str, typing.List[float]] = dict()
+        self._mismatched: typing.Dict[str, int] = dict()
+
+    def _replay_one(self, record, depends):
+        concurrent.futures.wait(depends)
+        call = record['call']
+        params = self.remapper.remap(json.loads(record['in']))
+        begin = time.monotonic()
+        try:
+            self.transport.call(call, params)
+            successful = True
+        except Exception as e:
+            successful = False
+            logging.getLogger(__name__).debug(f'replay [{record["i"]}] {call} failed : {e}')
+        seconds = time.monotonic() - begin
+
+        self.replayed.record(call, seconds, not successful)
+        with self._locker:
+            self._deltas.setdefault(call, list()).append(seconds - record['seconds'])
+            if successful != (record['out'] is not None):
+                self._mismatched[call] = self._mismatched.get(call, 0) + 1
+
+    def run(self) -> float:
+        """返回回放的耗时"""
+        for record in self.records:
+            self.recorded.record(record['call'], record['seconds'], record['out'] is None)
+        if not self.records:
+            return 0.0
+
+        first_timestamp = self.records[0]['t']
+        dependency = DependencyTracker()
+        last_futures: typing.Dict[str, concurrent.futures.Future] = dict()
+        begin = time.monotonic()
+        # 依赖的调用总是先提交，线程池按提交顺序执行，等待依赖不会导致死锁
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency, 'replay') as executor:
+            for record in self.records:
+                if self.speed > 0:
+                    delay = begin + (record['t'] - first_timestamp) / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                keys = dependency.keys(json.loads(record['in']))
+                depends = [last_futures[k] for k in keys if k in last_futures]
+                future = executor.submit(self._replay_one, record, depends)
+                for key in keys:
+                    last_futures[key] = future
+        return time.monotonic() - begin
+
+    def report(self, wall_seconds) -> dict:
+        span = max(self.records[-1]['t'] - self.records[0]['t'], 1e-6) if self.records else 1e-6
+        recorded = self.recorded.to_dict(span)
+        replayed = self.replayed.to_dict(max(wall_seconds, 1e-6))
+        calls = dict()
+        for call, replay in replayed.items():
+            p50, p95, p99 = np.percentile(self._deltas[call], (50, 95, 99,)) * 1000
+            calls[call] = {
+                'recorded': recorded[call],
+                'replayed': replay,
+                'delta_p50_ms': round(float(p50), 3),
+                'delta_p95_ms': round(float(p95), 3),
+                'delta_p99_ms': round(float(p99), 3),
+                'mismatched': self._mismatched.get(call, 0),
+            }
+        return {
+            'records': len(self.records),
+            'speed': self.speed,
+            'recorded_seconds': round(span, 3),
+            'replayed_seconds': round(wall_seconds, 3),
+            'mismatched': sum(self._mismatched.values()),
+            'calls': calls,
+            'service': self.transport.service_stats(),
+        }
+
+
+def replay(transport, records, speed=1.0, concurrency=64, remap_idents=True) -> dict:
+    with transport.open():
+        replayer = Replayer(transport, records, speed, concurrency, remap_idents)
+        return replayer.report(replayer.run())
+
+
+def _compare(result: dict, baseline: dict) -> typing.List[str]:
+    lines = [f'{"call":32}{"metric":>10}{"baseline":>12}{"current":>12}{"change":>10}']
+    for name, current in result['calls'].items():
+        old = baseline.get('calls', dict()).get(name)
+        if not old:
+            continue
+        for key in ('p50_ms', 'p99_ms',):
+            old_value, value = old['replayed'][key], current['replayed'][key]
+            change = f'{(value - old_value) / old_value * 100:>+9.1f}%' if old_value else ''
+            lines.append(f'{name:32}{key:>10}{old_value:>12.6g}{value:>12.6g}{change:>10}')
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='replay recorded Op calls')
+    parser.add_argument('capture', help='file written by ice_service.op_recorder')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 keeps the original timing, 0 as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--keep-idents', action='store_true', help='do not remap storage idents')
+    parser.add_argument('--transport', choices=('local', 'ice',), default='local')
+    parser.add_argument('--proxy', default='dss : tcp -h 127.0.0.1 -p 21119', help='proxy of ice transport')
+    parser.add_argument('--db-url', help='database of local transport, default a temporary sqlite file')
+    parser.add_argument('--output', help='write result as json')
+    parser.add_argument('--baseline', help='compare with a previous json result')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    if args.transport == 'ice':
+        transport = load.IceTransport(args.proxy)
+    else:
+        transport = load.LocalTransport(args.db_url)
+
+    result = replay(transport, op_recorder.load(args.capture), args.speed, args.concurrency, not args.keep_idents)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print('\n'.join(_compare(result, json.load(f))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
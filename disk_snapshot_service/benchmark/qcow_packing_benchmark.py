@@ -0,0 +1,237 @@
+"""qcow文件复用策略的长期基准
+
+模拟一个磁盘多年的每日备份，对比不同 QcowPackingPolicy 下打开最新快照的代价随时间的变化
+    1. 每天通过 SnapshotI.Op 创建一个快照存储（generate_journal_for_create + create_snapshot + close_snapshot），
+       并按 --daily-change-gib 增大镜像文件（稀疏文件）模拟写入的数据，之后由 HashingScheduler 转换为 Storage 状态
+    2. 快照存储数量超过 --retention 后销毁最早的快照存储，执行 StorageCollection 直至没有可执行的回收作业，
+       回收逻辑使用 collection_simulator 中的模拟镜像服务，删除文件时同时删除稀疏文件
+    3. 每隔 --sample-days 天打开一次最新的快照存储，记录 open_snapshot 的耗时与镜像服务打开的代价
+镜像服务打开快照链的代价使用 OpenCostModel 估算：替身镜像服务 open 收到的每个关键节点所在文件，
+计入 打开文件 + 文件中的快照点数量 * 每个快照点 + 文件大小 * 每GiB 的耗时（读取快照表、L1/L2 与引用计数表）
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.qcow_packing_benchmark --days 730 --output result.json
+    python -m benchmark.qcow_packing_benchmark --policies unlimited 64,32,256 --retention 90
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import typing
+import uuid
+from unittest import mock
+
+GiB = 1024 * 1024 * 1024
+DEFAULT_POLICIES = ('unlimited', '64,32,256',)
+
+
+class OpenCostModel(object):
+    """估算镜像服务打开快照链的耗时，单位毫秒"""
+
+    def __init__(self, file_ms=5.0, snapshot_ms=0.5, gib_ms=1.0):
+        self.file_ms = file_ms
+        self.snapshot_ms = snapshot_ms
+        self.gib_ms = gib_ms
+
+    def cost(self, files: typing.Dict[str, typing.Tuple[int, int]]) -> float:
+        """files 为 文件路径 -> (快照点数量, 文件大小)"""
+        return sum(self.file_ms + snapshots * self.snapshot_ms + file_bytes / GiB * self.gib_ms
+                   for snapshots, file_bytes in files.values())
+
+
+def parse_policy(value: str):
+    """unlimited 或 快照点数量,链深度,文件大小GiB ，0 表示不限制"""
+    from business_logic import storage_action as action
+
+    if value == 'unlimited':
+        return action.QcowPackingPolicy()
+    snapshots, depth, file_gib = (int(item) for item in value.split(','))
+    return action.QcowPackingPolicy(snapshots, depth, file_gib * GiB)
+
+
+def _grow_file(image_path, grow_bytes):
+    with open(image_path, 'a') as f:
+        f.truncate(os.path.getsize(image_path) + grow_bytes)  # 稀疏文件，不占用磁盘空间
+
+
+class _Simulation(object):
+
+    def __init__(self, transport, storage_folder, disk_bytes, cost_model: OpenCostModel):
+        from service_logic import storage_hashing
+
+        self.transport = transport
+        self.scheduler = storage_hashing.HashingScheduler(max_workers=1)
+        self.storage_folder = storage_folder
+        self.disk_bytes = disk_bytes
+        self.cost_model = cost_model
+        self.alive: typing.List[str] = list()  # 未销毁的快照存储，按创建顺序
+        self.tree_ident = None
+        self.opened_files: typing.Dict[str, typing.Tuple[int, int]] = dict()
+        self._caller_params = {'caller_pid': os.getpid(), 'caller_pid_created': int(time.time())}
+
+    def create(self, day, grow_bytes):
+        from data_access import session as s
+        from data_access import storage as da_storage
+
+        new_ident, handle, journal_token = f'day{day:05d}', uuid.uuid4().hex, uuid.uuid4().hex
+        self.transport.call('generate_journal_for_create', {
+            'journal_token': journal_token,
+            'new_ident': new_ident,
+            'parent_ident': self.alive[-1] if self.alive else None,
+            'new_type': 'qcow',
+            'new_storage_folder': self.storage_folder,
+            'new_disk_bytes': self.disk_bytes,
+        })
+        self.transport.call('create_snapshot', dict(handle=handle, journal_token=journal_token, **self._caller_params))
+        with s.readonly():
+            storage_obj = da_storage.get_obj_by_ident(new_ident)
+            image_path, self.tree_ident = storage_obj.image_path, storage_obj.tree_ident
+        _grow_file(image_path, grow_bytes)
+        self.transport.call('close_snapshot', {'handle': handle})
+        while self.scheduler.schedule_once():
+            time.sleep(0.001)
+        self.alive.append(new_ident)
+
+    def destroy_oldest(self):
+        from business_logic import journal
+        from data_access import session as s
+        from service_logic import consume_journal
+
+        journal_token = uuid.uuid4().hex
+        self.transport.call('generate_journal_for_destroy', {'journal_token': journal_token,
+                                                             'idents': [self.alive.pop(0)]})
+        with s.readonly():
+            destroy = [jn for jn in journal.query_unconsumed() if jn.token == journal_token]
+        consume_journal.DestroyJournal(destroy[0]).execute()
+
+    def collect(self, max_rounds=64) -> int:
+        from service_logic import storage_collection as sc
+
+        collection, rounds = sc.StorageCollection(self.tree_ident), 0
+        while rounds < max_rounds and collection.collect():
+            rounds += 1
+        return rounds
+
+    def _record_open(self, raw_open):
+        from data_access import session as s
+        from data_access import storage as da_storage
+
+        def _open(idents, flag, current=None):
+            with s.readonly():
+                self.opened_files = {
+                    ident.path: (da_storage.query_image_path_exist_count(ident.path),
+                                 os.path.getsize(ident.path) if os.path.exists(ident.path) else 0,)
+                    for ident in idents
+                }
+            return raw_open(idents, flag, current)
+
+        return _open
+
+    def open_latest(self) -> dict:
+        handle = uuid.uuid4().hex
+        read = self.transport.img_services.read
+        with mock.patch.object(read, 'open', self._record_open(read.open)):
+            begin = time.perf_counter()
+            self.transport.call('open_snapshot', dict(handle=handle, storage_ident=self.alive[-1],
+                                                      open_raw_handle=True, **self._caller_params))
+            open_ms = (time.perf_counter() - begin) * 1000
+        self.transport.call('close_snapshot', {'handle': handle})
+        return {
+            'open_snapshot_ms': round(open_ms, 3),
+            'key_files': len(self.opened_files),
+            'snapshots_in_key_files': sum(snapshots for snapshots, _ in self.opened_files.values()),
+            'max_file_gib': round(max(size for _, size in self.opened_files.values()) / GiB, 1),
+            'img_open_ms': round(self.cost_model.cost(self.opened_files), 3),
+        }
+
+
+@contextlib.contextmanager
+def _collection_action(stats):
+    """回收逻辑使用模拟的镜像服务，删除文件时同时删除稀疏文件"""
+    from benchmark import collection_simulator as simulator
+
+    class _Action(simulator.FakeDiskSnapshotAction):
+
+        def remove_file(self, file_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return super(_Action, self).remove_file(file_path)
+
+    with _Action(stats).patch():
+        yield
+
+
+def simulate(policy_name: str, days=730, retention=30, daily_change_gib=2, disk_bytes=1024 * GiB, sample_days=30,
+             cost_model: OpenCostModel = None) -> dict:
+    from benchmark import collection_simulator as simulator
+    from benchmark import rpc_load_generator as load
+    from business_logic import storage_action as action
+
+    policy, cost_model = parse_policy(policy_name), cost_model or OpenCostModel()
+    stats = simulator.SimulationStats('daily_backup', days)
+    samples = list()
+    with tempfile.TemporaryDirectory(prefix='qcow_packing_') as work_dir, \
+            load.LocalTransport(db_url=f'sqlite:///{os.path.join(work_dir, "dss.db")}').open() as transport, \
+            mock.patch.object(action.ImagePathGenerator, 'packing_policy', policy), _collection_action(stats):
+        storage_folder = os.path.join(work_dir, 'images')
+        os.makedirs(storage_folder)
+        simulation = _Simulation(transport, storage_folder, disk_bytes, cost_model)
+        begin = time.perf_counter()
+        for day in range(1, days + 1):
+            simulation.create(day, daily_change_gib * GiB)
+            if len(simulation.alive) > retention:
+                simulation.destroy_oldest()
+                stats.rounds += simulation.collect()
+            if day % sample_days == 0 or day == days:
+                samples.append(dict(day=day, files=len(os.listdir(storage_folder)), **simulation.open_latest()))
+        wall_seconds = time.perf_counter() - begin
+        simulation.scheduler.stop()
+
+    return {
+        'policy': policy_name,
+        'days': days,
+        'retention': retention,
+        'samples': samples,
+        'collection': {k: stats.to_dict()[k] for k in ('rounds', 'snapshots_deleted', 'files_removed',)},
+        'wall_seconds': round(wall_seconds, 1),
+    }
+
+
+def main(argv=None):
+    import logging
+
+    parser = argparse.ArgumentParser(description='open latency of daily backups under qcow packing policies')
+    parser.add_argument('--policies', nargs='+', default=list(DEFAULT_POLICIES),
+                        help='unlimited or max_snapshots_per_file,max_chain_depth,max_file_gib (0 means no limit)')
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--retention', type=int, default=30, help='snapshots kept, older ones are destroyed')
+    parser.add_argument('--daily-change-gib', type=int, default=2)
+    parser.add_argument('--sample-days', type=int, default=30)
+    parser.add_argument('--output', help='write result as json')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO)
+    results = [simulate(policy, args.days, args.retention, args.daily_change_gib, sample_days=args.sample_days)
+               for policy in args.policies]
+    print(json.dumps(results, indent=2))
+
+    print(f'{"policy":14}{"day":>6}{"files":>7}{"key files":>11}{"snapshots":>11}{"max GiB":>10}'
+          f'{"img open ms":>13}{"dss open ms":>13}')
+    for result in results:
+        for sample in result['samples']:
+            print(f'{result["policy"]:14}{sample["day"]:>6}{sample["files"]:>7}{sample["key_files"]:>11}'
+                  f'{sample["snapshots_in_key_files"]:>11}{sample["max_file_gib"]:>10}'
+                  f'{sample["img_open_ms"]:>13.1f}{sample["open_snapshot_ms"]:>13.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
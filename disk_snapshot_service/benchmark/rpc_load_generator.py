@@ -0,0 +1,575 @@
+"""端到端 RPC 负载生成器
+
+按配置的操作比例（create / open / close / destroy）驱动 SnapshotApi.Snapshot.Op
+    create  : generate_journal_for_create + create_snapshot，获得写句柄
+    open    : open_snapshot，获得读句柄（同步打开原生句柄）
+    close   : close_snapshot，关闭随机的一个已打开句柄
+    destroy : generate_journal_for_destroy，销毁一个未被打开的叶子快照存储
+支持固定并发（闭环）与目标速率（开环）两种方式；开环时延迟从计划发出的时间开始计算，避免协同遗漏
+统计每个 RPC 调用与每种操作的 p50/p95/p99 延迟、失败比例与吞吐量，结果可写入 json 与之前的结果对比
+
+传输方式：
+    local : 在当前进程中调用 SnapshotI.Op，使用 sqlite 与进程内替身镜像服务，可以同时统计服务端数据
+    ice   : 通过 Ice 调用运行中的服务，镜像服务可以使用 python -m ice_service.fake_img_service 启动；
+            服务端数据从服务的 Snapshot.MetricsAddress 获取（--metrics-address），服务默认不提供，需要在配置中启用
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.rpc_load_generator --concurrency 32 --duration 30 --output result.json
+    python -m benchmark.rpc_load_generator --rate 200 --mix create=2 open=4 close=5 destroy=1 --baseline result.json
+    python -m benchmark.rpc_load_generator --img-latency open=lognormal:0.05,1 --img-max-concurrency 4
+    python -m benchmark.rpc_load_generator --transport ice --proxy "dss : tcp -h 127.0.0.1 -p 21119"
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.request
+import uuid
+
+import numpy as np
+
+GiB = 1024 * 1024 * 1024
+
+OPERATIONS = ('create', 'open', 'close', 'destroy',)
+DEFAULT_MIX = {'create': 2, 'open': 4, 'close': 5, 'destroy': 1}
+
+
+class LatencyRecorder(object):
+    """按名称记录延迟与失败"""
+
+    def __init__(self):
+        self._locker = threading.Lock()
+        self._latencies: typing.Dict[str, typing.List[float]] = dict()
+        self._errors: typing.Dict[str, int] = dict()
+        self.skipped: typing.Dict[str, int] = dict()
+
+    def skip(self, name):
+        with self._locker:
+            self.skipped[name] = self.skipped.get(name, 0) + 1
+
+    def record(self, name, seconds, error=False):
+        with self._locker:
+            self._latencies.setdefault(name, list()).append(seconds)
+            self._errors[name] = self._errors.get(name, 0) + bool(error)
+
+    def to_dict(self, wall_seconds) -> dict:
+        with self._locker:
+            result = dict()
+            for name, latencies in sorted(self._latencies.items()):
+                p50, p95, p99 = np.percentile(latencies, (50, 95, 99,)) * 1000
+                result[name] = {
+                    'calls': len(latencies),
+                    'errors': self._errors[name],
+                    'error_rate': round(self._errors[name] / len(latencies), 4),
+                    'calls_per_second': round(len(latencies) / wall_seconds, 1),
+                    'p50_ms': round(float(p50), 3),
+                    'p95_ms': round(float(p95), 3),
+                    'p99_ms': round(float(p99), 3),
+                    'max_ms': round(max(latencies) * 1000, 3),
+                }
+            return result
+
+
+class TreeModel(object):
+    """客户端记录的快照存储树，决定每次操作的参数
+
+    :remark:
+        shape 为 chain 时，新快照存储的父节点为所在树中最新关闭的快照存储，形成长链
+        shape 为 random 时，父节点为所在树中随机的已关闭快照存储，形成分支较多的树
+        每棵树的根节点由 create 操作创建，树的数量达到 trees 后不再创建根节点
+    """
+
+    SHAPES = ('chain', 'random',)
+
+    def __init__(self, rng: random.Random, shape='chain', trees=4, max_open_handles=64):
+        assert shape in self.SHAPES, ('无效的树形状', f'invalid shape {shape}', 0)
+        self.rng = rng
+        self.shape = shape
+        self.trees = trees
+        self.max_open_handles = max_open_handles
+        self._locker = threading.Lock()
+        self._closed: typing.Dict[int, typing.List[str]] = dict()  # 树序号 -> 已关闭的快照存储，按关闭顺序
+        self._tree_of: typing.Dict[str, int] = dict()
+        self._parent_of: typing.Dict[str, typing.Union[str, None]] = dict()
+        self._children: typing.Dict[str, int] = dict()
+        self._opened: typing.Dict[str, typing.Tuple[str, bool]] = dict()  # 句柄 -> (快照存储, 是否为写句柄)
+        self._using: typing.Dict[str, int] = dict()  # 快照存储 -> 打开的句柄数量
+        self._pending_trees = 0  # 正在创建的根节点
+        self._next_tree = 0
+
+    @property
+    def opened_count(self) -> int:
+        return len(self._opened)
+
+    def choose_operation(self, op):
+        """操作条件不满足时改为其他操作，例如没有打开的句柄时无法 close"""
+        with self._locker:
+            if len(self._opened) >= self.max_open_handles:
+                return 'close'
+            if op == 'close' and not self._opened:
+                return 'create'
+            if op in ('open', 'destroy',) and not self._tree_of:
+                return 'create'
+            return op
+
+    def reserve_create(self) -> typing.Tuple[str, typing.Union[str, None]]:
+        """返回 (新快照存储, 父快照存储)"""
+        with self._locker:
+            new_ident = uuid.uuid4().hex
+            if len(self._closed) + self._pending_trees < self.trees:
+                self._pending_trees += 1
+                self._next_tree += 1
+                tree_index, parent_ident = self._next_tree, None
+            else:
+                tree_index = self.rng.choice([i for i, idents in self._closed.items() if idents] or [None])
+                if tree_index is None:
+                    return None, None  # 所有树的快照存储都在创建中
+                idents = self._closed[tree_index]
+                parent_ident = idents[-1] if self.shape == 'chain' else self.rng.choice(idents)
+            self._tree_of[new_ident] = tree_index
+            self._parent_of[new_ident] = parent_ident
+            return new_ident, parent_ident
+
+    def finish_create(self, new_ident, handle, successful):
+        with self._locker:
+            if self._parent_of[new_ident] is None:
+                self._pending_trees -= 1
+                if successful:
+                    self._closed[self._tree_of[new_ident]] = list()
+            if successful:
+                self._opened[handle] = (new_ident, True)
+                self._using[new_ident] = 1
+                parent_ident = self._parent_of[new_ident]
+                if parent_ident:
+                    self._children[parent_ident] = self._children.get(parent_ident, 0) + 1
+            else:
+                self._tree_of.pop(new_ident)
+                self._parent_of.pop(new_ident)
+
+    def choose_open(self) -> typing.Union[str, None]:
+        with self._locker:
+            candidates = [ident for idents in self._closed.values() for ident in idents]
+            return self.rng.choice(candidates) if candidates else None
+
+    def finish_open(self, ident, handle):
+        with self._locker:
+            self._opened[handle] = (ident, False)
+            self._using[ident] = self._using.get(ident, 0) + 1
+
+    def take_close(self) -> typing.Union[str, None]:
+        with self._locker:
+            if not self._opened:
+                return None
+            handle = self.rng.choice(list(self._opened.keys()))
+            ident, writing = self._opened.pop(handle)
+            self._using[ident] -= 1
+            if writing:
+                self._closed[self._tree_of[ident]].append(ident)
+            return handle
+
+    def take_destroy(self) -> typing.Union[str, None]:
+        with self._locker:
+            candidates = [ident for idents in self._closed.values() for ident in idents
+                          if not self._children.get(ident) and not self._using.get(ident)]
+            if not candidates:
+                return None
+            ident = self.rng.choice(candidates)
+            self._closed[self._tree_of[ident]].remove(ident)
+            parent_ident = self._parent_of[ident]
+            if parent_ident:
+                self._children[parent_ident] -= 1
+            return ident
+
+
+@contextlib.contextmanager
+def _database_url(db_url):
+    """默认使用临时的 sqlite 文件数据库；内存数据库仅有一个连接，不支持多个线程同时使用事务"""
+    if db_url:
+        yield db_url
+        return
+    with tempfile.TemporaryDirectory(prefix='rpc_load_') as work_dir:
+        yield f'sqlite:///{os.path.join(work_dir, "dss.db")}'
+
+
+class LocalTransport(object):
+    """在当前进程中调用 SnapshotI.Op"""
+
+    name = 'local'
+
+    def __init__(self, db_url=None, img_profiles=None, img_max_concurrency=0, seed=None, raw_handle_cache=0):
+        """
+        :param raw_handle_cache: 缓存的原生读句柄数量上限，参考 business_logic.raw_handle_cache
+        """
+        self.db_url = db_url
+        self.img_profiles = img_profiles
+        self.img_max_concurrency = img_max_concurrency
+        self.seed = seed
+        self.raw_handle_cache = raw_handle_cache
+        self.img_services = None
+        self._servant = None
+
+    @contextlib.contextmanager
+    def open(self):
+        from ice_service import service  # 与服务进程的模块加载顺序一致，避免循环引用
+        from business_logic import handle_pool as pool
+        from business_logic import raw_handle_cache as rhc
+        from business_logic import storage_reference_manager as srm
+        from business_logic import tree_versions
+        from data_access import models as m
+        from data_access import session as s
+        from ice_service import fake_img_service as fake
+
+        self.img_services = fake.FakeImgServices(self.img_profiles, self.img_max_concurrency, self.seed)
+        with _database_url(self.db_url) as db_url, s.local_database(db_url) as engine, self.img_services.install():
+            m.Base.metadata.drop_all(engine)
+            m.Base.metadata.create_all(engine)
+            srm._storage_reference_manager = None
+            pool._handle_pool = None
+            tree_versions._tree_versions = None
+            rhc._raw_handle_cache = None
+            rhc.configure(self.raw_handle_cache, 300)
+            self._servant = service.SnapshotI()
+            try:
+                yield self
+            finally:
+                rhc.get_raw_handle_cache().clear()
+                s.session_maker.remove()
+                srm._storage_reference_manager = None
+                pool._handle_pool = None
+                tree_versions._tree_versions = None
+
+    def call(self, call, params: dict) -> dict:
+        return json.loads(self._servant.Op(call, json.dumps(params)))
+
+    def service_stats(self) -> dict:
+        from business_logic import chain_metrics
+        from business_logic import handle_pool as pool
+        from business_logic import raw_handle_cache as rhc
+        from business_logic import storage_space
+        from business_logic import tree_versions
+        from data_access import session as s
+
+        return {
+            'db_pool': s.pool_metrics.to_dict(),
+            'handles': len(pool.HandlePool.get_handle_pool().cache),
+            'raw_handle_cache': rhc.get_raw_handle_cache().to_dict(),
+            'chain_metrics': chain_metrics.get_chain_metrics().to_dict(),
+            'storage_space': storage_space.get_storage_space().to_dict(),
+            'tree_versions': tree_versions.get_tree_versions().to_dict(),
+            'img_service': self.img_services.to_dict(),
+        }
+
+
+class IceTransport(object):
+    """通过 Ice 调用运行中的服务"""
+
+    name = 'ice'
+
+    def __init__(self, proxy: str, metrics_address: str = None):
+        self.proxy = proxy
+        self.metrics_address = metrics_address
+        self._prx = None
+
+    @contextlib.contextmanager
+    def open(self):
+        import Ice  # 仅 ice 传输方式需要 Ice 运行环境
+        from cpkt.rpc import ice
+
+        init_data = Ice.InitializationData()
+        init_data.properties = Ice.createProperties()
+        init_data.properties.setProperty(r'Ice.ThreadPool.Client.Size', r'8')
+        init_data.properties.setProperty(r'Ice.ThreadPool.Client.SizeMax', r'128')
+        init_data.properties.setProperty(r'Ice.RetryIntervals', r'-1')
+        with Ice.initialize(sys.argv[:1], init_data) as communicator:
+            self._prx = ice.SnapshotApi.SnapshotPrx.checkedCast(communicator.stringToProxy(self.proxy))
+            yield self
+
+    def call(self, call, params: dict) -> dict:
+        return json.loads(self._prx.Op(call, json.dumps(params)))
+
+    def service_stats(self) -> dict:
+        """从服务的 metrics_exporter 获取统计数据，没有配置地址时为空"""
+        if not self.metrics_address:
+            return dict()
+        try:
+            return fetch_metrics(self.metrics_address)
+        except Exception as e:
+            logging.warning(f'fetch metrics from {self.metrics_address} failed : {e}')
+            return {'error': str(e)}
+
+
+def fetch_metrics(address: str, timeout=10) -> typing.Dict[str, float]:
+    """GET /metrics ，返回 样本名称（含标签） -> 数值"""
+    with urllib.request.urlopen(f'http://{address}/metrics', timeout=timeout) as response:
+        text = response.read().decode('utf-8')
+    samples = dict()
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+class LoadGenerator(object):
+
+    def __init__(self, transport, mix: typing.Dict[str, float] = None, model: TreeModel = None,
+                 storage_folder='/tmp/rpc_load', disk_bytes=64 * GiB, seed=0):
+        self.transport = transport
+        self.mix = mix or DEFAULT_MIX
+        assert set(self.mix) <= set(OPERATIONS), ('无效的操作', f'invalid mix {self.mix}', 0)
+        self.rng = random.Random(seed)
+        self.model = model or TreeModel(random.Random(seed + 1))
+        self.storage_folder = storage_folder
+        self.disk_bytes = disk_bytes
+        self.recorder = LatencyRecorder()
+        self._rng_locker = threading.Lock()
+        self._caller_params = {'caller_pid': os.getpid(), 'caller_pid_created': int(time.time())}
+
+    def _call(self, call, params):
+        begin = time.monotonic()
+        try:
+            result = self.transport.call(call, params)
+        except Exception:
+            self.recorder.record(call, time.monotonic() - begin, True)
+            raise
+        self.recorder.record(call, time.monotonic() - begin)
+        return result
+
+    def _create(self):
+        new_ident, parent_ident = self.model.reserve_create()
+        if not new_ident:
+            return False
+        handle = uuid.uuid4().hex
+        successful = False
+        journal_token = uuid.uuid4().hex
+        try:
+            self._call('generate_journal_for_create', {
+                'journal_token': journal_token,
+                'new_ident': new_ident,
+                'parent_ident': parent_ident,
+                'new_type': 'qcow',
+                'new_storage_folder': self.storage_folder,
+                'new_disk_bytes': self.disk_bytes,
+            })
+            self._call('create_snapshot', dict(handle=handle, journal_token=journal_token, **self._caller_params))
+            successful = True
+        finally:
+            self.model.finish_create(new_ident, handle, successful)
+        return True
+
+    def _open(self):
+        ident = self.model.choose_open()
+        if not ident:
+            return False
+        handle = uuid.uuid4().hex
+        self._call('open_snapshot', dict(handle=handle, storage_ident=ident, open_raw_handle=True,
+                                         **self._caller_params))
+        self.model.finish_open(ident, handle)
+        return True
+
+    def _close(self):
+        handle = self.model.take_close()
+        if not handle:
+            return False
+        self._call('close_snapshot', {'handle': handle})
+        return True
+
+    def _destroy(self):
+        ident = self.model.take_destroy()
+        if not ident:
+            return False
+        self._call('generate_journal_for_destroy', {'journal_token': uuid.uuid4().hex, 'idents': [ident]})
+        return True
+
+    def _next_operation(self) -> str:
+        with self._rng_locker:
+            op = self.rng.choices(list(self.mix.keys()), list(self.mix.values()))[0]
+        return self.model.choose_operation(op)
+
+    def execute_once(self, scheduled=None) -> bool:
+        """执行一次操作；scheduled 为计划发出的时间，延迟从该时间开始计算
+
+        :return: 模型中没有可操作的对象时返回 False
+        """
+        op = self._next_operation()
+        begin = scheduled or time.monotonic()
+        try:
+            executed = getattr(self, f'_{op}')()
+        except Exception as e:
+            self.recorder.record(f'op.{op}', time.monotonic() - begin, True)
+            logging.getLogger(__name__).debug(f'{op} failed : {e}')
+            return True
+        if executed:
+            self.recorder.record(f'op.{op}', time.monotonic() - begin)
+        else:
+            self.recorder.skip(f'op.{op}')
+        return executed
+
+    def run_concurrency(self, concurrency, duration=None, operations=None):
+        """闭环：concurrency 个线程连续执行操作"""
+        deadline = time.monotonic() + duration if duration else None
+        remaining = [operations]
+        locker = threading.Lock()
+
+        def _take() -> bool:
+            with locker:
+                if deadline and time.monotonic() >= deadline:
+                    return False
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return False
+                    remaining[0] -= 1
+                return True
+
+        def _give_back():
+            with locker:
+                if remaining[0] is not None:
+                    remaining[0] += 1
+
+        def _worker():
+            while _take():
+                if not self.execute_once():
+                    _give_back()  # 跳过的操作不计入数量，等待其他线程完成创建或打开
+                    time.sleep(0.001)
+
+        threads = [threading.Thread(target=_worker, name=f'load_{i}') for i in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def run_rate(self, rate, duration=None, operations=None, max_workers=128):
+        """开环：按 rate 次每秒的速率发出操作，不等待之前的操作完成"""
+        total = operations if operations is not None else int(rate * duration)
+        begin = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers, 'load') as executor:
+            for i in range(total):
+                scheduled = begin + i / rate
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.execute_once, scheduled)
+
+    def close_all(self):
+        """关闭所有剩余的句柄，不计入统计"""
+        while True:
+            handle = self.model.take_close()
+            if not handle:
+                break
+            with contextlib.suppress(Exception):
+                self.transport.call('close_snapshot', {'handle': handle})
+
+
+def run(transport, mix=None, shape='chain', trees=4, concurrency=16, rate=None, duration=None, operations=1000,
+        max_open_handles=64, seed=0) -> dict:
+    with transport.open():
+        generator = LoadGenerator(transport, mix, TreeModel(random.Random(seed + 1), shape, trees, max_open_handles),
+                                  seed=seed)
+        begin = time.monotonic()
+        if rate:
+            generator.run_rate(rate, duration, operations)
+        else:
+            generator.run_concurrency(concurrency, duration, operations)
+        wall_seconds = time.monotonic() - begin
+        service_stats = transport.service_stats()
+        generator.close_all()
+
+    calls = generator.recorder.to_dict(wall_seconds)
+    return {
+        'transport': transport.name,
+        'mode': f'rate {rate}' if rate else f'concurrency {concurrency}',
+        'mix': generator.mix,
+        'shape': shape,
+        'trees': trees,
+        'wall_seconds': round(wall_seconds, 3),
+        'operations_per_second': round(
+            sum(v['calls'] for k, v in calls.items() if k.startswith('op.')) / wall_seconds, 1),
+        'calls': calls,
+        'skipped': generator.recorder.skipped,
+        'service': service_stats,
+    }
+
+
+def _compare(result: dict, baseline: dict) -> typing.List[str]:
+    lines = [f'{"call":32}{"metric":>18}{"baseline":>12}{"current":>12}{"change":>10}']
+    for name, current in result['calls'].items():
+        old = baseline.get('calls', dict()).get(name)
+        if not old:
+            continue
+        for key in ('p50_ms', 'p99_ms', 'error_rate', 'calls_per_second',):
+            if old[key]:
+                change = f'{(current[key] - old[key]) / old[key] * 100:>+9.1f}%'
+            else:
+                change = ''
+            lines.append(f'{name:32}{key:>18}{old[key]:>12.6g}{current[key]:>12.6g}{change:>10}')
+    return lines
+
+
+def _parse_mix(values) -> dict:
+    mix = dict()
+    for value in values:
+        op, _, weight = value.partition('=')
+        mix[op] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='end to end rpc load generator')
+    parser.add_argument('--transport', choices=('local', 'ice',), default='local')
+    parser.add_argument('--proxy', default='dss : tcp -h 127.0.0.1 -p 21119', help='proxy of ice transport')
+    parser.add_argument('--metrics-address', default='',
+                        help='Snapshot.MetricsAddress of ice transport, e.g. 127.0.0.1:21109, '
+                             'default empty to skip service stats')
+    parser.add_argument('--db-url', help='database of local transport, default a temporary sqlite file')
+    parser.add_argument('--mix', nargs='+', default=[f'{k}={v}' for k, v in DEFAULT_MIX.items()])
+    parser.add_argument('--shape', choices=TreeModel.SHAPES, default='chain')
+    parser.add_argument('--trees', type=int, default=4)
+    parser.add_argument('--max-open-handles', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=16, help='closed loop workers')
+    parser.add_argument('--rate', type=float, help='open loop operations per second, overrides --concurrency')
+    parser.add_argument('--duration', type=float, help='seconds, overrides --operations')
+    parser.add_argument('--operations', type=int, default=1000)
+    parser.add_argument('--img-latency', action='append', help='fake image service, e.g. open=uniform:0.01,0.1')
+    parser.add_argument('--img-error-rate', action='append', help='fake image service, e.g. create=0.01')
+    parser.add_argument('--img-max-concurrency', type=int, default=0)
+    parser.add_argument('--raw-handle-cache', type=int, default=0, help='cached raw read handles of local transport')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write result as json')
+    parser.add_argument('--baseline', help='compare with a previous json result')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    if args.transport == 'ice':
+        transport = IceTransport(args.proxy, args.metrics_address)
+    else:
+        from ice_service import fake_img_service as fake
+
+        profiles = fake.generate_profiles(args.img_latency, args.img_error_rate)
+        transport = LocalTransport(args.db_url, profiles, args.img_max_concurrency, args.seed, args.raw_handle_cache)
+
+    result = run(transport, _parse_mix(args.mix), args.shape, args.trees, args.concurrency, args.rate,
+                 args.duration, None if args.duration else args.operations, args.max_open_handles, args.seed)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print('\n'.join(_compare(result, json.load(f))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""服务启动耗时的基准
+
+每次在新的进程中依次加载与调用，统计各阶段的耗时（秒），输出 --repeat 次的中位数
+    import_service    : 加载 ice_service.service ，之后即可激活 Ice 适配器
+    import_dispatch   : 加载 Op 调用的分发表（全部业务模块），在预热线程或首次 Op 调用时进行
+    import_components : 加载后台组件
+    first_op          : 使用 sqlite 数据库，第一次 Op 调用（query_timeline）的耗时
+    second_op         : 第二次相同的 Op 调用的耗时
+    eager_activate    : 改动前激活 Ice 适配器前需要的加载耗时，即 import_service + import_dispatch + import_components
+    lazy_activate     : 改动后激活 Ice 适配器前需要的加载耗时，即 import_service
+
+usage:
+    cd disk_snapshot_service
+    python -m benchmark.startup_benchmark --repeat 10
+    python -m benchmark.startup_benchmark --repeat 5 --output result.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+STAGES = ('import_service', 'import_dispatch', 'import_components', 'first_op', 'second_op',)
+
+
+def _measure() -> dict:
+    """在子进程中运行"""
+    result, begin = dict(), time.monotonic()
+
+    def mark(stage):
+        nonlocal begin
+        result[stage] = time.monotonic() - begin
+        begin = time.monotonic()
+
+    from ice_service import service
+    mark('import_service')
+    from ice_service import dispatch
+    _ = dispatch
+    mark('import_dispatch')
+    from ice_service import components
+    _ = components
+    mark('import_components')
+
+    from data_access import models as m
+    from data_access import session as s
+    from ice_service import startup
+
+    readiness = startup.Readiness()
+    servant = service.SnapshotI(readiness, 60)
+    with tempfile.TemporaryDirectory(prefix='startup_') as work_dir, \
+            s.local_database(f'sqlite:///{os.path.join(work_dir, "dss.db")}') as engine:
+        m.Base.metadata.create_all(engine)
+        readiness.set_ready()
+        in_json = json.dumps({'tree_ident': 'startup_benchmark'})
+        begin = time.monotonic()
+        servant.Op('query_timeline', in_json)
+        mark('first_op')
+        servant.Op('query_timeline', in_json)
+        mark('second_op')
+        s.session_maker.remove()
+    return result
+
+
+def run_once() -> dict:
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmark.startup_benchmark', '--child'],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=dict(os.environ, DISABLE_LOGGING_CONF='1'),
+    )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def summarize(runs) -> dict:
+    result = {stage: statistics.median(run[stage] for run in runs) for stage in STAGES}
+    result['eager_activate'] = statistics.median(
+        run['import_service'] + run['import_dispatch'] + run['import_components'] for run in runs)
+    result['lazy_activate'] = result['import_service']
+    result['repeat'] = len(runs)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='service startup time')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write result json to file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_measure()))
+        return 0
+
+    result = summarize([run_once() for _ in range(args.repeat)])
+    print(json.dumps(result, indent=2))
+    for stage in STAGES + ('eager_activate', 'lazy_activate',):
+        print(f'{stage:20}{result[stage] * 1000:>10.1f} ms')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
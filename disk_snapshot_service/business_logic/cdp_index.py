@@ -0,0 +1,166 @@
+"""CDP快照存储的时间区间索引
+
+按时间点打开CDP快照存储时，需要在快照存储树中找到包含该时间点的CDP快照存储，以及其依赖的父快照存储
+长时间运行的CDP会产生数以千计的CDP快照存储（一次连续的CDP写入按时间切分为多个首尾相连的CDP快照存储）
+
+    1. 每棵快照存储树一个索引，使用 storage_timeline.IntervalIndex 查找
+       正在写入（没有 finish_timestamp ）的CDP快照存储视为包含 start_timestamp 之后的所有时间点
+    2. 连续的CDP快照存储（父快照存储同为CDP）属于同一次CDP写入，打开时仅在调用者指定的快照存储所在的CDP写入中查找
+    3. 索引缓存在内存中，快照存储树中的快照存储的状态或父节点变化时失效；查找结果总是使用本次打开时查询到的数据库对象
+       再次校验，校验失败时重建索引后再查找一次
+"""
+import collections
+import threading
+import typing
+
+from cpkt.core import xlogging as lg
+
+from business_logic import storage
+from business_logic import storage_timeline as timeline
+from business_logic import storage_tree as tree
+from data_access import models as m
+
+_logger = lg.get_logger(__name__)
+
+
+def _contains(storage_obj: m.SnapshotStorage, timestamp) -> bool:
+    if storage_obj.start_timestamp is None or timestamp < storage_obj.start_timestamp:
+        return False
+    return storage_obj.finish_timestamp is None or timestamp <= storage_obj.finish_timestamp
+
+
+class CdpSegment(object):
+
+    def __init__(self, ident: str, run_ident: str, start_timestamp, finish_timestamp):
+        self.ident = ident
+        self.run_ident = run_ident  # 所在CDP写入的第一个CDP快照存储
+        self.start_timestamp = start_timestamp
+        self.finish_timestamp = finish_timestamp
+
+    def __str__(self):
+        return f'cdp_segment:<{self.ident},{self.start_timestamp}-{self.finish_timestamp}>'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class TreeCdpIndex(object):
+    """一棵快照存储树中所有CDP快照存储的时间区间"""
+
+    def __init__(self, tree_ident: str, segments: typing.List[CdpSegment]):
+        self.tree_ident = tree_ident
+        self._index = timeline.IntervalIndex(segments)
+
+    def __str__(self):
+        return f'tree_cdp_index:<{self.tree_ident},{len(self._index)} segments,{self._index.unfinished_count} writing>'
+
+    @staticmethod
+    def build(storage_tree: tree.DiskSnapshotStorageTree) -> 'TreeCdpIndex':
+        segments, run_idents = list(), dict()  # 节点 -> 所在CDP写入的第一个CDP快照存储，避免长链上重复向上查找
+        for node in storage_tree.node_dict.values():
+            if not node.storage.is_cdp or node.storage.start_timestamp is None:
+                continue
+            path, run_node = list(), node
+            while run_node.ident not in run_idents and run_node.parent is not None and run_node.parent.storage.is_cdp:
+                path.append(run_node)
+                run_node = run_node.parent
+            run_ident = run_idents.get(run_node.ident, run_node.ident)
+            for path_node in path + [run_node]:
+                run_idents[path_node.ident] = run_ident
+            segments.append(CdpSegment(node.ident, run_ident,
+                                       node.storage.start_timestamp, node.storage.finish_timestamp))
+        return TreeCdpIndex(storage_tree.tree_ident, segments)
+
+    def find(self, timestamp) -> typing.List[CdpSegment]:
+        """包含时间点的CDP快照存储，按 start_timestamp 从大到小排列"""
+        return self._index.find(timestamp)
+
+
+class CdpIndex(object):
+    """缓存各快照存储树的CDP时间区间索引"""
+
+    def __init__(self, max_trees=256):
+        self.max_trees = max_trees
+        self._trees: typing.Dict[str, TreeCdpIndex] = collections.OrderedDict()
+        self._locker = threading.Lock()
+        self.builds = 0
+
+    def __str__(self):
+        return f'cdp_index:<{len(self._trees)} trees>'
+
+    def _get(self, storage_tree: tree.DiskSnapshotStorageTree, rebuild=False) -> TreeCdpIndex:
+        with self._locker:
+            tree_index = None if rebuild else self._trees.get(storage_tree.tree_ident)
+            if tree_index is not None:
+                self._trees.move_to_end(storage_tree.tree_ident)
+                return tree_index
+
+        tree_index = TreeCdpIndex.build(storage_tree)
+        with self._locker:
+            self.builds += 1
+            self._trees[storage_tree.tree_ident] = tree_index
+            while len(self._trees) > self.max_trees:
+                self._trees.popitem(last=False)
+        _logger.debug('%s built', tree_index)
+        return tree_index
+
+    def _find(self, storage_tree: tree.DiskSnapshotStorageTree, run_ident: str, timestamp, rebuild):
+        for segment in self._get(storage_tree, rebuild).find(timestamp):
+            if segment.run_ident != run_ident or segment.ident not in storage_tree.node_dict:
+                continue
+            if _contains(storage_tree.get_node_by_ident(segment.ident).storage, timestamp):
+                return segment.ident
+        return None
+
+    def prepare(self, storage_tree: tree.DiskSnapshotStorageTree) -> TreeCdpIndex:
+        """预先生成索引，在存储锁内调用"""
+        return self._get(storage_tree)
+
+    def resolve(self, storage_tree: tree.DiskSnapshotStorageTree, storage_ident: str, timestamp) -> str:
+        """返回 storage_ident 所在的CDP写入中包含时间点的CDP快照存储
+
+        :remark:
+            在存储锁内调用，storage_tree 为本次查询的快照存储树
+        """
+        node = storage_tree.get_node_by_ident(storage_ident)
+        assert node.storage.is_cdp, (
+            '仅CDP快照存储可以按时间点打开', f'open {storage_ident} at {timestamp}, NOT cdp', 0)
+        while node.parent is not None and node.parent.storage.is_cdp:
+            node = node.parent
+
+        ident = self._find(storage_tree, node.ident, timestamp, False)
+        if ident is None:
+            ident = self._find(storage_tree, node.ident, timestamp, True)  # 索引可能已过期
+        assert ident is not None, (
+            '快照时间点不存在', f'timestamp {timestamp} NOT in cdp of {storage_ident}', 0)
+        return ident
+
+    def invalidate(self, tree_ident: str):
+        """快照存储树中的快照存储发生变化，在锁空间内调用"""
+        with self._locker:
+            self._trees.pop(tree_ident, None)
+
+    def clear(self):
+        with self._locker:
+            self._trees.clear()
+
+
+_cdp_index: CdpIndex = None
+_cdp_index_locker = threading.Lock()
+
+
+def get_cdp_index() -> CdpIndex:
+    global _cdp_index
+
+    if _cdp_index is None:
+        with _cdp_index_locker:
+            if _cdp_index is None:
+                _cdp_index = CdpIndex()
+                storage.add_change_listener(_on_storage_changed)
+    return _cdp_index
+
+
+def _on_storage_changed(storage_ident: str, tree_ident: str):
+    _ = storage_ident
+    if _cdp_index is not None:
+        _cdp_index.invalidate(tree_ident)
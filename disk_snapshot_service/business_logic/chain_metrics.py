@@ -0,0 +1,143 @@
+"""打开快照存储时的读放大统计
+
+打开快照存储需要叠加快照存储链上的关键快照存储（参考 storage_chain），链越长，镜像服务需要打开的文件越多，读取越慢
+    1. 每次打开记录链深度（链上的快照存储数量）、关键快照存储数量与不同文件的数量
+    2. 按快照存储树汇总，仅保留最近打开的 max_trees 棵快照存储树
+    3. 关键快照存储过多的qcow快照链由回收逻辑合成全量快照，参考 storage_collection.FlattenQcowChainWork
+"""
+import collections
+import threading
+import typing
+
+from cpkt.core import xlogging as lg
+
+from business_logic import storage_chain as chain
+
+_logger = lg.get_logger(__name__)
+
+
+class ChainSample(object):
+    """一次打开的快照存储链"""
+
+    __slots__ = ('depth', 'key_items', 'files',)
+
+    def __init__(self, depth: int, key_items: int, files: int):
+        self.depth = depth
+        self.key_items = key_items
+        self.files = files
+
+    def __str__(self):
+        return f'chain_sample:<depth:{self.depth},key_items:{self.key_items},files:{self.files}>'
+
+    def __repr__(self):
+        return self.__str__()
+
+    @staticmethod
+    def from_chain(r_chain: chain.StorageChain) -> 'ChainSample':
+        """在 acquire 之后调用"""
+        return ChainSample(len(r_chain.storage_items), len(r_chain.key_storage_items),
+                           len({item.image_path for item in r_chain.key_storage_items}))
+
+    def to_dict(self) -> dict:
+        return {'depth': self.depth, 'key_items': self.key_items, 'files': self.files}
+
+
+class ChainSummary(object):
+    """累计的读放大数据"""
+
+    def __init__(self):
+        self.opens = 0
+        self.depth_sum = 0
+        self.key_items_sum = 0
+        self.files_sum = 0
+        self.max_depth = 0
+        self.max_key_items = 0
+        self.max_files = 0
+        self.last: typing.Union[ChainSample, None] = None
+
+    def add(self, sample: ChainSample):
+        self.opens += 1
+        self.depth_sum += sample.depth
+        self.key_items_sum += sample.key_items
+        self.files_sum += sample.files
+        self.max_depth = max(self.max_depth, sample.depth)
+        self.max_key_items = max(self.max_key_items, sample.key_items)
+        self.max_files = max(self.max_files, sample.files)
+        self.last = sample
+
+    def _average(self, value_sum) -> float:
+        return round(value_sum / self.opens, 2) if self.opens else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'opens': self.opens,
+            'avg_depth': self._average(self.depth_sum),
+            'avg_key_items': self._average(self.key_items_sum),
+            'avg_files': self._average(self.files_sum),
+            'max_depth': self.max_depth,
+            'max_key_items': self.max_key_items,
+            'max_files': self.max_files,
+            'last': self.last.to_dict() if self.last else None,
+        }
+
+
+class ChainMetrics(object):
+    """统计打开快照存储时的读放大"""
+
+    def __init__(self, max_trees=256):
+        self.max_trees = max_trees
+        self.total = ChainSummary()
+        self._trees: typing.Dict[str, ChainSummary] = collections.OrderedDict()
+        self._locker = threading.Lock()
+
+    def __str__(self):
+        return f'chain_metrics:<{self.total.opens} opens,{len(self._trees)} trees>'
+
+    def record(self, tree_ident: str, r_chain: chain.StorageChain) -> ChainSample:
+        sample = ChainSample.from_chain(r_chain)
+        with self._locker:
+            self.total.add(sample)
+            summary = self._trees.get(tree_ident)
+            if summary is None:
+                summary = self._trees[tree_ident] = ChainSummary()
+                while len(self._trees) > self.max_trees:
+                    self._trees.popitem(last=False)
+            else:
+                self._trees.move_to_end(tree_ident)
+            summary.add(sample)
+        return sample
+
+    def query_tree(self, tree_ident: str) -> typing.Union[dict, None]:
+        with self._locker:
+            summary = self._trees.get(tree_ident)
+            return summary.to_dict() if summary else None
+
+    def to_dict(self, top=10) -> dict:
+        """汇总数据，trees 为平均关键快照存储数量最多的 top 棵快照存储树"""
+        with self._locker:
+            trees = sorted(self._trees.items(),
+                           key=lambda item: item[1].key_items_sum / item[1].opens, reverse=True)[:top]
+            return {
+                'total': self.total.to_dict(),
+                'tree_count': len(self._trees),
+                'trees': {tree_ident: summary.to_dict() for tree_ident, summary in trees},
+            }
+
+    def clear(self):
+        with self._locker:
+            self.total = ChainSummary()
+            self._trees.clear()
+
+
+_chain_metrics: ChainMetrics = None
+_chain_metrics_locker = threading.Lock()
+
+
+def get_chain_metrics() -> ChainMetrics:
+    global _chain_metrics
+
+    if _chain_metrics is None:
+        with _chain_metrics_locker:
+            if _chain_metrics is None:
+                _chain_metrics = ChainMetrics()
+    return _chain_metrics
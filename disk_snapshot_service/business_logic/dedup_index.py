@@ -0,0 +1,314 @@
+import bisect
+import json
+import os
+import threading
+import typing
+
+import numpy as np
+from cpkt.core import xlogging as lg
+
+from business_logic import hash_file
+
+_logger = lg.get_logger(__name__)
+
+DEFAULT_INDEX_DIR = '/var/lib/disk_snapshot_service/dedup_index'
+
+FP_DTYPE = np.dtype('<u8')  # hash记录的前8字节，作为排序与查找的键，单独存储以便二分查找
+VALUE_DTYPE = np.dtype([
+    ('tail', '<u4', (hash_file.RECORD_WORDS - 2,)),  # hash记录的其余部分，查找时校验
+    ('hash_id', '<u4'),  # hash 表的 id
+    ('block', '<u4'),  # 数据块在磁盘中的序号
+])
+
+
+def _fingerprint(records: np.ndarray) -> np.ndarray:
+    return (records[:, 0].astype(np.uint64) << np.uint64(32)) | records[:, 1].astype(np.uint64)
+
+
+def _in_ranges(ranges: typing.List[typing.List[int]], hash_id: int) -> bool:
+    pos = bisect.bisect_right(ranges, [hash_id, float('inf')]) - 1
+    return pos >= 0 and ranges[pos][0] <= hash_id <= ranges[pos][1]
+
+
+def _add_to_ranges(ranges: typing.List[typing.List[int]], hash_id: int) -> typing.List[typing.List[int]]:
+    """返回加入 hash_id 后的有序区间列表，区间为 [begin, end] ，相邻的区间合并为一个"""
+    ranges = [list(r) for r in ranges]
+    pos = bisect.bisect_right(ranges, [hash_id, float('inf')])
+    if pos > 0 and ranges[pos - 1][1] >= hash_id - 1:
+        ranges[pos - 1][1] = max(ranges[pos - 1][1], hash_id)
+        pos -= 1
+    else:
+        ranges.insert(pos, [hash_id, hash_id])
+    if pos + 1 < len(ranges) and ranges[pos + 1][0] <= ranges[pos][1] + 1:
+        ranges[pos][1] = max(ranges[pos][1], ranges.pop(pos + 1)[1])
+    return ranges
+
+
+class LookupResult(object):
+    """批量查找的结果，与查找的hash记录一一对应"""
+
+    def __init__(self, count: int):
+        self.found = np.zeros(count, np.bool_)
+        self.hash_id = np.zeros(count, np.uint32)
+        self.block = np.zeros(count, np.uint32)
+
+    @property
+    def found_count(self) -> int:
+        return int(np.count_nonzero(self.found))
+
+
+class Run(object):
+    """按 fp 排序的索引记录，fp 与其余字段分别存储在两个文件中，以内存映射的方式只读打开
+
+    :remark:
+        readers 与 removed 由 DedupIndex 在 _runs_locker 内修改，合并后不再有效的 run 在没有读取者时才删除文件
+    """
+
+    def __init__(self, index_dir: str, name: str):
+        self.name = name
+        self.fp_path = os.path.join(index_dir, f'{name}.fp.npy')
+        self.value_path = os.path.join(index_dir, f'{name}.value.npy')
+        self.fp: np.ndarray = None
+        self.value: np.ndarray = None
+        self.readers = 0
+        self.removed = False
+
+    def __len__(self):
+        return len(self.fp)
+
+    @property
+    def disk_bytes(self) -> int:
+        return os.path.getsize(self.fp_path) + os.path.getsize(self.value_path)
+
+    def load(self) -> 'Run':
+        self.fp = np.load(self.fp_path, mmap_mode='r')
+        self.value = np.load(self.value_path, mmap_mode='r')
+        return self
+
+    def save(self, fp: np.ndarray, value: np.ndarray) -> 'Run':
+        for path, array in ((self.fp_path, fp), (self.value_path, value),):
+            with open(path, 'wb') as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+        return self.load()
+
+    def remove(self):
+        for path in (self.fp_path, self.value_path,):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class DedupIndex(object):
+    """跨快照存储的数据块hash去重索引
+
+    :remark:
+        索引由多个有序的定长记录文件（run）组成，每个 run 按 fp 排序，不同 run 之间不存在重复的hash记录
+        添加hash文件时，仅将索引中不存在的hash记录写入新的 run，run 的数量超过 MAX_RUNS 时合并较小的多个 run
+        manifest 记录当前有效的 run 与已索引的 hash id 区间，通过替换文件的方式原子更新
+            hash id 按创建的顺序递增，连续加入的 hash id 合并为一个区间，manifest 不随索引的hash文件数量增长
+        修改由 _locker 串行化；查找在 _runs_locker 内获取当前的 run 并增加引用计数，不等待进行中的修改
+            合并后不再有效的 run 由最后一个读取者释放时删除文件
+        索引目录在首次写入时创建，未使用去重索引时不在磁盘上留下目录
+        快照存储被回收后，索引中的记录不会被删除，调用者需要校验 hash id 仍然有效；重建索引可以清理这些记录
+    """
+
+    MANIFEST = 'manifest.json'
+    MAX_RUNS = 8
+
+    def __init__(self, index_dir: str, chunk_records: int = hash_file.CHUNK_RECORDS):
+        self.index_dir = index_dir
+        self.chunk_records = chunk_records
+        self._locker = threading.Lock()  # 串行化索引的修改
+        self._runs_locker = threading.Lock()  # 保护 _runs 、 _hash_id_ranges 与 run 的引用计数
+        self._runs: typing.List[Run] = list()
+        self._hash_id_ranges: typing.List[typing.List[int]] = list()
+        self._next_run = 0
+        self._load_manifest()
+
+    def __str__(self):
+        with self._runs_locker:
+            runs = list(self._runs)
+        return f'dedup_index:<{self.index_dir},{len(runs)} runs,{sum(len(run) for run in runs)} records>'
+
+    @property
+    def records_count(self) -> int:
+        with self._runs_locker:
+            runs = list(self._runs)
+        return sum(len(run) for run in runs)
+
+    @property
+    def disk_bytes(self) -> int:
+        runs = self._acquire_runs()
+        try:
+            return sum(run.disk_bytes for run in runs)
+        finally:
+            self._release_runs(runs)
+
+    def is_indexed(self, hash_id: int) -> bool:
+        with self._runs_locker:
+            return _in_ranges(self._hash_id_ranges, hash_id)
+
+    def _acquire_runs(self) -> typing.List[Run]:
+        with self._runs_locker:
+            runs = list(self._runs)
+            for run in runs:
+                run.readers += 1
+        return runs
+
+    def _release_runs(self, runs: typing.List[Run]):
+        with self._runs_locker:
+            for run in runs:
+                run.readers -= 1
+            unused = [run for run in runs if run.removed and run.readers == 0]
+        for run in unused:
+            run.remove()
+
+    def _load_manifest(self):
+        manifest_path = os.path.join(self.index_dir, self.MANIFEST)
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self._runs = [Run(self.index_dir, name).load() for name in manifest['runs']]
+        if 'hash_ids' in manifest:  # 旧版本的 manifest 逐个记录 hash id
+            for hash_id in sorted(manifest['hash_ids']):
+                self._hash_id_ranges = _add_to_ranges(self._hash_id_ranges, hash_id)
+        else:
+            self._hash_id_ranges = manifest['hash_id_ranges']
+        self._next_run = manifest['next_run']
+
+    def _save_manifest(self, runs, hash_id_ranges, written_runs=()):
+        os.makedirs(self.index_dir, exist_ok=True)
+        manifest_path = os.path.join(self.index_dir, self.MANIFEST)
+        tmp_path = f'{manifest_path}.writing'
+        with open(tmp_path, 'w') as f:
+            json.dump({'runs': [run.name for run in runs], 'hash_id_ranges': hash_id_ranges,
+                       'next_run': self._next_run}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+
+        with self._runs_locker:
+            removed = [run for run in self._runs + list(written_runs) if run not in runs]
+            self._runs, self._hash_id_ranges = runs, hash_id_ranges
+            for run in removed:
+                run.removed = True
+            unused = [run for run in removed if run.readers == 0]
+        for run in unused:
+            run.remove()
+
+    def _write_run(self, fp: np.ndarray, value: np.ndarray) -> Run:
+        os.makedirs(self.index_dir, exist_ok=True)
+        run = Run(self.index_dir, f'run-{self._next_run:08d}')
+        self._next_run += 1
+        return run.save(fp, value)
+
+    @staticmethod
+    def _lookup_in_runs(runs, keys: np.ndarray, fp: np.ndarray, result: LookupResult):
+        for run in reversed(runs):
+            pending = np.flatnonzero(~result.found)
+            if len(pending) == 0 or len(run) == 0:
+                continue
+            pos = np.searchsorted(run.fp, fp[pending])
+            pos[pos == len(run)] = 0
+            candidates = run.value[pos]
+            matched = (run.fp[pos] == fp[pending]) & np.all(candidates['tail'] == keys[pending, 2:], axis=1)
+            hit = pending[matched]
+            result.found[hit] = True
+            result.hash_id[hit] = candidates['hash_id'][matched]
+            result.block[hit] = candidates['block'][matched]
+
+    def lookup(self, keys: np.ndarray) -> LookupResult:
+        """批量查找hash记录
+
+        :param keys: (数量, RECORD_WORDS) 的hash记录
+        :remark:
+            fp 相同但其余部分不同的记录（概率极低）可能被判定为不存在，对去重而言是安全的
+        """
+        keys = np.asarray(keys, hash_file.RECORD_DTYPE).reshape(-1, hash_file.RECORD_WORDS)
+        result = LookupResult(len(keys))
+        runs = self._acquire_runs()
+        try:
+            self._lookup_in_runs(runs, keys, _fingerprint(keys), result)
+        finally:
+            self._release_runs(runs)
+        return result
+
+    def _new_records(self, runs, records: np.ndarray, begin_block: int, hash_id: int):
+        """提取记录中不在索引中的hash，返回按 fp 排序、去除重复后的索引记录"""
+        blocks = np.flatnonzero(hash_file.is_present(records))
+        keys = records[blocks]
+        fp = _fingerprint(keys)
+
+        order = np.argsort(fp, kind='stable')
+        keys, fp, blocks = keys[order], fp[order], blocks[order]
+        unique = np.ones(len(fp), np.bool_)
+        unique[1:] = fp[1:] != fp[:-1]  # 同一批中 fp 相同的记录仅保留第一个
+        keys, fp, blocks = keys[unique], fp[unique], blocks[unique]
+
+        existed = LookupResult(len(keys))
+        self._lookup_in_runs(runs, keys, fp, existed)
+        absent = ~existed.found
+
+        value = np.empty(int(np.count_nonzero(absent)), VALUE_DTYPE)
+        value['tail'] = keys[absent, 2:]
+        value['hash_id'] = hash_id
+        value['block'] = blocks[absent] + begin_block
+        return fp[absent], value
+
+    def add_hash_file(self, hash_id: int, path: str) -> int:
+        """将hash文件中的数据块加入索引
+
+        :return: 新增的索引记录数量
+        """
+        with self._locker:
+            if self.is_indexed(hash_id):
+                return 0  # 已经索引
+
+            runs = list(self._runs)
+            records = hash_file.open_records(path)
+            added = 0
+            for begin in range(0, len(records), self.chunk_records):
+                fp, value = self._new_records(runs, records[begin:begin + self.chunk_records], begin, hash_id)
+                if len(fp):
+                    runs.append(self._write_run(fp, value))
+                    added += len(fp)
+            written_runs = runs[len(self._runs):]
+            if len(runs) > self.MAX_RUNS:
+                runs = self._compact(runs)
+            self._save_manifest(runs, _add_to_ranges(self._hash_id_ranges, hash_id), written_runs)
+
+        _logger.info(f'{self} add hash {hash_id} {path}, {added} records added')
+        return added
+
+    def _compact(self, runs):
+        """合并较小的多个 run，合并后 run 的数量为 MAX_RUNS // 2
+
+        :remark:
+            run 之间不存在重复记录，合并只需重新排序；保留最大的几个 run 不动，限制每次合并的数据量
+        """
+        runs = sorted(runs, key=len, reverse=True)
+        keep = self.MAX_RUNS // 2 - 1
+        fp = np.concatenate([run.fp for run in runs[keep:]])
+        order = np.argsort(fp, kind='stable')
+        value = np.concatenate([run.value for run in runs[keep:]])[order]
+        return runs[:keep] + [self._write_run(fp[order], value)]
+
+    def clear(self):
+        with self._locker:
+            self._save_manifest(list(), list())
+
+
+_dedup_index = None
+_dedup_index_locker = threading.Lock()
+
+
+def get_dedup_index(index_dir=DEFAULT_INDEX_DIR) -> DedupIndex:
+    global _dedup_index
+
+    if _dedup_index is None:
+        with _dedup_index_locker:
+            if _dedup_index is None:
+                _dedup_index = DedupIndex(index_dir)
+    return _dedup_index
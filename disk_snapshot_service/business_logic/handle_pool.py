@@ -5,6 +5,7 @@ from cpkt.core import exc
 from cpkt.core import xlogging as lg
 
 from basic_library import xfunctions as xf
+from business_logic import raw_handle_cache
 from business_logic import storage_action as action
 from business_logic import storage_chain as chain
 
@@ -23,6 +24,9 @@ class Handle(object):
         self.ice_endpoint: str = ''
         self.created_time = xf.current_timestamp()
         self.locker = threading.Lock()
+        self.hash_mode: str = None  # 写句柄关闭时的工作模式，参考 set_hash_mode
+        self.shared: SharedRead = None  # 共享打开的读句柄，快照存储链与原生句柄属于 shared
+        self.cached_raw: raw_handle_cache.CacheEntry = None  # 原生句柄来自缓存，关闭时归还
 
     def __repr__(self):
         return self.__str__()
@@ -32,9 +36,18 @@ class Handle(object):
                 f'{xf.humanize_timestamp(self.created_time)} | {self.writing} | '
                 f'{self.storage_chain.name if self.storage_chain else None}')
 
+    def open_raw_handle(self):
+        """打开读取的原生句柄，优先使用缓存"""
+        with self.locker:
+            if not self.raw_handle:
+                self.raw_handle, self.ice_endpoint, self.cached_raw = raw_handle_cache.get_raw_handle_cache().open(
+                    self.storage_chain, self.raw_flag)
+
     def _close_raw_handle(self):
         with self.locker:
-            if self.raw_handle:
+            if self.cached_raw:
+                raw_handle_cache.get_raw_handle_cache().release(self.cached_raw)
+            elif self.raw_handle:
                 action.DiskSnapshotAction.close_disk_snapshot(self.raw_handle, self.ice_endpoint)
 
     def _release_chain(self):
@@ -44,13 +57,66 @@ class Handle(object):
         except Exception as e:
             _logger.warning(lg.format_exception(e))
 
-    def destroy(self):
-        HandlePool.get_handle_pool().remove(self.handle)
+    def release(self):
+        """关闭原生句柄并释放快照存储链，调用前需要已从 pool 中移除"""
+        if self.shared:
+            HandlePool.get_handle_pool().release_shared(self)
+            return
         try:
             self._close_raw_handle()
         finally:
             self._release_chain()
 
+    def destroy(self):
+        HandlePool.get_handle_pool().remove(self.handle)
+        self.release()
+
+
+class SharedRead(object):
+    """多个读句柄共享的快照存储链与原生读句柄
+
+    :remark:
+        打开相同 (storage_ident, timestamp) 的读句柄共享同一个已获取的快照存储链与原生读句柄，
+        引用计数为使用该对象的句柄，最后一个句柄关闭时释放快照存储链并关闭原生句柄
+        原生句柄使用首个请求原生句柄的调用者的 raw_flag 打开
+    """
+
+    def __init__(self, key: typing.Tuple[str, str]):
+        self.key = key
+        self.references: typing.Set[str] = set()
+        self.storage_chain: chain.StorageChainForRead = None
+        self.raw_handle: int = 0
+        self.ice_endpoint: str = ''
+        self.locker = threading.Lock()  # 获取快照存储链与打开原生句柄
+
+    def __str__(self):
+        return f'shared read {self.key} : {len(self.references)} references | {self.raw_handle} | ' \
+               f'{self.storage_chain.name if self.storage_chain else None}'
+
+    def attach(self, handle_inst: Handle, acquire_chain: typing.Callable[[], chain.StorageChainForRead]):
+        """在没有获取快照存储链时调用 acquire_chain 获取"""
+        with self.locker:
+            if not self.storage_chain:
+                self.storage_chain = acquire_chain()
+            handle_inst.storage_chain = self.storage_chain
+            handle_inst.raw_handle, handle_inst.ice_endpoint = self.raw_handle, self.ice_endpoint
+
+    def open_raw_handle(self, handle_inst: Handle):
+        with self.locker:
+            if not self.raw_handle:
+                self.raw_handle, self.ice_endpoint = action.DiskSnapshotAction.open_disk_snapshot(
+                    self.storage_chain, handle_inst.raw_flag)
+            handle_inst.raw_handle, handle_inst.ice_endpoint = self.raw_handle, self.ice_endpoint
+
+    def destroy(self):
+        with self.locker:
+            try:
+                if self.raw_handle:
+                    action.DiskSnapshotAction.close_disk_snapshot(self.raw_handle, self.ice_endpoint)
+            finally:
+                if self.storage_chain:
+                    self.storage_chain.release()
+
 
 _handle_pool = None
 _handle_pool_locker = threading.Lock()
@@ -62,6 +128,8 @@ class HandlePool(object):
     def __init__(self):
         self.cache: typing.Dict[str, Handle] = dict()
         self.cache_locker = threading.Lock()
+        self.shared: typing.Dict[typing.Tuple[str, str], SharedRead] = dict()
+        self.shared_locker = threading.Lock()
 
     @staticmethod
     def get_handle_pool():
@@ -78,17 +146,17 @@ class HandlePool(object):
             assert handle_inst.handle not in self.cache, (
                 '添加句柄失败，重复的快照存储操作句柄', f'same handle in pool {self.cache[handle_inst.handle]}', 0)
             self.cache[handle_inst.handle] = handle_inst
-            _logger.info(f'insert handle [{handle_inst.handle}] to pool')
-            return handle_inst
+        _logger.info('insert handle [%s] to pool', handle_inst.handle)
+        return handle_inst
 
     def remove(self, handle: str) -> Handle:
         with self.cache_locker:
             handle_inst = self.cache.pop(handle, None)
-            if handle_inst:
-                _logger.info(f'remove {handle_inst} from pool')
-            else:
-                _logger.warning(f'handle {handle} NOT in pool')
-            return handle_inst
+        if handle_inst:
+            _logger.info('remove %s from pool', str(handle_inst))
+        else:
+            _logger.warning('handle %s NOT in pool', handle)
+        return handle_inst
 
     def get(self, handle: str) -> Handle:
         with self.cache_locker:
@@ -97,6 +165,41 @@ class HandlePool(object):
                 _logger.warning(f'handle {handle} NOT in pool')
             return handle_inst
 
+    def reference_shared(self, handle_inst: Handle, storage_ident: str, timestamp) -> SharedRead:
+        """句柄引用 (storage_ident, timestamp) 对应的共享对象，不存在时新建"""
+        key = (storage_ident, None if timestamp is None else str(timestamp),)
+        with self.shared_locker:
+            shared = self.shared.get(key)
+            if shared is None:
+                shared = self.shared[key] = SharedRead(key)
+            shared.references.add(handle_inst.handle)
+            handle_inst.shared = shared
+        _logger.info('handle [%s] reference %s', handle_inst.handle, str(shared))
+        return shared
+
+    def release_shared(self, handle_inst: Handle):
+        """最后一个引用的句柄释放时，销毁共享对象"""
+        shared = handle_inst.shared
+        with self.shared_locker:
+            shared.references.discard(handle_inst.handle)
+            last = not shared.references
+            if last and self.shared.get(shared.key) is shared:
+                del self.shared[shared.key]
+        if last:
+            _logger.info('destroy %s by [%s]', str(shared), handle_inst.handle)
+            shared.destroy()
+
+    def handle_count(self) -> typing.Tuple[int, int]:
+        """返回 读句柄数量, 写句柄数量"""
+        with self.cache_locker:
+            writing = sum(1 for handle_inst in self.cache.values() if handle_inst.writing)
+            return len(self.cache) - writing, writing
+
+    def shared_count(self) -> typing.Tuple[int, int]:
+        """返回 共享对象数量, 引用的句柄数量"""
+        with self.shared_locker:
+            return len(self.shared), sum(len(shared.references) for shared in self.shared.values())
+
 
 def generate_handle(handle: str, writing: bool, raw_flag: str) -> Handle:
     """产生新的Handle对象，并将其加入到 pool 中"""
@@ -0,0 +1,104 @@
+"""快照点的hash文件
+
+文件格式（Hash.VERSION_MD4_CRC32）：
+    磁盘按 BLOCK_BYTES 划分数据块，每个数据块对应一条定长记录，第 N 条记录对应第 N 个数据块
+    记录为 MD4(16字节) + CRC32(4字节)，小端序，共 RECORD_BYTES 字节
+    全零记录表示快照点中没有该数据块（增量hash中未变更的数据块）
+    文件末尾的全零记录可以省略，即文件长度可以小于磁盘对应的记录数量
+"""
+
+import os
+import typing
+
+import numpy as np
+from cpkt.core import xlogging as lg
+
+_logger = lg.get_logger(__name__)
+
+BLOCK_BYTES = 64 * 1024
+RECORD_WORDS = 5
+RECORD_BYTES = RECORD_WORDS * 4
+RECORD_DTYPE = np.dtype('<u4')
+
+CHUNK_RECORDS = 1024 * 1024  # 每次处理的记录数量，约 20MB 内存
+
+
+def records_count(disk_bytes: int) -> int:
+    """磁盘大小对应的记录数量"""
+    return (disk_bytes + BLOCK_BYTES - 1) // BLOCK_BYTES
+
+
+def open_records(path: str) -> np.ndarray:
+    """以内存映射的方式只读打开hash文件，返回 (记录数量, RECORD_WORDS) 的数组"""
+    file_bytes = os.path.getsize(path)
+    assert file_bytes % RECORD_BYTES == 0, ('hash文件格式错误', f'invalid hash file size {path} {file_bytes}', 0)
+    if file_bytes == 0:
+        return np.zeros((0, RECORD_WORDS), RECORD_DTYPE)
+    return np.memmap(path, RECORD_DTYPE, 'r').reshape(-1, RECORD_WORDS)
+
+
+def write_records(path: str, records_iter: typing.Iterable[np.ndarray]):
+    """先写入临时文件，完成后替换目标文件，避免中断时留下不完整的hash文件"""
+    tmp_path = f'{path}.writing'
+    try:
+        with open(tmp_path, 'wb') as f:
+            for records in records_iter:
+                f.write(np.ascontiguousarray(records, RECORD_DTYPE).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_chunk(records: np.ndarray, begin: int, end: int) -> np.ndarray:
+    """读取 [begin, end) 区间的记录，超出文件长度的部分补零"""
+    chunk = np.zeros((end - begin, RECORD_WORDS), RECORD_DTYPE)
+    exist = records[begin:end]
+    chunk[:len(exist)] = exist
+    return chunk
+
+
+def is_present(records: np.ndarray) -> np.ndarray:
+    """记录是否非零，逐列按位或，避免 any(axis=1) 的逐行归约"""
+    result = records[:, 0].copy()
+    for i in range(1, RECORD_WORDS):
+        result |= records[:, i]
+    return result != 0
+
+
+def overlay(base_path: str, increment_path: str, count: int, chunk_records: int = CHUNK_RECORDS) -> int:
+    """将 base_path 中的记录叠加到 increment_path 中
+
+    :param base_path: 被合并快照点的hash文件
+    :param increment_path: 子快照点的增量hash文件，叠加后的结果替换此文件
+    :param count: 磁盘对应的记录数量
+    :param chunk_records: 每次处理的记录数量，决定内存占用上限
+    :return: 从 base_path 中补充的记录数量
+    :remark:
+        子快照点中存在的记录优先，子快照点中的全零记录使用 base_path 中的记录
+        按照 chunk_records 分段处理，输入文件使用内存映射，内存占用与磁盘大小无关
+    """
+    base = open_records(base_path)
+    increment = open_records(increment_path)
+    assert len(base) <= count and len(increment) <= count, (
+        'hash文件格式错误', f'hash file too large {base_path}:{len(base)} {increment_path}:{len(increment)} {count}', 0)
+
+    filled = 0
+
+    def _merge_chunks():
+        nonlocal filled
+        for begin in range(0, count, chunk_records):
+            end = min(begin + chunk_records, count)
+            merged = _read_chunk(increment, begin, end)
+            absent = ~is_present(merged)
+            np.copyto(merged, _read_chunk(base, begin, end), where=absent[:, np.newaxis])
+            filled += int(np.count_nonzero(absent & is_present(merged)))
+            yield merged
+
+    write_records(increment_path, _merge_chunks())
+
+    _logger.info(f'overlay hash {base_path} to {increment_path}, {filled}/{count} records filled')
+    return filled
@@ -1,22 +1,37 @@
 import threading
+import time
+import typing
 
 from cpkt.core import xlogging as lg
 
+from basic_library import metrics
+
 _logger = lg.get_logger(__name__)
 
 
 class LockWithTrace(object):
+    """可重入锁，记录持有者的 trace
+
+    :remark:
+        wait_seconds 与 hold_seconds 仅统计最外层的获取与释放，参考 ice_service.metrics_exporter
+    """
 
     def __init__(self, name):
         self.name = name
         self._locker = threading.RLock()
         self._current_trace = list()
+        self._acquired_at = 0.0
+        self.wait_seconds = metrics.Histogram()
+        self.hold_seconds = metrics.Histogram()
 
     def acquire(self, trace):
+        begin = time.monotonic()
         self._locker.acquire()
         try:
             if not self._current_trace:
-                _logger.debug(f'locker {self.name} acquire : {trace}')
+                self._acquired_at = time.monotonic()
+                self.wait_seconds.observe(self._acquired_at - begin)
+                _logger.debug('locker %s acquire : %s', self.name, trace)
             self._current_trace.append(trace)
         except Exception:
             self._locker.release()
@@ -27,7 +42,8 @@ class LockWithTrace(object):
         try:
             trace = self._current_trace.pop(-1)
             if not self._current_trace:
-                _logger.debug(f'locker {self.name} release : {trace}')
+                self.hold_seconds.observe(time.monotonic() - self._acquired_at)
+                _logger.debug('locker %s release : %s', self.name, trace)
         finally:
             self._locker.release()
 
@@ -67,6 +83,10 @@ class LockerManager(object):
         """获取锁对象"""
         return self._locker_dict[key].acquire(trace)
 
+    @property
+    def lockers(self) -> typing.List[LockWithTrace]:
+        return list(self._locker_dict.values())
+
 
 def get_journal_locker(trace) -> LockWithTrace:
     """获取日志表锁对象"""
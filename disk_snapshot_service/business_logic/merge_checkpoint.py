@@ -0,0 +1,96 @@
+import typing
+
+from cpkt.core import xlogging as lg
+
+from data_access import merge_checkpoint as da_checkpoint
+from data_access import models as m
+
+_logger = lg.get_logger(__name__)
+
+
+class MergeCheckpoint(object):
+    """合并作业的进度
+
+    :remark:
+        合并作业按照 RANGE_BYTES 分段搬迁数据，每完成一段就持久化一次进度
+        服务重启后，回收逻辑根据进度继续搬迁剩余的数据，而非重新开始
+        作业因可恢复的异常失败时保留进度并累计失败次数，下一轮回收继续搬迁
+        数据库对象不能保证线程安全，从数据库对象中复制数据作全局使用
+    """
+
+    RANGE_BYTES = 4 * 1024 * 1024 * 1024
+
+    def __init__(self, checkpoint_obj: m.MergeCheckpoint):
+        self._storage_ident = checkpoint_obj.storage_ident
+        self._work_type = checkpoint_obj.work_type
+        self._merge_idents = checkpoint_obj.merge_idents.split(',')
+        self._total_bytes = checkpoint_obj.total_bytes
+        self._finished_bytes = checkpoint_obj.finished_bytes
+        self._failed_count = checkpoint_obj.failed_count
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return f'MergeCheckpoint: {self.storage_ident}-{self.work_type}-{self.finished_bytes}/{self.total_bytes}'
+
+    @property
+    def storage_ident(self) -> str:
+        return self._storage_ident
+
+    @property
+    def work_type(self) -> str:
+        return self._work_type
+
+    @property
+    def merge_idents(self) -> typing.List[str]:
+        return self._merge_idents
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    @property
+    def finished_bytes(self) -> int:
+        return self._finished_bytes
+
+    @property
+    def failed_count(self) -> int:
+        return self._failed_count
+
+    @property
+    def is_resumed(self) -> bool:
+        """是否已经搬迁过部分数据"""
+        return self._finished_bytes != 0
+
+    def pending_ranges(self) -> typing.Iterator[typing.Tuple[int, int]]:
+        """剩余需要搬迁的数据区间 [begin, end)"""
+        begin = self._finished_bytes
+        while begin < self._total_bytes:
+            end = min(begin + self.RANGE_BYTES, self._total_bytes)
+            yield begin, end
+            begin = end
+
+    def update_finished(self, finished_bytes: int):
+        """持久化进度，需要在事务中调用"""
+        assert self._finished_bytes <= finished_bytes <= self._total_bytes
+        da_checkpoint.update_finished_bytes(self._storage_ident, finished_bytes)
+        self._finished_bytes = finished_bytes
+
+    def update_failed(self):
+        """累计失败次数，需要在事务中调用"""
+        da_checkpoint.increase_failed_count(self._storage_ident)
+        self._failed_count += 1
+
+    def remove(self):
+        """合并作业结束后，删除进度"""
+        da_checkpoint.delete_obj(self._storage_ident)
+
+
+def create(storage_ident: str, work_type: str, merge_idents: typing.List[str], total_bytes: int) -> MergeCheckpoint:
+    return MergeCheckpoint(da_checkpoint.create_obj(storage_ident, work_type, ','.join(merge_idents), total_bytes))
+
+
+def query_in_tree(tree_ident: str) -> typing.List[MergeCheckpoint]:
+    """获取快照存储树中，未完成的合并作业进度"""
+    return [MergeCheckpoint(o) for o in da_checkpoint.query_objs_in_tree(tree_ident)]
@@ -0,0 +1,243 @@
+"""预先创建的qcow文件池
+
+创建快照存储时需要新的qcow文件（首个快照、磁盘大小变化、父快照正在写入等情况），镜像服务创建文件的耗时计入
+create_snapshot 的延迟，在整点等备份集中的时刻尤为明显
+文件池在后台按 (文件夹, 磁盘大小) 预先创建不包含快照点的空文件，ImagePathGenerator.generate_new_qcow 优先取用
+
+    1. 文件池中的文件记录在 qcow_pool_file 表中，取用时在创建快照存储的数据库事务中删除记录
+       事务提交后文件归快照存储所有，由回收逻辑删除；事务回滚时文件仍归文件池所有
+    2. 各 (文件夹, 磁盘大小) 的文件数量由观察到的需求决定：统计最近 history_buckets 个时间段中每段的取用次数
+       （包括文件池为空时的取用），目标数量为其最大值，不超过 max_per_key ，总数不超过 max_total
+    3. 补充文件时先登记为 creating 并提交，创建完成后修改为 ready ；删除多余文件时先修改为 deleting 并提交，删除完成后
+       删除记录。服务启动时，删除 creating 与 deleting 状态的记录及其文件，异常退出不会遗留无主的文件
+    4. 需求统计保存在内存中，服务启动后经过完整的统计时长才会删除多余的文件
+"""
+import os
+import threading
+import time
+import typing
+import uuid
+
+from cpkt.core import xlogging as lg
+
+from business_logic import storage_action as action
+from data_access import models as m
+from data_access import qcow_pool as da_pool
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+
+class QcowPool(threading.Thread):
+    """按需求预先创建qcow文件
+
+    :remark:
+        max_per_key 为 0 时不预先创建文件，generate_new_qcow 总是生成新的文件名
+    """
+
+    def __init__(self, max_per_key=0, max_total=64, bucket_seconds=300, history_buckets=288, interval_seconds=5):
+        super(QcowPool, self).__init__(name='qcow_pool', daemon=True)
+        self.max_per_key = max_per_key
+        self.max_total = max_total
+        self.bucket_seconds = bucket_seconds
+        self.history_buckets = history_buckets
+        self.interval_seconds = interval_seconds
+        self._demand: typing.Dict[typing.Tuple[str, int], typing.Dict[int, int]] = dict()  # 键 -> {时间段: 取用次数}
+        self._locker = threading.Lock()
+        self._wakeup = threading.Event()
+        self._quit = threading.Event()
+        self._started_at = time.monotonic()
+        self._raw_flag = action.DiskSnapshotAction.generate_flag('qcow pool')
+
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.removed = 0
+        self.failures = 0
+
+    def __str__(self):
+        return f'qcow_pool:<{self.max_per_key} per key,{self.max_total} max>'
+
+    def _current_bucket(self) -> int:
+        return int(time.monotonic() // self.bucket_seconds)
+
+    def take(self, folder: str, disk_bytes: int) -> typing.Union[str, None]:
+        """取出一个可用的文件，需要在创建快照存储的数据库事务中调用，参考 ImagePathGenerator.generate_new_qcow"""
+        if self.max_per_key <= 0:
+            return None
+
+        key, bucket = (folder, int(disk_bytes),), self._current_bucket()
+        with self._locker:
+            buckets = self._demand.setdefault(key, dict())
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+
+        path = da_pool.take_ready_path(folder, disk_bytes)
+        with self._locker:
+            if path:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._wakeup.set()
+        _logger.debug('take %s %s : %s', folder, disk_bytes, path)
+        return path
+
+    def targets(self) -> typing.Dict[typing.Tuple[str, int], int]:
+        """各 (文件夹, 磁盘大小) 的目标文件数量"""
+        oldest = self._current_bucket() - self.history_buckets + 1
+        with self._locker:
+            for key in list(self._demand):
+                buckets = {k: v for k, v in self._demand[key].items() if k >= oldest}
+                if buckets:
+                    self._demand[key] = buckets
+                else:
+                    del self._demand[key]
+            peaks = {key: min(self.max_per_key, max(buckets.values())) for key, buckets in self._demand.items()}
+
+        result, total = dict(), 0
+        for key, peak in sorted(peaks.items(), key=lambda item: item[1], reverse=True):  # 需求大的优先
+            result[key] = max(0, min(peak, self.max_total - total))
+            total += result[key]
+        return result
+
+    @property
+    def _history_complete(self) -> bool:
+        return time.monotonic() - self._started_at >= self.bucket_seconds * self.history_buckets
+
+    def _remove_file(self, file_obj_id: int, path: str) -> bool:
+        if os.path.exists(path) and not action.DiskSnapshotAction.remove_qcow_file(path):
+            _logger.warning(f'{self} remove {path} failed')
+            return False
+        with s.transaction():
+            da_pool.delete_obj(file_obj_id)
+        return True
+
+    @s.scoped_session_thread
+    def recover(self):
+        """删除创建中或删除中的文件，服务启动时调用"""
+        with s.transaction():
+            file_objs = [(file_obj.id, file_obj.path,) for file_obj in
+                         (da_pool.query_objs_by_status(m.QcowPoolFile.STATUS_CREATING)
+                          + da_pool.query_objs_by_status(m.QcowPoolFile.STATUS_DELETING))]
+        for file_obj_id, path in file_objs:
+            _logger.info(f'{self} recover {path}')
+            self._remove_file(file_obj_id, path)
+
+    def _create_file(self, folder: str, disk_bytes: int) -> bool:
+        path = os.path.join(folder, (uuid.uuid4().hex + '.qcow'))  # 与 generate_new_qcow 生成的文件名相同
+        with s.transaction():
+            file_obj_id = da_pool.create_obj(path, folder, disk_bytes).id
+        try:
+            action.DiskSnapshotAction.precreate_qcow_file(path, disk_bytes, self._raw_flag)
+            with s.transaction():
+                assert da_pool.update_status(
+                    file_obj_id, m.QcowPoolFile.STATUS_CREATING, m.QcowPoolFile.STATUS_READY
+                ), ('预创建qcow文件失败', f'status of {path} changed', 0)
+        except Exception as e:
+            _logger.warning(f'{self} create {path} failed : {e}')
+            with self._locker:
+                self.failures += 1
+            self._remove_file(file_obj_id, path)
+            return False
+
+        with self._locker:
+            self.created += 1
+        return True
+
+    @s.scoped_session_thread
+    def refill(self):
+        """补充文件至目标数量，同一键创建失败后本轮不再重试"""
+        if self.max_per_key <= 0:
+            return
+        with s.readonly():
+            counts = da_pool.query_ready_counts()
+        for (folder, disk_bytes), target in self.targets().items():
+            for _ in range(target - counts.get((folder, disk_bytes), 0)):
+                if self._quit.is_set() or not self._create_file(folder, disk_bytes):
+                    break
+
+    @s.scoped_session_thread
+    def shrink(self, force=False):
+        """删除超出目标数量的文件，force 为 True 时不等待需求统计完整"""
+        if not (force or self._history_complete):
+            return
+        targets = self.targets()
+        with s.readonly():
+            file_objs = [(file_obj.id, file_obj.path, (file_obj.folder, int(file_obj.disk_bytes),),) for file_obj in
+                         da_pool.query_objs_by_status(m.QcowPoolFile.STATUS_READY)]
+        kept = dict()
+        for file_obj_id, path, key in file_objs:  # 保留最早创建的文件
+            kept[key] = kept.get(key, 0) + 1
+            if kept[key] <= targets.get(key, 0):
+                continue
+            with s.transaction():
+                if not da_pool.update_status(file_obj_id, m.QcowPoolFile.STATUS_READY, m.QcowPoolFile.STATUS_DELETING):
+                    continue  # 已被取用
+            if self._remove_file(file_obj_id, path):
+                with self._locker:
+                    self.removed += 1
+
+    def to_dict(self) -> dict:
+        with s.readonly():
+            ready = sum(da_pool.query_ready_counts().values())
+        lookups = self.hits + self.misses
+        with self._locker:
+            return {
+                'ready': ready,
+                'max_per_key': self.max_per_key,
+                'max_total': self.max_total,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'created': self.created,
+                'removed': self.removed,
+                'failures': self.failures,
+            }
+
+    def stop(self):
+        self._quit.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        _logger.info(f'{self} start')
+        try:
+            self.recover()
+        except Exception as e:
+            _logger.error(f'{self} recover failed : {e}')
+        while not self._quit.is_set():
+            try:
+                self.refill()
+                self.shrink()
+            except Exception as e:
+                _logger.error(f'{self} refill failed : {e}')
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+
+
+_qcow_pool: QcowPool = None
+_qcow_pool_locker = threading.Lock()
+
+
+def get_qcow_pool() -> QcowPool:
+    global _qcow_pool
+
+    if _qcow_pool is None:
+        with _qcow_pool_locker:
+            if _qcow_pool is None:
+                _qcow_pool = QcowPool()
+                action.ImagePathGenerator.qcow_file_provider = _take
+    return _qcow_pool
+
+
+def configure(max_per_key, max_total, bucket_seconds) -> QcowPool:
+    qcow_pool = get_qcow_pool()
+    qcow_pool.max_per_key, qcow_pool.max_total, qcow_pool.bucket_seconds = max_per_key, max_total, bucket_seconds
+    _logger.info(f'{qcow_pool} configured, bucket {bucket_seconds}s')
+    return qcow_pool
+
+
+def _take(folder: str, disk_bytes: int) -> typing.Union[str, None]:
+    if _qcow_pool is None:
+        return None
+    return _qcow_pool.take(folder, disk_bytes)
@@ -0,0 +1,212 @@
+"""原生读句柄缓存
+
+ImgService4R.open 的耗时随快照存储链的关键节点数量增长，校验作业会反复打开同一个磁盘的最新快照
+读句柄关闭时原生句柄不立即关闭，而是以快照存储链的关键节点为键放入缓存，之后打开相同关键节点的读句柄直接复用
+
+    1. 缓存中的原生句柄在 StorageReferenceManager 中登记读取记录，回收逻辑不会删除其依赖的快照存储
+    2. 快照存储链中任意节点的状态或父节点发生变化（例如被销毁、合并）时，相关的缓存项失效
+       失效在数据库事务与存储锁内发生，原生句柄在锁空间外关闭（下一次使用缓存时，或后台线程中）
+    3. 缓存项数量超过 max_entries 时淘汰最久未使用的项，空闲超过 idle_seconds 的项由后台线程关闭
+    4. 原生句柄同一时刻仅由一个读句柄使用；使用中的缓存项失效时，归还后关闭
+"""
+import collections
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+from basic_library import xfunctions as xf
+from business_logic import storage
+from business_logic import storage_action as action
+from business_logic import storage_chain as chain
+from business_logic import storage_reference_manager as srm
+
+_logger = lg.get_logger(__name__)
+
+
+class CacheEntry(object):
+
+    def __init__(self, key: tuple, idents: typing.Set[str], raw_handle: int, ice_endpoint: str):
+        self.key = key
+        self.idents = idents  # 快照存储链上的所有节点，任一节点变化时失效
+        self.raw_handle = raw_handle
+        self.ice_endpoint = ice_endpoint
+        self.name = f'raw handle cache | {xf.generate_unique_number(xf.UNIQUE_NUMBER_STORAGE_CHAIN)} | {raw_handle}'
+        self.last_used = time.monotonic()
+        self.in_use = True
+        self.invalid = False
+
+    def __str__(self):
+        return f'{self.name} | {self.ice_endpoint} | {self.key}'
+
+
+class RawHandleCache(threading.Thread):
+    """LRU 原生读句柄缓存
+
+    :remark:
+        max_entries 为 0 时不缓存，读句柄关闭时直接关闭原生句柄
+    """
+
+    def __init__(self, max_entries=0, idle_seconds=300, interval_seconds=5):
+        super(RawHandleCache, self).__init__(name='raw_handle_cache', daemon=True)
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.interval_seconds = interval_seconds
+        self._idle: typing.Dict[str, CacheEntry] = collections.OrderedDict()  # 按最近使用排序的空闲项
+        self._in_use: typing.Dict[str, CacheEntry] = dict()
+        self._closing: typing.List[CacheEntry] = list()  # 已失效，等待在锁空间外关闭
+        self._locker = threading.Lock()
+        self._quit = threading.Event()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __str__(self):
+        return f'raw_handle_cache:<{len(self._idle)} idle,{len(self._in_use)} in use,{self.max_entries} max>'
+
+    @staticmethod
+    def generate_key(acquired_chain: chain.StorageChainForRead) -> tuple:
+        return (tuple((item.image_path, item.ident,) for item in acquired_chain.key_storage_items),
+                None if acquired_chain.timestamp is None else str(acquired_chain.timestamp),)
+
+    def open(self, acquired_chain: chain.StorageChainForRead, raw_flag) -> typing.Tuple[int, str, CacheEntry]:
+        """返回原生句柄、镜像服务端点与缓存项，不缓存时缓存项为 None"""
+        self.close_pending()
+        if self.max_entries <= 0:
+            return action.DiskSnapshotAction.open_disk_snapshot(acquired_chain, raw_flag) + (None,)
+
+        key = self.generate_key(acquired_chain)
+        with self._locker:
+            for name, entry in reversed(self._idle.items()):
+                if entry.key == key:
+                    del self._idle[name]
+                    entry.in_use, entry.last_used = True, time.monotonic()
+                    self._in_use[name] = entry
+                    self.hits += 1
+                    return entry.raw_handle, entry.ice_endpoint, entry
+            self.misses += 1
+
+        raw_handle, ice_endpoint = action.DiskSnapshotAction.open_disk_snapshot(acquired_chain, raw_flag)
+        entry = CacheEntry(key, {item.ident for item in acquired_chain.storage_items}, raw_handle, ice_endpoint)
+        srm.get_srm().add_reading_record(entry.name, acquired_chain.key_storage_items)
+        with self._locker:
+            self._in_use[entry.name] = entry
+        _logger.info('%s opened', str(entry))
+        return raw_handle, ice_endpoint, entry
+
+    def release(self, entry: CacheEntry):
+        """读句柄关闭时归还原生句柄"""
+        with self._locker:
+            self._in_use.pop(entry.name, None)
+            entry.in_use, entry.last_used = False, time.monotonic()
+            if entry.invalid or self.max_entries <= 0:
+                self._closing.append(entry)
+            else:
+                self._idle[entry.name] = entry
+                while len(self._idle) > self.max_entries:
+                    self._closing.append(self._idle.popitem(last=False)[1])
+                    self.evictions += 1
+        self.close_pending()
+
+    def invalidate(self, storage_ident: str):
+        """快照存储发生变化，在锁空间内调用，不关闭原生句柄"""
+        with self._locker:
+            for name, entry in list(self._idle.items()):
+                if storage_ident in entry.idents:
+                    del self._idle[name]
+                    entry.invalid = True
+                    self._closing.append(entry)
+                    self.invalidations += 1
+            for entry in self._in_use.values():
+                if storage_ident in entry.idents and not entry.invalid:
+                    entry.invalid = True
+                    self.invalidations += 1
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._locker:
+            for name, entry in list(self._idle.items()):
+                if now - entry.last_used >= self.idle_seconds:
+                    del self._idle[name]
+                    self._closing.append(entry)
+                    self.evictions += 1
+
+    def close_pending(self):
+        with self._locker:
+            entries, self._closing = self._closing, list()
+        for entry in entries:
+            try:
+                action.DiskSnapshotAction.close_disk_snapshot(entry.raw_handle, entry.ice_endpoint)
+                _logger.info('%s closed', str(entry))
+            except Exception as e:
+                _logger.warning(f'close {entry} failed : {e}')
+            finally:
+                srm.get_srm().remove_reading_record(entry.name)
+
+    def clear(self):
+        with self._locker:
+            self._closing.extend(self._idle.values())
+            self._idle.clear()
+            for entry in self._in_use.values():
+                entry.invalid = True
+        self.close_pending()
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        with self._locker:
+            return {
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def stop(self):
+        self._quit.set()
+        if self.is_alive():
+            self.join()
+        self.clear()
+
+    def run(self):
+        _logger.info(f'{self} start')
+        while not self._quit.wait(self.interval_seconds):
+            try:
+                self.evict_idle()
+                self.close_pending()
+            except Exception as e:
+                _logger.error(f'{self} evict failed : {e}')
+
+
+_raw_handle_cache: RawHandleCache = None
+_raw_handle_cache_locker = threading.Lock()
+
+
+def get_raw_handle_cache() -> RawHandleCache:
+    global _raw_handle_cache
+
+    if _raw_handle_cache is None:
+        with _raw_handle_cache_locker:
+            if _raw_handle_cache is None:
+                _raw_handle_cache = RawHandleCache()
+                storage.add_change_listener(_on_storage_changed)
+    return _raw_handle_cache
+
+
+def configure(max_entries, idle_seconds) -> RawHandleCache:
+    cache = get_raw_handle_cache()
+    cache.max_entries, cache.idle_seconds = max_entries, idle_seconds
+    _logger.info(f'{cache} configured, idle {idle_seconds}s')
+    return cache
+
+
+def _on_storage_changed(storage_ident: str, tree_ident: str):
+    _ = tree_ident
+    if _raw_handle_cache is not None:
+        _raw_handle_cache.invalidate(storage_ident)
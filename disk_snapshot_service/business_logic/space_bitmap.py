@@ -0,0 +1,91 @@
+"""快照存储的数据块位图文件
+
+文件格式（由镜像服务在写入快照存储时生成，与镜像文件在同一目录中，文件名参考 ImagePathGenerator.generate_map）：
+    磁盘按 BLOCK_BYTES 划分数据块，每个数据块对应一位，第 N 个字节的第 i 位（低位在前）对应第 N * 8 + i 个数据块
+    置位表示快照存储写入了该数据块（相对父快照存储的增量数据）
+    文件末尾的全零字节可以省略，即文件长度可以小于磁盘对应的字节数量
+    同名的 .snmap 与 .binmap 为镜像服务内部使用的文件，不在此读取
+"""
+
+import os
+import typing
+
+import numpy as np
+from cpkt.core import xlogging as lg
+
+from business_logic import hash_file
+
+_logger = lg.get_logger(__name__)
+
+BLOCK_BYTES = hash_file.BLOCK_BYTES
+BITMAP_DTYPE = np.dtype('u1')
+
+CHUNK_BYTES = 4 * 1024 * 1024  # 每次处理的字节数量，对应 2TB 磁盘空间
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+
+def blocks_count(disk_bytes: int) -> int:
+    """磁盘大小对应的数据块数量"""
+    return (disk_bytes + BLOCK_BYTES - 1) // BLOCK_BYTES
+
+
+def bitmap_bytes(disk_bytes: int) -> int:
+    """磁盘大小对应的位图字节数量"""
+    return (blocks_count(disk_bytes) + 7) // 8
+
+
+def open_bitmap(path: str) -> np.ndarray:
+    """以内存映射的方式只读打开位图文件"""
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, BITMAP_DTYPE)
+    return np.memmap(path, BITMAP_DTYPE, 'r')
+
+
+def write_bitmap(path: str, blocks: np.ndarray):
+    """将每个数据块是否写入（bool 数组）保存为位图文件，先写入临时文件，完成后替换目标文件"""
+    tmp_path = f'{path}.writing'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(np.packbits(np.asarray(blocks, bool), bitorder='little').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _popcount(chunk: np.ndarray) -> int:
+    return int(_POPCOUNT[chunk].sum(dtype=np.int64))
+
+
+def count_blocks(bitmap: np.ndarray, disk_bytes: int, chunk_bytes: int = CHUNK_BYTES) -> int:
+    """位图中置位的数据块数量，忽略超出磁盘大小的部分"""
+    total = min(len(bitmap), bitmap_bytes(disk_bytes))
+    result = 0
+    for begin in range(0, total, chunk_bytes):
+        result += _popcount(bitmap[begin:min(begin + chunk_bytes, total)])
+    return result
+
+
+def count_shadowed_blocks(bitmap: np.ndarray, children_bitmaps: typing.List[np.ndarray], disk_bytes: int,
+                          chunk_bytes: int = CHUNK_BYTES) -> int:
+    """位图中置位、且所有子位图中均置位的数据块数量
+
+    :remark:
+        这些数据块被所有子快照存储覆盖，打开子快照存储时不会读取，合并时无需搬迁
+    """
+    if not children_bitmaps:
+        return 0
+    # 超出任一位图文件长度的部分均为零，无需处理
+    total = min([len(bitmap)] + [len(child) for child in children_bitmaps] + [bitmap_bytes(disk_bytes)])
+    result = 0
+    for begin in range(0, total, chunk_bytes):
+        end = min(begin + chunk_bytes, total)
+        chunk = np.array(bitmap[begin:end], BITMAP_DTYPE)
+        for child in children_bitmaps:
+            chunk &= child[begin:end]
+        result += _popcount(chunk)
+    return result
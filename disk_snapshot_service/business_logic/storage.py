@@ -2,11 +2,29 @@ import typing
 
 from cpkt.core import xlogging as lg
 
+from data_access import hash as da_hash
 from data_access import models as m
 from data_access import storage
 
 _logger = lg.get_logger(__name__)
 
+_change_listeners: typing.List[typing.Callable[[str, str], None]] = list()
+
+
+def add_change_listener(listener: typing.Callable[[str, str], None]):
+    """快照存储的状态或父节点变化时，以快照存储 ident 与所在的快照存储树 tree_ident 调用 listener
+
+    :remark:
+        在数据库事务与存储锁内调用，listener 不可有 IO
+    """
+    if listener not in _change_listeners:
+        _change_listeners.append(listener)
+
+
+def _notify_changed(storage_ident: str, tree_ident: str):
+    for listener in _change_listeners:
+        listener(storage_ident, tree_ident)
+
 
 class StorageItem(object):
     """快照存储元素项
@@ -80,7 +98,8 @@ class Storage(object):
     def update_status(self, new_status):
         old_status = self.status
         storage.update_obj_status(self.storage_obj, new_status)
-        _logger.info(f'update [{self.ident}] status from {old_status} to {self.status}')
+        _notify_changed(self.ident, self.tree_ident)
+        _logger.info('update [%s] status from %s to %s', self.ident, old_status, self.status)
 
     def update_parent(self, parent_storage):
         old_parent_ident = self.parent_ident
@@ -88,7 +107,12 @@ class Storage(object):
             storage.update_obj_parent(self.storage_obj, parent_storage.storage_obj)
         else:
             storage.update_obj_parent(self.storage_obj, None)
-        _logger.info(f'update [{self.ident}] parent from {old_parent_ident} to {self.parent_ident}')
+        _notify_changed(self.ident, self.tree_ident)
+        _logger.info('update [%s] parent from %s to %s', self.ident, old_parent_ident, self.parent_ident)
+
+    def update_new_storage_size(self, new_storage_size):
+        """快照存储写入的数据量，参考 storage_space"""
+        storage.update_obj_values(self.storage_obj, {'new_storage_size': new_storage_size})
 
     @property
     def ident(self):
@@ -159,9 +183,119 @@ def query_by_ident(ident: str) -> typing.Union[Storage, None]:
         return None
 
 
+def query_items_by_status(status, limit=None) -> typing.List[StorageItem]:
+    return [StorageItem(o) for o in storage.query_objs_by_status(status, limit)]
+
+
+def query_interrupted_rows() -> typing.List[typing.Tuple[str, str]]:
+    """创建或写入过程被服务退出中断的快照存储 [(ident, tree_ident), ...]，参考 startup_recovery"""
+    return [(ident, tree_ident) for ident, tree_ident in storage.query_interrupted_rows()]
+
+
+def query_tree_idents_by_status(status, storage_type, limit) -> typing.List[str]:
+    return storage.query_tree_idents_by_status(status, storage_type, limit)
+
+
+def update_status_in_bulk(rows: typing.List[typing.Tuple[str, str]], new_status, batch_size=500) -> int:
+    """批量修改快照存储的状态，rows 为 [(ident, tree_ident), ...]
+
+    :return: 修改的数量
+    """
+    updated = 0
+    for begin in range(0, len(rows), batch_size):
+        updated += storage.update_status_in_bulk([ident for ident, _ in rows[begin:begin + batch_size]], new_status)
+    for ident, tree_ident in rows:
+        _notify_changed(ident, tree_ident)
+    _logger.info('update %s storages status to %s in bulk', updated, new_status)
+    return updated
+
+
+class HashItem(object):
+    """快照存储的hash文件元素项
+
+    数据库对象不能保证线程安全，从数据库对象中复制数据作全局使用
+    """
+
+    def __init__(self, hash_obj: m.Hash):
+        self._id = hash_obj.id
+        self._storage_ident = hash_obj.storage_ident
+        self._version = hash_obj.version
+        self._type = hash_obj.type
+        self._path = hash_obj.path
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return f'Hash: {self._storage_ident}-{self._version}-{self._type}-{self._path}'
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def storage_ident(self):
+        return self._storage_ident
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def is_full(self):
+        return self._type == m.Hash.TYPE_FULL
+
+
+def create_hash(storage_ident, version, hash_type, path):
+    hash_obj = da_hash.create_obj(storage_ident, version, hash_type, path)
+    _logger.info(f'new hash obj created : <{storage_ident} {hash_obj.type} {hash_obj.path}>')
+    return hash_obj
+
+
+def query_hash(storage_ident) -> typing.Union[HashItem, None]:
+    hash_obj = da_hash.get_last_obj_by_storage_ident(storage_ident)
+    if hash_obj:
+        return HashItem(hash_obj)
+    else:
+        return None
+
+
+def query_hashes_by_storage_status(status) -> typing.List[HashItem]:
+    return [HashItem(o) for o in da_hash.query_objs_by_storage_status(status)]
+
+
+def update_hash_type(storage_ident, hash_type):
+    hash_obj = da_hash.get_last_obj_by_storage_ident(storage_ident)
+    da_hash.update_obj_type(hash_obj, hash_type)
+    _logger.info(f'update hash [{storage_ident}] type to {hash_type}')
+
+
+def generate_hash_type(storage_obj: Storage) -> str:
+    """与父快照存储在同一文件中时，hash文件仅包含本快照点的变更数据"""
+    if storage_obj.parent_ident:
+        parent_storage = query_by_ident(storage_obj.parent_ident)
+        if parent_storage.is_qcow and parent_storage.image_path == storage_obj.image_path:
+            return m.Hash.TYPE_INCREMENT
+    return m.Hash.TYPE_FULL
+
+
 def is_image_path_using(image_path) -> bool:
     return storage.query_image_path_using_count(image_path) != 0
 
 
 def count_exist_in_file(image_path) -> int:
     return storage.query_image_path_exist_count(image_path)
+
+
+def query_parents_in_tree(tree_ident) -> typing.Dict[str, typing.Tuple[str, str]]:
+    """快照存储树中有效的快照存储 {ident: (parent_ident, image_path), ...}"""
+    return {ident: (parent_ident, image_path) for ident, parent_ident, image_path in
+            storage.query_parent_rows(tree_ident)}
@@ -1,3 +1,4 @@
+import decimal
 import os
 import typing
 import uuid
@@ -7,6 +8,7 @@ from cpkt.core import rt
 from cpkt.core import xlogging as lg
 from cpkt.rpc import ice
 
+from business_logic import hash_file
 from business_logic import storage
 from business_logic import storage_chain as chain
 from business_logic import storage_reference_manager as srm
@@ -16,11 +18,16 @@ from ice_service import service
 _logger = lg.get_logger(__name__)
 
 
+def format_cdp_timestamp(timestamp) -> str:
+    """CDP快照点名称，读取到该时间点（精确到微秒）的数据"""
+    return '{:.6f}'.format(decimal.Decimal(timestamp))
+
+
 def _to_img_ident(storage_item: storage.StorageItem, timestamp=None):
     if storage_item.is_qcow:
         return ice.IMG.ImageSnapshotIdent(storage_item.image_path, storage_item.ident)
-    if timestamp:  # TODO
-        assert False, ('TODO ', 'TODO', 0)
+    if timestamp is not None:
+        return ice.IMG.ImageSnapshotIdent(storage_item.image_path, format_cdp_timestamp(timestamp))
     else:
         return ice.IMG.ImageSnapshotIdent(storage_item.image_path, 'all')
 
@@ -39,7 +46,8 @@ class DiskSnapshotAction(object):
         write_img_prx = service.get_write_img_prx()
         handle = write_img_prx.create(
             _to_img_ident(new_storage_item),
-            [_to_img_ident(item) for item in chain_for_create.key_storage_items[:-1]],
+            [_to_img_ident(item, chain_for_create.cdp_timestamp(item))
+             for item in chain_for_create.key_storage_items[:-1]],
             new_storage_item.disk_bytes,
             raw_flag
         )
@@ -74,24 +82,52 @@ class DiskSnapshotAction(object):
     def open_disk_snapshot(acquired_chain: chain.StorageChain, raw_flag):
         read_img_prx = service.get_read_img_prx()
         return read_img_prx.open(
-            [_to_img_ident(item) for item in acquired_chain.key_storage_items],
+            [_to_img_ident(item, acquired_chain.cdp_timestamp(item)) for item in acquired_chain.key_storage_items],
             raw_flag
         ), service.convert_proxy_to_string(read_img_prx)
 
+    @staticmethod
+    def hash_qcow_snapshot(acquired_chain: chain.StorageChain, raw_flag, hash_path, hash_version):
+        """读取快照存储链中最后一个快照点的数据，生成hash文件"""
+        pass
+
+    @staticmethod
+    def fixup_qcow_hash(acquired_chain: chain.StorageChain, raw_flag, hash_path, hash_version):
+        """修正写入者生成的hash文件，仅重新计算写入者未能覆盖的数据块"""
+        pass
+
     @staticmethod
     def move_data_from_qcow(source_storage: storage.Storage, target_chain: chain.StorageChain, raw_flag,
-                            hash_version=0):
+                            hash_version=0, begin_bytes=0, end_bytes=None):
+        """搬迁 [begin_bytes, end_bytes) 区间的数据，end_bytes 为 None 时表示到磁盘末尾"""
         pass
 
     @staticmethod
     def merge_cdp_to_qcow(rw_chain: chain.StorageChain, merge_cdp_snapshot_storages: typing.List[storage.Storage],
-                          raw_flag, hash_version=0):
+                          raw_flag, hash_version=0, begin_bytes=0, end_bytes=None):
+        """合并 [begin_bytes, end_bytes) 区间的数据，end_bytes 为 None 时表示到磁盘末尾"""
         pass
 
     @staticmethod
-    def merge_qcow_hash(children_snapshot_storage: typing.List[storage.Storage], merge_storage: storage.Storage,
-                        hash_version=0):
-        pass
+    def merge_qcow_hash(children_hash: typing.List[typing.Union[storage.HashItem, None]],
+                        merge_hash: typing.Union[storage.HashItem, None], disk_bytes) -> typing.List[str]:
+        """将被合并快照点的hash数据叠加到子快照点的增量hash文件中
+
+        :return: 叠加了hash数据的子快照存储
+        """
+        if merge_hash is None:
+            return list()  # 被合并的快照点没有hash数据
+
+        merged_idents = list()
+        count = hash_file.records_count(disk_bytes)
+        for child_hash in children_hash:
+            if child_hash is None or child_hash.is_full:
+                continue  # 子快照没有hash数据，或具有全量数据hash，无需合并hash数据
+            assert child_hash.version == merge_hash.version, (
+                'hash文件版本不一致', f'merge hash version {merge_hash} != {child_hash}', 0)
+            hash_file.overlay(merge_hash.path, child_hash.path, count)
+            merged_idents.append(child_hash.storage_ident)
+        return merged_idents
 
     @staticmethod
     def delete_qcow_snapshot(file_path, snapshot_name):
@@ -126,6 +162,11 @@ class DiskSnapshotAction(object):
 
         return True
 
+    @staticmethod
+    def precreate_qcow_file(file_path, disk_bytes, raw_flag):
+        """创建不包含快照点的空QCOW文件，之后在该文件中创建的首个快照点的磁盘大小必须为 disk_bytes"""
+        pass
+
     @staticmethod
     def remove_qcow_file(file_path) -> bool:
         """删除QCOW文件，及其相关辅助文件"""
@@ -151,7 +192,71 @@ class DiskSnapshotAction(object):
         return True
 
 
+class QcowPackingPolicy(object):
+    """限制单个qcow文件复用的程度
+
+    :remark:
+        每日备份的磁盘会在同一文件中持续创建快照点，文件中的快照点数量、文件大小与文件内的快照链深度无限增长
+        镜像服务打开快照点与还原时读取的元数据随之增长，达到任一上限后在新文件中创建快照点
+        max_snapshots_per_file : 文件中未删除的快照点数量
+        max_chain_depth : 文件内以父快照点结束的连续快照链长度
+        max_file_bytes : 文件大小
+        为 0 时表示不限制
+    """
+
+    def __init__(self, max_snapshots_per_file=0, max_chain_depth=0, max_file_bytes=0):
+        self.max_snapshots_per_file = max_snapshots_per_file
+        self.max_chain_depth = max_chain_depth
+        self.max_file_bytes = max_file_bytes
+
+    def __str__(self):
+        return (f'qcow_packing_policy:<{self.max_snapshots_per_file} snapshots,{self.max_chain_depth} depth,'
+                f'{self.max_file_bytes} bytes>')
+
+    @staticmethod
+    def _chain_depth_in_file(parent_storage_obj: m.SnapshotStorage, max_depth) -> int:
+        """最多计算 max_depth 个节点；一次查询快照存储树的父子关系，在内存中沿父节点回溯"""
+        if max_depth <= 1 or not parent_storage_obj.parent_ident:
+            return 1
+        parents = storage.query_parents_in_tree(parent_storage_obj.tree_ident)
+        depth, parent_ident = 1, parent_storage_obj.parent_ident
+        while depth < max_depth and parent_ident in parents:
+            parent_ident, image_path = parents[parent_ident]
+            if image_path != parent_storage_obj.image_path:
+                break
+            depth += 1
+        return depth
+
+    @staticmethod
+    def _file_bytes(image_path) -> int:
+        try:
+            return os.path.getsize(image_path)
+        except OSError:
+            return 0
+
+    def exceeded(self, parent_storage_obj: m.SnapshotStorage) -> typing.Union[str, None]:
+        """父快照存储所在的文件不可继续使用时返回原因"""
+        image_path = parent_storage_obj.image_path
+        if self.max_snapshots_per_file > 0:
+            count = storage.count_exist_in_file(image_path)
+            if count >= self.max_snapshots_per_file:
+                return f'{count} snapshots in file'
+        if self.max_chain_depth > 0:
+            depth = self._chain_depth_in_file(parent_storage_obj, self.max_chain_depth)
+            if depth >= self.max_chain_depth:
+                return f'chain depth {depth} in file'
+        if self.max_file_bytes > 0:
+            file_bytes = self._file_bytes(image_path)
+            if file_bytes >= self.max_file_bytes:
+                return f'file {file_bytes} bytes'
+        return None
+
+
 class ImagePathGenerator(object):
+    # 复用父快照存储所在文件的限制，参考 QcowPackingPolicy
+    packing_policy = QcowPackingPolicy()
+    # 预先创建的qcow文件的提供者，(folder, disk_bytes) -> path or None ，参考 business_logic.qcow_pool
+    qcow_file_provider: typing.Callable[[str, int], typing.Union[str, None]] = None
 
     @staticmethod
     def generate_cdp(folder, new_ident):
@@ -159,10 +264,22 @@ class ImagePathGenerator(object):
 
         return os.path.join(folder, (new_ident + '.cdp'))
 
+    @staticmethod
+    def generate_hash(image_path, storage_ident):
+        """生成快照点的hash文件名，与镜像文件在同一目录中，回收镜像文件时一并删除"""
+
+        return f'{image_path}_{storage_ident}.hash'
+
+    @staticmethod
+    def generate_map(image_path, storage_ident):
+        """快照存储的数据块位图文件名，由镜像服务生成，参考 space_bitmap"""
+
+        return f'{image_path}_{storage_ident}.map'
+
     @staticmethod
     def generate_qcow(parent_storage_obj: m.SnapshotStorage, folder, new_disk_bytes):
         if parent_storage_obj is None:
-            return ImagePathGenerator.generate_new_qcow(folder)
+            return ImagePathGenerator.generate_new_qcow(folder, new_disk_bytes)
 
         """
         需要创建新的文件的情况
@@ -170,6 +287,7 @@ class ImagePathGenerator(object):
         2. 如果与父的存储目录路径不同，
         3. 如果父文件不是qcow，
         4. 如果父文件正在创建或写入中，
+        5. 如果父文件已达到 packing_policy 的限制，
 
         其他情况
         1. 复用父快照文件 
@@ -180,12 +298,25 @@ class ImagePathGenerator(object):
                 or folder != os.path.split(parent_storage_obj.image_path)[0]
                 or srm.get_srm().is_storage_writing(parent_storage_obj.image_path)
         ):
-            return ImagePathGenerator.generate_new_qcow(folder)
-        else:
-            return parent_storage_obj.image_path
+            return ImagePathGenerator.generate_new_qcow(folder, new_disk_bytes)
+
+        exceeded = ImagePathGenerator.packing_policy.exceeded(parent_storage_obj)
+        if exceeded:
+            _logger.info(f'new qcow file for child of {parent_storage_obj}, {exceeded}')
+            return ImagePathGenerator.generate_new_qcow(folder, new_disk_bytes)
+        return parent_storage_obj.image_path
 
     @staticmethod
-    def generate_new_qcow(folder):
-        """生成一个指定文件夹中的文件名，后缀qcow"""
+    def generate_new_qcow(folder, new_disk_bytes=None):
+        """生成一个指定文件夹中的文件名，后缀qcow
+
+        :remark:
+            指定 new_disk_bytes 时优先使用预先创建的文件，需要在创建快照存储的数据库事务中调用
+        """
 
+        provider = ImagePathGenerator.qcow_file_provider
+        if new_disk_bytes and provider is not None:
+            path = provider(folder, new_disk_bytes)
+            if path:
+                return path
         return os.path.join(folder, (uuid.uuid4().hex + '.qcow'))
@@ -21,6 +21,8 @@ class StorageChain(abc.ABC):
         storage_obj均为只读，不应该发生写入操作
     """
 
+    abnormal_tail = False  # 链中最后一个节点是否可以为异常状态
+
     def __init__(self, reference_manager, caller_name: str, name_prefix: str, timestamp):
         self.timestamp = timestamp
         self._reference_manager: srm.StorageReferenceManager = reference_manager
@@ -28,6 +30,7 @@ class StorageChain(abc.ABC):
         self._storage_items: typing.List[storage.StorageItem] = list()  # 快照链上的所有存储对象
         self._valid = False
         self._key_storage_items: typing.List[storage.StorageItem] = None  # 快照链上的关键对象，打开快照时，仅需要这些对象
+        self._positions: typing.Dict[str, int] = None  # ident -> 在 _storage_items 中的位置
 
     def __del__(self):
         if self._valid:
@@ -64,7 +67,10 @@ class StorageChain(abc.ABC):
         storage_info_list_max_i = storage_items_count - 1
 
         for i, storage_item in enumerate(self._storage_items):
-            assert storage_item.status not in (m.SnapshotStorage.STATUS_DELETED, m.SnapshotStorage.STATUS_ABNORMAL,)
+            if i == storage_info_list_max_i and self.abnormal_tail:
+                assert storage_item.status != m.SnapshotStorage.STATUS_DELETED
+            else:
+                assert storage_item.status not in (m.SnapshotStorage.STATUS_DELETED, m.SnapshotStorage.STATUS_ABNORMAL,)
 
             if i == storage_info_list_max_i:
                 key_items.append(storage_item)  # 最后一个节点
@@ -82,6 +88,21 @@ class StorageChain(abc.ABC):
 
         return key_items
 
+    def cdp_timestamp(self, storage_item: storage.StorageItem):
+        """读取CDP快照存储的截止时间点，为 None 时读取全部数据
+
+        :remark:
+            链中最后一个节点为链的时间戳，其他节点为链中下一个节点的 parent_timestamp
+        """
+        if not storage_item.is_cdp:
+            return None
+        if self._positions is None or len(self._positions) != len(self._storage_items):
+            self._positions = {item.ident: i for i, item in enumerate(self._storage_items)}
+        i = self._positions[storage_item.ident]
+        if i == len(self._storage_items) - 1:
+            return self.timestamp
+        return self._storage_items[i + 1].parent_timestamp
+
     def insert_head(self, storage_obj: m.SnapshotStorage):
         assert not self._valid
         self._storage_items.insert(0, storage.StorageItem(storage_obj))
@@ -150,8 +171,11 @@ class StorageChainForWrite(StorageChain):
     :remark:
         链中的最后一个元素为将要写入数据的快照存储
         当写入文件是qcow时，该写入快照点不支持边读边写模式
+        回收逻辑删除异常的快照存储时，链中的最后一个元素为异常状态
     """
 
+    abnormal_tail = True
+
     def __init__(self, reference_manager, caller_name: str, timestamp=None):
         super(StorageChainForWrite, self).__init__(reference_manager, caller_name, 'w', timestamp)
         self._key_storage_items_for_write = None  # 关键快照存储链
@@ -159,7 +183,9 @@ class StorageChainForWrite(StorageChain):
     def _query_key_storage_items_for_write(self):
         """获取写入时的关键storage列表"""
         last_item = self._storage_items[-1]
-        assert last_item.status == m.SnapshotStorage.STATUS_CREATING
+        # 创建中的快照存储（写入数据），或回收中与异常的快照存储（删除数据）
+        assert last_item.status in (m.SnapshotStorage.STATUS_CREATING, m.SnapshotStorage.STATUS_RECYCLING,
+                                    m.SnapshotStorage.STATUS_ABNORMAL,)
         if last_item.is_cdp:
             return [last_item, ]
         else:
@@ -114,6 +114,16 @@ class StorageReferenceManager(object):
             self.is_storage_using.cache_clear()
             self.is_storage_writing.cache_clear()
 
+    def count_records(self) -> typing.Tuple[int, int, int]:
+        """返回 读取者数量, 读取引用的快照存储数量, 写入者数量"""
+
+        with self.reading_record_locker.gen_rlock():
+            readers = len(self.reading_record_dict)
+            reading = sum(len(record_list) for record_list in self.reading_record_dict.values())
+        with self.writing_record_locker.gen_rlock():
+            writers = len(self.writing_record_dict)
+        return readers, reading, writers
+
     def remove_writing_record(self, caller_name: str):
 
         assert caller_name
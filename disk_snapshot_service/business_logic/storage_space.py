@@ -0,0 +1,284 @@
+"""快照存储的空间统计
+
+回收逻辑与容量报表需要知道每个快照存储占用的空间，以及删除或合并快照存储后可以释放的空间
+从镜像服务生成的数据块位图文件统计（参考 space_bitmap），无需调用镜像服务
+    1. written_bytes ：快照存储写入的数据量，即位图中置位的数据块；位图文件不存在时使用 new_storage_size
+    2. reclaimable_bytes ：回收快照存储可以释放的数据量
+       叶子快照存储删除后释放全部写入的数据；非叶子快照存储合并后，被所有子快照存储覆盖的数据块无需搬迁，可以释放
+    3. unique_bytes ：快照存储中仍被读取的数据量，即 written_bytes - 合并时可以释放的数据量
+       子快照存储依赖CDP快照存储的某个时刻时，无法从位图判断覆盖关系，视为没有被覆盖
+    4. 位图在快照存储不再写入后不再变化，每个快照存储的统计结果缓存在内存中；快照存储树的汇总结果在快照存储树中的
+       快照存储变化时（例如 Hashing 转为 Storage 、合并作业完成后修改依赖关系）失效
+"""
+import collections
+import os
+import threading
+import typing
+
+from cpkt.core import xlogging as lg
+
+from business_logic import space_bitmap
+from business_logic import storage
+from business_logic import storage_action as action
+from business_logic import storage_tree as tree
+from data_access import models as m
+
+_logger = lg.get_logger(__name__)
+
+# 数据不再变化的快照存储，统计结果可以缓存
+STABLE_STATUS = (
+    m.SnapshotStorage.STATUS_HASHING,
+    m.SnapshotStorage.STATUS_STORAGE,
+    m.SnapshotStorage.STATUS_RECYCLING,
+)
+
+
+def read_written_bytes(image_path: str, storage_ident: str, disk_bytes: int) -> typing.Union[int, None]:
+    """从位图文件统计快照存储写入的数据量，位图文件不存在时返回 None
+
+    :remark:
+        有文件IO，不可在锁空间内调用
+    """
+    map_path = action.ImagePathGenerator.generate_map(image_path, storage_ident)
+    if not os.path.exists(map_path):
+        return None
+    return _blocks_to_bytes(space_bitmap.count_blocks(space_bitmap.open_bitmap(map_path), disk_bytes), disk_bytes)
+
+
+def read_written_bytes_or_none(image_path: str, storage_ident: str, disk_bytes: int,
+                               trace_msg: str) -> typing.Union[int, None]:
+    """同 read_written_bytes ，统计失败时返回 None
+
+    :remark:
+        快照存储关闭、计算hash、合并完成时记录 new_storage_size ，统计失败不影响这些逻辑，new_storage_size 保持为空
+    """
+    try:
+        return read_written_bytes(image_path, storage_ident, disk_bytes)
+    except Exception as e:
+        _logger.warning(f'{trace_msg} read written bytes of {storage_ident} failed : {e}')
+        return None
+
+
+def _blocks_to_bytes(blocks: int, disk_bytes: int) -> int:
+    return min(blocks * space_bitmap.BLOCK_BYTES, disk_bytes)  # 最后一个数据块可能不完整
+
+
+class SpaceNode(object):
+    """统计空间需要的快照存储数据，从数据库对象中复制，在锁空间外使用"""
+
+    __slots__ = ('ident', 'status', 'image_path', 'disk_bytes', 'new_storage_size', 'children_idents',
+                 'depend_with_timestamp',)
+
+    def __init__(self, node: tree.StorageNode):
+        storage_obj = node.storage
+        self.ident = storage_obj.ident
+        self.status = storage_obj.status
+        self.image_path = storage_obj.image_path
+        self.disk_bytes = storage_obj.disk_bytes
+        self.new_storage_size = storage_obj.new_storage_size
+        self.children_idents = tuple(sorted(child.ident for child in node.children))
+        self.depend_with_timestamp = any(child.storage.parent_timestamp is not None for child in node.children)
+
+    @property
+    def is_leaf(self):
+        return not self.children_idents
+
+    @property
+    def is_stable(self):
+        return self.status in STABLE_STATUS
+
+    @property
+    def map_path(self):
+        return action.ImagePathGenerator.generate_map(self.image_path, self.ident)
+
+
+class StorageSpaceItem(object):
+    """单个快照存储的空间统计，数据量为 None 时表示位图文件不存在，无法统计"""
+
+    __slots__ = ('ident', 'status', 'written_bytes', 'unique_bytes', 'reclaimable_bytes',)
+
+    def __init__(self, ident, status, written_bytes, unique_bytes, reclaimable_bytes):
+        self.ident = ident
+        self.status = status
+        self.written_bytes = written_bytes
+        self.unique_bytes = unique_bytes
+        self.reclaimable_bytes = reclaimable_bytes
+
+    def __str__(self):
+        return f'storage_space_item:<{self.ident},{self.written_bytes},{self.reclaimable_bytes}>'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class TreeSpace(object):
+    """一棵快照存储树的空间统计"""
+
+    def __init__(self, tree_ident: str, items: typing.List[StorageSpaceItem]):
+        self.tree_ident = tree_ident
+        self.items: typing.Dict[str, StorageSpaceItem] = {item.ident: item for item in items}
+        self.written_bytes = sum(item.written_bytes or 0 for item in items)
+        self.unique_bytes = sum(item.unique_bytes or 0 for item in items)
+        # 回收中的快照存储完成回收后可以释放的数据量
+        self.recycling_reclaimable_bytes = sum(item.reclaimable_bytes or 0 for item in items
+                                               if item.status == m.SnapshotStorage.STATUS_RECYCLING)
+        self.unknown_count = sum(1 for item in items if item.written_bytes is None)
+
+    def __str__(self):
+        return f'tree_space:<{self.tree_ident},{len(self.items)} storages,{self.written_bytes} bytes>'
+
+    def to_dict(self) -> dict:
+        return {
+            'storage_count': len(self.items),
+            'written_bytes': self.written_bytes,
+            'unique_bytes': self.unique_bytes,
+            'recycling_reclaimable_bytes': self.recycling_reclaimable_bytes,
+            'unknown_count': self.unknown_count,
+        }
+
+
+class StorageSpace(object):
+    """缓存快照存储与快照存储树的空间统计
+
+    :remark:
+        query_nodes 在存储锁与数据库事务内调用，build 读取位图文件，在锁空间外调用
+        生成期间快照存储树发生变化时，结果不再缓存
+    """
+
+    def __init__(self, max_trees=64):
+        self.max_trees = max_trees
+        self._trees: typing.Dict[str, TreeSpace] = collections.OrderedDict()
+        self._generations: typing.Dict[str, int] = collections.defaultdict(int)
+        self._written: typing.Dict[str, typing.Union[int, None]] = dict()
+        self._shadowed: typing.Dict[str, typing.Tuple[tuple, int]] = dict()  # ident -> (子快照存储, 被覆盖的数据量)
+        self._locker = threading.Lock()
+        self.builds = 0
+        self.bitmap_reads = 0
+
+    def __str__(self):
+        return f'storage_space:<{len(self._trees)} trees,{len(self._written)} storages>'
+
+    def get(self, tree_ident: str) -> typing.Union[TreeSpace, None]:
+        with self._locker:
+            tree_space = self._trees.get(tree_ident)
+            if tree_space is not None:
+                self._trees.move_to_end(tree_ident)
+            return tree_space
+
+    def query_nodes(self, tree_ident: str) -> typing.Tuple[int, typing.List[SpaceNode]]:
+        """在存储锁与数据库事务内调用
+
+        :return: (快照存储树的版本, 快照存储)
+        """
+        storage_tree = tree.generate(tree_ident)
+        with self._locker:
+            generation = self._generations[tree_ident]
+        return generation, [SpaceNode(node) for node in storage_tree.nodes_by_bfs]
+
+    def build(self, tree_ident: str, generation: int, nodes: typing.List[SpaceNode]) -> TreeSpace:
+        """在锁空间外调用，nodes 为 query_nodes 的结果"""
+        nodes_dict = {node.ident: node for node in nodes}
+        bitmaps = dict()  # 本次生成中打开的位图文件
+        tree_space = TreeSpace(tree_ident, [self._calc_item(node, nodes_dict, bitmaps) for node in nodes])
+        with self._locker:
+            self.builds += 1
+            if self._generations[tree_ident] == generation:
+                self._trees[tree_ident] = tree_space
+                while len(self._trees) > self.max_trees:
+                    self._trees.popitem(last=False)
+        _logger.debug('%s built', tree_space)
+        return tree_space
+
+    def _open_bitmap(self, node: SpaceNode, bitmaps: dict):
+        if node.ident not in bitmaps:
+            path = node.map_path
+            bitmaps[node.ident] = space_bitmap.open_bitmap(path) if os.path.exists(path) else None
+            self.bitmap_reads += 1
+        return bitmaps[node.ident]
+
+    def _calc_written(self, node: SpaceNode, bitmaps: dict) -> typing.Union[int, None]:
+        with self._locker:
+            if node.ident in self._written:
+                return self._written[node.ident]
+
+        bitmap = self._open_bitmap(node, bitmaps)
+        if bitmap is None:
+            written = node.new_storage_size
+        else:
+            written = _blocks_to_bytes(space_bitmap.count_blocks(bitmap, node.disk_bytes), node.disk_bytes)
+        if node.is_stable and bitmap is not None:
+            with self._locker:
+                self._written[node.ident] = written
+        return written
+
+    def _calc_shadowed(self, node: SpaceNode, nodes_dict: dict, bitmaps: dict) -> int:
+        if node.is_leaf or node.depend_with_timestamp:
+            return 0
+        with self._locker:
+            cached = self._shadowed.get(node.ident)
+            if cached is not None and cached[0] == node.children_idents:
+                return cached[1]
+
+        children = [nodes_dict[ident] for ident in node.children_idents]
+        bitmap = self._open_bitmap(node, bitmaps)
+        children_bitmaps = [self._open_bitmap(child, bitmaps) for child in children]
+        if bitmap is None or any(child_bitmap is None for child_bitmap in children_bitmaps):
+            return 0  # 无法判断覆盖关系
+
+        shadowed = _blocks_to_bytes(
+            space_bitmap.count_shadowed_blocks(bitmap, children_bitmaps, node.disk_bytes), node.disk_bytes)
+        if node.is_stable and all(child.is_stable for child in children):
+            with self._locker:
+                self._shadowed[node.ident] = (node.children_idents, shadowed)
+        return shadowed
+
+    def _calc_item(self, node: SpaceNode, nodes_dict: dict, bitmaps: dict) -> StorageSpaceItem:
+        written = self._calc_written(node, bitmaps)
+        if written is None:
+            return StorageSpaceItem(node.ident, node.status, None, None, None)
+        shadowed = min(self._calc_shadowed(node, nodes_dict, bitmaps), written)
+        return StorageSpaceItem(node.ident, node.status, written, written - shadowed,
+                                written if node.is_leaf else shadowed)
+
+    def invalidate(self, storage_ident: str, tree_ident: str):
+        """快照存储树中的快照存储发生变化，在锁空间内调用"""
+        with self._locker:
+            self._generations[tree_ident] += 1
+            self._trees.pop(tree_ident, None)
+            self._written.pop(storage_ident, None)
+            self._shadowed.pop(storage_ident, None)
+
+    def clear(self):
+        with self._locker:
+            self._trees.clear()
+            self._written.clear()
+            self._shadowed.clear()
+
+    def to_dict(self) -> dict:
+        with self._locker:
+            return {
+                'trees': len(self._trees),
+                'storages': len(self._written),
+                'builds': self.builds,
+                'bitmap_reads': self.bitmap_reads,
+            }
+
+
+_storage_space: StorageSpace = None
+_storage_space_locker = threading.Lock()
+
+
+def get_storage_space() -> StorageSpace:
+    global _storage_space
+
+    if _storage_space is None:
+        with _storage_space_locker:
+            if _storage_space is None:
+                _storage_space = StorageSpace()
+                storage.add_change_listener(_on_storage_changed)
+    return _storage_space
+
+
+def _on_storage_changed(storage_ident: str, tree_ident: str):
+    if _storage_space is not None:
+        _storage_space.invalidate(storage_ident, tree_ident)
@@ -0,0 +1,260 @@
+"""快照存储树的时间线
+
+恢复界面与保留策略需要知道磁盘历史中的每个时间点由哪些快照存储覆盖，以及哪些时间段没有覆盖
+    1. 时间线由快照存储树中可读取（写入中、计算hash中、存储）的快照存储组成
+       CDP快照存储覆盖 [start_timestamp, finish_timestamp] ，没有 finish_timestamp 时覆盖 start_timestamp 之后的所有时间点
+       qcow快照存储覆盖 start_timestamp 时间点
+       没有 start_timestamp 的快照存储使用 parent_timestamp （从父快照存储的该时间点创建），两者均为空时不在时间线上
+    2. 不被任何快照存储覆盖的时间段为间隙，与快照存储一起按开始时间排列，分页返回
+    3. 每棵快照存储树一个时间线，从数据库仅查询需要的列生成，缓存在内存中，快照存储树中的快照存储变化时失效
+       生成时需要持有存储锁，避免将其他事务提交前的数据缓存下来
+"""
+import bisect
+import collections
+import decimal
+import itertools
+import threading
+import typing
+
+from cpkt.core import xlogging as lg
+
+from business_logic import storage
+from data_access import models as m
+from data_access import storage as da_storage
+
+_logger = lg.get_logger(__name__)
+
+INFINITY = decimal.Decimal('Infinity')
+
+TIMELINE_STATUS = (
+    m.SnapshotStorage.STATUS_WRITING,
+    m.SnapshotStorage.STATUS_HASHING,
+    m.SnapshotStorage.STATUS_STORAGE,
+)
+
+
+class IntervalIndex(object):
+    """时间区间的查找结构
+
+    元素需要有 ident 、 start_timestamp 与 finish_timestamp 属性，finish_timestamp 为 None 表示没有结束
+    已结束的区间按 start_timestamp 排序并记录 finish_timestamp 的前缀最大值，查找时间点时 bisect 到最后一个
+    start_timestamp 不大于该时间点的区间，再向前扫描直到前缀最大值小于该时间点；没有结束的区间单独记录
+    """
+
+    def __init__(self, items: typing.Iterable):
+        items = list(items)
+        self._finished = sorted((item for item in items if item.finish_timestamp is not None),
+                                key=lambda item: (item.start_timestamp, item.ident))
+        self._starts = [item.start_timestamp for item in self._finished]
+        self._max_finishes = list(itertools.accumulate((item.finish_timestamp for item in self._finished), max))
+        self._unfinished = [item for item in items if item.finish_timestamp is None]
+
+    def __len__(self):
+        return len(self._finished) + len(self._unfinished)
+
+    @property
+    def unfinished_count(self):
+        return len(self._unfinished)
+
+    def find(self, timestamp) -> list:
+        """包含时间点的区间，按 start_timestamp 从大到小排列，相同时按 ident 从大到小排列"""
+        result = [item for item in self._unfinished if item.start_timestamp <= timestamp]
+        i = bisect.bisect_right(self._starts, timestamp) - 1
+        while i >= 0 and self._max_finishes[i] >= timestamp:
+            if self._finished[i].finish_timestamp >= timestamp:
+                result.append(self._finished[i])
+            i -= 1
+        return sorted(result, key=lambda item: (item.start_timestamp, item.ident), reverse=True)
+
+
+class TimelineEntry(object):
+    """时间线中的一项，ident 为 None 时为间隙"""
+
+    __slots__ = ('ident', 'type', 'status', 'parent_ident', 'parent_timestamp', 'start_timestamp',
+                 'finish_timestamp',)
+
+    def __init__(self, ident, storage_type, status, parent_ident, parent_timestamp, start_timestamp,
+                 finish_timestamp):
+        self.ident = ident
+        self.type = storage_type
+        self.status = status
+        self.parent_ident = parent_ident
+        self.parent_timestamp = parent_timestamp
+        self.start_timestamp = start_timestamp
+        self.finish_timestamp = finish_timestamp
+
+    @staticmethod
+    def gap(start_timestamp, finish_timestamp) -> 'TimelineEntry':
+        return TimelineEntry(None, None, None, None, None, start_timestamp, finish_timestamp)
+
+    def __str__(self):
+        if self.is_gap:
+            return f'timeline_gap:<{self.start_timestamp}-{self.finish_timestamp}>'
+        return f'timeline_entry:<{self.ident},{self.start_timestamp}-{self.finish_timestamp}>'
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def is_gap(self):
+        return self.ident is None
+
+    @property
+    def sort_key(self):
+        return self.start_timestamp, int(self.is_gap), self.ident or ''
+
+    @property
+    def page_token(self) -> str:
+        return f'{self.start_timestamp}|{self.ident or ""}'
+
+
+def _parse_page_token(page_token: str):
+    start, _, ident = page_token.partition('|')
+    try:
+        start = decimal.Decimal(start)
+    except decimal.InvalidOperation:
+        start = None
+    assert start is not None and start.is_finite(), ('分页标记无效', f'invalid page token {page_token}', 0)
+    return start, int(not ident), ident
+
+
+def _entry_from_row(row) -> typing.Union[TimelineEntry, None]:
+    ident, parent_ident, parent_timestamp, storage_type, status, start_timestamp, finish_timestamp = row
+    if start_timestamp is None:
+        start_timestamp = parent_timestamp
+    if start_timestamp is None:
+        return None
+    if storage_type == m.SnapshotStorage.TYPE_QCOW:
+        finish_timestamp = start_timestamp
+    elif finish_timestamp is not None and finish_timestamp < start_timestamp:
+        _logger.warning(f'timeline of {ident} finish {finish_timestamp} before start {start_timestamp}')
+        finish_timestamp = start_timestamp
+    return TimelineEntry(ident, storage_type, status, parent_ident, parent_timestamp, start_timestamp,
+                         finish_timestamp)
+
+
+class TreeTimeline(object):
+    """一棵快照存储树的时间线"""
+
+    def __init__(self, tree_ident: str, entries: typing.List[TimelineEntry]):
+        self.tree_ident = tree_ident
+        self.index = IntervalIndex(entries)
+        self._entries = list()  # 快照存储与间隙，按 sort_key 排列
+        covered = None  # 已处理的快照存储覆盖到的时间点
+        for entry in sorted(entries, key=lambda item: item.sort_key):
+            if covered is not None and entry.start_timestamp > covered:
+                self._entries.append(TimelineEntry.gap(covered, entry.start_timestamp))
+            self._entries.append(entry)
+            finish = INFINITY if entry.finish_timestamp is None else entry.finish_timestamp
+            covered = finish if covered is None else max(covered, finish)
+        self.gap_count = len(self._entries) - len(entries)
+        self._keys = [entry.sort_key for entry in self._entries]
+        self._max_finishes = list(itertools.accumulate(
+            (INFINITY if entry.finish_timestamp is None else entry.finish_timestamp for entry in self._entries), max))
+
+    def __str__(self):
+        return f'tree_timeline:<{self.tree_ident},{len(self.index)} storages,{self.gap_count} gaps>'
+
+    @staticmethod
+    def build(tree_ident: str) -> 'TreeTimeline':
+        """在存储锁与数据库事务内调用"""
+        rows = da_storage.query_timeline_rows(tree_ident, TIMELINE_STATUS)
+        return TreeTimeline(tree_ident, [entry for entry in map(_entry_from_row, rows) if entry is not None])
+
+    @property
+    def first_timestamp(self):
+        return self._entries[0].start_timestamp if self._entries else None
+
+    @property
+    def last_timestamp(self):
+        """时间线的结束时间点，存在没有结束的CDP快照存储时为 None"""
+        if not self._entries or self._max_finishes[-1] == INFINITY:
+            return None
+        return self._max_finishes[-1]
+
+    def page(self, begin_timestamp=None, end_timestamp=None, page_token: str = None, limit=1000):
+        """与 [begin_timestamp, end_timestamp] 有交集的快照存储与间隙
+
+        :return: (entries, next_page_token)，next_page_token 为 None 时没有更多数据
+        """
+        i = 0 if begin_timestamp is None else bisect.bisect_left(self._max_finishes, begin_timestamp)
+        if page_token:
+            i = max(i, bisect.bisect_right(self._keys, _parse_page_token(page_token)))
+
+        result = list()
+        while i < len(self._entries) and len(result) < limit:
+            entry = self._entries[i]
+            if end_timestamp is not None and entry.start_timestamp > end_timestamp:
+                break
+            if (begin_timestamp is None or entry.finish_timestamp is None
+                    or entry.finish_timestamp >= begin_timestamp):
+                result.append(entry)
+            i += 1
+
+        more = i < len(self._entries) and (end_timestamp is None or self._entries[i].start_timestamp <= end_timestamp)
+        return result, (result[-1].page_token if result and more else None)
+
+    def find(self, timestamp) -> typing.List[TimelineEntry]:
+        """覆盖时间点的快照存储，按 start_timestamp 从大到小排列"""
+        return self.index.find(timestamp)
+
+
+class StorageTimelines(object):
+    """缓存各快照存储树的时间线"""
+
+    def __init__(self, max_trees=64):
+        self.max_trees = max_trees
+        self._trees: typing.Dict[str, TreeTimeline] = collections.OrderedDict()
+        self._locker = threading.Lock()
+        self.builds = 0
+
+    def __str__(self):
+        return f'storage_timelines:<{len(self._trees)} trees>'
+
+    def get(self, tree_ident: str) -> typing.Union[TreeTimeline, None]:
+        with self._locker:
+            tree_timeline = self._trees.get(tree_ident)
+            if tree_timeline is not None:
+                self._trees.move_to_end(tree_ident)
+            return tree_timeline
+
+    def build(self, tree_ident: str) -> TreeTimeline:
+        """在存储锁与数据库事务内调用"""
+        tree_timeline = TreeTimeline.build(tree_ident)
+        with self._locker:
+            self.builds += 1
+            self._trees[tree_ident] = tree_timeline
+            while len(self._trees) > self.max_trees:
+                self._trees.popitem(last=False)
+        _logger.debug('%s built', tree_timeline)
+        return tree_timeline
+
+    def invalidate(self, tree_ident: str):
+        """快照存储树中的快照存储发生变化，在锁空间内调用"""
+        with self._locker:
+            self._trees.pop(tree_ident, None)
+
+    def clear(self):
+        with self._locker:
+            self._trees.clear()
+
+
+_storage_timelines: StorageTimelines = None
+_storage_timelines_locker = threading.Lock()
+
+
+def get_storage_timelines() -> StorageTimelines:
+    global _storage_timelines
+
+    if _storage_timelines is None:
+        with _storage_timelines_locker:
+            if _storage_timelines is None:
+                _storage_timelines = StorageTimelines()
+                storage.add_change_listener(_on_storage_changed)
+    return _storage_timelines
+
+
+def _on_storage_changed(storage_ident: str, tree_ident: str):
+    _ = storage_ident
+    if _storage_timelines is not None:
+        _storage_timelines.invalidate(tree_ident)
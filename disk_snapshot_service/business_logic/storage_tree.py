@@ -4,6 +4,7 @@ from cpkt.core import exc
 from cpkt.core import xlogging as lg
 
 import anytree
+from business_logic import storage
 from data_access import models as m
 from data_access import storage as da_storage
 
@@ -11,9 +12,13 @@ _logger = lg.get_logger(__name__)
 
 
 class StorageNode(anytree.Node):
-    """真实存在的磁盘快照存储对象树节点"""
+    """真实存在的磁盘快照存储对象树节点
 
-    def __init__(self, s: m.SnapshotStorage):
+    :remark:
+        不可修改的快照存储树中，storage 为从数据库对象复制的 StorageItem ，参考 DiskSnapshotStorageTree.create_frozen_tree
+    """
+
+    def __init__(self, s: typing.Union[m.SnapshotStorage, storage.StorageItem]):
         super(StorageNode, self).__init__(name=s.ident)
         self._storage: m.SnapshotStorage = s
 
@@ -57,12 +62,22 @@ class DiskSnapshotStorageTree(object):
         storage_objs = da_storage.query_valid_objs(tree_ident)
         return storage_tree.__init_root(storage_objs)
 
+    @staticmethod
+    def create_frozen_tree(tree_ident: str) -> 'DiskSnapshotStorageTree':
+        """生成不可修改的快照存储树，节点不持有数据库对象，可以在多个线程中共享，参考 tree_versions"""
+
+        storage_tree = DiskSnapshotStorageTree(tree_ident)
+        storage_items = [storage.StorageItem(obj) for obj in da_storage.query_valid_objs(tree_ident)]
+        return storage_tree.__init_root(storage_items)
+
     def __init_root(self, storage_objs):
         """磁盘快照存储数据库对象转换为树节点对象，并加入树中"""
 
         for obj in storage_objs:  # type: m.SnapshotStorage
             self.node_dict[obj.ident] = StorageNode(obj)
-        for ident, node in self.node_dict.items():
+        # 数据库通常按创建顺序返回，从叶子向根连接节点；anytree 设置父节点时会遍历新父节点的祖先检查环路，
+        # 按创建顺序连接时长链的耗时与节点数量的平方成正比
+        for ident, node in reversed(list(self.node_dict.items())):
             parent_ident = node.storage.parent_ident
             if parent_ident:
                 node.parent = self.node_dict[parent_ident]
@@ -97,10 +112,15 @@ class DiskSnapshotStorageTree(object):
         return node.fetch_nodes_to_root(root_to_node)
 
 
-def generate(tree_ident) -> DiskSnapshotStorageTree:
-    """生成快照存储树"""
+def generate(tree_ident, frozen=False) -> DiskSnapshotStorageTree:
+    """生成快照存储树
+
+    :param frozen: 为 True 时生成不可修改的快照存储树，节点的 storage 为 StorageItem
+    """
 
     try:
+        if frozen:
+            return DiskSnapshotStorageTree.create_frozen_tree(tree_ident)
         return DiskSnapshotStorageTree.create_tree(tree_ident)
     except AssertionError:
         raise
@@ -0,0 +1,111 @@
+import decimal
+import random
+
+import pytest
+
+from business_logic import cdp_index
+from business_logic import storage
+from business_logic import storage_tree as tree
+from data_access import models as m
+from data_access import session as s
+
+pytestmark = pytest.mark.usefixtures('db')
+
+TREE_IDENT = 'tree'
+SEGMENTS = 5000
+BEGIN = decimal.Decimal('1600000000.000000')
+
+
+def _segment_range(i):
+    """第 i 个CDP快照存储的时间区间，每 100 个之间有 1 秒的间隙"""
+    start = BEGIN + i * 10 + (i // 100)
+    return start, start + 10
+
+
+@pytest.fixture()
+def cdp_tree(create_storage, reset_singletons):
+    """q0 -> c0 -> c1 -> ... -> c4999（最后一个正在写入）
+          -> qb -> d0 -> d1 （另一次CDP写入，时间与 c 重叠）
+    """
+    with s.transaction():
+        cdp = m.SnapshotStorage.TYPE_CDP
+        create_storage('q0')
+        parent_ident = 'q0'
+        for i in range(SEGMENTS):
+            start, finish = _segment_range(i)
+            writing = i == SEGMENTS - 1
+            create_storage(f'c{i}', parent_ident,
+                           m.SnapshotStorage.STATUS_WRITING if writing else m.SnapshotStorage.STATUS_STORAGE, cdp,
+                           start=start, finish=None if writing else finish)
+            parent_ident = f'c{i}'
+        create_storage('qb', 'q0')
+        create_storage('d0', 'qb', storage_type=cdp, start=BEGIN, finish=BEGIN + 100)
+        create_storage('d1', 'd0', storage_type=cdp, start=BEGIN + 100, finish=BEGIN + 200)
+    reset_singletons((cdp_index, '_cdp_index'))
+    return cdp_index.get_cdp_index()
+
+
+def _resolve(storage_ident, timestamp):
+    with s.readonly():
+        return cdp_index.get_cdp_index().resolve(tree.generate(TREE_IDENT), storage_ident, timestamp)
+
+
+def _linear_find(ranges, timestamp):
+    """逐个比较的参考实现"""
+    for i in reversed(range(SEGMENTS)):
+        start, finish = ranges[i]
+        if start <= timestamp and (i == SEGMENTS - 1 or timestamp <= finish):
+            return f'c{i}'
+    return None
+
+
+def test_resolve_many_segments(cdp_tree):
+    rng, ranges, misses = random.Random(0), [_segment_range(i) for i in range(SEGMENTS)], 0
+    with s.readonly():
+        storage_tree = tree.generate(TREE_IDENT)
+    end = _segment_range(SEGMENTS)[0]
+    for _ in range(1000):
+        timestamp = BEGIN + decimal.Decimal(rng.randrange(int((end - BEGIN) * 1000))) / 1000
+        expected = _linear_find(ranges, timestamp)
+        if expected is None:
+            misses += 1
+            with pytest.raises(AssertionError):
+                cdp_tree.resolve(storage_tree, 'c0', timestamp)
+        else:
+            assert cdp_tree.resolve(storage_tree, f'c{rng.randrange(SEGMENTS)}', timestamp) == expected
+    assert cdp_tree.builds == 1 + misses  # 找不到时重建一次索引
+
+
+def test_resolve_boundary_and_writing(cdp_tree):
+    start, finish = _segment_range(7)
+    assert _resolve('c0', start) == 'c7'
+    assert _resolve('c0', finish) == 'c8'  # 首尾相连时使用较新的CDP快照存储
+    assert _resolve('c0', _segment_range(99)[1]) == 'c99'  # 间隙之前
+    assert _resolve('c0', _segment_range(SEGMENTS - 1)[0] + 10 ** 6) == f'c{SEGMENTS - 1}'  # 正在写入
+
+    for timestamp in (BEGIN - 1, _segment_range(99)[1] + decimal.Decimal('0.5'),):
+        with pytest.raises(AssertionError, match='快照时间点不存在'):
+            _resolve('c0', timestamp)
+
+
+def test_resolve_in_cdp_run(cdp_tree):
+    assert _resolve('d1', BEGIN + 50) == 'd0'
+    assert _resolve('c3', BEGIN + 45) == 'c4'
+    with pytest.raises(AssertionError, match='快照时间点不存在'):
+        _resolve('d0', BEGIN + 300)  # 仅在同一次CDP写入中查找
+    with pytest.raises(AssertionError, match='仅CDP快照存储可以按时间点打开'):
+        _resolve('q0', BEGIN + 50)
+
+
+def test_stale_index(cdp_tree, create_storage):
+    assert _resolve('d0', BEGIN + 150) == 'd1'
+    with s.transaction():
+        create_storage('d2', 'd1', m.SnapshotStorage.STATUS_WRITING, m.SnapshotStorage.TYPE_CDP, start=BEGIN + 200)
+    assert _resolve('d0', BEGIN + 250) == 'd2'  # 新建的CDP快照存储，重建索引后找到
+    assert cdp_tree.builds == 2
+
+    with s.transaction():
+        storage.query_by_ident('d1').update_status(m.SnapshotStorage.STATUS_RECYCLING)
+    assert cdp_tree.builds == 2 and cdp_tree._trees == dict()  # 快照存储树中的快照存储变化时失效
+    assert _resolve('d0', BEGIN + 150) == 'd1'
+    assert cdp_tree.builds == 3
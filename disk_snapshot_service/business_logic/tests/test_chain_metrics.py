@@ -0,0 +1,41 @@
+from business_logic import chain_metrics
+from business_logic import storage_chain as chain
+from business_logic import storage_reference_manager as srm
+from data_access import models as m
+
+GiB = 1024 * 1024 * 1024
+
+
+def _chain(*image_paths) -> chain.StorageChainForRead:
+    r_chain = chain.StorageChainForRead(srm.StorageReferenceManager(), 'test')
+    parent_ident = None
+    for i, image_path in enumerate(image_paths):
+        ident = f's{i}'
+        r_chain.insert_tail(m.SnapshotStorage(
+            ident=ident, parent_ident=parent_ident, type=m.SnapshotStorage.TYPE_QCOW, disk_bytes=GiB,
+            status=m.SnapshotStorage.STATUS_STORAGE, image_path=image_path, file_level_deduplication=False))
+        parent_ident = ident
+    return r_chain.acquire()
+
+
+def test_record():
+    metrics = chain_metrics.ChainMetrics(max_trees=2)
+    r_chain = _chain('/a', '/a', '/b', '/c', '/c')
+    try:
+        sample = metrics.record('t1', r_chain)
+    finally:
+        r_chain.release()
+    assert (sample.depth, sample.key_items, sample.files) == (5, 3, 3)
+
+    for tree_ident, image_paths in (('t2', ('/a',)), ('t1', ('/a', '/b')), ('t3', ('/a',))):
+        r_chain = _chain(*image_paths)
+        metrics.record(tree_ident, r_chain)
+        r_chain.release()
+
+    summary = metrics.query_tree('t1')
+    assert (summary['opens'], summary['avg_key_items'], summary['max_depth']) == (2, 2.5, 5)
+    assert summary['last'] == {'depth': 2, 'key_items': 2, 'files': 2}
+    assert metrics.query_tree('t2') is None  # 超出 max_trees ，最久未打开的快照存储树被移除
+
+    result = metrics.to_dict(top=1)
+    assert (result['total']['opens'], result['tree_count'], list(result['trees'])) == (4, 2, ['t1'])
@@ -0,0 +1,110 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from business_logic import dedup_index
+from business_logic import hash_file
+
+
+def _random_records(rng, count):
+    return rng.integers(1, 2 ** 32, (count, hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)
+
+
+def _write(path, records):
+    hash_file.write_records(str(path), [records])
+    return str(path)
+
+
+@pytest.fixture()
+def index(tmp_path):
+    return dedup_index.DedupIndex(str(tmp_path / 'index'), chunk_records=100)
+
+
+def test_lookup_returns_first_location(tmp_path, index):
+    rng = np.random.default_rng(0)
+    a = _random_records(rng, 250)
+    a[10] = 0
+    b = np.concatenate([a[200:], _random_records(rng, 50)])
+
+    assert not (tmp_path / 'index').exists()  # 首次写入时创建目录
+    assert not index.lookup(a).found.any()
+    assert index.add_hash_file(1, _write(tmp_path / 'a.hash', a)) == 249
+    assert index.add_hash_file(2, _write(tmp_path / 'b.hash', b)) == 50
+    assert index.add_hash_file(2, str(tmp_path / 'b.hash')) == 0
+    assert index.records_count == 299
+
+    result = index.lookup(b)
+    assert result.found.all()
+    assert result.hash_id.tolist() == [1] * 50 + [2] * 50
+    assert result.block.tolist() == list(range(200, 250)) + list(range(50, 100))
+
+    assert not index.lookup(_random_records(rng, 10)).found.any()
+    assert not index.lookup(np.zeros((1, hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)).found.any()
+
+
+def test_lookup_check_whole_record(tmp_path, index):
+    rng = np.random.default_rng(1)
+    a = _random_records(rng, 5)
+    index.add_hash_file(1, _write(tmp_path / 'a.hash', a))
+
+    same_fp = a.copy()
+    same_fp[:, -1] += 1
+    assert not index.lookup(same_fp).found.any()
+
+
+def test_compact_and_reload(tmp_path, index):
+    rng = np.random.default_rng(2)
+    all_records = list()
+    for hash_id in range(1, 12):
+        records = _random_records(rng, 150)
+        all_records.append(records)
+        index.add_hash_file(hash_id, _write(tmp_path / f'{hash_id}.hash', records))
+        assert len(index._runs) <= dedup_index.DedupIndex.MAX_RUNS
+
+    reloaded = dedup_index.DedupIndex(index.index_dir)
+    assert reloaded.records_count == 11 * 150
+    assert reloaded.is_indexed(11)
+    result = reloaded.lookup(np.concatenate(all_records))
+    assert result.found.all()
+    assert result.hash_id.tolist() == [i for i in range(1, 12) for _ in range(150)]
+    assert len(list((tmp_path / 'index').glob('*.npy'))) == len(reloaded._runs) * 2
+
+
+def test_manifest_store_hash_id_ranges(tmp_path, index):
+    rng = np.random.default_rng(4)
+    for hash_id in (1, 2, 3, 5, 7, 6):
+        index.add_hash_file(hash_id, _write(tmp_path / f'{hash_id}.hash', _random_records(rng, 10)))
+    assert not index.is_indexed(4) and index.is_indexed(6)
+    with open(tmp_path / 'index' / dedup_index.DedupIndex.MANIFEST) as f:
+        assert json.load(f)['hash_id_ranges'] == [[1, 3], [5, 7]]
+
+    index.add_hash_file(4, _write(tmp_path / '4.hash', _random_records(rng, 10)))
+    assert dedup_index.DedupIndex(index.index_dir)._hash_id_ranges == [[1, 7]]
+
+
+def test_remove_compacted_runs_after_lookup(tmp_path, index):
+    rng = np.random.default_rng(5)
+    records = _random_records(rng, 5)  # 合并时保留较大的 run ，较小的 run 被合并
+    index.add_hash_file(1, _write(tmp_path / '1.hash', records))
+    reading = index._acquire_runs()  # 模拟进行中的查找
+    for hash_id in range(2, dedup_index.DedupIndex.MAX_RUNS + 2):
+        index.add_hash_file(hash_id, _write(tmp_path / f'{hash_id}.hash', _random_records(rng, 10)))
+
+    removed, = reading
+    assert removed not in index._runs and removed.removed
+    assert os.path.exists(removed.fp_path)
+    index._release_runs(reading)
+    assert not os.path.exists(removed.fp_path)
+    assert index.lookup(records).found.all()
+
+
+def test_clear(tmp_path, index):
+    rng = np.random.default_rng(3)
+    records = _random_records(rng, 10)
+    index.add_hash_file(1, _write(tmp_path / 'a.hash', records))
+    index.clear()
+    assert index.records_count == 0
+    assert not index.is_indexed(1)
+    assert not index.lookup(records).found.any()
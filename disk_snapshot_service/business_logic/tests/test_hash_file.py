@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from business_logic import hash_file
+
+
+def _records(values):
+    """每个值生成一条记录，0 表示全零记录"""
+    records = np.zeros((len(values), hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)
+    records[:, -1] = values
+    return records
+
+
+def _write(path, values):
+    hash_file.write_records(str(path), [_records(values)])
+    return str(path)
+
+
+def _read(path):
+    return hash_file.open_records(path)[:, -1].tolist()
+
+
+@pytest.mark.parametrize('chunk_records', [1, 2, 3, 1024])
+def test_overlay_fill_absent_records(tmp_path, chunk_records):
+    base = _write(tmp_path / 'base.hash', [1, 2, 0, 4, 5])
+    increment = _write(tmp_path / 'increment.hash', [0, 12, 0, 0])
+
+    filled = hash_file.overlay(base, increment, 6, chunk_records)
+
+    assert _read(increment) == [1, 12, 0, 4, 5, 0]
+    assert filled == 3
+    assert not (tmp_path / 'increment.hash.writing').exists()
+
+
+def test_overlay_empty_files(tmp_path):
+    base = _write(tmp_path / 'base.hash', [])
+    increment = _write(tmp_path / 'increment.hash', [])
+
+    assert hash_file.overlay(base, increment, 3) == 0
+    assert _read(increment) == [0, 0, 0]
+
+
+def test_overlay_matches_record_by_record(tmp_path):
+    rng = np.random.default_rng(0)
+    count = 10000
+    base_values = rng.integers(0, 3, count) * rng.integers(1, 100, count)
+    increment_values = rng.integers(0, 2, count // 2) * rng.integers(100, 200, count // 2)
+    base = _write(tmp_path / 'base.hash', base_values)
+    increment = _write(tmp_path / 'increment.hash', increment_values)
+
+    hash_file.overlay(base, increment, count, 333)
+
+    expected = [i if i else b for i, b in zip(list(increment_values) + [0] * (count - count // 2), base_values)]
+    assert _read(increment) == expected
+
+
+def test_overlay_invalid_file_size(tmp_path):
+    base = _write(tmp_path / 'base.hash', [1, 2])
+    (tmp_path / 'increment.hash').write_bytes(b'\x01' * (hash_file.RECORD_BYTES + 1))
+
+    with pytest.raises(AssertionError):
+        hash_file.overlay(base, str(tmp_path / 'increment.hash'), 2)
+
+
+def test_records_count():
+    assert hash_file.records_count(0) == 0
+    assert hash_file.records_count(1) == 1
+    assert hash_file.records_count(hash_file.BLOCK_BYTES) == 1
+    assert hash_file.records_count(1024 ** 4) == 16 * 1024 * 1024
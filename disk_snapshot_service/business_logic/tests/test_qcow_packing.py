@@ -0,0 +1,83 @@
+import os
+from unittest import mock
+
+import pytest
+
+from business_logic import storage
+from business_logic import storage_action as action
+from data_access import models as m
+from data_access import session as s
+
+pytestmark = pytest.mark.usefixtures('db')
+
+GiB = 1024 * 1024 * 1024
+
+
+@pytest.fixture()
+def create_chain(create_storage):
+    def _create_chain(folder, count, image_path=None, parent_ident=None, prefix='q') -> m.SnapshotStorage:
+        """在同一文件中创建 count 个快照存储，返回最后一个"""
+        image_path = image_path or os.path.join(folder, f'{prefix}.qcow')
+        storage_obj = None
+        for i in range(count):
+            storage_obj = create_storage(f'{prefix}{i}', parent_ident, image_path=image_path, disk_bytes=10 * GiB)
+            parent_ident = storage_obj.ident
+        return storage_obj
+
+    return _create_chain
+
+
+@pytest.fixture()
+def policy():
+    with mock.patch.object(action.ImagePathGenerator, 'packing_policy', action.QcowPackingPolicy()) as packing_policy:
+        yield packing_policy
+
+
+def test_reuse_parent_file_without_limit(policy, tmp_path, create_chain):
+    with s.transaction():
+        parent = create_chain(str(tmp_path), 10)
+        assert action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB) == parent.image_path
+
+
+def test_max_snapshots_per_file(policy, tmp_path, create_chain, create_storage):
+    policy.max_snapshots_per_file = 4
+    with s.transaction():
+        parent = create_chain(str(tmp_path), 3)
+        assert action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB) == parent.image_path
+        create_storage('other', image_path=parent.image_path, disk_bytes=10 * GiB)  # 其他分支
+        new_path = action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB)
+        assert new_path != parent.image_path and os.path.dirname(new_path) == str(tmp_path)
+
+
+def test_max_chain_depth(policy, tmp_path, create_chain):
+    policy.max_chain_depth = 3
+    with s.transaction():
+        root = create_chain(str(tmp_path), 2, prefix='a')
+        parent = create_chain(str(tmp_path), 2, parent_ident=root.ident, prefix='b')  # 父文件中的链深度为 2
+        assert action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB) == parent.image_path
+
+        parent = create_chain(str(tmp_path), 1, image_path=parent.image_path, parent_ident=parent.ident, prefix='c')
+        assert action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB) != parent.image_path
+
+
+def test_chain_depth_query_tree_once(policy, tmp_path, create_chain):
+    policy.max_chain_depth = 32
+    with s.transaction():
+        root = create_chain(str(tmp_path), 1, prefix='a')
+        parent = create_chain(str(tmp_path), 40, parent_ident=root.ident, prefix='b')
+        with mock.patch.object(storage, 'query_parents_in_tree', wraps=storage.query_parents_in_tree) as query, \
+                mock.patch.object(storage, 'query_by_ident', side_effect=AssertionError('query by ident')):
+            assert action.QcowPackingPolicy._chain_depth_in_file(parent, 32) == 32
+            assert action.QcowPackingPolicy._chain_depth_in_file(parent, 64) == 40  # 父文件之外的节点不计入
+        assert query.call_count == 2
+
+
+def test_max_file_bytes(policy, tmp_path, create_chain):
+    policy.max_file_bytes = GiB
+    with s.transaction():
+        parent = create_chain(str(tmp_path), 1)
+        assert action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB) == parent.image_path
+
+        with open(parent.image_path, 'w') as f:
+            f.truncate(GiB)  # 稀疏文件
+        assert action.ImagePathGenerator.generate_qcow(parent, str(tmp_path), 10 * GiB) != parent.image_path
@@ -0,0 +1,128 @@
+import os
+from unittest import mock
+
+import pytest
+
+from business_logic import qcow_pool
+from business_logic import storage_action as action
+from data_access import models as m
+from data_access import qcow_pool as da_pool
+from data_access import session as s
+
+DISK_BYTES = 1024 * 1024
+
+
+def _precreate(file_path, disk_bytes, raw_flag):
+    with open(file_path, 'w') as f:
+        f.write(str(disk_bytes))
+
+
+@pytest.fixture()
+def pool(db, tmp_path, reset_singletons):
+    reset_singletons((qcow_pool, '_qcow_pool'), (action.ImagePathGenerator, 'qcow_file_provider'))
+    precreated = qcow_pool.configure(max_per_key=4, max_total=6, bucket_seconds=300)
+    with mock.patch.object(action.DiskSnapshotAction, 'precreate_qcow_file', side_effect=_precreate):
+        yield precreated, str(tmp_path)
+
+
+def _ready_paths():
+    with s.readonly():
+        return [file_obj.path for file_obj in da_pool.query_objs_by_status(m.QcowPoolFile.STATUS_READY)]
+
+
+def test_refill_by_demand(pool):
+    precreated, folder = pool
+    with s.transaction():
+        paths = [action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES) for _ in range(3)]
+    assert precreated.misses == 3 and all(path.startswith(folder) for path in paths)
+    assert precreated.targets() == {(folder, DISK_BYTES): 3}
+
+    precreated.refill()
+    ready = _ready_paths()
+    assert len(ready) == 3 and all(os.path.exists(path) for path in ready)
+
+    with s.transaction():
+        path = action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES)
+    assert path == ready[0] and precreated.hits == 1
+    assert _ready_paths() == ready[1:]
+
+    with s.transaction():
+        assert action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES * 2) not in ready  # 磁盘大小不同
+        assert action.ImagePathGenerator.generate_new_qcow(folder) not in ready  # 未指定磁盘大小时不取用
+    assert _ready_paths() == ready[1:]
+
+
+def test_take_rollback(pool):
+    precreated, folder = pool
+    with s.transaction():
+        action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES)
+    precreated.refill()
+    ready = _ready_paths()
+
+    with pytest.raises(ValueError):
+        with s.transaction():
+            assert action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES) == ready[0]
+            raise ValueError('create snapshot failed')
+    assert _ready_paths() == ready  # 事务回滚后文件仍归文件池所有
+
+
+def test_max_total(pool):
+    precreated, folder = pool
+    other = os.path.join(folder, 'other')
+    os.makedirs(other)
+    with s.transaction():
+        for _ in range(5):
+            action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES)
+            action.ImagePathGenerator.generate_new_qcow(other, DISK_BYTES)
+    assert sorted(precreated.targets().values()) == [2, 4]  # 每个键不超过 4 ，总数不超过 6
+
+
+def test_shrink(pool):
+    precreated, folder = pool
+    with s.transaction():
+        for _ in range(3):
+            action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES)
+    precreated.refill()
+    ready = _ready_paths()
+
+    precreated.shrink()
+    assert _ready_paths() == ready  # 需求统计不完整时不删除
+
+    precreated._demand.clear()
+    precreated.shrink(force=True)
+    assert _ready_paths() == [] and precreated.removed == 3
+    assert not any(os.path.exists(path) for path in ready)
+
+
+def test_create_failed(pool):
+    precreated, folder = pool
+    with s.transaction():
+        action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES)
+    with mock.patch.object(action.DiskSnapshotAction, 'precreate_qcow_file', side_effect=OSError('no space')):
+        precreated.refill()
+    assert precreated.failures == 1
+    with s.readonly():
+        assert da_pool.query_objs_by_status(m.QcowPoolFile.STATUS_CREATING) == []
+
+
+def test_recover(pool):
+    precreated, folder = pool
+    paths = [os.path.join(folder, f'{name}.qcow') for name in ('creating', 'deleting', 'ready',)]
+    with s.transaction():
+        for path, status in zip(paths, (m.QcowPoolFile.STATUS_CREATING, m.QcowPoolFile.STATUS_DELETING, None,)):
+            _precreate(path, DISK_BYTES, None)
+            file_obj_id = da_pool.create_obj(path, folder, DISK_BYTES).id
+            da_pool.update_status(file_obj_id, m.QcowPoolFile.STATUS_CREATING, status or m.QcowPoolFile.STATUS_READY)
+
+    precreated.recover()
+    assert [os.path.exists(path) for path in paths] == [False, False, True]
+    assert _ready_paths() == paths[2:]
+
+
+def test_disabled(pool):
+    precreated, folder = pool
+    precreated.max_per_key = 0
+    with s.transaction():
+        action.ImagePathGenerator.generate_new_qcow(folder, DISK_BYTES)
+    precreated.refill()
+    assert precreated.misses == 0 and _ready_paths() == []
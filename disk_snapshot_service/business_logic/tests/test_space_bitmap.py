@@ -0,0 +1,35 @@
+import numpy as np
+
+from business_logic import space_bitmap
+
+MiB = 1024 * 1024
+
+
+def _write(tmp_path, name, blocks, count):
+    bits = np.zeros(count, bool)
+    bits[list(blocks)] = True
+    path = str(tmp_path / name)
+    space_bitmap.write_bitmap(path, bits)
+    return space_bitmap.open_bitmap(path)
+
+
+def test_count_blocks(tmp_path):
+    disk_bytes = 100 * MiB + 1  # 1601 个数据块
+    assert space_bitmap.blocks_count(disk_bytes) == 1601 and space_bitmap.bitmap_bytes(disk_bytes) == 201
+    bitmap = _write(tmp_path, 'a.map', [0, 7, 8, 1600], 1601)
+    assert space_bitmap.count_blocks(bitmap, disk_bytes) == 4
+    assert space_bitmap.count_blocks(bitmap, disk_bytes, chunk_bytes=3) == 4
+    assert space_bitmap.count_blocks(bitmap, 64 * 1024 * 8) == 2  # 忽略超出磁盘大小的部分
+    assert space_bitmap.count_blocks(_write(tmp_path, 'e.map', [], 0), disk_bytes) == 0
+
+
+def test_count_shadowed_blocks(tmp_path):
+    disk_bytes = 64 * MiB  # 1024 个数据块
+    parent = _write(tmp_path, 'p.map', range(0, 1024, 2), 1024)
+    first = _write(tmp_path, 'c1.map', range(0, 512), 512)  # 末尾的全零字节省略
+    second = _write(tmp_path, 'c2.map', list(range(0, 100)) + [1000], 1024)
+    assert space_bitmap.count_shadowed_blocks(parent, [], disk_bytes) == 0
+    assert space_bitmap.count_shadowed_blocks(parent, [first], disk_bytes) == 256
+    for chunk_bytes in (1, 7, space_bitmap.CHUNK_BYTES):
+        assert space_bitmap.count_shadowed_blocks(parent, [first, second], disk_bytes, chunk_bytes) == 50
+    assert parent[0] == 0b01010101  # 统计时不修改位图文件
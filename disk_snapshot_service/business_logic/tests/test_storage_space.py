@@ -0,0 +1,92 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from business_logic import space_bitmap
+from business_logic import storage
+from business_logic import storage_action as action
+from business_logic import storage_space
+from data_access import models as m
+from data_access import session as s
+
+MiB = 1024 * 1024
+BLOCK = space_bitmap.BLOCK_BYTES
+TREE_IDENT = 'tree'
+
+
+def _create(create_storage, tmp_path, ident, parent_ident, status, blocks=None, new_storage_size=None):
+    image_path = str(tmp_path / f'{ident}.qcow')
+    storage_obj = create_storage(ident, parent_ident, status, image_path=image_path, disk_bytes=64 * MiB)
+    storage_obj.new_storage_size = new_storage_size
+    if blocks is not None:
+        bits = np.zeros(1024, bool)
+        bits[list(blocks)] = True
+        space_bitmap.write_bitmap(action.ImagePathGenerator.generate_map(image_path, ident), bits)
+
+
+@pytest.fixture()
+def space(db, tmp_path, create_storage, reset_singletons):
+    """q1(0-9) -> q2(0-4,20)
+               -> q3(0-2,30) -> q4 没有位图文件
+    """
+    with s.transaction():
+        _create(create_storage, tmp_path, 'q1', None, m.SnapshotStorage.STATUS_RECYCLING, range(10))
+        _create(create_storage, tmp_path, 'q2', 'q1', m.SnapshotStorage.STATUS_STORAGE, [0, 1, 2, 3, 4, 20])
+        _create(create_storage, tmp_path, 'q3', 'q1', m.SnapshotStorage.STATUS_STORAGE, [0, 1, 2, 30])
+        _create(create_storage, tmp_path, 'q4', 'q3', m.SnapshotStorage.STATUS_WRITING, new_storage_size=MiB)
+    reset_singletons((storage_space, '_storage_space'))
+    return storage_space.get_storage_space()
+
+
+def _build(space):
+    with s.readonly():
+        generation, nodes = space.query_nodes(TREE_IDENT)
+    return space.build(TREE_IDENT, generation, nodes)
+
+
+def _describe(tree_space):
+    return {ident: (item.written_bytes, item.unique_bytes, item.reclaimable_bytes)
+            for ident, item in tree_space.items.items()}
+
+
+def test_build(space):
+    tree_space = _build(space)
+    assert _describe(tree_space) == {
+        'q1': (10 * BLOCK, 7 * BLOCK, 3 * BLOCK),
+        'q2': (6 * BLOCK, 6 * BLOCK, 6 * BLOCK),
+        'q3': (4 * BLOCK, 4 * BLOCK, 0),  # 子快照存储没有位图文件，无法判断覆盖关系
+        'q4': (MiB, MiB, MiB),
+    }
+    assert tree_space.to_dict() == {
+        'storage_count': 4, 'written_bytes': 20 * BLOCK + MiB, 'unique_bytes': 17 * BLOCK + MiB,
+        'recycling_reclaimable_bytes': 3 * BLOCK, 'unknown_count': 0}
+    assert space.get(TREE_IDENT) is tree_space
+
+
+def test_invalidate(space):
+    _build(space)
+    reads = space.bitmap_reads
+
+    with s.transaction():
+        storage.query_by_ident('q2').update_status(m.SnapshotStorage.STATUS_RECYCLING)
+    assert space.get(TREE_IDENT) is None
+    tree_space = _build(space)
+    assert tree_space.recycling_reclaimable_bytes == 9 * BLOCK
+    assert space.bitmap_reads - reads == 3  # q2 的统计结果失效；q4 没有位图文件，不缓存
+
+    with s.readonly():
+        generation, nodes = space.query_nodes(TREE_IDENT)
+    with s.transaction():
+        storage.query_by_ident('q4').update_status(m.SnapshotStorage.STATUS_ABNORMAL)
+    space.build(TREE_IDENT, generation, nodes)
+    assert space.get(TREE_IDENT) is None  # 生成期间快照存储树发生变化，结果不缓存
+
+
+def test_read_written_bytes(space, tmp_path):
+    assert storage_space.read_written_bytes(str(tmp_path / 'q2.qcow'), 'q2', 64 * MiB) == 6 * BLOCK
+    assert storage_space.read_written_bytes(str(tmp_path / 'q4.qcow'), 'q4', 64 * MiB) is None
+
+    assert storage_space.read_written_bytes_or_none(str(tmp_path / 'q2.qcow'), 'q2', 64 * MiB, 'test') == 6 * BLOCK
+    with patch.object(storage_space.space_bitmap, 'count_blocks', side_effect=OSError('io error')):
+        assert storage_space.read_written_bytes_or_none(str(tmp_path / 'q2.qcow'), 'q2', 64 * MiB, 'test') is None
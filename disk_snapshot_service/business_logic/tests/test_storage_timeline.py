@@ -0,0 +1,119 @@
+import decimal
+import random
+
+import pytest
+
+from business_logic import storage
+from business_logic import storage_timeline as timeline
+from data_access import models as m
+from data_access import session as s
+
+TREE_IDENT = 'tree'
+D = decimal.Decimal
+
+
+@pytest.fixture()
+def timelines(db, create_storage, reset_singletons):
+    """q0(100) -> c0[100,200] -> c1[200,300] -> q1(400) -> c2[500,) 正在写入
+                                             -> q2(250，使用 parent_timestamp)
+       q3 没有时间戳，x0 已删除，x1 回收中，均不在时间线上
+    """
+    with s.transaction():
+        cdp = m.SnapshotStorage.TYPE_CDP
+        create_storage('q0', start=D(100))
+        create_storage('c0', 'q0', storage_type=cdp, start=D(100), finish=D(200))
+        create_storage('c1', 'c0', storage_type=cdp, start=D(200), finish=D(300))
+        create_storage('q1', 'c1', start=D(400))
+        create_storage('c2', 'q1', m.SnapshotStorage.STATUS_WRITING, cdp, start=D(500))
+        create_storage('q2', 'c1', parent_timestamp=D(250))
+        create_storage('q3', 'q0')
+        create_storage('x0', 'q0', m.SnapshotStorage.STATUS_DELETED, start=D(350))
+        create_storage('x1', 'q0', m.SnapshotStorage.STATUS_RECYCLING, start=D(350))
+    reset_singletons((timeline, '_storage_timelines'))
+    return timeline.get_storage_timelines()
+
+
+def _get(timelines) -> timeline.TreeTimeline:
+    tree_timeline = timelines.get(TREE_IDENT)
+    if tree_timeline is None:
+        with s.readonly():
+            tree_timeline = timelines.build(TREE_IDENT)
+    return tree_timeline
+
+
+def _describe(entries):
+    return [f'{entry.start_timestamp:.0f}-{entry.finish_timestamp:.0f}' if entry.is_gap else entry.ident
+            for entry in entries]
+
+
+def test_page(timelines):
+    tree_timeline = _get(timelines)
+    entries, page_token = tree_timeline.page()
+    assert _describe(entries) == ['c0', 'q0', 'c1', 'q2', '300-400', 'q1', '400-500', 'c2']
+    assert page_token is None
+    assert (tree_timeline.first_timestamp, tree_timeline.last_timestamp) == (D(100), None)
+    assert (len(tree_timeline.index), tree_timeline.gap_count) == (6, 2)
+
+    described, page_token = list(), None
+    while True:
+        entries, page_token = tree_timeline.page(page_token=page_token, limit=3)
+        described.extend(_describe(entries))
+        if page_token is None:
+            break
+    assert described == ['c0', 'q0', 'c1', 'q2', '300-400', 'q1', '400-500', 'c2']
+
+    assert _describe(tree_timeline.page(D(260), D(450))[0]) == ['c1', '300-400', 'q1', '400-500']
+    assert _describe(tree_timeline.page(D(260), D(450), limit=2)[0]) == ['c1', '300-400']
+    assert _describe(tree_timeline.page(D(10 ** 6))[0]) == ['c2']
+    with pytest.raises(AssertionError, match='分页标记无效'):
+        tree_timeline.page(page_token='bad')
+
+
+def test_find(timelines):
+    tree_timeline = _get(timelines)
+    assert [entry.ident for entry in tree_timeline.find(D(200))] == ['c1', 'c0']
+    assert [entry.ident for entry in tree_timeline.find(D(250))] == ['q2', 'c1']
+    assert [entry.ident for entry in tree_timeline.find(D(350))] == []
+    assert [entry.ident for entry in tree_timeline.find(D(400))] == ['q1']
+    assert [entry.ident for entry in tree_timeline.find(D(10 ** 6))] == ['c2']
+    assert [entry.ident for entry in tree_timeline.find(D(99))] == []
+
+
+def test_invalidate(timelines):
+    _get(timelines)
+    assert timelines.get(TREE_IDENT) is not None and timelines.builds == 1
+
+    with s.transaction():
+        storage.query_by_ident('c2').update_status(m.SnapshotStorage.STATUS_HASHING)
+    assert timelines.get(TREE_IDENT) is None
+    assert _describe(_get(timelines).page(D(450))[0]) == ['400-500', 'c2']
+    assert timelines.builds == 2
+
+
+def test_many_segments():
+    """10 万个首尾相连的快照存储，每 1000 个之间有 1 秒的间隙"""
+    count, begin = 100000, D('1600000000.000000')
+
+    def _range(i):
+        start = begin + i * 10 + i // 1000
+        return start, start + 10
+
+    entries = [timeline.TimelineEntry(f's{i}', m.SnapshotStorage.TYPE_CDP, m.SnapshotStorage.STATUS_STORAGE,
+                                      None, None, *_range(i)) for i in range(count)]
+    random.Random(0).shuffle(entries)
+    tree_timeline = timeline.TreeTimeline(TREE_IDENT, entries)
+    assert tree_timeline.gap_count == count // 1000 - 1
+
+    rng = random.Random(0)
+    for _ in range(1000):
+        i = rng.randrange(count)
+        start, finish = _range(i)
+        timestamp = start + D(rng.randrange(1, 10000)) / 1000
+        assert [entry.ident for entry in tree_timeline.find(timestamp)] == [f's{i}']
+        assert [entry.ident for entry in tree_timeline.find(start)] == ([f's{i}', f's{i - 1}']
+                                                                        if i % 1000 else [f's{i}'])
+        in_gap = i % 1000 == 999 or i == count - 1
+        assert [entry.ident for entry in tree_timeline.find(finish + D('0.5'))] == ([] if in_gap else [f's{i + 1}'])
+
+    entries, page_token = tree_timeline.page(_range(54321)[0] + 1, limit=3)
+    assert _describe(entries) == ['s54321', 's54322', 's54323'] and page_token == f'{_range(54323)[0]}|s54323'
@@ -0,0 +1,49 @@
+import pytest
+
+from business_logic import locker_manager as lm
+from business_logic import storage
+from business_logic import tree_versions
+from data_access import models as m
+from data_access import session as s
+
+pytestmark = pytest.mark.usefixtures('db')
+
+TREE_IDENT = 'tree'
+
+
+@pytest.fixture()
+def versions(create_storage):
+    with s.transaction():
+        for ident, parent_ident in (('q1', None), ('q2', 'q1'), ('q3', 'q2'),):
+            create_storage(ident, parent_ident)
+    return tree_versions.get_tree_versions()
+
+
+def _build(versions):
+    with lm.get_storage_locker('test_tree_versions'), s.readonly():
+        return versions.build(TREE_IDENT)
+
+
+def test_tree_versions(versions):
+    assert versions.get(TREE_IDENT) == (None, 0)
+    storage_tree, version = _build(versions)
+    assert [n.ident for n in storage_tree.fetch_nodes_to_root('q3')] == ['q1', 'q2', 'q3']
+    assert isinstance(storage_tree.get_node_by_ident('q3').storage, storage.StorageItem)  # 不持有数据库对象
+    assert versions.get(TREE_IDENT) == (storage_tree, version)
+
+    # 回收逻辑写入中：之前与写入中取得的版本号校验都失败，缓存的快照存储树仍可使用
+    with versions.writing(TREE_IDENT):
+        assert not versions.is_current(TREE_IDENT, version)
+        cached_tree, writing_version = versions.get(TREE_IDENT)
+        assert cached_tree is storage_tree and not versions.is_current(TREE_IDENT, writing_version)
+    assert not versions.is_current(TREE_IDENT, writing_version)  # 写入结束时版本号再次递增
+    cached_tree, new_version = versions.get(TREE_IDENT)
+    assert cached_tree is storage_tree and versions.is_current(TREE_IDENT, new_version)
+
+    # 快照存储变化：丢弃缓存的快照存储树
+    with lm.get_storage_locker('test_tree_versions'), s.transaction():
+        storage.query_by_ident('q3').update_status(m.SnapshotStorage.STATUS_RECYCLING)
+    assert versions.get(TREE_IDENT)[0] is None and not versions.is_current(TREE_IDENT, new_version)
+    storage_tree, version = _build(versions)
+    assert storage_tree.get_node_by_ident('q3').storage.status == m.SnapshotStorage.STATUS_RECYCLING
+    assert versions.to_dict() == {'trees': 1, 'hits': 3, 'misses': 2, 'builds': 2, 'conflicts': 4}
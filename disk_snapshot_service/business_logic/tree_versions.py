@@ -0,0 +1,139 @@
+"""快照存储树的不可修改版本
+
+打开快照存储（handle_operation.OpenStorage）只需要快照存储树的一致视图，在存储锁内从数据库生成快照存储树，
+与备份（创建、关闭快照存储）和回收逻辑竞争同一把存储锁
+    1. 每棵快照存储树有一个版本号，快照存储的状态或父节点变化时（在存储锁与数据库事务内）递增，同时丢弃缓存的快照存储树
+    2. 缓存的快照存储树在存储锁内生成（build），节点为从数据库对象复制的 StorageItem ，生成后不再修改，多个线程共享
+    3. 读取者不持有存储锁：取得当前的快照存储树与版本号（get），生成快照存储链并登记引用后，校验版本号没有变化（is_current）
+       校验失败时释放快照存储链，回退到在存储锁内生成
+    4. 回收逻辑从检查引用到创建作业、分配资源期间为写入中（writing），开始与结束时各递增一次版本号，不丢弃缓存的快照存储树；
+       写入中校验总是失败。读取者先登记引用再校验：
+       a. 校验时写入还未开始：登记的引用一定能被之后检查引用的回收逻辑看到
+       b. 校验时写入中：校验失败
+       c. 校验时写入已结束：取得版本号在写入结束前，版本号已变化，校验失败；取得版本号在写入结束后，
+          回收作业已分配资源，与在存储锁内打开的读取者一致
+
+版本号在进程内单调递增，不会复用；快照存储树的版本号不随缓存淘汰而删除，避免旧版本的读取者校验成功
+"""
+import collections
+import contextlib
+import itertools
+import threading
+import typing
+
+from cpkt.core import xlogging as lg
+
+from business_logic import storage
+from business_logic import storage_tree as tree
+
+_logger = lg.get_logger(__name__)
+
+
+class TreeVersions(object):
+    """缓存各快照存储树的当前版本"""
+
+    def __init__(self, max_trees=256):
+        self.max_trees = max_trees
+        self._trees: typing.Dict[str, tree.DiskSnapshotStorageTree] = collections.OrderedDict()
+        self._versions: typing.Dict[str, int] = dict()  # tree_ident -> 版本号，没有记录时为 0
+        self._writing: typing.Dict[str, int] = collections.Counter()  # tree_ident -> 写入中的回收逻辑数量
+        self._counter = itertools.count(1)
+        self._locker = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.conflicts = 0  # 读取者校验版本号失败的次数
+
+    def __str__(self):
+        return f'tree_versions:<{len(self._trees)} trees,{self.hits} hits,{self.conflicts} conflicts>'
+
+    def get(self, tree_ident: str) -> typing.Tuple[typing.Union[tree.DiskSnapshotStorageTree, None], int]:
+        """返回 当前版本的快照存储树（没有缓存时为 None）, 版本号 ，无需持有存储锁"""
+        with self._locker:
+            storage_tree = self._trees.get(tree_ident)
+            if storage_tree is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._trees.move_to_end(tree_ident)
+            return storage_tree, self._versions.get(tree_ident, 0)
+
+    def build(self, tree_ident: str) -> typing.Tuple[tree.DiskSnapshotStorageTree, int]:
+        """在存储锁与数据库事务内调用，生成并发布当前版本"""
+        storage_tree = tree.generate(tree_ident, frozen=True)
+        with self._locker:
+            self.builds += 1
+            self._trees[tree_ident] = storage_tree
+            while len(self._trees) > self.max_trees:
+                self._trees.popitem(last=False)
+            version = self._versions.get(tree_ident, 0)
+        _logger.debug('%s built %s at %s', self, tree_ident, version)
+        return storage_tree, version
+
+    def is_current(self, tree_ident: str, version: int) -> bool:
+        """读取者登记引用后调用，回收逻辑写入中时失败"""
+        with self._locker:
+            if self._versions.get(tree_ident, 0) == version and not self._writing[tree_ident]:
+                return True
+            self.conflicts += 1
+            return False
+
+    def begin_write(self, tree_ident: str):
+        """在存储锁内、检查快照存储的引用前调用，之前取得版本号的读取者校验失败"""
+        with self._locker:
+            self._versions[tree_ident] = next(self._counter)
+            self._writing[tree_ident] += 1
+
+    def end_write(self, tree_ident: str):
+        """在存储锁内、回收作业分配资源且事务提交后调用，写入期间取得版本号的读取者校验失败"""
+        with self._locker:
+            self._versions[tree_ident] = next(self._counter)
+            self._writing[tree_ident] -= 1
+            if not self._writing[tree_ident]:
+                del self._writing[tree_ident]
+
+    @contextlib.contextmanager
+    def writing(self, tree_ident: str):
+        self.begin_write(tree_ident)
+        try:
+            yield
+        finally:
+            self.end_write(tree_ident)
+
+    def invalidate(self, tree_ident: str):
+        """快照存储树中的快照存储发生变化，在锁空间内调用"""
+        with self._locker:
+            self._versions[tree_ident] = next(self._counter)
+            self._trees.pop(tree_ident, None)
+
+    def clear(self):
+        with self._locker:
+            for tree_ident in self._trees:
+                self._versions[tree_ident] = next(self._counter)
+            self._trees.clear()
+
+    def to_dict(self) -> dict:
+        with self._locker:
+            return {'trees': len(self._trees), 'hits': self.hits, 'misses': self.misses, 'builds': self.builds,
+                    'conflicts': self.conflicts}
+
+
+_tree_versions: TreeVersions = None
+_tree_versions_locker = threading.Lock()
+
+
+def get_tree_versions() -> TreeVersions:
+    global _tree_versions
+
+    if _tree_versions is None:
+        with _tree_versions_locker:
+            if _tree_versions is None:
+                _tree_versions = TreeVersions()
+                storage.add_change_listener(_on_storage_changed)
+    return _tree_versions
+
+
+def _on_storage_changed(storage_ident: str, tree_ident: str):
+    _ = storage_ident
+    if _tree_versions is not None:
+        _tree_versions.invalidate(tree_ident)
@@ -0,0 +1,73 @@
+import pytest
+from ice_service import service  # noqa 与服务进程的模块加载顺序一致，避免循环引用
+from business_logic import storage_reference_manager as srm
+from business_logic import tree_versions
+from data_access import models as m
+from data_access import session as s
+
+
+GiB = 1024 * 1024 * 1024
+
+
+@pytest.fixture()
+def reset_singletons():
+    """重置全局单例，用例结束时再次重置
+
+    usage:
+        reset_singletons((timeline, '_storage_timelines'), (action.ImagePathGenerator, 'qcow_file_provider'))
+    """
+
+    targets = list()
+
+    def _reset(*items):
+        for owner, name in items:
+            setattr(owner, name, None)
+            targets.append((owner, name))
+
+    try:
+        yield _reset
+    finally:
+        for owner, name in reversed(targets):
+            setattr(owner, name, None)
+
+
+@pytest.fixture()
+def db(reset_singletons):
+    """使用内存数据库替代服务数据库，每个用例独立"""
+
+    with s.local_database('sqlite://') as engine:
+        m.Base.metadata.create_all(engine)
+        reset_singletons((srm, '_storage_reference_manager'), (tree_versions, '_tree_versions'))
+        try:
+            yield engine
+        finally:
+            s.session_maker.remove()
+
+
+@pytest.fixture()
+def create_storage():
+    """创建快照存储，需要在事务中调用；缺省为快照存储树 tree 中 1GiB 的 qcow 快照存储，状态为 Storage"""
+
+    def _create(ident, parent_ident=None, status=m.SnapshotStorage.STATUS_STORAGE,
+                storage_type=m.SnapshotStorage.TYPE_QCOW, image_path=None, disk_bytes=GiB, tree_ident='tree',
+                start=None, finish=None, parent_timestamp=None) -> m.SnapshotStorage:
+        storage_obj = m.SnapshotStorage(
+            ident=ident, parent_ident=parent_ident, parent_timestamp=parent_timestamp, type=storage_type,
+            disk_bytes=disk_bytes, status=status, image_path=image_path or f'/mnt/{ident}', tree_ident=tree_ident,
+            start_timestamp=start, finish_timestamp=finish)
+        session = s.get_scoped_session()
+        session.add(storage_obj)
+        session.flush()
+        return storage_obj
+
+    return _create
+
+
+@pytest.fixture()
+def fake_img():
+    """进程内的替身镜像服务，没有延迟与失败，用例可以修改 profiles"""
+
+    from ice_service import fake_img_service
+
+    with fake_img_service.FakeImgServices(seed=0).install() as services:
+        yield services
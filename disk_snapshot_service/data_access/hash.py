@@ -0,0 +1,45 @@
+import typing
+
+from cpkt.core import xlogging as lg
+
+from basic_library import xfunctions as xf
+from data_access import models as m
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+
+def create_obj(storage_ident: str, version: str, hash_type: str, path: str) -> m.Hash:
+    new_hash_obj = m.Hash(
+        storage_ident=storage_ident,
+        timestamp=xf.current_timestamp(),
+        version=version,
+        type=hash_type,
+        path=path,
+    )
+    session = s.get_scoped_session()
+    session.add(new_hash_obj)
+    session.flush()
+    return new_hash_obj
+
+
+def get_last_obj_by_storage_ident(storage_ident: str) -> m.Hash:
+    return (s.get_scoped_session().query(m.Hash)
+            .filter(m.Hash.storage_ident == storage_ident)
+            .order_by(m.Hash.id.desc())
+            .first())
+
+
+def update_obj_type(hash_obj: m.Hash, hash_type: str):
+    hash_obj.type = hash_type
+    s.get_scoped_session().flush()
+
+
+def query_objs_by_storage_status(status) -> typing.List[m.Hash]:
+    """获取指定状态的快照存储的hash"""
+
+    return (s.get_scoped_session().query(m.Hash)
+            .join(m.SnapshotStorage, m.SnapshotStorage.ident == m.Hash.storage_ident)
+            .filter(m.SnapshotStorage.status == status)
+            .order_by(m.Hash.id)
+            .all())
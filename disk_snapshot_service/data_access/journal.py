@@ -1,3 +1,6 @@
+import typing
+
+import sqlalchemy
 from cpkt.core import xlogging as lg
 
 from basic_library import xfunctions as xf
@@ -11,7 +14,7 @@ def consume(journal_obj):
     assert not journal_obj.consumed_timestamp, ('磁盘快照日志已被消费', f'journal has consumed {journal_obj}', 0)
     journal_obj.consumed_timestamp = xf.current_timestamp()
     s.get_scoped_session().flush()
-    _logger.info(f'journal consumed : {journal_obj}')
+    _logger.info('journal consumed : %s', str(journal_obj))
     return journal_obj
 
 
@@ -24,6 +27,18 @@ def query_unconsumed_objs(journal_type=None, before_journal_obj: m.Journal = Non
     return q.order_by(m.Journal.id).all()
 
 
+def query_unconsumed_summary() -> typing.Dict[str, typing.Tuple[int, typing.Any]]:
+    """获取各类型未消费日志的 (数量, 最早的产生时间)"""
+
+    return {operation_type: (count, oldest) for operation_type, count, oldest in (
+        s.get_scoped_session().query(m.Journal.operation_type, sqlalchemy.func.count(m.Journal.id),
+                                     sqlalchemy.func.min(m.Journal.produced_timestamp))
+        .filter(m.Journal.consumed_timestamp.is_(None))
+        .group_by(m.Journal.operation_type)
+        .all()
+    )}
+
+
 def alter_children(journal_obj, new_value: str):
     old_value = journal_obj.children_idents
     journal_obj.children_idents = new_value
@@ -0,0 +1,85 @@
+import typing
+
+import sqlalchemy
+from cpkt.core import xlogging as lg
+
+from basic_library import xfunctions as xf
+from data_access import models as m
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+
+def create_obj(storage_ident: str, work_type: str, merge_idents: str, total_bytes: int) -> m.MergeCheckpoint:
+    new_checkpoint_obj = m.MergeCheckpoint(
+        storage_ident=storage_ident,
+        work_type=work_type,
+        merge_idents=merge_idents,
+        total_bytes=total_bytes,
+        finished_bytes=0,
+        failed_count=0,
+        updated_timestamp=xf.current_timestamp(),
+    )
+    session = s.get_scoped_session()
+    session.add(new_checkpoint_obj)
+    session.flush()
+    _logger.info(f'create <{new_checkpoint_obj}>')
+    return new_checkpoint_obj
+
+
+def get_obj_by_storage_ident(storage_ident: str) -> typing.Union[m.MergeCheckpoint, None]:
+    return (s.get_scoped_session().query(m.MergeCheckpoint)
+            .filter(m.MergeCheckpoint.storage_ident == storage_ident)
+            .first()
+            )
+
+
+def query_objs_in_tree(tree_ident: str) -> typing.List[m.MergeCheckpoint]:
+    """获取快照存储树中，新快照存储仍处于创建中的合并进度"""
+
+    return (s.get_scoped_session().query(m.MergeCheckpoint)
+            .join(m.SnapshotStorage, m.SnapshotStorage.ident == m.MergeCheckpoint.storage_ident)
+            .filter(m.SnapshotStorage.tree_ident == tree_ident)
+            .filter(m.SnapshotStorage.status == m.SnapshotStorage.STATUS_CREATING)
+            .order_by(m.MergeCheckpoint.id)
+            .all()
+            )
+
+
+def query_progress_by_type() -> typing.Dict[str, typing.Tuple[int, int, int]]:
+    """获取各类型合并作业的 (数量, 已搬迁的数据量, 总数据量)"""
+
+    return {work_type: (count, int(finished_bytes or 0), int(total_bytes or 0))
+            for work_type, count, finished_bytes, total_bytes in (
+                s.get_scoped_session().query(m.MergeCheckpoint.work_type, sqlalchemy.func.count(m.MergeCheckpoint.id),
+                                             sqlalchemy.func.sum(m.MergeCheckpoint.finished_bytes),
+                                             sqlalchemy.func.sum(m.MergeCheckpoint.total_bytes))
+                .group_by(m.MergeCheckpoint.work_type)
+                .all()
+            )}
+
+
+def update_finished_bytes(storage_ident: str, finished_bytes: int):
+    (s.get_scoped_session().query(m.MergeCheckpoint)
+     .filter(m.MergeCheckpoint.storage_ident == storage_ident)
+     .update({m.MergeCheckpoint.finished_bytes: finished_bytes,
+              m.MergeCheckpoint.updated_timestamp: xf.current_timestamp(), },
+             synchronize_session=False)
+     )
+
+
+def increase_failed_count(storage_ident: str):
+    (s.get_scoped_session().query(m.MergeCheckpoint)
+     .filter(m.MergeCheckpoint.storage_ident == storage_ident)
+     .update({m.MergeCheckpoint.failed_count: m.MergeCheckpoint.failed_count + 1,
+              m.MergeCheckpoint.updated_timestamp: xf.current_timestamp(), },
+             synchronize_session=False)
+     )
+
+
+def delete_obj(storage_ident: str):
+    (s.get_scoped_session().query(m.MergeCheckpoint)
+     .filter(m.MergeCheckpoint.storage_ident == storage_ident)
+     .delete(synchronize_session=False)
+     )
+    _logger.info(f'delete merge_checkpoint : {storage_ident}')
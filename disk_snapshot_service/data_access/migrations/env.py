@@ -12,7 +12,8 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
-fileConfig(config.config_file_name)
+if config.config_file_name and config.attributes.get('configure_logger', True):
+    fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
@@ -29,6 +30,16 @@ target_metadata = models.Base.metadata
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
+# 可以通过 alembic -x db_url=sqlite:////path/to/file.db upgrade head 指定数据库
+db_url = context.get_x_argument(as_dictionary=True).get('db_url')
+if db_url:
+    config.set_main_option('sqlalchemy.url', db_url)
+
+
+def is_sqlite(url):
+    # sqlite 不支持大部分 ALTER TABLE，使用 batch 模式重建表
+    return str(url).startswith('sqlite')
+
 
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
@@ -44,7 +55,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        render_as_batch=is_sqlite(url)
     )
 
     with context.begin_transaction():
@@ -66,7 +78,8 @@ def run_migrations_online():
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata,
+            render_as_batch=is_sqlite(connection.engine.url)
         )
 
         with context.begin_transaction():
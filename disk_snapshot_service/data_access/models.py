@@ -1,10 +1,20 @@
 import sqlalchemy
 from sqlalchemy import orm
+from sqlalchemy.ext import compiler
 from sqlalchemy.ext import declarative
 
 Base = declarative.declarative_base()
 
 
+@compiler.compiles(sqlalchemy.BigInteger, 'sqlite')
+def _compile_big_integer_for_sqlite(type_, sql_compiler, **kw):
+    """sqlite 仅支持 INTEGER 类型的自增主键，供测试与模拟器使用"""
+    _ = type_
+    _ = sql_compiler
+    _ = kw
+    return 'INTEGER'
+
+
 class Journal(Base):
     __tablename__ = 'journal'
 
@@ -80,7 +90,7 @@ class SnapshotStorage(Base):
 
     type = sqlalchemy.Column(sqlalchemy.String(1), nullable=False)  # type 为枚举类型
     disk_bytes = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
-    status = sqlalchemy.Column(sqlalchemy.String(1), nullable=False)  # status 为枚举类型
+    status = sqlalchemy.Column(sqlalchemy.String(1), index=True, nullable=False)  # status 为枚举类型
     image_path = sqlalchemy.Column(sqlalchemy.String(250), nullable=False)
     new_storage_size = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=True)
     start_timestamp = sqlalchemy.Column(sqlalchemy.Numeric(16, 6, 6, True), nullable=True)
@@ -131,3 +141,77 @@ class Hash(Base):
     # 全量、增量
     type = sqlalchemy.Column(sqlalchemy.String(1), nullable=False)  # type 为枚举类型
     path = sqlalchemy.Column(sqlalchemy.String(250), nullable=False)
+
+
+class MergeCheckpoint(Base):
+    __tablename__ = 'merge_checkpoint'
+
+    # work_type:
+    TYPE_CDP = 'c'
+    TYPE_QCOW_MOVE_DATA = 'm'
+    TYPE_QCOW_FLATTEN = 'f'
+
+    TYPE_DISPLAY = {
+        TYPE_CDP: 'merge_cdp',
+        TYPE_QCOW_MOVE_DATA: 'merge_qcow_move_data',
+        TYPE_QCOW_FLATTEN: 'flatten_qcow_chain',
+    }
+
+    id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True, autoincrement=True, nullable=False)
+    # 合并作业生成的新快照存储
+    storage_ident = sqlalchemy.Column(sqlalchemy.String(32), sqlalchemy.ForeignKey("snapshot_storage.ident"),
+                                      unique=True, nullable=False)
+    work_type = sqlalchemy.Column(sqlalchemy.String(1), nullable=False)  # work_type 为枚举类型
+    # 被合并的快照存储，逗号分隔，顺序为从父到子
+    merge_idents = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    total_bytes = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    # [0, finished_bytes) 区间的数据已经搬迁完毕
+    finished_bytes = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    # 作业因可恢复的异常而失败的次数
+    failed_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0, server_default='0')
+    updated_timestamp = sqlalchemy.Column(sqlalchemy.Numeric(16, 6, 6, True), nullable=False)
+
+    @property
+    def work_type_display(self) -> str:
+        return self.TYPE_DISPLAY[self.work_type]
+
+    def __str__(self):
+        return 'merge_checkpoint: {}-{}-{}/{}'.format(
+            self.storage_ident, self.work_type_display, self.finished_bytes, self.total_bytes)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class QcowPoolFile(Base):
+    """预先创建的空qcow文件，参考 business_logic.qcow_pool"""
+
+    __tablename__ = 'qcow_pool_file'
+
+    # status:
+    STATUS_CREATING = 'c'
+    STATUS_READY = 'r'
+    STATUS_DELETING = 'd'
+
+    STATUS_DISPLAY = {
+        STATUS_CREATING: 'creating',
+        STATUS_READY: 'ready',
+        STATUS_DELETING: 'deleting',
+    }
+
+    id = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True, autoincrement=True, nullable=False)
+    path = sqlalchemy.Column(sqlalchemy.String(250), unique=True, nullable=False)
+    folder = sqlalchemy.Column(sqlalchemy.String(250), nullable=False)
+    disk_bytes = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    status = sqlalchemy.Column(sqlalchemy.String(1), nullable=False)  # status 为枚举类型
+    updated_timestamp = sqlalchemy.Column(sqlalchemy.Numeric(16, 6, 6, True), nullable=False)
+
+    @property
+    def status_display(self) -> str:
+        return self.STATUS_DISPLAY[self.status]
+
+    def __str__(self):
+        return 'qcow_pool_file: {}-{}-{}'.format(self.path, self.disk_bytes, self.status_display)
+
+    def __repr__(self):
+        return self.__str__()
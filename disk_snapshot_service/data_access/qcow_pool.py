@@ -0,0 +1,88 @@
+import typing
+
+import sqlalchemy
+from cpkt.core import xlogging as lg
+
+from basic_library import xfunctions as xf
+from data_access import models as m
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+
+def create_obj(path: str, folder: str, disk_bytes: int) -> m.QcowPoolFile:
+    """登记即将创建的文件，创建完成前状态为 creating"""
+
+    new_file_obj = m.QcowPoolFile(
+        path=path,
+        folder=folder,
+        disk_bytes=disk_bytes,
+        status=m.QcowPoolFile.STATUS_CREATING,
+        updated_timestamp=xf.current_timestamp(),
+    )
+    session = s.get_scoped_session()
+    session.add(new_file_obj)
+    session.flush()
+    return new_file_obj
+
+
+def query_objs_by_status(status) -> typing.List[m.QcowPoolFile]:
+    return (s.get_scoped_session().query(m.QcowPoolFile)
+            .filter(m.QcowPoolFile.status == status)
+            .order_by(m.QcowPoolFile.id)
+            .all()
+            )
+
+
+def query_ready_counts() -> typing.Dict[typing.Tuple[str, int], int]:
+    """获取各 (文件夹, 磁盘大小) 可用的文件数量"""
+
+    return {(folder, int(disk_bytes)): count for folder, disk_bytes, count in (
+        s.get_scoped_session().query(m.QcowPoolFile.folder, m.QcowPoolFile.disk_bytes,
+                                     sqlalchemy.func.count(m.QcowPoolFile.id))
+        .filter(m.QcowPoolFile.status == m.QcowPoolFile.STATUS_READY)
+        .group_by(m.QcowPoolFile.folder, m.QcowPoolFile.disk_bytes)
+        .all()
+    )}
+
+
+def update_status(file_id: int, old_status, new_status) -> bool:
+    """仅在状态为 old_status 时修改，返回是否修改成功
+
+    :remark:
+        取用与收缩都通过本函数抢占可用的文件，同一文件仅有一方成功
+    """
+
+    return (s.get_scoped_session().query(m.QcowPoolFile)
+            .filter(m.QcowPoolFile.id == file_id)
+            .filter(m.QcowPoolFile.status == old_status)
+            .update({m.QcowPoolFile.status: new_status,
+                     m.QcowPoolFile.updated_timestamp: xf.current_timestamp(), },
+                    synchronize_session=False)
+            ) == 1
+
+
+def take_ready_path(folder: str, disk_bytes: int) -> typing.Union[str, None]:
+    """取出一个可用的文件，删除其记录后文件归调用者所有；调用者的事务回滚时文件仍归文件池所有"""
+
+    session = s.get_scoped_session()
+    for file_id, path in (session.query(m.QcowPoolFile.id, m.QcowPoolFile.path)
+                          .filter(m.QcowPoolFile.folder == folder)
+                          .filter(m.QcowPoolFile.disk_bytes == disk_bytes)
+                          .filter(m.QcowPoolFile.status == m.QcowPoolFile.STATUS_READY)
+                          .order_by(m.QcowPoolFile.id)
+                          .limit(4)
+                          .all()):
+        if (session.query(m.QcowPoolFile)
+                .filter(m.QcowPoolFile.id == file_id)
+                .filter(m.QcowPoolFile.status == m.QcowPoolFile.STATUS_READY)
+                .delete(synchronize_session=False)) == 1:
+            return path
+    return None
+
+
+def delete_obj(file_id: int):
+    (s.get_scoped_session().query(m.QcowPoolFile)
+     .filter(m.QcowPoolFile.id == file_id)
+     .delete(synchronize_session=False)
+     )
@@ -1,35 +1,270 @@
 import contextlib
+import functools
+import threading
+import time
 
 import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy import orm
+from sqlalchemy import pool
 
 db_connect_str = 'postgresql+psycopg2://postgres:f@127.0.0.1:21114/disksnapshotservice'
+
+
+class PoolConfig(object):
+    """数据库连接池参数
+
+    :remark:
+        Ice 分发线程最多 128 个（Ice.ThreadPool.Server.SizeMax），每个线程持有自己的 scoped session
+        pool_size + max_overflow 限制了数据库连接的数量上限，超出后等待 pool_timeout 秒
+    """
+
+    def __init__(self, pool_size=16, max_overflow=48, pool_timeout=30, pool_recycle=3600, pool_pre_ping=True):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+
+    def __str__(self):
+        return (f'PoolConfig: size {self.pool_size}, overflow {self.max_overflow}, timeout {self.pool_timeout}, '
+                f'recycle {self.pool_recycle}, pre_ping {self.pool_pre_ping}')
+
+    def to_engine_kwargs(self) -> dict:
+        return {
+            'pool_size': self.pool_size,
+            'max_overflow': self.max_overflow,
+            'pool_timeout': self.pool_timeout,
+            'pool_recycle': self.pool_recycle,
+            'pool_pre_ping': self.pool_pre_ping,
+        }
+
+
+class PoolMetrics(object):
+    """连接池的统计数据，通过连接池事件收集"""
+
+    def __init__(self):
+        self._locker = threading.Lock()
+        self.connections = 0  # 当前打开的数据库连接
+        self.connections_max = 0
+        self.connects_total = 0
+        self.in_use = 0  # 当前被签出的连接
+        self.in_use_max = 0
+        self.checkouts_total = 0
+        self.checkout_wait_seconds_total = 0.0
+        self.checkout_wait_seconds_max = 0.0
+        self.checkout_timeouts_total = 0
+
+    def to_dict(self) -> dict:
+        with self._locker:
+            return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+    def on_connect(self, *args):
+        _ = args
+        with self._locker:
+            self.connections += 1
+            self.connects_total += 1
+            self.connections_max = max(self.connections_max, self.connections)
+
+    def on_close(self, *args):
+        _ = args
+        with self._locker:
+            self.connections -= 1
+
+    def on_checkout(self, *args):
+        _ = args
+        with self._locker:
+            self.in_use += 1
+            self.checkouts_total += 1
+            self.in_use_max = max(self.in_use_max, self.in_use)
+
+    def on_checkin(self, *args):
+        _ = args
+        with self._locker:
+            self.in_use -= 1
+
+    def on_wait(self, seconds: float, timeout: bool):
+        with self._locker:
+            self.checkout_wait_seconds_total += seconds
+            self.checkout_wait_seconds_max = max(self.checkout_wait_seconds_max, seconds)
+            if timeout:
+                self.checkout_timeouts_total += 1
+
+    def listen(self, engine_pool: pool.Pool):
+        event.listen(engine_pool, 'connect', self.on_connect)
+        event.listen(engine_pool, 'close', self.on_close)
+        event.listen(engine_pool, 'checkout', self.on_checkout)
+        event.listen(engine_pool, 'checkin', self.on_checkin)
+
+
+class InstrumentedQueuePool(pool.QueuePool):
+    """记录签出连接时的等待时间（连接池没有签出前的事件）"""
+
+    metrics: PoolMetrics = None
+
+    def _do_get(self):
+        begin = time.monotonic()
+        timeout = False
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            timeout = True
+            raise
+        finally:
+            if self.metrics:
+                self.metrics.on_wait(time.monotonic() - begin, timeout)
+
+
+SQLITE_BEGIN = 'sqlite_begin'  # 连接的执行选项，sqlite 事务的类型
+
+
+def is_sqlite(connect_str: str) -> bool:
+    return connect_str.startswith('sqlite')
+
+
+def _is_sqlite_memory(connect_str: str) -> bool:
+    return connect_str in ('sqlite://', 'sqlite:///:memory:',)
+
+
+def _prepare_sqlite_engine(new_engine, wal: bool):
+    """sqlite 本地模式
+
+    :remark:
+        1. 文件数据库使用 WAL 模式，读写可以并发进行
+        2. 启用外键约束，与 PostgreSQL 行为一致
+        3. pysqlite 驱动会延迟发出 BEGIN，导致 SAVEPOINT 与事务边界不符合预期；
+           禁用驱动的事务管理，由 SQLAlchemy 在 begin 事件中显式发出 BEGIN，
+           使 transaction() 与 readonly() 的语义与 PostgreSQL 一致
+        4. 写事务使用 BEGIN IMMEDIATE，参考 _begin_sqlite_writing
+    """
+
+    @event.listens_for(new_engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        _ = connection_record
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.execute('PRAGMA busy_timeout=30000')
+        cursor.close()
+
+    @event.listens_for(new_engine, 'begin')
+    def _on_begin(connection):
+        connection.execute(f'BEGIN {connection.get_execution_options().get(SQLITE_BEGIN, "DEFERRED")}')
+
+
+def create_engine(connect_str: str, config: PoolConfig, metrics: PoolMetrics, **kwargs):
+    """创建 engine，支持 PostgreSQL 与 sqlite（文件或内存）
+
+    :remark:
+        内存数据库仅存在于单个连接中，使用 StaticPool 在所有线程间共享这一个连接，
+        因此不支持多个线程同时使用事务；并发的测试与基准需要使用文件数据库
+    """
+    if is_sqlite(connect_str):
+        kwargs.setdefault('connect_args', dict())['check_same_thread'] = False
+        if _is_sqlite_memory(connect_str):
+            new_engine = sqlalchemy.create_engine(connect_str, echo=False, poolclass=pool.StaticPool, **kwargs)
+            _prepare_sqlite_engine(new_engine, False)
+            metrics.listen(new_engine.pool)
+            return new_engine
+
+    instrumented_pool = type('InstrumentedQueuePool', (InstrumentedQueuePool,), {'metrics': metrics})
+    new_engine = sqlalchemy.create_engine(
+        connect_str, echo=False, poolclass=instrumented_pool, **config.to_engine_kwargs(), **kwargs)
+    if is_sqlite(connect_str):
+        _prepare_sqlite_engine(new_engine, True)
+    metrics.listen(new_engine.pool)
+    return new_engine
+
+
 """
 使用scoped_session简化代码
 注意：在“业务线程”退出时通过remove释放session；建议使用scoped_session_thread装饰器辅助释放
 """
-engine = sqlalchemy.create_engine(db_connect_str, echo=False, max_overflow=1024)
+pool_config = PoolConfig()
+pool_metrics = PoolMetrics()
+engine = create_engine(db_connect_str, pool_config, pool_metrics)
 session_maker = orm.scoped_session(orm.sessionmaker(bind=engine))
 
 
+def configure_engine(config: PoolConfig = None, connect_str: str = None):
+    """使用新的连接池参数或数据库重建 engine，需要在服务开始处理请求前调用
+
+    :param config: 连接池参数，None 时保持不变
+    :param connect_str: 数据库连接字符串，None 时保持不变；支持 sqlite 本地模式，参考 create_engine
+    """
+    global engine, pool_config, pool_metrics, db_connect_str
+
+    old_engine = engine
+    pool_config = config or pool_config
+    db_connect_str = connect_str or db_connect_str
+    pool_metrics = PoolMetrics()
+    engine = create_engine(db_connect_str, pool_config, pool_metrics)
+    session_maker.remove()
+    session_maker.configure(bind=engine)
+    old_engine.dispose()
+    return engine
+
+
+@contextlib.contextmanager
+def local_database(connect_str: str = 'sqlite://', config: PoolConfig = None):
+    """临时切换到其他数据库（通常为 sqlite），供测试与基准使用，退出时恢复原有配置"""
+    old_connect_str, old_config = db_connect_str, pool_config
+    try:
+        yield configure_engine(config, connect_str)
+    finally:
+        configure_engine(old_config, old_connect_str)
+
+
 def get_scoped_session():
     """返回线程关联的session"""
     return session_maker()
 
 
 def scoped_session_thread(func):
-    """装饰器，辅助线程释放session对象"""
+    """装饰器，辅助线程释放session对象
+
+    :remark:
+        Ice 分发线程会被复用，每次分发结束后同样需要释放，避免session持有的连接与对象跨请求残留
+    """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        s = get_scoped_session()
         try:
             return func(*args, **kwargs)
         finally:
-            s.remove()
+            session_maker.remove()
 
     return wrapper
 
 
+@contextlib.contextmanager
+def _track_depth(session):
+    """记录 transaction() 与 readonly() 的嵌套层数，返回是否为最外层"""
+    depth = session.info.get('transaction_depth', 0)
+    session.info['transaction_depth'] = depth + 1
+    try:
+        yield depth == 0
+    finally:
+        session.info['transaction_depth'] = depth
+
+
+def _begin_sqlite_writing(session):
+    """sqlite 中写事务在开始时获得写锁
+
+    :remark:
+        DEFERRED 事务读取后再写入时，如果其他连接已经提交了写入，sqlite 直接返回 database is locked 而不等待；
+        PostgreSQL 中此时等待行锁，使用 IMMEDIATE 使并发写事务依次执行，与服务的行为一致
+        在事务外访问过期的数据库对象会隐式开始读事务，需要先结束该事务才能以 IMMEDIATE 开始新事务；
+        使用 rollback 结束，事务外未提交的修改被丢弃而不是随之提交，与 readonly 一致
+    """
+    if is_sqlite(session.get_bind().url.drivername):
+        session.rollback()
+        session.connection(execution_options={SQLITE_BEGIN: 'IMMEDIATE'})
+
+
 @contextlib.contextmanager
 def transaction(session=None, nested=False):
     if not session:
@@ -39,21 +274,25 @@ def transaction(session=None, nested=False):
         with session.begin_nested():
             yield session
     else:
-        try:
-            with session.begin(subtransactions=True):
-                yield session
-        except Exception:
-            session.rollback()
-            raise
-        else:
-            session.commit()
+        with _track_depth(session) as outermost:
+            if outermost:
+                _begin_sqlite_writing(session)
+            try:
+                with session.begin(subtransactions=True):
+                    yield session
+            except Exception:
+                session.rollback()
+                raise
+            else:
+                session.commit()
 
 
 @contextlib.contextmanager
 def readonly(session=None):
     if not session:
         session = get_scoped_session()
-    try:
-        yield session
-    finally:
-        session.rollback()
+    with _track_depth(session):
+        try:
+            yield session
+        finally:
+            session.rollback()
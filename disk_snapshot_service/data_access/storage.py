@@ -1,5 +1,6 @@
 import typing
 
+import sqlalchemy
 from cpkt.core import xlogging as lg
 
 from data_access import models as m
@@ -18,6 +19,84 @@ def query_valid_objs(tree_ident):
             )
 
 
+def query_timeline_rows(tree_ident, statuses) -> typing.List[tuple]:
+    """获取快照存储树中指定状态的快照存储的时间信息，仅查询需要的列
+
+    :return: [(ident, parent_ident, parent_timestamp, type, status, start_timestamp, finish_timestamp), ...]
+    """
+
+    return (s.get_scoped_session()
+            .query(m.SnapshotStorage.ident, m.SnapshotStorage.parent_ident, m.SnapshotStorage.parent_timestamp,
+                   m.SnapshotStorage.type, m.SnapshotStorage.status, m.SnapshotStorage.start_timestamp,
+                   m.SnapshotStorage.finish_timestamp)
+            .filter(m.SnapshotStorage.tree_ident == tree_ident)
+            .filter(m.SnapshotStorage.status.in_(statuses))
+            .all()
+            )
+
+
+def query_parent_rows(tree_ident) -> typing.List[tuple]:
+    """获取快照存储树中有效的快照存储的父节点与所在文件，仅查询需要的列
+
+    :return: [(ident, parent_ident, image_path), ...]
+    """
+
+    return (s.get_scoped_session()
+            .query(m.SnapshotStorage.ident, m.SnapshotStorage.parent_ident, m.SnapshotStorage.image_path)
+            .filter(m.SnapshotStorage.tree_ident == tree_ident)
+            .filter(m.SnapshotStorage.status != m.SnapshotStorage.STATUS_DELETED)
+            .all()
+            )
+
+
+def query_status_type_counts() -> typing.Dict[typing.Tuple[str, str], int]:
+    """获取各 (状态, 类型) 的快照存储数量"""
+
+    return {(status, storage_type): count for status, storage_type, count in (
+        s.get_scoped_session().query(m.SnapshotStorage.status, m.SnapshotStorage.type,
+                                     sqlalchemy.func.count(m.SnapshotStorage.ident))
+        .group_by(m.SnapshotStorage.status, m.SnapshotStorage.type)
+        .all()
+    )}
+
+
+def query_objs_by_status(status, limit=None) -> typing.List[m.SnapshotStorage]:
+    """获取指定状态的快照存储"""
+
+    q = s.get_scoped_session().query(m.SnapshotStorage).filter(m.SnapshotStorage.status == status)
+    if limit:
+        q = q.limit(limit)
+    return q.all()
+
+
+def query_interrupted_rows() -> typing.List[typing.Tuple[str, str]]:
+    """获取创建或写入过程被服务退出中断的快照存储，排除可以根据合并进度继续的快照存储
+
+    :return: [(ident, tree_ident), ...]
+    """
+
+    return (s.get_scoped_session().query(m.SnapshotStorage.ident, m.SnapshotStorage.tree_ident)
+            .outerjoin(m.MergeCheckpoint, m.MergeCheckpoint.storage_ident == m.SnapshotStorage.ident)
+            .filter(m.SnapshotStorage.status.in_((m.SnapshotStorage.STATUS_CREATING,
+                                                  m.SnapshotStorage.STATUS_WRITING,)))
+            .filter(m.MergeCheckpoint.id.is_(None))
+            .all()
+            )
+
+
+def query_tree_idents_by_status(status, storage_type, limit) -> typing.List[str]:
+    """获取包含指定状态与类型的快照存储的快照存储树"""
+
+    return [tree_ident for tree_ident, in (
+        s.get_scoped_session().query(m.SnapshotStorage.tree_ident)
+        .filter(m.SnapshotStorage.status == status)
+        .filter(m.SnapshotStorage.type == storage_type)
+        .distinct()
+        .limit(limit)
+        .all()
+    )]
+
+
 def get_obj_by_ident(storage_ident) -> m.SnapshotStorage:
     """获取指定快照存储"""
 
@@ -48,7 +127,8 @@ _status_transition = {
                                         m.SnapshotStorage.STATUS_RECYCLING,),
     m.SnapshotStorage.STATUS_WRITING: (m.SnapshotStorage.STATUS_CREATING,),
     m.SnapshotStorage.STATUS_HASHING: (m.SnapshotStorage.STATUS_WRITING,),
-    m.SnapshotStorage.STATUS_STORAGE: (m.SnapshotStorage.STATUS_HASHING,),
+    m.SnapshotStorage.STATUS_STORAGE: (m.SnapshotStorage.STATUS_HASHING,
+                                       m.SnapshotStorage.STATUS_CREATING,),  # 回收合并生成的快照存储
     m.SnapshotStorage.STATUS_RECYCLING: (m.SnapshotStorage.STATUS_STORAGE,),
     m.SnapshotStorage.STATUS_DELETED: (m.SnapshotStorage.STATUS_RECYCLING, m.SnapshotStorage.STATUS_ABNORMAL,),
 }
@@ -66,6 +146,23 @@ def update_obj_status(storage_obj: m.SnapshotStorage, new_status) -> m.SnapshotS
     return storage_obj
 
 
+def update_status_in_bulk(storage_idents: typing.List[str], new_status) -> int:
+    """批量修改快照存储的状态，仅修改满足状态转移定义的快照存储
+
+    :return: 修改的数量
+    :remark:
+        不同步会话中已经加载的对象，调用前不应持有这些快照存储的对象
+    """
+
+    if not storage_idents:
+        return 0
+    return (s.get_scoped_session().query(m.SnapshotStorage)
+            .filter(m.SnapshotStorage.ident.in_(storage_idents))
+            .filter(m.SnapshotStorage.status.in_(_status_transition[new_status]))
+            .update({m.SnapshotStorage.status: new_status}, synchronize_session=False)
+            )
+
+
 def update_obj_parent(storage_obj: m.SnapshotStorage,
                       parent_storage_obj: typing.Union[m.SnapshotStorage, None]) -> m.SnapshotStorage:
     _logger.info(f'alter [{storage_obj}] parent to <{parent_storage_obj}>')
@@ -86,6 +183,7 @@ def query_image_path_using_count(image_path: str) -> int:
             .filter(m.SnapshotStorage.image_path == image_path)
             .filter(m.SnapshotStorage.status.notin_((m.SnapshotStorage.STATUS_DELETED,
                                                      m.SnapshotStorage.STATUS_RECYCLING,
+                                                     m.SnapshotStorage.STATUS_ABNORMAL,
                                                      )))
             .count()
             )
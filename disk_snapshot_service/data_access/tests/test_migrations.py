@@ -0,0 +1,29 @@
+import os
+
+import sqlalchemy
+from alembic import command
+from alembic import config
+
+from data_access import models as m
+
+DATA_ACCESS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_upgrade_sqlite(tmp_path):
+    db_url = f'sqlite:///{tmp_path / "migrations.db"}'
+    cfg = config.Config(os.path.join(DATA_ACCESS_DIR, 'alembic.ini'))
+    cfg.set_main_option('script_location', os.path.join(DATA_ACCESS_DIR, 'migrations'))
+    cfg.set_main_option('sqlalchemy.url', db_url)
+    cfg.attributes['configure_logger'] = False
+
+    command.upgrade(cfg, 'head')
+
+    engine = sqlalchemy.create_engine(db_url)
+    try:
+        inspector = sqlalchemy.inspect(engine)
+        assert set(inspector.get_table_names()) == set(m.Base.metadata.tables) | {'alembic_version'}
+        for table in m.Base.metadata.sorted_tables:
+            columns = {c['name'] for c in inspector.get_columns(table.name)}
+            assert columns == set(table.columns.keys()), table.name
+    finally:
+        engine.dispose()
@@ -0,0 +1,208 @@
+import threading
+
+import pytest
+
+from data_access import models as m
+from data_access import session as s
+from data_access import storage as da_storage
+
+THREADS = 64
+ROUNDS = 20
+
+
+@pytest.fixture()
+def metrics(tmp_path):
+    """使用文件数据库与受限的连接池，模拟 Ice 分发线程的突发请求"""
+
+    metrics = s.PoolMetrics()
+    config = s.PoolConfig(pool_size=4, max_overflow=4, pool_timeout=30)
+    engine = s.create_engine(f'sqlite:///{tmp_path / "load.db"}', config, metrics)
+    m.Base.metadata.create_all(engine)
+    s.session_maker.remove()
+    s.session_maker.configure(bind=engine)
+    try:
+        yield metrics
+    finally:
+        s.session_maker.remove()
+        s.session_maker.configure(bind=s.engine)
+        engine.dispose()
+
+
+@s.scoped_session_thread
+def _dispatch(create_storage, ident):
+    with s.transaction():
+        create_storage(ident)
+    for _ in range(ROUNDS - 1):
+        with s.readonly():
+            assert da_storage.get_obj_by_ident(ident)
+
+
+def _run_threads(target, count):
+    errors = list()
+
+    def _run(i):
+        try:
+            target(i)
+            assert not s.session_maker.registry.has()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def _burst(create_storage, prefix):
+    _run_threads(lambda i: _dispatch(create_storage, f'{prefix}{i}'), THREADS)
+
+
+def _hold(count):
+    """count 个线程同时持有连接，之后全部归还；签出的连接数不受线程调度影响"""
+    holding = threading.Barrier(count)
+
+    @s.scoped_session_thread
+    def _query(_):
+        with s.readonly():
+            assert da_storage.get_obj_by_ident('a0')
+            holding.wait(timeout=30)
+
+    _run_threads(_query, count)
+
+
+def test_connections_stable_under_burst(metrics, create_storage):
+    checkouts = metrics.checkouts_total
+    _burst(create_storage, 'a')
+    first = metrics.to_dict()
+    assert first['checkouts_total'] - checkouts == THREADS * ROUNDS
+    assert first['in_use'] == 0
+    assert first['in_use_max'] <= 8
+    assert first['connections_max'] <= 8
+    assert first['connections'] <= 4  # 溢出的连接归还后关闭
+    assert first['checkout_timeouts_total'] == 0
+
+    # 突发请求期间签出的连接数在 pool_size 上下波动时，QueuePool 会关闭并重建溢出的连接，次数取决于线程调度；
+    # 这里同时持有 pool_size + max_overflow 个连接，检查连接池中的连接被复用
+    _hold(8)
+    held = metrics.to_dict()
+    assert held['connects_total'] - first['connects_total'] <= 4  # 连接池中的连接被复用
+    assert held['connections'] <= 4
+
+    _burst(create_storage, 'b')
+    second = metrics.to_dict()
+    assert second['connections_max'] <= 8
+    assert second['connections'] <= 4
+    assert second['checkout_timeouts_total'] == 0
+    assert second['checkout_wait_seconds_max'] >= 0
+
+
+def test_scoped_session_thread_remove_session(db):
+    @s.scoped_session_thread
+    def _query():
+        s.get_scoped_session()
+        assert s.session_maker.registry.has()
+
+    _query()
+    assert not s.session_maker.registry.has()
+
+
+def test_sqlite_file_use_wal(tmp_path):
+    with s.local_database(f'sqlite:///{tmp_path / "local.db"}') as engine:
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert engine.execute('PRAGMA foreign_keys').scalar() == 1
+    assert s.db_connect_str.startswith('postgresql')
+
+
+def test_transaction_rollback(db, create_storage):
+    with pytest.raises(ValueError):
+        with s.transaction():
+            create_storage('a')
+            raise ValueError()
+
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('a') is None
+
+
+def test_nested_transaction_rollback(db, create_storage):
+    with s.transaction():
+        create_storage('a')
+        with pytest.raises(ValueError):
+            with s.transaction(nested=True):  # SAVEPOINT
+                create_storage('b')
+                raise ValueError()
+
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('a')
+        assert da_storage.get_obj_by_ident('b') is None
+
+
+def test_readonly_discard_changes(db, create_storage):
+    with s.readonly():
+        create_storage('a')
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('a') is None
+
+
+def test_sqlite_writing_after_stale_read(tmp_path, create_storage):
+    """事务外的隐式读事务过时后，写事务不会因 database is locked 失败"""
+    with s.local_database(f'sqlite:///{tmp_path / "local.db"}') as engine:
+        m.Base.metadata.create_all(engine)
+        with s.transaction():
+            create_storage('a')
+        storage_obj = da_storage.get_obj_by_ident('a')  # 隐式开始读事务
+
+        thread = threading.Thread(target=s.scoped_session_thread(lambda: _dispatch(create_storage, 'b')))
+        thread.start()
+        thread.join()
+
+        with s.transaction():
+            create_storage(f'{storage_obj.ident}c')
+        with s.readonly():
+            assert da_storage.get_obj_by_ident('ac')
+        s.session_maker.remove()
+
+
+def test_sqlite_writing_discard_changes_outside_transaction(tmp_path, create_storage):
+    """开始写事务时结束隐式读事务，不提交事务外的修改"""
+    with s.local_database(f'sqlite:///{tmp_path / "local.db"}') as engine:
+        m.Base.metadata.create_all(engine)
+        create_storage('outside')
+        with s.transaction():
+            create_storage('a')
+        with s.readonly():
+            assert da_storage.get_obj_by_ident('a')
+            assert da_storage.get_obj_by_ident('outside') is None
+        s.session_maker.remove()
+
+
+def test_sqlite_concurrent_read_then_write(tmp_path, create_storage):
+    """先读取再写入的并发写事务依次执行，不因 database is locked 失败"""
+    reading = threading.Barrier(2)
+    errors = list()
+
+    @s.scoped_session_thread
+    def _update(status):
+        try:
+            with s.transaction():
+                storage_obj = da_storage.get_obj_by_ident('a')
+                reading.wait(timeout=1)  # IMMEDIATE 时第二个事务在开始时等待，不会同时读取
+                da_storage.update_obj_status(storage_obj, status)
+        except threading.BrokenBarrierError:
+            pass
+        except BaseException as e:
+            errors.append(e)
+
+    with s.local_database(f'sqlite:///{tmp_path / "local.db"}') as engine:
+        m.Base.metadata.create_all(engine)
+        with s.transaction():
+            create_storage('a')
+        threads = [threading.Thread(target=_update, args=(status,)) for status in (
+            m.SnapshotStorage.STATUS_RECYCLING, m.SnapshotStorage.STATUS_DELETED,)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        s.session_maker.remove()
+    assert not errors
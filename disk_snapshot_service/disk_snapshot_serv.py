@@ -7,6 +7,10 @@ if 'DISABLE_LOGGING_CONF' in os.environ:
 else:
     current_dir = os.path.split(os.path.realpath(__file__))[0]
     lg.set_logging_config(os.path.join(current_dir, 'logging.ini'))
+    if 'DISABLE_ASYNC_LOGGING' not in os.environ:
+        from basic_library import queue_logging
+
+        queue_logging.start()  # 日志在独立线程中格式化与写入文件，参考 queue_logging
 
 if True:  # 必须在所有代码加载前配置日志参数，抑制IDE警告
     import sys
@@ -35,5 +39,28 @@ app_default_properties = [
     (r'ImgService4R.Proxy', r'img : tcp -h 127.0.0.1 -p 21101'),
     (r'ImgService4W.Proxy', r'img : tcp -h 127.0.0.1 -p 21104'),
     (r'CdpWriter.Proxy', r'img : tcp -h 127.0.0.1 -p 21130'),
+    (r'DataAccess.Url', r'postgresql+psycopg2://postgres:f@127.0.0.1:21114/disksnapshotservice'),  # 支持 sqlite:////path
+    (r'DataAccess.PoolSize', r'16'),
+    (r'DataAccess.MaxOverflow', r'48'),
+    (r'DataAccess.PoolTimeout', r'30'),  # 单位秒，等待空闲连接的超时
+    (r'DataAccess.PoolRecycle', r'3600'),  # 单位秒，连接的最长使用时间
+    (r'DataAccess.PoolPrePing', r'1'),
+    (r'Snapshot.RecordPath', r''),  # 非空时记录所有 Op 调用到该文件，供 benchmark.op_replayer 回放
+    (r'Snapshot.LogPolicy', r'*=full'),  # Op 调用的日志详细程度与采样比例，参考 ice_service.op_log_policy
+    (r'Snapshot.LogPolicyPath', r'/run/dss_log_policy'),  # 运行时修改日志策略
+    (r'Snapshot.RawHandleCacheSize', r'32'),  # 缓存的原生读句柄数量上限，0 表示不缓存
+    (r'Snapshot.RawHandleCacheIdleSeconds', r'300'),  # 单位秒，缓存的原生读句柄空闲超时后关闭
+    (r'Snapshot.QcowMaxSnapshotsPerFile', r'64'),  # 单个qcow文件中的快照点数量上限，0 表示不限制
+    (r'Snapshot.QcowMaxChainDepth', r'32'),  # 单个qcow文件内快照链的深度上限，0 表示不限制
+    (r'Snapshot.QcowMaxFileMiB', r'262144'),  # 单位MiB，qcow文件达到该大小后不再复用，0 表示不限制
+    (r'Snapshot.QcowPoolSize', r'4'),  # 每个存储目录与磁盘大小预先创建的qcow文件数量上限，0 表示不预先创建
+    (r'Snapshot.QcowPoolMaxTotal', r'64'),  # 预先创建的qcow文件总数上限
+    (r'Snapshot.QcowPoolBucketSeconds', r'300'),  # 单位秒，按该时长统计取用次数，决定预先创建的数量
+    (r'Snapshot.FlattenMinKeyItems', r'16'),  # 打开快照需要叠加的qcow文件数量达到该值时合成全量快照，0 表示不合成
+    (r'Snapshot.MetricsAddress', r''),  # 以 Prometheus 文本格式提供统计数据的地址，例如 127.0.0.1:21109，为空时不提供
+    (r'Snapshot.MetricsCacheSeconds', r'15'),  # 单位秒，需要查询数据库的统计数据的缓存时长
+    (r'Snapshot.ReadyPath', r'/run/dss_ready'),  # 后台组件启动后、预热前写入该文件，内容为已完成启动阶段的耗时，为空时不写入；就绪前启动失败时删除该文件并退出进程
+    (r'Snapshot.ReadyTimeoutSeconds', r'60'),  # 单位秒，就绪前到达的 Op 调用等待就绪的超时
+    (r'Snapshot.WarmUpTrees', r'64'),  # 预热时生成时间区间索引的快照存储树数量上限，0 表示不预热
 ]
 service.app.main(sys.argv, '/etc/aio/disk_snapshot_serv.cfg', app_default_properties, _logger)
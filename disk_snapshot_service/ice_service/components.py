@@ -0,0 +1,192 @@
+"""服务的后台组件，在预热线程中加载与启动，参考 service.Server.run
+
+启动顺序：
+    1. 数据库、原生读句柄缓存、qcow文件复用与预先创建、回收参数
+    2. 获取被中断的快照存储（startup_recovery.scan），必须在处理第一个 Op 调用前完成
+    3. 创建全局单例，加载 Op 分发表
+    4. 启动后台线程：修正被中断的快照存储、Hashing 、统计数据；以上任意一步失败时服务退出，之后服务就绪
+    5. 就绪后预热：连接镜像服务，生成正在写入CDP的快照存储树的时间区间索引；失败不影响服务
+"""
+import time
+
+from cpkt.core import xlogging as lg
+
+from business_logic import cdp_index
+from business_logic import chain_metrics
+from business_logic import handle_pool as pool
+from business_logic import locker_manager as lm
+from business_logic import qcow_pool
+from business_logic import raw_handle_cache
+from business_logic import storage
+from business_logic import storage_action
+from business_logic import storage_reference_manager as srm
+from business_logic import storage_space
+from business_logic import storage_timeline as timeline
+from business_logic import storage_tree as tree
+from business_logic import tree_versions
+from data_access import models as m
+from data_access import session as s
+from ice_service import dispatch
+from ice_service import metrics_exporter
+from ice_service import service
+from ice_service import startup
+from service_logic import handle_operation
+from service_logic import service_metrics
+from service_logic import startup_recovery
+from service_logic import storage_collection
+from service_logic import storage_hashing
+
+_logger = lg.get_logger(__name__)
+
+
+class ServiceComponents(object):
+
+    def __init__(self, properties):
+        self.properties = properties
+        self.cache: raw_handle_cache.RawHandleCache = None
+        self.precreated: qcow_pool.QcowPool = None
+        self.recovery: startup_recovery.StartupRecovery = None
+        self.hashing_scheduler: storage_hashing.HashingScheduler = None
+        self.exporter: metrics_exporter.MetricsExporter = None
+
+    def _configure_database(self):
+        """从配置文件中读取数据库连接与连接池参数"""
+        properties = self.properties
+        default = s.PoolConfig()
+        config = s.PoolConfig(
+            pool_size=properties.getPropertyAsIntWithDefault('DataAccess.PoolSize', default.pool_size),
+            max_overflow=properties.getPropertyAsIntWithDefault('DataAccess.MaxOverflow', default.max_overflow),
+            pool_timeout=properties.getPropertyAsIntWithDefault('DataAccess.PoolTimeout', default.pool_timeout),
+            pool_recycle=properties.getPropertyAsIntWithDefault('DataAccess.PoolRecycle', default.pool_recycle),
+            pool_pre_ping=properties.getPropertyAsIntWithDefault('DataAccess.PoolPrePing', 1) != 0,
+        )
+        connect_str = properties.getPropertyWithDefault('DataAccess.Url', s.db_connect_str)
+        s.configure_engine(config, connect_str)
+        _logger.info(f'database configured : {connect_str.split("@")[-1]} {config}')
+
+    def _start_raw_handle_cache(self) -> raw_handle_cache.RawHandleCache:
+        """Snapshot.RawHandleCacheSize 为 0 时不缓存原生读句柄，参考 raw_handle_cache"""
+        properties = self.properties
+        cache = raw_handle_cache.configure(
+            properties.getPropertyAsIntWithDefault('Snapshot.RawHandleCacheSize', 0),
+            properties.getPropertyAsIntWithDefault('Snapshot.RawHandleCacheIdleSeconds', 300),
+        )
+        cache.start()
+        return cache
+
+    def _configure_qcow_packing(self):
+        """限制单个qcow文件中的快照点数量、文件内快照链深度与文件大小，为 0 时不限制，参考 QcowPackingPolicy"""
+        properties = self.properties
+        policy = storage_action.QcowPackingPolicy(
+            properties.getPropertyAsIntWithDefault('Snapshot.QcowMaxSnapshotsPerFile', 0),
+            properties.getPropertyAsIntWithDefault('Snapshot.QcowMaxChainDepth', 0),
+            properties.getPropertyAsIntWithDefault('Snapshot.QcowMaxFileMiB', 0) * 1024 * 1024,
+        )
+        storage_action.ImagePathGenerator.packing_policy = policy
+        _logger.info(f'{policy} configured')
+
+    def _configure_storage_collection(self):
+        """Snapshot.FlattenMinKeyItems 为 0 时不合成全量快照，参考 storage_collection.FlattenQcowChainWork"""
+        storage_collection.StorageCollection.flatten_min_key_items = self.properties.getPropertyAsIntWithDefault(
+            'Snapshot.FlattenMinKeyItems', 0)
+
+    def _start_qcow_pool(self) -> qcow_pool.QcowPool:
+        """Snapshot.QcowPoolSize 为 0 时不预先创建qcow文件，参考 qcow_pool"""
+        properties = self.properties
+        precreated = qcow_pool.configure(
+            properties.getPropertyAsIntWithDefault('Snapshot.QcowPoolSize', 0),
+            properties.getPropertyAsIntWithDefault('Snapshot.QcowPoolMaxTotal', 64),
+            properties.getPropertyAsIntWithDefault('Snapshot.QcowPoolBucketSeconds', 300),
+        )
+        precreated.start()
+        return precreated
+
+    def _start_metrics_exporter(self) -> metrics_exporter.MetricsExporter:
+        """配置了 Snapshot.MetricsAddress 时，以 Prometheus 文本格式提供统计数据，参考 metrics_exporter"""
+        properties = self.properties
+        exporter = metrics_exporter.MetricsExporter(
+            service_metrics.AggregateCache(properties.getPropertyAsIntWithDefault('Snapshot.MetricsCacheSeconds', 15)),
+            self.hashing_scheduler, self.precreated, self.cache,
+        )
+        address = properties.getProperty('Snapshot.MetricsAddress')
+        if address:
+            exporter.start(address)
+        return exporter
+
+    @staticmethod
+    def _create_singletons():
+        """全局单例在首次使用时创建，提前创建避免首批 Op 调用承担创建与注册监听的耗时"""
+        lm.LockerManager.get_locker_manager()
+        srm.get_srm()
+        pool.HandlePool.get_handle_pool()
+        handle_operation.get_background_closer()
+        chain_metrics.get_chain_metrics()
+        storage_space.get_storage_space()
+        timeline.get_storage_timelines()
+        cdp_index.get_cdp_index()
+        tree_versions.get_tree_versions()
+        _logger.info(f'{len(dispatch.EXECUTE)} Op calls loaded')
+
+    @s.scoped_session_thread
+    def start(self, readiness: startup.Readiness):
+        self._configure_database()
+        self.cache = self._start_raw_handle_cache()
+        self._configure_qcow_packing()
+        self._configure_storage_collection()
+        self.precreated = self._start_qcow_pool()
+        readiness.mark('components')
+
+        self.recovery = startup_recovery.StartupRecovery()
+        self.recovery.scan()
+        readiness.mark('recovery_scan')
+
+        self._create_singletons()
+
+        self.recovery.start()
+        self.hashing_scheduler = storage_hashing.get_hashing_scheduler()
+        self.hashing_scheduler.start()
+        self.exporter = self._start_metrics_exporter()
+        readiness.set_ready()
+
+        self._warm_up_proxies()
+        self._warm_up_cdp_index(self.properties.getPropertyAsIntWithDefault('Snapshot.WarmUpTrees', 64))
+        readiness.mark('warmed_up')
+
+    @staticmethod
+    def _warm_up_proxies():
+        for get_prx in (service.get_read_img_prx, service.get_write_img_prx, service.get_cdp_prx):
+            try:
+                get_prx()
+            except Exception as e:
+                _logger.warning(f'warm up {get_prx.__name__} failed : {e}')
+
+    @staticmethod
+    def _warm_up_cdp_index(max_trees: int):
+        """生成正在写入CDP的快照存储树的时间区间索引，每棵快照存储树单独持有存储锁"""
+        begin = time.monotonic()
+        with s.readonly():
+            tree_idents = storage.query_tree_idents_by_status(
+                m.SnapshotStorage.STATUS_WRITING, m.SnapshotStorage.TYPE_CDP, max_trees)
+        for tree_ident in tree_idents:
+            try:
+                with lm.get_storage_locker(f'warm up cdp index {tree_ident}'), s.readonly():
+                    cdp_index.get_cdp_index().prepare(tree.generate(tree_ident))
+            except Exception as e:
+                _logger.warning(f'warm up cdp index {tree_ident} failed : {e}')
+        _logger.info(f'warm up cdp index of {len(tree_idents)} trees in {time.monotonic() - begin:.3f}s')
+
+    def stop(self):
+        if self.exporter:
+            self.exporter.stop()
+        if self.recovery:
+            self.recovery.stop()
+        handle_operation.get_background_closer().stop()  # 先等待关闭中的快照存储完成，其 Hashing 由调度器处理
+        if self.hashing_scheduler:
+            self.hashing_scheduler.stop()
+        if self.precreated:
+            _logger.info(f'{self.precreated} stop : {self.precreated.to_dict()}')
+            self.precreated.stop()
+        if self.cache:
+            _logger.info(f'{self.cache} stop : {self.cache.to_dict()}')
+            self.cache.stop()
+        _logger.info(f'{chain_metrics.get_chain_metrics()} : {chain_metrics.get_chain_metrics().to_dict()}')
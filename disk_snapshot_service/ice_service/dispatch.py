@@ -0,0 +1,112 @@
+"""Op 调用的分发表与执行
+
+依赖全部业务模块，加载较慢；service 在预热线程或首次 Op 调用时加载本模块，Ice 适配器无需等待加载完成即可启动
+"""
+import time
+
+import interface_data_define as idd
+from data_access import session as s
+from ice_service import metrics_exporter
+from service_logic import consume_journal
+from service_logic import generate_journal
+from service_logic import handle_operation
+from service_logic import storage_query
+
+EXECUTE = {
+    # 生成创建快照存储的日志
+    "generate_journal_for_create": (
+        idd.GenerateJournalForCreateParamsSchema,
+        generate_journal.for_create,
+        idd.EmptySchema,
+    ),
+    # 生成销毁快照存储的日志
+    "generate_journal_for_destroy": (
+        idd.GenerateJournalForDestroyParamsSchema,
+        generate_journal.for_destroy,
+        idd.EmptySchema,
+    ),
+    # 创建快照存储，获得写权限原生句柄
+    "create_snapshot": (
+        idd.CreateSnapshotParamsSchema,
+        consume_journal.create_snapshot,
+        idd.CreateSnapshotResultSchema,
+    ),
+    # 关闭快照存储原生句柄，并释放锁定的快照存储
+    "close_snapshot": (
+        idd.CloseSnapshotParamsSchema,
+        handle_operation.close_snapshot,
+        idd.EmptySchema,
+    ),
+    # 查询后台关闭句柄的状态
+    # remark:
+    #    close_snapshot 指定 background 时，在后台关闭原生句柄，调用者可以通过此接口等待关闭完成
+    "query_close_status": (
+        idd.QueryCloseStatusParamsSchema,
+        handle_operation.query_close_status,
+        idd.QueryCloseStatusResultSchema,
+    ),
+    # 打开快照存储，可选获得读取原生句柄
+    # remark:
+    #    支持延迟打开原生读句柄，参考 get_raw_handle
+    "open_snapshot": (
+        idd.OpenSnapshotParamsSchema,
+        handle_operation.open_snapshot,
+        idd.OpenSnapshotResultSchema,
+    ),
+    # 获取原生句柄
+    # remark:
+    #    支持延迟打开原生读句柄，如果 open_snapshot 未打开原生读句柄，那么可以在 open_snapshot 后，调用此接口获取
+    "get_raw_handle": (
+        idd.GetRawHandleParamsSchema,
+        handle_operation.get_raw_handle,
+        idd.GetRawHandleResultSchema,
+    ),
+    # 设置写句柄关闭时的工作模式
+    # remark:
+    #   支持 直接使用hash文件、修正后使用hash文件
+    "set_hash_mode": (
+        idd.SetHashModeParamsSchema,
+        handle_operation.set_hash_mode,
+        idd.EmptySchema,
+    ),
+    # 查询快照存储树的时间线
+    # remark:
+    #   分页返回快照存储覆盖的时间区间与间隙；指定 timestamps 时返回覆盖各时间点的快照存储
+    "query_timeline": (
+        idd.QueryTimelineParamsSchema,
+        storage_query.query_timeline,
+        idd.QueryTimelineResultSchema,
+    ),
+    # 查询快照存储树的空间统计
+    # remark:
+    #   从数据块位图文件统计，参考 business_logic.storage_space
+    "query_space": (
+        idd.QuerySpaceParamsSchema,
+        storage_query.query_space,
+        idd.QuerySpaceResultSchema,
+    ),
+}
+
+
+def call_label(call: str) -> str:
+    """统计数据中的调用名称，不存在的调用名称使用同一个标签，避免标签取值无限增长"""
+    return call if call in EXECUTE else metrics_exporter.UNKNOWN_CALL
+
+
+@s.scoped_session_thread
+def execute(call: str, in_json: str) -> str:
+    begin = time.monotonic()
+    try:
+        params, errors = EXECUTE[call][0]().loads(in_json)
+        assert not errors, ('内部异常，代码 LoadJsonFailed', f'load failed {errors}', 0,)
+
+        result = EXECUTE[call][1](params)
+
+        out_json, errors = EXECUTE[call][2]().dumps(result, ensure_ascii=False)
+        assert not errors, ('内部异常，代码 DumpJsonFailed', f'dump failed {errors}', 0,)
+        return out_json
+    except Exception:
+        metrics_exporter.op_failures.inc(call_label(call))
+        raise
+    finally:
+        metrics_exporter.op_seconds.observe(call_label(call), time.monotonic() - begin)
@@ -0,0 +1,314 @@
+"""本地替身镜像服务（ImgService4R、ImgService4W、CdpWriter）
+
+开发环境没有镜像服务，无法复现镜像服务响应缓慢时 Ice 分发线程耗尽与长时间持有锁的问题
+替身服务实现 create、open、close、DelSnaport 接口，可配置每个接口的延迟分布、失败比例与失败时的返回值
+
+使用方式：
+    1. 进程内：install() 替换 ice_service.service 中获取镜像服务代理的函数，无需 Ice 运行环境，供测试与基准使用
+    2. 独立进程：使用与服务配置相同的端点启动 Ice 服务
+
+usage:
+    cd disk_snapshot_service
+    python -m ice_service.fake_img_service --latency create=lognormal:0.2,0.5 --error-rate DelSnaport=0.1
+    python -m ice_service.fake_img_service --latency open=uniform:0.5,3 --max-concurrency 4
+"""
+import argparse
+import contextlib
+import math
+import random
+import sys
+import threading
+import time
+import typing
+from unittest import mock
+
+from cpkt.core import xlogging as lg
+from cpkt.rpc import ice
+
+from ice_service import service
+
+_logger = lg.get_logger(__name__)
+
+ROLE_READ = 'ImgService4R'
+ROLE_WRITE = 'ImgService4W'
+ROLE_CDP = 'CdpWriter'
+
+DEFAULT_ENDPOINTS = {
+    ROLE_READ: 'tcp -h 127.0.0.1 -p 21101',
+    ROLE_WRITE: 'tcp -h 127.0.0.1 -p 21104',
+    ROLE_CDP: 'tcp -h 127.0.0.1 -p 21130',
+}
+
+OPERATIONS = ('create', 'open', 'close', 'DelSnaport',)
+
+# 失败时的默认返回值
+#   create : 0 与 -1 表示失败，参考 DiskSnapshotAction.create_qcow_snapshot
+#   DelSnaport : -2 表示快照正在使用中，-1 表示其他失败
+DEFAULT_ERROR_CODES = {
+    'create': (-1,),
+    'open': (-1,),
+    'close': (-1,),
+    'DelSnaport': (-1,),
+}
+
+
+class LatencyModel(object):
+    """接口延迟的分布，单位秒
+
+    :remark:
+        fixed:秒数
+        uniform:最小值,最大值
+        exponential:平均值
+        lognormal:中位数,sigma ，长尾分布，接近慢存储上的实际延迟
+    """
+
+    KINDS = ('fixed', 'uniform', 'exponential', 'lognormal',)
+
+    def __init__(self, kind='fixed', *params):
+        assert kind in self.KINDS, ('无效的延迟分布', f'invalid latency kind {kind}', 0)
+        self.kind = kind
+        self.params = tuple(float(p) for p in params) or (0.0,)
+
+    def __str__(self):
+        return f'{self.kind}:{",".join(str(p) for p in self.params)}'
+
+    @classmethod
+    def parse(cls, spec: str) -> 'LatencyModel':
+        kind, _, params = spec.partition(':')
+        return cls(kind, *[p for p in params.split(',') if p])
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == 'exponential':
+            return rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        return rng.lognormvariate(math.log(self.params[0]), self.params[1])
+
+
+class OperationProfile(object):
+    """单个接口的行为
+
+    :param error_rate: 返回失败的比例
+    :param error_codes: 失败时随机选择的返回值
+    """
+
+    def __init__(self, latency: LatencyModel = None, error_rate=0.0, error_codes=None):
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes) if error_codes else None
+
+    def __str__(self):
+        return f'latency {self.latency}, error {self.error_rate} {self.error_codes}'
+
+
+class OperationStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class FakeImgServiceI(ice.IMG.ImgService):
+    """替身镜像服务的 servant
+
+    :remark:
+        返回的原生句柄从 1 开始递增；已打开的快照存储被 DelSnaport 时返回 -2
+        max_concurrency 限制同时处理的调用数量，模拟镜像服务自身的线程池，超出的调用排队等待
+    """
+
+    def __init__(self, role: str, profiles: typing.Dict[str, OperationProfile] = None, max_concurrency=0, seed=None):
+        self.role = role
+        self.profiles = {op: OperationProfile() for op in OPERATIONS}
+        self.profiles.update(profiles or dict())
+        self._rng = random.Random(seed)
+        self._locker = threading.Lock()
+        self._concurrency = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self._last_handle = 0
+        self._handles: typing.Dict[int, typing.List[typing.Tuple[str, str]]] = dict()  # 句柄 -> 打开的快照存储
+        self.stats = {op: OperationStats() for op in OPERATIONS}
+        self.in_flight = 0
+        self.in_flight_max = 0
+
+    def __str__(self):
+        return f'fake_img_service:<{self.role},{len(self._handles)} handles>'
+
+    @property
+    def opened_handles(self) -> typing.List[int]:
+        with self._locker:
+            return list(self._handles.keys())
+
+    def to_dict(self) -> dict:
+        with self._locker:
+            return {
+                'role': self.role,
+                'handles': len(self._handles),
+                'in_flight': self.in_flight,
+                'in_flight_max': self.in_flight_max,
+                'operations': {op: stats.to_dict() for op, stats in self.stats.items()},
+            }
+
+    def _sample(self, op) -> typing.Tuple[float, typing.Union[int, None]]:
+        profile = self.profiles[op]
+        with self._locker:
+            latency = max(profile.latency.sample(self._rng), 0.0)
+            if self._rng.random() < profile.error_rate:
+                return latency, self._rng.choice(profile.error_codes or DEFAULT_ERROR_CODES[op])
+            return latency, None
+
+    @contextlib.contextmanager
+    def _call(self, op):
+        latency, error_code = self._sample(op)
+        begin = time.monotonic()
+        with self._concurrency or contextlib.suppress():  # 未限制并发时不等待
+            with self._locker:
+                self.in_flight += 1
+                self.in_flight_max = max(self.in_flight_max, self.in_flight)
+            try:
+                time.sleep(latency)
+                yield error_code
+            finally:
+                with self._locker:
+                    self.in_flight -= 1
+                    stats = self.stats[op]
+                    stats.calls += 1
+                    stats.errors += error_code is not None
+                    elapsed = time.monotonic() - begin
+                    stats.latency_seconds_total += elapsed
+                    stats.latency_seconds_max = max(stats.latency_seconds_max, elapsed)
+
+    def _new_handle(self, idents) -> int:
+        with self._locker:
+            self._last_handle += 1
+            self._handles[self._last_handle] = [(ident.path, ident.snapshot) for ident in idents]
+            return self._last_handle
+
+    def create(self, ident, last_idents, disk_bytes, flag, current=None):
+        _ = last_idents, disk_bytes, current
+        with self._call('create') as error_code:
+            if error_code is not None:
+                _logger.warning(f'{self} create {ident} {flag} failed, {error_code}')
+                return error_code
+            return self._new_handle([ident])
+
+    def open(self, idents, flag, current=None):
+        _ = current
+        with self._call('open') as error_code:
+            if error_code is not None:
+                _logger.warning(f'{self} open {idents} {flag} failed, {error_code}')
+                return error_code
+            return self._new_handle(idents)
+
+    def close(self, handle, flush, current=None):
+        _ = flush, current
+        with self._call('close') as error_code:
+            if error_code is not None:
+                return error_code
+            with self._locker:
+                return 0 if self._handles.pop(handle, None) is not None else -1
+
+    def DelSnaport(self, ident, current=None):
+        _ = current
+        with self._call('DelSnaport') as error_code:
+            if error_code is not None:
+                return error_code
+            with self._locker:
+                using = any((ident.path, ident.snapshot) in idents for idents in self._handles.values())
+            return -2 if using else 0
+
+
+class FakeImgServices(object):
+    """三个角色的替身镜像服务"""
+
+    def __init__(self, profiles: typing.Dict[str, OperationProfile] = None, max_concurrency=0, seed=None):
+        self.servants = {
+            role: FakeImgServiceI(role, profiles, max_concurrency, None if seed is None else seed + i)
+            for i, role in enumerate((ROLE_READ, ROLE_WRITE, ROLE_CDP,))
+        }
+
+    @property
+    def read(self) -> FakeImgServiceI:
+        return self.servants[ROLE_READ]
+
+    @property
+    def write(self) -> FakeImgServiceI:
+        return self.servants[ROLE_WRITE]
+
+    @property
+    def cdp(self) -> FakeImgServiceI:
+        return self.servants[ROLE_CDP]
+
+    def to_dict(self) -> dict:
+        return {role: servant.to_dict() for role, servant in self.servants.items()}
+
+    @contextlib.contextmanager
+    def install(self):
+        """在当前进程中替换镜像服务代理，servant 直接作为代理使用"""
+
+        endpoints = {f'fake:{role}': servant for role, servant in self.servants.items()}
+        with mock.patch.object(service, 'get_read_img_prx', lambda: self.read), \
+                mock.patch.object(service, 'get_write_img_prx', lambda: self.write), \
+                mock.patch.object(service, 'get_cdp_prx', lambda: self.cdp), \
+                mock.patch.object(service, 'convert_proxy_to_string', lambda prx: f'fake:{prx.role}'), \
+                mock.patch.object(service, 'convert_string_to_prx', lambda s: endpoints[s]):
+            yield self
+
+
+def _parse_pairs(values, convert) -> dict:
+    result = dict()
+    for value in values or list():
+        op, _, spec = value.partition('=')
+        assert op in OPERATIONS, ('无效的接口名称', f'invalid operation {op}', 0)
+        result[op] = convert(spec)
+    return result
+
+
+def generate_profiles(latency=None, error_rate=None, error_codes=None) -> typing.Dict[str, OperationProfile]:
+    """从命令行参数生成接口行为，参数格式为 接口名=值"""
+
+    latency = _parse_pairs(latency, LatencyModel.parse)
+    error_rate = _parse_pairs(error_rate, float)
+    error_codes = _parse_pairs(error_codes, lambda s: [int(c) for c in s.split(',')])
+    return {
+        op: OperationProfile(latency.get(op), error_rate.get(op, 0.0), error_codes.get(op)) for op in OPERATIONS
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='fake image service')
+    parser.add_argument('--latency', action='append', help='operation=kind:params, e.g. create=uniform:0.1,0.5')
+    parser.add_argument('--error-rate', action='append', help='operation=rate, e.g. DelSnaport=0.1')
+    parser.add_argument('--error-codes', action='append', help='operation=codes, e.g. DelSnaport=-1,-2')
+    parser.add_argument('--max-concurrency', type=int, default=0)
+    parser.add_argument('--seed', type=int)
+    for role, endpoints in DEFAULT_ENDPOINTS.items():
+        parser.add_argument(f'--{role}', default=endpoints, help=f'endpoints of {role}')
+    args = parser.parse_args(argv)
+
+    import Ice  # 仅独立进程模式需要 Ice 运行环境
+
+    profiles = generate_profiles(args.latency, args.error_rate, args.error_codes)
+    services = FakeImgServices(profiles, args.max_concurrency, args.seed)
+
+    init_data = Ice.InitializationData()
+    init_data.properties = Ice.createProperties()
+    init_data.properties.setProperty(r'Ice.ThreadPool.Server.Size', r'8')
+    init_data.properties.setProperty(r'Ice.ThreadPool.Server.SizeMax', r'128')
+    with Ice.initialize(sys.argv[:1], init_data) as communicator:
+        for role, servant in services.servants.items():
+            adapter = communicator.createObjectAdapterWithEndpoints(f'Fake{role}', getattr(args, role))
+            adapter.add(servant, communicator.stringToIdentity('img'))
+            adapter.activate()
+            _logger.info(f'{servant} listen on {getattr(args, role)}, {servant.profiles["create"]}')
+        communicator.waitForShutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
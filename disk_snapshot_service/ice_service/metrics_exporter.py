@@ -0,0 +1,226 @@
+"""以 Prometheus 文本格式输出服务的统计数据
+
+配置了 Snapshot.MetricsAddress（host:port）时，在该地址监听 HTTP ，GET /metrics 返回统计数据
+    1. 内存中的数据在每次采集时读取：句柄、快照存储引用、锁等待与持有耗时、Op 调用耗时、数据库连接池、
+       Hashing 、原生读句柄缓存、读放大与空间统计
+    2. 需要查询数据库的分组统计来自 service_metrics.AggregateCache ，缓存 Snapshot.MetricsCacheSeconds 秒，
+       不会因为采集而频繁扫描全表
+仅供本机采集，不做认证，不要监听外部地址
+"""
+import http.server
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+from basic_library import metrics
+from business_logic import chain_metrics
+from business_logic import handle_pool as pool
+from business_logic import locker_manager as lm
+from business_logic import qcow_pool
+from business_logic import raw_handle_cache
+from business_logic import storage_reference_manager as srm
+from business_logic import storage_space
+from business_logic import tree_versions
+from data_access import models as m
+from data_access import session as s
+from service_logic import service_metrics
+from service_logic import storage_hashing
+
+_logger = lg.get_logger(__name__)
+
+PREFIX = 'dss_'
+UNKNOWN_CALL = 'unknown'  # 不存在的调用名称，避免标签取值无限增长
+
+op_seconds = metrics.HistogramFamily('call')
+op_failures = metrics.CounterFamily('call')
+
+_STORAGE_TYPE = {
+    m.SnapshotStorage.TYPE_QCOW: 'qcow',
+    m.SnapshotStorage.TYPE_CDP: 'cdp',
+}
+
+
+def _display(display: dict, value) -> str:
+    return display.get(value, value)
+
+
+class MetricsExporter(object):
+    """生成统计数据，并提供 HTTP 服务
+
+    :remark:
+        hashing_scheduler 等组件为 None 时不输出对应的统计数据
+    """
+
+    def __init__(self, aggregate_cache: service_metrics.AggregateCache,
+                 hashing_scheduler: storage_hashing.HashingScheduler = None,
+                 precreated: qcow_pool.QcowPool = None,
+                 cache: raw_handle_cache.RawHandleCache = None):
+        self.aggregate_cache = aggregate_cache
+        self.hashing_scheduler = hashing_scheduler
+        self.precreated = precreated
+        self.cache = cache
+        self.scrapes = 0
+        self._server: typing.Union[http.server.ThreadingHTTPServer, None] = None
+        self._thread: typing.Union[threading.Thread, None] = None
+
+    def __str__(self):
+        return f'metrics_exporter:<{self.address},{self.scrapes} scrapes>'
+
+    @property
+    def address(self) -> typing.Union[str, None]:
+        if self._server is None:
+            return None
+        host, port = self._server.server_address[:2]
+        return f'{host}:{port}'
+
+    @s.scoped_session_thread
+    def render(self) -> str:
+        writer = metrics.MetricWriter(PREFIX)
+        self._write_aggregates(writer)
+        self._write_handles(writer)
+        self._write_lockers(writer)
+        self._write_ops(writer)
+        self._write_db_pool(writer)
+        self._write_components(writer)
+        self.scrapes += 1
+        return writer.text()
+
+    def _write_aggregates(self, writer: metrics.MetricWriter):
+        aggregates = self.aggregate_cache.get()
+        writer.counter('aggregate_refresh_failures_total', '查询数据库分组统计失败的次数',
+                       self.aggregate_cache.failures)
+        if aggregates is None:
+            return
+        writer.gauge('aggregate_age_seconds', '数据库分组统计距离查询的时间', round(time.time() - aggregates.collected_at, 3))
+        writer.gauge('aggregate_query_seconds', '数据库分组统计的查询耗时', round(aggregates.seconds, 6))
+        for (status, storage_type), count in sorted(aggregates.storages.items()):
+            writer.gauge('storages', '各状态与类型的快照存储数量', count, {
+                'status': _display(m.SnapshotStorage.STATUS_DISPLAY, status),
+                'type': _display(_STORAGE_TYPE, storage_type)})
+        for operation_type, (count, oldest) in sorted(aggregates.journals.items()):
+            labels = {'type': _display(m.Journal.TYPE_DISPLAY, operation_type)}
+            writer.gauge('journal_backlog', '未消费的日志数量', count, labels)
+            writer.gauge('journal_backlog_oldest_seconds', '最早的未消费日志距今的时间',
+                         round(max(time.time() - float(oldest), 0.0), 3), labels)
+        for work_type, (count, finished_bytes, total_bytes) in sorted(aggregates.merges.items()):
+            labels = {'type': _display(m.MergeCheckpoint.TYPE_DISPLAY, work_type)}
+            writer.gauge('merge_works', '进行中的合并作业数量', count, labels)
+            writer.gauge('merge_finished_bytes', '合并作业已搬迁的数据量', finished_bytes, labels)
+            writer.gauge('merge_total_bytes', '合并作业需要搬迁的数据量', total_bytes, labels)
+        writer.gauge('qcow_pool_ready', '预先创建的可用qcow文件数量', aggregates.qcow_pool_ready)
+
+    @staticmethod
+    def _write_handles(writer: metrics.MetricWriter):
+        handle_pool = pool.HandlePool.get_handle_pool()
+        reading, writing = handle_pool.handle_count()
+        writer.gauge('handles', '打开的快照存储句柄数量', reading, {'mode': 'read'})
+        writer.gauge('handles', '打开的快照存储句柄数量', writing, {'mode': 'write'})
+        shared, references = handle_pool.shared_count()
+        writer.gauge('shared_reads', '共享打开的读句柄数量', shared)
+        writer.gauge('shared_read_references', '引用共享读句柄的句柄数量', references)
+
+        readers, reading, writers = srm.get_srm().count_records()
+        writer.gauge('reference_callers', '持有快照存储引用的调用者数量', readers, {'mode': 'read'})
+        writer.gauge('reference_callers', '持有快照存储引用的调用者数量', writers, {'mode': 'write'})
+        # 写入者仅引用一个快照存储，写入的引用记录数量与 reference_callers{mode="write"} 相同，不重复提供
+        writer.gauge('reference_records', '快照存储引用记录数量', reading, {'mode': 'read'})
+
+    @staticmethod
+    def _write_lockers(writer: metrics.MetricWriter):
+        for locker in lm.LockerManager.get_locker_manager().lockers:
+            writer.histogram('lock_wait_seconds', '等待获取锁的耗时', locker.wait_seconds, {'lock': locker.name})
+        for locker in lm.LockerManager.get_locker_manager().lockers:
+            writer.histogram('lock_hold_seconds', '持有锁的耗时', locker.hold_seconds, {'lock': locker.name})
+
+    @staticmethod
+    def _write_ops(writer: metrics.MetricWriter):
+        writer.histogram_family('op_seconds', 'Op 调用耗时', op_seconds)
+        writer.counter_family('op_failures_total', 'Op 调用失败的次数', op_failures)
+
+    @staticmethod
+    def _write_db_pool(writer: metrics.MetricWriter):
+        pool_metrics = s.pool_metrics.to_dict()
+        writer.gauge('db_pool_connections', '打开的数据库连接数量', pool_metrics['connections'])
+        writer.gauge('db_pool_in_use', '签出的数据库连接数量', pool_metrics['in_use'])
+        writer.counter('db_pool_checkouts_total', '签出数据库连接的次数', pool_metrics['checkouts_total'])
+        writer.counter('db_pool_checkout_wait_seconds_total', '等待签出数据库连接的总耗时',
+                       round(pool_metrics['checkout_wait_seconds_total'], 6))
+        writer.counter('db_pool_checkout_timeouts_total', '签出数据库连接超时的次数', pool_metrics['checkout_timeouts_total'])
+
+    def _write_components(self, writer: metrics.MetricWriter):
+        if self.hashing_scheduler is not None:
+            writer.gauge('hashing_queue_depth', '排队中与执行中的 Hashing 任务数量', self.hashing_scheduler.queue_depth)
+            writer.counter('hashing_completed_total', '完成 Hashing 的快照存储数量', self.hashing_scheduler.completed)
+            writer.counter('hashing_failed_total', 'Hashing 失败的次数', self.hashing_scheduler.failed)
+
+        if self.precreated is not None:
+            writer.counter('qcow_pool_hits_total', '使用预先创建的qcow文件的次数', self.precreated.hits)
+            writer.counter('qcow_pool_misses_total', '没有可用的预先创建qcow文件的次数', self.precreated.misses)
+
+        if self.cache is not None:
+            cache = self.cache.to_dict()
+            writer.gauge('raw_handle_cache_entries', '缓存的原生读句柄数量', cache['idle'], {'state': 'idle'})
+            writer.gauge('raw_handle_cache_entries', '缓存的原生读句柄数量', cache['in_use'], {'state': 'in_use'})
+            writer.counter('raw_handle_cache_hits_total', '原生读句柄缓存命中的次数', cache['hits'])
+            writer.counter('raw_handle_cache_misses_total', '原生读句柄缓存未命中的次数', cache['misses'])
+            writer.counter('raw_handle_cache_evictions_total', '原生读句柄缓存淘汰的次数', cache['evictions'])
+
+        chain_total = chain_metrics.get_chain_metrics().to_dict(top=0)['total']
+        writer.counter('chain_opens_total', '打开快照存储链的次数', chain_total['opens'])
+        writer.gauge('chain_key_items_avg', '打开快照存储链叠加的平均关键快照存储数量', chain_total['avg_key_items'])
+        writer.gauge('chain_key_items_max', '打开快照存储链叠加的最大关键快照存储数量', chain_total['max_key_items'])
+
+        space = storage_space.get_storage_space().to_dict()
+        writer.gauge('space_cached_trees', '缓存了空间统计的快照存储树数量', space['trees'])
+        writer.counter('space_builds_total', '生成快照存储树空间统计的次数', space['builds'])
+        writer.counter('space_bitmap_reads_total', '读取数据块位图文件的次数', space['bitmap_reads'])
+
+        versions = tree_versions.get_tree_versions().to_dict()
+        writer.gauge('tree_versions_cached_trees', '缓存了当前版本的快照存储树数量', versions['trees'])
+        writer.counter('tree_versions_hits_total', '打开快照存储时使用缓存版本的次数', versions['hits'])
+        writer.counter('tree_versions_builds_total', '在存储锁内生成快照存储树版本的次数', versions['builds'])
+        writer.counter('tree_versions_conflicts_total', '登记引用后校验版本失败的次数', versions['conflicts'])
+
+    def start(self, address: str):
+        """在 host:port 监听，port 为 0 时由系统分配"""
+        host, _, port = address.rpartition(':')
+        self._server = http.server.ThreadingHTTPServer((host, int(port)), _Handler)
+        self._server.daemon_threads = True
+        self._server.exporter = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics_exporter', daemon=True)
+        self._thread.start()
+        _logger.info(f'{self} start')
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        _logger.info(f'{self} stop')
+        self._server, self._thread = None, None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = self.server.exporter.render().encode('utf-8')
+        except Exception as e:
+            _logger.error(f'render metrics failed : {e}')
+            _logger.error(lg.format_exception(e))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.MetricWriter.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug('metrics %s : %s', self.address_string(), format % args)
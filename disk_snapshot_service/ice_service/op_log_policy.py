@@ -0,0 +1,134 @@
+"""Op 调用的日志策略
+
+每种调用可配置日志详细程度与采样比例，格式为以分号分隔的 调用名=详细程度[:采样比例] ，* 表示其他调用
+    full  : 记录输入与输出 json （默认）
+    brief : 仅记录调用序号、输出长度与耗时
+    off   : 不记录
+    例如 *=brief:0.1;create_snapshot=full;get_raw_handle=off
+调用失败时总是记录输入与异常
+同时可以配置 logger 的级别，格式为 logger:名称=级别 ，例如 logger:business_logic.locker_manager=INFO
+
+运行时修改：将策略写入 watch_path 文件，每秒最多检查一次文件的修改时间；删除文件后恢复为启动时的策略
+"""
+import logging
+import os
+import random
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+_logger = lg.get_logger(__name__)
+
+LEVEL_OFF = 'off'
+LEVEL_BRIEF = 'brief'
+LEVEL_FULL = 'full'
+LEVELS = (LEVEL_OFF, LEVEL_BRIEF, LEVEL_FULL,)
+
+DEFAULT_SPEC = '*=full'
+LOGGER_PREFIX = 'logger:'
+
+
+def parse(spec: str) -> typing.Tuple[typing.Dict[str, typing.Tuple[str, float]], typing.Dict[str, int]]:
+    """返回 调用名 -> (详细程度, 采样比例) 与 logger 名称 -> 级别"""
+    result, loggers = {'*': (LEVEL_FULL, 1.0,)}, dict()
+    for item in (spec or '').replace('\n', ';').split(';'):
+        if not item.strip():
+            continue
+        call, _, value = item.partition('=')
+        if call.strip().startswith(LOGGER_PREFIX):
+            level = logging.getLevelName(value.strip().upper())
+            assert isinstance(level, int), ('无效的日志策略', f'invalid logger level {item}', 0)
+            loggers[call.strip()[len(LOGGER_PREFIX):]] = level
+            continue
+        level, _, sample_rate = value.strip().partition(':')
+        assert level in LEVELS, ('无效的日志策略', f'invalid log level {item}', 0)
+        sample_rate = float(sample_rate) if sample_rate else 1.0
+        assert 0 <= sample_rate <= 1, ('无效的日志策略', f'invalid sample rate {item}', 0)
+        result[call.strip()] = (level, sample_rate,)
+    return result, loggers
+
+
+class OpLogPolicy(object):
+
+    def __init__(self, spec=DEFAULT_SPEC, watch_path=None, check_interval_seconds=1):
+        self.spec = spec
+        self.watch_path = watch_path
+        self.check_interval_seconds = check_interval_seconds
+        self._policies: typing.Dict[str, typing.Tuple[str, float]] = dict()
+        self._loggers: typing.Dict[str, int] = dict()  # 已修改级别的 logger -> 修改前的级别
+        self._rng = random.Random()
+        self._locker = threading.Lock()
+        self._last_check = 0.0
+        self._watch_mtime = None
+        self.configure(spec)
+
+    def __str__(self):
+        return f'op_log_policy:<{self._policies}>'
+
+    def configure(self, spec: str):
+        policies, loggers = parse(spec)
+        self._policies = policies  # 整体替换，读取时无需加锁
+        for name, level in self._loggers.items():
+            if name not in loggers:
+                logging.getLogger(name).setLevel(level)
+        for name, level in loggers.items():
+            self._loggers.setdefault(name, logging.getLogger(name).level)
+            logging.getLogger(name).setLevel(level)
+        self._loggers = {name: level for name, level in self._loggers.items() if name in loggers}
+        _logger.info(f'{self} configured, loggers {loggers}, watch {self.watch_path}')
+
+    def restore_loggers(self):
+        """恢复修改过级别的 logger"""
+        for name, level in self._loggers.items():
+            logging.getLogger(name).setLevel(level)
+        self._loggers = dict()
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval_seconds:
+            return
+        with self._locker:
+            if now - self._last_check < self.check_interval_seconds:
+                return
+            self._last_check = now
+            try:
+                mtime = os.stat(self.watch_path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime == self._watch_mtime:
+                return
+            self._watch_mtime = mtime
+            try:
+                if mtime is None:
+                    self.configure(self.spec)
+                else:
+                    with open(self.watch_path) as f:
+                        self.configure(f.read())
+            except Exception as e:
+                _logger.warning(f'reload {self.watch_path} failed : {e}')
+
+    def sample(self, call: str) -> str:
+        """返回本次调用的日志详细程度，未被采样时返回 LEVEL_OFF"""
+        if self.watch_path:
+            self._reload_if_changed()
+        level, sample_rate = self._policies.get(call) or self._policies['*']
+        if sample_rate < 1 and self._rng.random() >= sample_rate:
+            return LEVEL_OFF
+        return level
+
+
+_op_log_policy = OpLogPolicy()
+
+
+def get_op_log_policy() -> OpLogPolicy:
+    return _op_log_policy
+
+
+def configure(spec=DEFAULT_SPEC, watch_path=None) -> OpLogPolicy:
+    global _op_log_policy
+
+    _op_log_policy.restore_loggers()
+    _op_log_policy = OpLogPolicy(spec, watch_path)
+    return _op_log_policy
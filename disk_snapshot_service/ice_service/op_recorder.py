@@ -0,0 +1,123 @@
+"""记录 SnapshotI.Op 的调用，供回放使用
+
+每个调用写入一行 json（文件名以 .gz 结尾时使用 gzip 压缩）：
+    t       : 调用开始的时间戳
+    i       : Op 序号
+    call    : 调用名称
+    in      : 输入 json
+    out     : 输出 json，调用失败时为 null
+    seconds : 调用耗时
+    pid     : 调用者的 pid（输入中的 caller_pid，没有时为 null）
+    thread  : 分发线程
+
+写入在独立线程中进行，不增加 Op 的延迟；队列满时丢弃记录并计数
+"""
+import gzip
+import json
+import queue
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+_logger = lg.get_logger(__name__)
+
+
+class OpRecorder(threading.Thread):
+
+    def __init__(self, path: str, max_queue=65536, flush_interval_seconds=1):
+        super(OpRecorder, self).__init__(name='op_recorder', daemon=True)
+        self.path = path
+        self.flush_interval_seconds = flush_interval_seconds
+        self._queue = queue.Queue(max_queue)
+        self._quit = threading.Event()
+        self.recorded = 0
+        self.dropped = 0
+
+    def __str__(self):
+        return f'op_recorder:<{self.path},{self.recorded} recorded,{self.dropped} dropped>'
+
+    def record(self, op_index, call, in_json, out_json, begin_timestamp, seconds):
+        try:
+            self._queue.put_nowait((op_index, call, in_json, out_json, begin_timestamp, seconds,
+                                    threading.current_thread().name,))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        self._quit.set()
+        self.join()
+
+    @staticmethod
+    def _caller_pid(in_json) -> typing.Union[int, None]:
+        if '"caller_pid"' not in in_json:
+            return None
+        try:
+            return json.loads(in_json).get('caller_pid')
+        except ValueError:
+            return None
+
+    def _write(self, f, item):
+        op_index, call, in_json, out_json, begin_timestamp, seconds, thread_name = item
+        f.write(json.dumps({
+            't': round(begin_timestamp, 6),
+            'i': op_index,
+            'call': call,
+            'in': in_json,
+            'out': out_json,
+            'seconds': round(seconds, 6),
+            'pid': self._caller_pid(in_json),
+            'thread': thread_name,
+        }, ensure_ascii=False))
+        f.write('\n')
+        self.recorded += 1
+
+    def run(self):
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'at', encoding='utf-8') as f:
+            last_flush = time.monotonic()
+            while not (self._quit.is_set() and self._queue.empty()):
+                try:
+                    self._write(f, self._queue.get(timeout=self.flush_interval_seconds))
+                except queue.Empty:
+                    pass
+                if time.monotonic() - last_flush >= self.flush_interval_seconds:
+                    f.flush()
+                    last_flush = time.monotonic()
+        _logger.info(f'{self} stopped')
+
+
+_op_recorder: OpRecorder = None
+_op_recorder_locker = threading.Lock()
+
+
+def get_op_recorder() -> typing.Union[OpRecorder, None]:
+    """没有开始记录时返回 None"""
+    return _op_recorder
+
+
+def start(path: str) -> OpRecorder:
+    global _op_recorder
+
+    with _op_recorder_locker:
+        assert _op_recorder is None, ('重复开始记录调用', f'recording to {_op_recorder}', 0)
+        _op_recorder = OpRecorder(path)
+        _op_recorder.start()
+    _logger.info(f'{_op_recorder} started')
+    return _op_recorder
+
+
+def stop():
+    global _op_recorder
+
+    with _op_recorder_locker:
+        recorder, _op_recorder = _op_recorder, None
+    if recorder:
+        recorder.stop()
+
+
+def load(path: str) -> typing.List[dict]:
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
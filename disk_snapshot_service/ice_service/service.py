@@ -1,68 +1,39 @@
+"""Ice 服务入口
+
+只依赖加载较快的模块，Ice 适配器在业务模块加载前即可激活：
+    1. Op 调用的分发表依赖全部业务模块，在 ice_service.dispatch 中，由预热线程或首次 Op 调用加载
+    2. 数据库与后台组件在预热线程中启动，参考 ice_service.components
+    3. 预热完成前到达的 Op 调用等待就绪信号，超时后失败，参考 ice_service.startup
+"""
+import importlib
+import threading
+import time
+
 from cpkt.core import exc
 from cpkt.core import xlogging as lg
 from cpkt.icehelper import application
 from cpkt.rpc import ice
 
-import interface_data_define as idd
 from basic_library import xfunctions as xf
-from service_logic import consume_journal
-from service_logic import generate_journal
-from service_logic import handle_operation
+from ice_service import op_log_policy
+from ice_service import op_recorder
+from ice_service import startup
 
 _logger = lg.get_logger(__name__)
 
+WARM_UP_JOIN_SECONDS = 30  # 退出时等待预热线程的最长时间
+
+
+def _load(module_name: str):
+    """首次调用时加载模块；import 语句持有模块锁，并发调用时只加载一次"""
+    return importlib.import_module(module_name)
+
 
 class SnapshotI(ice.SnapshotApi.Snapshot):
-    EXECUTE = {
-        # 生成创建快照存储的日志
-        "generate_journal_for_create": (
-            idd.GenerateJournalForCreateParamsSchema,
-            generate_journal.for_create,
-            idd.EmptySchema,
-        ),
-        # 生成销毁快照存储的日志
-        "generate_journal_for_destroy": (
-            idd.GenerateJournalForDestroyParamsSchema,
-            generate_journal.for_destroy,
-            idd.EmptySchema,
-        ),
-        # 创建快照存储，获得写权限原生句柄
-        "create_snapshot": (
-            idd.CreateSnapshotParamsSchema,
-            consume_journal.create_snapshot,
-            idd.CreateSnapshotResultSchema,
-        ),
-        # 关闭快照存储原生句柄，并释放锁定的快照存储
-        "close_snapshot": (
-            idd.CloseSnapshotParamsSchema,
-            handle_operation.close_snapshot,
-            idd.EmptySchema,
-        ),
-        # 打开快照存储，可选获得读取原生句柄
-        # remark:
-        #    支持延迟打开原生读句柄，参考 get_raw_handle
-        "open_snapshot": (
-            idd.OpenSnapshotParamsSchema,
-            handle_operation.open_snapshot,
-            idd.OpenSnapshotResultSchema,
-        ),
-        # 获取原生句柄
-        # remark:
-        #    支持延迟打开原生读句柄，如果 open_snapshot 未打开原生读句柄，那么可以在 open_snapshot 后，调用此接口获取
-        "get_raw_handle": (
-            idd.GetRawHandleParamsSchema,
-            handle_operation.get_raw_handle,
-            idd.GetRawHandleResultSchema,
-        ),
-        # 设置写句柄关闭时的工作模式
-        # remark:
-        #   支持 直接使用hash文件、修正后使用hash文件
-        "set_hash_mode": (
-            idd.SetHashModeParamsSchema,
-            handle_operation.set_hash_mode,
-            idd.EmptySchema,
-        ),
-    }
+
+    def __init__(self, readiness: startup.Readiness = None, ready_timeout: float = 60):
+        self.readiness = readiness  # 为 None 时不等待就绪
+        self.ready_timeout = ready_timeout
 
     def OpWithBinary(self, call, in_json, in_raw, current=None):
         _ = self
@@ -73,32 +44,87 @@ class SnapshotI(ice.SnapshotApi.Snapshot):
         return out_json, out_raw
 
     def Op(self, call, in_json, current=None):
-        _ = self
         _ = current
         op_index = xf.generate_unique_number(xf.UNIQUE_ICE_OP_INDEX)
-        _logger.info(f'Op [{op_index}] {call} : {in_json}')
+        log_level = op_log_policy.get_op_log_policy().sample(call)
+        if log_level == op_log_policy.LEVEL_FULL:
+            _logger.info('Op [%s] %s : %s', op_index, call, in_json)
+        recorder = op_recorder.get_op_recorder()
+        begin_timestamp, begin, out_json = time.time(), time.monotonic(), None
         try:
-            params, errors = SnapshotI.EXECUTE[call][0]().loads(in_json)
-            assert not errors, ('内部异常，代码 LoadJsonFailed', f'load failed {errors}', 0,)
-
-            result = SnapshotI.EXECUTE[call][1](params)
+            if self.readiness and not self.readiness.wait(self.ready_timeout):
+                assert not self.readiness.failed, ('服务启动失败', f'service start failed : {self.readiness.failed}', 0,)
+                assert False, ('服务正在启动，请稍后重试', f'service not ready : {self.readiness}', 0,)
 
-            out_json, errors = SnapshotI.EXECUTE[call][2]().dumps(result, ensure_ascii=False)
-            assert not errors, ('内部异常，代码 DumpJsonFailed', f'dump failed {errors}', 0,)
+            out_json = _load('ice_service.dispatch').execute(call, in_json)
 
-            _logger.info(f'Op [{op_index}] {call} : {out_json}')
+            if log_level == op_log_policy.LEVEL_FULL:
+                _logger.info('Op [%s] %s : %s', op_index, call, out_json)
+            elif log_level == op_log_policy.LEVEL_BRIEF:
+                _logger.info('Op [%s] %s : %s bytes in %.6fs', op_index, call, len(out_json), time.monotonic() - begin)
             return out_json
         except Exception as e:
+            out_json = None
+            if log_level != op_log_policy.LEVEL_FULL:  # 未记录输入
+                _logger.error('Op [%s] %s : %s', op_index, call, in_json)
             _logger.error(f'Op [{op_index}] {call} failed\n{lg.format_exception(e)}')
             raise exc.standardize_exception(e)
+        finally:
+            if recorder:
+                recorder.record(op_index, call, in_json, out_json, begin_timestamp, time.monotonic() - begin)
 
 
 class Server(application.Application):
+    components = None  # 预热线程中加载，参考 ice_service.components.ServiceComponents
+
+    def _start_op_recorder(self):
+        """配置了 Snapshot.RecordPath 时，记录所有 Op 调用，参考 op_recorder"""
+        record_path = self.communicator().getProperties().getProperty('Snapshot.RecordPath')
+        if record_path:
+            op_recorder.start(record_path)
+
+    def _configure_op_log_policy(self):
+        """Snapshot.LogPolicy 为启动时的策略，运行时写入 Snapshot.LogPolicyPath 文件修改，参考 op_log_policy"""
+        properties = self.communicator().getProperties()
+        op_log_policy.configure(
+            properties.getPropertyWithDefault('Snapshot.LogPolicy', op_log_policy.DEFAULT_SPEC),
+            properties.getProperty('Snapshot.LogPolicyPath') or None,
+        )
+
+    def _warm_up(self, readiness: startup.Readiness):
+        try:
+            self.components = _load('ice_service.components').ServiceComponents(self.communicator().getProperties())
+            readiness.mark('modules_loaded')
+            self.components.start(readiness)
+        except Exception as e:
+            _logger.error(lg.format_exception(e))
+            readiness.set_failed(f'warm up failed : {e}')
+            if readiness.failed:  # 就绪前失败，服务不可用，退出进程由外部重新启动
+                readiness.clear()
+                self.communicator().shutdown()
+
     def run(self, args):
+        properties = self.communicator().getProperties()
+        readiness = startup.Readiness(properties.getProperty('Snapshot.ReadyPath') or None)
+        readiness.clear()
+        self._configure_op_log_policy()
+        self._start_op_recorder()
         adapter = self.communicator().createObjectAdapter("ApiAdapter")
-        adapter.add(SnapshotI(), self.communicator().stringToIdentity("dss"))
+        adapter.add(SnapshotI(readiness, properties.getPropertyAsIntWithDefault('Snapshot.ReadyTimeoutSeconds', 60)),
+                    self.communicator().stringToIdentity("dss"))
         adapter.activate()
+        readiness.mark('adapter_activated')
+
+        warm_up = threading.Thread(target=self._warm_up, args=(readiness,), name='warm_up', daemon=True)
+        warm_up.start()
         self.communicator().waitForShutdown()
+        warm_up.join(WARM_UP_JOIN_SECONDS)
+        if warm_up.is_alive():
+            _logger.warning(f'warm up not finished in {WARM_UP_JOIN_SECONDS}s, {readiness}')
+        if self.components:
+            self.components.stop()
+        op_recorder.stop()
+        readiness.clear()
         return 0
 
 
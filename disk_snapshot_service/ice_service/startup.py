@@ -0,0 +1,85 @@
+"""服务启动的阶段记录与就绪信号
+
+服务启动时先激活 Ice 适配器，业务模块的加载与后台组件的启动在预热线程中进行（参考 service.Server.run）
+    1. 每个阶段完成时调用 mark ，记录距离启动的耗时
+    2. 后台组件启动后、预热前调用 set_ready（参考 components.ServiceComponents.start）：唤醒等待就绪的 Op 调用；
+       配置了 ready_path 时写入该文件（内容为已完成阶段的耗时），供外部的启动脚本与监控判断服务是否可用；
+       之后的预热（连接镜像服务、生成时间区间索引）失败只记录日志，不影响服务
+    3. 就绪前失败时调用 set_failed ，等待中的 Op 调用立即失败，随后删除就绪文件并退出进程（参考 service.Server._warm_up）；
+       已就绪后不再改变状态，只记录日志
+"""
+import collections
+import json
+import os
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+_logger = lg.get_logger(__name__)
+
+
+class Readiness(object):
+
+    def __init__(self, ready_path: str = None):
+        self.ready_path = ready_path
+        self.stages: typing.Dict[str, float] = collections.OrderedDict()  # 阶段 -> 完成时距离启动的秒数
+        self.failed: typing.Union[str, None] = None
+        self._begin = time.monotonic()
+        self._done = threading.Event()
+
+    def __str__(self):
+        state = 'failed' if self.failed else 'ready' if self.is_ready else 'starting'
+        return f'readiness:<{state},{self.elapsed:.3f}s>'
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._begin
+
+    @property
+    def is_ready(self) -> bool:
+        return self._done.is_set() and self.failed is None
+
+    def mark(self, stage: str):
+        self.stages[stage] = round(self.elapsed, 6)
+        _logger.info(f'{self} {stage}')
+
+    def set_ready(self):
+        self.mark('ready')
+        self._done.set()
+        if self.ready_path:
+            self._write_ready_file()
+
+    def set_failed(self, reason: str):
+        if self.is_ready:
+            _logger.warning(f'{self} ignore failure after ready : {reason}')
+            return
+        self.failed = reason
+        _logger.error(f'{self} : {reason}')
+        self._done.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """等待预热完成，返回是否就绪"""
+        self._done.wait(timeout)
+        return self.is_ready
+
+    def to_dict(self) -> dict:
+        return {'ready': self.is_ready, 'failed': self.failed, 'pid': os.getpid(), 'stages': dict(self.stages)}
+
+    def _write_ready_file(self):
+        tmp_path = f'{self.ready_path}.writing'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, self.ready_path)
+        except OSError as e:
+            _logger.warning(f'{self} write {self.ready_path} failed : {e}')
+
+    def clear(self):
+        """删除就绪文件，服务启动与退出时调用"""
+        if self.ready_path and os.path.exists(self.ready_path):
+            try:
+                os.remove(self.ready_path)
+            except OSError as e:
+                _logger.warning(f'{self} remove {self.ready_path} failed : {e}')
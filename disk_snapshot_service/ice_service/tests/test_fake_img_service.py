@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+
+import pytest
+from cpkt.rpc import ice
+
+from business_logic import storage_action as action
+from business_logic import storage_chain as chain
+from business_logic import storage_reference_manager as srm
+from data_access import models as m
+from data_access import session as s
+from ice_service import fake_img_service as fake
+from ice_service import service
+
+GiB = 1024 * 1024 * 1024
+
+
+def _ident(snapshot):
+    return ice.IMG.ImageSnapshotIdent('/mnt/a.qcow', snapshot)
+
+
+def test_latency_model():
+    rng = random.Random(0)
+    assert fake.LatencyModel.parse('fixed:0.5').sample(rng) == 0.5
+    assert 1 <= fake.LatencyModel.parse('uniform:1,2').sample(rng) <= 2
+    samples = [fake.LatencyModel.parse('lognormal:0.1,0.5').sample(rng) for _ in range(1000)]
+    assert 0.08 < sorted(samples)[500] < 0.12
+    assert str(fake.LatencyModel.parse('exponential:0.2')) == 'exponential:0.2'
+    with pytest.raises(AssertionError):
+        fake.LatencyModel.parse('normal:1')
+
+
+def test_handles_and_del_snapshot_in_use():
+    servant = fake.FakeImgServiceI(fake.ROLE_WRITE)
+    handle = servant.create(_ident('s1'), list(), GiB, 'flag')
+    assert handle == 1
+    assert servant.open([_ident('s0'), _ident('s1')], 'flag') == 2
+    assert servant.DelSnaport(_ident('s1')) == -2
+    assert servant.close(handle, True) == 0
+    assert servant.DelSnaport(_ident('s1')) == -2
+    assert servant.close(2, True) == 0
+    assert servant.DelSnaport(_ident('s1')) == 0
+    assert servant.close(2, True) == -1
+    assert servant.to_dict()['operations']['DelSnaport']['calls'] == 3
+
+
+def test_error_injection():
+    profiles = fake.generate_profiles(error_rate=['create=1', 'DelSnaport=0.5'], error_codes=['DelSnaport=-1,-2'])
+    servant = fake.FakeImgServiceI(fake.ROLE_WRITE, profiles, seed=0)
+    assert servant.create(_ident('s1'), list(), GiB, 'flag') == -1
+    returned = {servant.DelSnaport(_ident('s1')) for _ in range(100)}
+    assert returned == {0, -1, -2}
+    stats = servant.to_dict()['operations']
+    assert stats['create']['errors'] == 1
+    assert 30 < stats['DelSnaport']['errors'] < 70
+
+
+def test_max_concurrency():
+    profiles = fake.generate_profiles(latency=['open=fixed:0.05'])
+    servant = fake.FakeImgServiceI(fake.ROLE_READ, profiles, max_concurrency=2)
+    threads = [threading.Thread(target=servant.open, args=([_ident('s1')], 'flag')) for _ in range(6)]
+    begin = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert servant.to_dict()['in_flight_max'] == 2
+    assert time.monotonic() - begin >= 0.15  # 6 个调用分 3 批处理
+
+
+@pytest.fixture()
+def write_chain(db, create_storage):
+    with s.transaction():
+        storage_obj = create_storage('q1', status=m.SnapshotStorage.STATUS_CREATING, image_path='/mnt/a.qcow')
+        storage_chain = chain.StorageChainForWrite(srm.get_srm(), 'test').insert_tail(storage_obj).acquire()
+    yield storage_chain
+    storage_chain.release()
+
+
+def test_install(fake_img, write_chain):
+    raw_handle, ice_endpoint = action.DiskSnapshotAction.create_qcow_snapshot(write_chain, 'flag')
+    assert (raw_handle, ice_endpoint) == (1, f'fake:{fake.ROLE_WRITE}')
+    assert fake_img.write.opened_handles == [1]
+
+    action.DiskSnapshotAction.close_disk_snapshot(raw_handle, ice_endpoint)
+    assert fake_img.write.opened_handles == list()
+
+    fake_img.write.profiles['create'] = fake.OperationProfile(error_rate=1)
+    with pytest.raises(Exception):
+        action.DiskSnapshotAction.create_qcow_snapshot(write_chain, 'flag')
+    assert service.get_write_img_prx() is fake_img.write
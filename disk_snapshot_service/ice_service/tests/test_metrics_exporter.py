@@ -0,0 +1,80 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from basic_library import metrics
+from business_logic import locker_manager as lm
+from data_access import journal as da_journal
+from data_access import models as m
+from data_access import session as s
+from ice_service import metrics_exporter
+from service_logic import service_metrics
+
+
+def _samples(text: str) -> dict:
+    return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+
+def test_histogram():
+    histogram = metrics.Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    assert histogram.snapshot() == ([(0.1, 2), (1.0, 3)], 3.65, 4)
+
+    writer = metrics.MetricWriter('t_')
+    writer.histogram('seconds', 'help', histogram, {'call': 'a"b'})
+    writer.gauge('value', 'help', None)
+    samples = _samples(writer.text())
+    assert samples['t_seconds_bucket{call="a\\"b",le="0.1"}'] == '2'
+    assert samples['t_seconds_bucket{call="a\\"b",le="+Inf"}'] == '4'
+    assert samples['t_seconds_count{call="a\\"b"}'] == '4' and samples['t_value'] == 'NaN'
+    assert writer.text().count('# TYPE t_seconds histogram') == 1
+
+
+def test_aggregate_cache(db, create_storage):
+    with s.transaction():
+        for ident, status in (('q0', m.SnapshotStorage.STATUS_STORAGE), ('q1', m.SnapshotStorage.STATUS_STORAGE),
+                              ('c0', m.SnapshotStorage.STATUS_WRITING)):
+            create_storage(ident, status=status, storage_type=ident[0])
+        da_journal.create_obj('token', '{}', m.Journal.TYPE_CREATE)
+
+    cache = service_metrics.AggregateCache(ttl_seconds=3600)
+    aggregates = cache.get()
+    assert aggregates.storages == {('s', 'q'): 2, ('w', 'c'): 1}
+    assert aggregates.journals[m.Journal.TYPE_CREATE][0] == 1
+    assert (aggregates.merges, aggregates.qcow_pool_ready) == (dict(), 0)
+
+    with s.transaction():
+        create_storage('q2')
+    assert cache.get() is aggregates and cache.refreshes == 1  # 缓存期间不重新查询
+    cache.invalidate()
+    assert cache.get().storages[('s', 'q')] == 3
+
+
+def test_exporter(db, create_storage):
+    with s.transaction():
+        create_storage('q0')
+    with lm.get_storage_locker('test_exporter'):
+        pass
+    metrics_exporter.op_seconds.observe('query_space', 0.01)
+
+    exporter = metrics_exporter.MetricsExporter(service_metrics.AggregateCache())
+    exporter.start('127.0.0.1:0')
+    try:
+        with urllib.request.urlopen(f'http://{exporter.address}/metrics') as response:
+            assert response.headers['Content-Type'] == metrics.MetricWriter.CONTENT_TYPE
+            samples = _samples(response.read().decode('utf-8'))
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'http://{exporter.address}/none')
+    finally:
+        exporter.stop()
+
+    assert samples['dss_storages{status="storage",type="qcow"}'] == '1'
+    assert samples['dss_handles{mode="write"}'] == '0'
+    assert samples['dss_reference_records{mode="read"}'] == '0'
+    assert 'dss_reference_records{mode="write"}' not in samples
+    assert int(samples['dss_lock_hold_seconds_count{lock="storage"}']) >= 1
+    assert int(samples['dss_op_seconds_count{call="query_space"}']) >= 1
+    assert 'dss_db_pool_in_use' in samples and 'dss_hashing_queue_depth' not in samples
+    assert exporter.scrapes == 1 and exporter.address is None
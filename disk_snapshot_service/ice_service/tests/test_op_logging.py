@@ -0,0 +1,136 @@
+import logging
+import os
+
+import pytest
+
+from basic_library import queue_logging
+from ice_service import op_log_policy
+
+
+class _Capture(logging.Handler):
+
+    def __init__(self):
+        super(_Capture, self).__init__()
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append((record.getMessage(), record.args))
+
+
+@pytest.fixture()
+def capture():
+    logger = logging.getLogger('test_op_logging')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = _Capture()
+    logger.addHandler(handler)
+    try:
+        yield logger, handler
+    finally:
+        queue_logging.stop()
+        logger.removeHandler(handler)
+
+
+@pytest.fixture()
+def policy():
+    try:
+        yield op_log_policy
+    finally:
+        op_log_policy.configure()
+
+
+class _Mutable(object):
+
+    def __init__(self):
+        self.value = 'before'
+
+    def __str__(self):
+        return self.value
+
+
+def test_queue_logging_lazy_format(capture):
+    logger, handler = capture
+    async_logging = queue_logging.start(logger)
+    assert async_logging.queue_handler in logger.handlers and handler not in logger.handlers
+
+    obj = _Mutable()
+    logger.info('lazy %s %d', 'a', 1)
+    logger.info('eager %s', obj)  # 非基本类型的参数在调用线程中格式化
+    obj.value = 'after'
+    logger.warning('f-string %s' % 'b')
+    queue_logging.stop()
+
+    assert handler in logger.handlers and async_logging.queue_handler not in logger.handlers
+    assert [message for message, _ in handler.records] == ['lazy a 1', 'eager before', 'f-string b']
+    assert handler.records[0][1] == ('a', 1,)  # 在 listener 线程中格式化
+    assert handler.records[1][1] is None
+
+
+def test_queue_logging_drop_when_full(capture):
+    logger, handler = capture
+    async_logging = queue_logging.AsyncLogging(logger, max_queue=2)
+    logger.removeHandler(handler)
+    logger.addHandler(async_logging.queue_handler)  # 不启动 listener ，队列不会被消费
+    for i in range(4):
+        logger.info('info %s', i)
+    logger.removeHandler(async_logging.queue_handler)
+    logger.addHandler(handler)
+    assert async_logging.queue_handler.dropped == 2
+
+
+def test_parse_policy():
+    policies, loggers = op_log_policy.parse('*=brief:0.5; open_snapshot=off\nlogger:a.b=info')
+    assert policies == {'*': ('brief', 0.5,), 'open_snapshot': ('off', 1.0,)}
+    assert loggers == {'a.b': logging.INFO}
+
+    for spec in ('*=verbose', '*=full:2', 'logger:a=noisy'):
+        with pytest.raises(AssertionError):
+            op_log_policy.parse(spec)
+
+
+def test_sample_rate(policy):
+    log_policy = policy.configure('*=brief:0.25;create_snapshot=full')
+    assert all(log_policy.sample('create_snapshot') == policy.LEVEL_FULL for _ in range(100))
+    levels = [log_policy.sample('open_snapshot') for _ in range(4000)]
+    assert set(levels) == {policy.LEVEL_BRIEF, policy.LEVEL_OFF}
+    assert 800 < levels.count(policy.LEVEL_BRIEF) < 1200
+
+
+def test_reload_from_watch_file(tmp_path, policy):
+    watch_path = str(tmp_path / 'policy')
+    log_policy = policy.configure('*=full', watch_path)
+    log_policy.check_interval_seconds = 0
+    logger = logging.getLogger('test_op_logging.watch')
+    assert log_policy.sample('open_snapshot') == policy.LEVEL_FULL
+
+    with open(watch_path, 'w') as f:
+        f.write('open_snapshot=off;logger:test_op_logging.watch=ERROR')
+    assert log_policy.sample('open_snapshot') == policy.LEVEL_OFF
+    assert logger.level == logging.ERROR
+
+    os.remove(watch_path)
+    assert log_policy.sample('open_snapshot') == policy.LEVEL_FULL
+    assert logger.level == logging.NOTSET
+
+
+def test_op_log_level(db, fake_img, policy, caplog, reset_singletons):
+    from business_logic import handle_pool as pool
+    from ice_service import service
+
+    reset_singletons((pool, '_handle_pool'))
+    servant = service.SnapshotI()
+    caplog.set_level(logging.INFO, logger=service.__name__)
+
+    policy.configure('*=brief')
+    servant.Op('generate_journal_for_create', '{"journal_token": "t1", "new_ident": "s1", "new_type": "qcow", '
+                                              '"new_storage_folder": "/mnt", "new_disk_bytes": 1024}')
+    messages = [r.getMessage() for r in caplog.records if r.name == service.__name__]
+    assert len(messages) == 1 and 'bytes in' in messages[0]
+
+    caplog.clear()
+    policy.configure('*=off')
+    with pytest.raises(Exception):
+        servant.Op('close_snapshot', '{"handle": "not exist"}')
+    messages = [r.getMessage() for r in caplog.records if r.name == service.__name__]
+    assert '"not exist"' in messages[0]  # 失败时记录输入
+    assert 'failed' in messages[1]
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from benchmark import op_replayer
+from benchmark import rpc_load_generator as load
+from ice_service import op_recorder
+
+
+@pytest.fixture()
+def recording(tmp_path):
+    path = str(tmp_path / 'ops.jsonl.gz')
+    op_recorder.start(path)
+    try:
+        yield path
+    finally:
+        op_recorder.stop()
+
+
+def test_record_and_replay(tmp_path, recording):
+    recorded = load.run(load.LocalTransport(f'sqlite:///{tmp_path / "record.db"}'), trees=2, concurrency=4,
+                        operations=100)
+    op_recorder.stop()
+
+    records = op_recorder.load(recording)
+    # 包含结束时关闭剩余句柄的调用
+    assert len(records) >= sum(v['calls'] for k, v in recorded['calls'].items() if not k.startswith('op.'))
+    assert {'t', 'i', 'call', 'in', 'out', 'seconds', 'pid', 'thread'} <= set(records[0])
+    assert records[0]['call'] == 'generate_journal_for_create'
+
+    result = op_replayer.replay(load.LocalTransport(f'sqlite:///{tmp_path / "replay.db"}'), records, speed=0)
+    assert result['records'] == len(records)
+    assert result['mismatched'] == 0
+    assert result['calls']['create_snapshot']['replayed']['calls'] == recorded['calls']['create_snapshot']['calls']
+
+
+def test_remap_consistent():
+    remapper = op_replayer.Remapper()
+    first = remapper.remap({'journal_token': 'a', 'new_ident': 'b', 'parent_ident': None, 'new_disk_bytes': 1})
+    second = remapper.remap({'handle': 'h', 'journal_token': 'a'})
+    third = remapper.remap({'journal_token': 't', 'idents': ['b']})
+    assert first['journal_token'] == second['journal_token'] != 'a'
+    assert third['idents'] == [first['new_ident']]
+    assert first['parent_ident'] is None and first['new_disk_bytes'] == 1
+
+    assert op_replayer.Remapper(remap_idents=False).remap({'storage_ident': 's'}) == {'storage_ident': 's'}
+
+
+def test_dependency_follow_token_and_handle():
+    dependency = op_replayer.DependencyTracker()
+    dependency.keys(json.loads('{"journal_token": "t", "new_ident": "s"}'))
+    assert 's' in dependency.keys({'journal_token': 't', 'handle': 'h'})
+    assert dependency.keys({'handle': 'h'}) == {'h', 's'}
@@ -0,0 +1,50 @@
+import random
+
+from benchmark import rpc_load_generator as load
+from business_logic import handle_pool as pool
+from ice_service import metrics_exporter
+from service_logic import service_metrics
+
+
+def test_tree_model_destroy_leaf_only():
+    model = load.TreeModel(random.Random(0), 'chain', trees=1)
+    root, parent = model.reserve_create()
+    assert parent is None
+    assert model.reserve_create() == (None, None)  # 根节点创建中
+    model.finish_create(root, 'h1', True)
+    assert model.take_destroy() is None  # 写句柄未关闭
+    assert model.take_close() == 'h1'
+
+    child, parent = model.reserve_create()
+    assert parent == root
+    model.finish_create(child, 'h2', True)
+    model.take_close()
+    assert model.take_destroy() == child
+    assert model.take_destroy() == root
+
+
+def test_run_local(tmp_path):
+    transport = load.LocalTransport(f'sqlite:///{tmp_path / "dss.db"}')
+    result = load.run(transport, shape='random', trees=2, concurrency=4, operations=200)
+
+    calls = result['calls']
+    assert sum(v['calls'] for k, v in calls.items() if k.startswith('op.')) == 200
+    assert all(v['errors'] == 0 for v in calls.values())
+    assert calls['create_snapshot']['calls'] == calls['generate_journal_for_create']['calls']
+    assert result['service']['img_service']['ImgService4W']['operations']['create']['calls'] > 0
+    assert pool._handle_pool is None
+
+
+def test_ice_service_stats(db):
+    exporter = metrics_exporter.MetricsExporter(service_metrics.AggregateCache())
+    exporter.start('127.0.0.1:0')
+    address = exporter.address
+    try:
+        stats = load.IceTransport('dss', address).service_stats()
+    finally:
+        exporter.stop()
+    assert stats['dss_handles{mode="write"}'] == 0
+    assert 'dss_tree_versions_conflicts_total' in stats
+
+    assert load.IceTransport('dss').service_stats() == dict()
+    assert 'error' in load.IceTransport('dss', address).service_stats()  # 已停止
@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from ice_service import service
+from ice_service import startup
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_import_service_is_light():
+    """加载 service 时不加载数据库与业务模块，Ice 适配器无需等待"""
+    code = ('import sys; from ice_service import service; '
+            'print(sorted(n for n in ("sqlalchemy", "marshmallow", "interface_data_define", "service_logic", '
+            '"business_logic", "ice_service.dispatch") if n in sys.modules))')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=SERVICE_ROOT, env=env)
+    assert output.decode().strip().splitlines()[-1] == '[]'
+
+
+def test_readiness(tmp_path):
+    ready_path = str(tmp_path / 'dss_ready')
+    readiness = startup.Readiness(ready_path)
+    assert not readiness.wait(0.01)
+
+    waiting = list()
+    waiter = threading.Thread(target=lambda: waiting.append(readiness.wait(5)))
+    waiter.start()
+    readiness.mark('components')
+    readiness.set_ready()
+    waiter.join()
+    assert waiting == [True]
+
+    with open(ready_path) as f:
+        content = json.load(f)
+    assert content['ready'] and list(content['stages']) == ['components', 'ready']
+    readiness.clear()
+    assert not os.path.exists(ready_path)
+
+
+def test_op_before_ready(db):
+    readiness = startup.Readiness()
+    servant = service.SnapshotI(readiness, 0.01)
+    in_json = '{"tree_ident": "t1"}'
+    with pytest.raises(Exception, match='服务正在启动'):
+        servant.Op('query_timeline', in_json)
+
+    readiness.set_ready()
+    assert json.loads(servant.Op('query_timeline', in_json))['storage_count'] == 0
+
+    readiness.set_failed('warm up failed')  # 已就绪后不再改变状态
+    assert readiness.is_ready
+    assert json.loads(servant.Op('query_timeline', in_json))['storage_count'] == 0
+
+    readiness = startup.Readiness()
+    readiness.set_failed('warm up failed')
+    with pytest.raises(Exception, match='服务启动失败'):
+        service.SnapshotI(readiness, 5).Op('query_timeline', in_json)
+
+
+class _Communicator(object):
+
+    def __init__(self):
+        self.shutdown_count = 0
+
+    @staticmethod
+    def getProperties():
+        return None  # 读取配置时预热失败
+
+    def shutdown(self):
+        self.shutdown_count += 1
+
+
+def test_warm_up_failed(tmp_path):
+    ready_path = tmp_path / 'dss_ready'
+    ready_path.write_text('{}')
+    readiness = startup.Readiness(str(ready_path))
+    communicator = _Communicator()
+    server = service.Server()
+    server.communicator = lambda: communicator
+
+    server._warm_up(readiness)
+    assert readiness.failed and not readiness.is_ready
+    assert not ready_path.exists()
+    assert communicator.shutdown_count == 1
+
+
+def test_readiness_clear_failed(tmp_path):
+    ready_path = tmp_path / 'dss_ready'
+    (ready_path / 'busy').mkdir(parents=True)
+    startup.Readiness(str(ready_path)).clear()  # 无法删除时只记录日志
+    assert ready_path.exists()
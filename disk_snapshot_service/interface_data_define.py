@@ -47,20 +47,48 @@ class CreateSnapshotResultSchema(Schema):
 
 
 class CloseSnapshotParams(object):
-    def __init__(self, handle):
+    def __init__(self, handle, background=False):
         self.handle = handle
+        self.background = background
 
 
 class CloseSnapshotParamsSchema(Schema):
     handle = fields.String(required=True, validate=Length(max=32))
+    background = fields.Boolean(missing=False)  # 句柄立即失效，在后台关闭原生句柄并释放快照存储链
 
     @post_load
     def make_params(self, data):
         return CloseSnapshotParams(**data)
 
 
+# 后台关闭句柄的状态：
+CLOSE_STATUS_CLOSING = 'closing'
+CLOSE_STATUS_CLOSED = 'closed'
+CLOSE_STATUS_FAILED = 'failed'
+CLOSE_STATUS_UNKNOWN = 'unknown'  # 不是后台关闭的句柄，或者结果已过期
+
+
+class QueryCloseStatusParams(object):
+    def __init__(self, handle):
+        self.handle = handle
+
+
+class QueryCloseStatusParamsSchema(Schema):
+    handle = fields.String(required=True, validate=Length(max=32))
+
+    @post_load
+    def make_params(self, data):
+        return QueryCloseStatusParams(**data)
+
+
+class QueryCloseStatusResultSchema(Schema):
+    status = fields.String()
+    error = fields.String()
+
+
 class OpenSnapshotParams(object):
-    def __init__(self, handle, caller_trace, caller_pid, caller_pid_created, storage_ident, timestamp, open_raw_handle):
+    def __init__(self, handle, caller_trace, caller_pid, caller_pid_created, storage_ident, timestamp, open_raw_handle,
+                 share=False):
         self.handle = handle
         if caller_trace:
             self.caller_trace = caller_trace
@@ -71,6 +99,7 @@ class OpenSnapshotParams(object):
         self.storage_ident = storage_ident
         self.timestamp = timestamp
         self.open_raw_handle = open_raw_handle
+        self.share = share
 
 
 class OpenSnapshotParamsSchema(Schema):
@@ -81,6 +110,7 @@ class OpenSnapshotParamsSchema(Schema):
     storage_ident = fields.String(required=True, validate=Length(max=32))
     timestamp = fields.Decimal(missing=None)
     open_raw_handle = fields.Boolean(missing=False)
+    share = fields.Boolean(missing=False)  # 与打开相同快照存储与时间戳的其他共享读句柄使用同一个原生句柄
 
     @post_load
     def make_params(self, data):
@@ -180,6 +210,18 @@ class GetRawHandleResultSchema(Schema):
     ice_endpoint = fields.String()
 
 
+# hash_mode 的枚举：
+HASH_MODE_NONE = 'none'  # 关闭写句柄后，重新读取快照数据生成hash文件
+HASH_MODE_USE_HASH_FILE = 'use'  # 写入者生成的hash文件完整可靠，关闭写句柄时直接使用
+HASH_MODE_FIXUP_HASH_FILE = 'fixup'  # 写入者生成的hash文件需要增量修正后使用
+
+VALID_HASH_MODE_ = (
+    HASH_MODE_NONE,
+    HASH_MODE_USE_HASH_FILE,
+    HASH_MODE_FIXUP_HASH_FILE,
+)
+
+
 class SetHashModeParams(object):
     def __init__(self, handle, hash_mode):
         self.handle = handle
@@ -188,8 +230,98 @@ class SetHashModeParams(object):
 
 class SetHashModeParamsSchema(Schema):
     handle = fields.String(required=True, validate=Length(max=32))
-    hash_mode = fields.String(required=True)
+    hash_mode = fields.String(required=True, validate=lambda _: _ in VALID_HASH_MODE_)
 
     @post_load
     def make_params(self, data):
         return SetHashModeParams(**data)
+
+
+class QueryTimelineParams(object):
+    def __init__(self, tree_ident, storage_ident, timestamps, begin_timestamp, end_timestamp, page_token, limit):
+        self.tree_ident = tree_ident
+        self.storage_ident = storage_ident
+        self.timestamps = timestamps
+        self.begin_timestamp = begin_timestamp
+        self.end_timestamp = end_timestamp
+        self.page_token = page_token
+        self.limit = limit
+
+
+class QueryTimelineParamsSchema(Schema):
+    tree_ident = fields.String(missing=None, validate=Length(max=40))
+    storage_ident = fields.String(missing=None, validate=Length(max=32))  # 未指定 tree_ident 时，查询所在的快照存储树
+    timestamps = fields.List(fields.Decimal(), missing=None, validate=Length(max=10000))  # 指定时仅查询覆盖各时间点的快照存储
+    begin_timestamp = fields.Decimal(missing=None)
+    end_timestamp = fields.Decimal(missing=None)
+    page_token = fields.String(missing=None)  # 上一页结果中的 next_page_token
+    limit = fields.Integer(missing=1000, validate=validate.Range(min=1, max=10000))
+
+    @post_load
+    def make_params(self, data):
+        return QueryTimelineParams(**data)
+
+
+# 时间线中的间隙的 type
+TIMELINE_TYPE_GAP = 'gap'
+
+
+class TimelineEntrySchema(Schema):
+    ident = fields.String()
+    type = fields.String()  # dd.DiskSnapshotService.STORAGE_TYPE_xxx 或 TIMELINE_TYPE_GAP
+    status = fields.String()
+    parent_ident = fields.String()
+    parent_timestamp = fields.Decimal(as_string=True)
+    start_timestamp = fields.Decimal(as_string=True)
+    finish_timestamp = fields.Decimal(as_string=True)  # 为 null 时表示没有结束
+
+
+class TimelineCoverSchema(Schema):
+    timestamp = fields.Decimal(as_string=True)
+    idents = fields.List(fields.String())  # 按开始时间从新到旧排列
+
+
+class QueryTimelineResultSchema(Schema):
+    tree_ident = fields.String()
+    first_timestamp = fields.Decimal(as_string=True)
+    last_timestamp = fields.Decimal(as_string=True)
+    storage_count = fields.Integer()
+    gap_count = fields.Integer()
+    entries = fields.Nested(TimelineEntrySchema, many=True)
+    next_page_token = fields.String()
+    covers = fields.Nested(TimelineCoverSchema, many=True)
+
+
+class QuerySpaceParams(object):
+    def __init__(self, tree_ident, storage_ident, with_storages):
+        self.tree_ident = tree_ident
+        self.storage_ident = storage_ident
+        self.with_storages = with_storages
+
+
+class QuerySpaceParamsSchema(Schema):
+    tree_ident = fields.String(missing=None, validate=Length(max=40))
+    storage_ident = fields.String(missing=None, validate=Length(max=32))  # 未指定 tree_ident 时，查询所在的快照存储树
+    with_storages = fields.Boolean(missing=False)  # 是否返回每个快照存储的统计
+
+    @post_load
+    def make_params(self, data):
+        return QuerySpaceParams(**data)
+
+
+class StorageSpaceSchema(Schema):
+    ident = fields.String()
+    status = fields.String()
+    written_bytes = fields.Integer()  # 为 null 时表示没有位图文件，无法统计
+    unique_bytes = fields.Integer()
+    reclaimable_bytes = fields.Integer()  # 叶子为删除后可以释放的数据量，非叶子为合并后可以释放的数据量
+
+
+class QuerySpaceResultSchema(Schema):
+    tree_ident = fields.String()
+    storage_count = fields.Integer()
+    written_bytes = fields.Integer()
+    unique_bytes = fields.Integer()
+    recycling_reclaimable_bytes = fields.Integer()  # 回收中的快照存储完成回收后可以释放的数据量
+    unknown_count = fields.Integer()  # 无法统计的快照存储数量
+    storages = fields.Nested(StorageSpaceSchema, many=True)
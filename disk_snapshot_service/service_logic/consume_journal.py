@@ -184,7 +184,7 @@ class CreateCdpStorage(CreateStorage):
               需要在日志表中记录当前节点，支持创建父快照时，调整当前节点的父
             * 其余情况，其父快照必须已经在存储对象表中
         2. 调用底层模块创建存储文件
-            * 如果创建突然中断，那么数据库记录会保持为 Creating 状态，下次启动时进行状态修正
+            * 如果创建突然中断，那么数据库记录会保持为 Creating 状态，下次启动时进行状态修正，参考 startup_recovery
             * 如果创建失败，那么标记为 Abnormal 状态，后台回收线程异步进行状态修正
         3. 更新数据库记录，将建立的存储对象标记为 Writing 状态
 
@@ -280,7 +280,7 @@ class CreateQcowStorage(CreateStorage):
               如本节点为根节点，那么在该步骤修改子节点依赖；因为如果本节点创建失败，逻辑上后续子节点应该无效
             * 父快照必须在 storage 表中
         2. 调用底层模块创建存储文件
-            * 如果创建突然中断，那么数据库记录会保持为 Creating 状态，下次启动时进行状态修正
+            * 如果创建突然中断，那么数据库记录会保持为 Creating 状态，下次启动时进行状态修正，参考 startup_recovery
             * 如果创建失败，那么标记为 Abnormal 状态，后台回收线程异步进行状态修正
         3. 更新数据库记录，将建立的存储对象标记为 Writing 状态
             * 如果本节点不是根节点，且具有子节点，需要移动子节点的指向
@@ -0,0 +1,64 @@
+"""重建数据块hash去重索引
+
+从数据库中获取所有 Storage 状态快照存储的hash文件，在临时目录中重新生成索引后替换原索引目录
+重建过程中不修改原索引；需要在服务停止时执行，避免与服务中的 HashingScheduler 同时修改索引
+
+usage:
+    cd disk_snapshot_service
+    python -m service_logic.dedup_index_rebuild --index-dir /var/lib/disk_snapshot_service/dedup_index
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+from cpkt.core import xlogging as lg
+
+from business_logic import dedup_index
+from business_logic import storage
+from data_access import models as m
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+
+def rebuild(index_dir: str) -> dedup_index.DedupIndex:
+    with s.readonly():
+        hash_items = storage.query_hashes_by_storage_status(m.SnapshotStorage.STATUS_STORAGE)
+
+    building_dir = f'{index_dir.rstrip(os.sep)}.rebuilding'
+    shutil.rmtree(building_dir, ignore_errors=True)
+    index = dedup_index.DedupIndex(building_dir)
+    index.clear()  # 索引目录在首次写入时创建，没有hash文件时同样生成空的索引
+
+    begin = time.monotonic()
+    for hash_item in hash_items:
+        if not os.path.exists(hash_item.path):
+            _logger.warning(f'rebuild dedup index skip {hash_item}, file not exist')
+            continue
+        index.add_hash_file(hash_item.id, hash_item.path)
+
+    removing_dir = f'{index_dir.rstrip(os.sep)}.removing'
+    if os.path.exists(index_dir):
+        os.replace(index_dir, removing_dir)
+    os.replace(building_dir, index_dir)
+    shutil.rmtree(removing_dir, ignore_errors=True)
+
+    index = dedup_index.DedupIndex(index_dir)
+    _logger.info(f'rebuild {index} from {len(hash_items)} hash files in {time.monotonic() - begin:.3f}s')
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='rebuild dedup index from hash files')
+    parser.add_argument('--index-dir', default=dedup_index.DEFAULT_INDEX_DIR)
+    args = parser.parse_args(argv)
+
+    index = rebuild(args.index_dir)
+    print(f'{index}, {index.disk_bytes} bytes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,26 @@
+import collections
+import os
+import threading
+import typing
+from concurrent import futures
+
 from cpkt.core import xlogging as lg
 
 import interface_data_define as idd
+from business_logic import cdp_index
+from business_logic import chain_metrics
 from business_logic import handle_pool as pool
 from business_logic import locker_manager as lm
 from business_logic import storage
 from business_logic import storage_action as action
 from business_logic import storage_chain as chain
 from business_logic import storage_reference_manager as srm
+from business_logic import storage_space
 from business_logic import storage_tree as tree
+from business_logic import tree_versions
 from data_access import models as m
 from data_access import session as s
+from service_logic import storage_hashing
 
 _logger = lg.get_logger(__name__)
 
@@ -17,8 +28,12 @@ _logger = lg.get_logger(__name__)
 class CloseStorage(object):
     """关闭磁盘快照"""
 
-    def __init__(self, handle: pool.Handle):
+    def __init__(self, handle: pool.Handle, detached=False):
+        """
+        :param detached: 句柄已从 pool 中移除，参考 BackgroundCloser
+        """
         self.handle = handle
+        self.detached = detached
 
     def __repr__(self):
         return self.__str__()
@@ -36,19 +51,65 @@ class CloseStorage(object):
             1. 如果底层模块发生错误，那么标记为 Abnormal 状态，后台回收线程异步进行状态修正
             2. 如果当前不为 Writing 状态，那么状态转移有误，同样视为异常状态
             3. 成功完成后，将标记为 Hashing 状态（CDP文件类型同样时 Hashing 状态）
+            4. 设置了 hash_mode 时，登记写入者生成的hash文件
+                * HASH_MODE_USE_HASH_FILE 直接标记为 Storage 状态，无需重新读取快照数据
+                * HASH_MODE_FIXUP_HASH_FILE 保持 Hashing 状态，由 HashingScheduler 进行增量修正
         读句柄
             无特殊处理
         """
         if self.handle.writing:
             try:
-                self.handle.destroy()
-                self._set_storage_status(m.SnapshotStorage.STATUS_HASHING)
+                self._destroy_handle()
+                hash_path = self._query_writer_hash_path()
+                hash_id = self._close_writing_storage(hash_path, self._read_new_storage_size(hash_path))
             except Exception as e:
                 self._set_storage_status(m.SnapshotStorage.STATUS_ABNORMAL)
                 raise e
+            if hash_id is not None and self.handle.hash_mode == idd.HASH_MODE_USE_HASH_FILE:
+                storage_hashing.get_hashing_scheduler().add_to_dedup_index(hash_id, hash_path)
+        else:
+            self._destroy_handle()
+
+    def _destroy_handle(self):
+        if self.detached:
+            self.handle.release()
         else:
             self.handle.destroy()
 
+    def _query_writer_hash_path(self):
+        storage_item = self.handle.storage_chain.last_storage_item
+        if storage_item.is_cdp or self.handle.hash_mode in (None, idd.HASH_MODE_NONE,):
+            return None
+
+        hash_path = action.ImagePathGenerator.generate_hash(storage_item.image_path, storage_item.ident)
+        if not os.path.exists(hash_path):
+            _logger.warning(f'{self} hash mode {self.handle.hash_mode}, but {hash_path} NOT exist, rehash it')
+            return None
+        return hash_path
+
+    def _read_new_storage_size(self, hash_path):
+        """直接标记为 Storage 状态时，在锁空间外统计写入的数据量，参考 storage_space"""
+        if not hash_path or self.handle.hash_mode != idd.HASH_MODE_USE_HASH_FILE:
+            return None  # 由 HashingScheduler 统计
+        storage_item = self.handle.storage_chain.last_storage_item
+        return storage_space.read_written_bytes_or_none(
+            storage_item.image_path, storage_item.ident, storage_item.disk_bytes, f'{self}')
+
+    def _close_writing_storage(self, hash_path, new_storage_size):
+        with lm.get_storage_locker(self.trace_msg), s.transaction():
+            storage_obj = storage.query_by_ident(self.handle.storage_chain.last_storage_item.ident)
+            storage_obj.update_status(m.SnapshotStorage.STATUS_HASHING)
+            if not hash_path:
+                return None
+
+            hash_id = storage.create_hash(
+                storage_obj.ident, m.Hash.VERSION_MD4_CRC32, storage.generate_hash_type(storage_obj), hash_path).id
+            if self.handle.hash_mode == idd.HASH_MODE_USE_HASH_FILE:
+                if new_storage_size is not None:
+                    storage_obj.update_new_storage_size(new_storage_size)
+                storage_obj.update_status(m.SnapshotStorage.STATUS_STORAGE)
+            return hash_id
+
     def _set_storage_status(self, status):
         with lm.get_storage_locker(self.trace_msg), s.transaction():
             storage.query_by_ident(self.handle.storage_chain.last_storage_item.ident).update_status(status)
@@ -56,7 +117,7 @@ class CloseStorage(object):
 
 class OpenStorage(object):
     def __init__(self, handle: str, caller_trace: str, caller_pid: int, caller_pid_created: int,
-                 storage_ident: str, timestamp, open_raw_handle):
+                 storage_ident: str, timestamp, open_raw_handle, share=False):
         """
         :param handle: 操作句柄
         :param caller_trace: 调试跟踪信息
@@ -65,6 +126,7 @@ class OpenStorage(object):
         :param storage_ident: 需要打开的快照
         :param timestamp: 打开快照的时间戳（CDP文件类型有效）
         :param open_raw_handle: 是否同步打开读写的原始句柄
+        :param share: 是否与其他共享读句柄使用同一个快照存储链与原始句柄，参考 HandlePool.reference_shared
 
         :param self.trace_msg: 调试跟踪信息，锁管理器使用
         """
@@ -78,6 +140,7 @@ class OpenStorage(object):
         self.timestamp = timestamp
 
         self.open_raw_handle = open_raw_handle
+        self.share = share
 
         self.raw_flag = action.DiskSnapshotAction.generate_flag(self._caller_trace)
 
@@ -106,55 +169,192 @@ class OpenStorage(object):
         """
         1. 获取快照存储链
         2. 调用底层接口打开快照存储链
+        共享模式下，快照存储链与原生句柄仅在首次使用时获取与打开
         """
         handle: pool.Handle = pool.generate_handle(self._handle, False, self.raw_flag)
         try:
-            with lm.get_journal_locker(self.trace_msg), lm.get_storage_locker(self.trace_msg), s.readonly():
-                depend_nodes = self._query_depend_nodes()
-                handle.storage_chain = self._generate_chain(depend_nodes).acquire()
+            if self.share:
+                return self._execute_shared(handle)
 
+            handle.storage_chain = self._acquire_chain()
             if self.open_raw_handle:
-                with handle.locker:
-                    handle.raw_handle, handle.ice_endpoint = action.DiskSnapshotAction.open_disk_snapshot(
-                        handle.storage_chain, handle.raw_flag)
-
+                handle.open_raw_handle()
             return handle
         except Exception:
             handle.destroy()
             raise
 
+    def _execute_shared(self, handle: pool.Handle):
+        shared = pool.HandlePool.get_handle_pool().reference_shared(handle, self.storage_ident, self.timestamp)
+        shared.attach(handle, self._acquire_chain)
+        if self.open_raw_handle:
+            shared.open_raw_handle(handle)
+        return handle
+
+    def _acquire_chain(self):
+        """未指定时间戳时优先使用快照存储树的当前版本，无需持有存储锁，参考 tree_versions"""
+        acquired = self._acquire_chain_from_version() if self.timestamp is None else None
+        if acquired is None:
+            with lm.get_journal_locker(self.trace_msg), lm.get_storage_locker(self.trace_msg), s.readonly():
+                tree_ident = storage.query_by_ident(self.storage_ident).tree_ident
+                acquired = tree_ident, self._generate_chain(self._query_depend_nodes(tree_ident)).acquire()
+        tree_ident, r_chain = acquired
+        chain_metrics.get_chain_metrics().record(tree_ident, r_chain)
+        return r_chain
+
+    def _acquire_chain_from_version(self):
+        """返回 (tree_ident, 快照存储链)；没有缓存的版本或登记引用后版本已变化时返回 None ，由调用者在存储锁内重新获取"""
+        with s.readonly():
+            storage_obj = storage.query_by_ident(self.storage_ident)  # 快照存储所在的快照存储树不会变化
+            if storage_obj is None:
+                return None
+            tree_ident = storage_obj.tree_ident
+
+        versions = tree_versions.get_tree_versions()
+        storage_tree, version = versions.get(tree_ident)
+        if storage_tree is None or self.storage_ident not in storage_tree.node_dict:
+            return None  # 新创建的快照存储不会使版本失效，可能不在缓存的版本中
+        try:
+            r_chain = self._generate_chain(storage_tree.fetch_nodes_to_root(self.storage_ident)).acquire()
+        except Exception:
+            if versions.is_current(tree_ident, version):
+                raise
+            return None
+        if versions.is_current(tree_ident, version):
+            return tree_ident, r_chain
+        r_chain.release()
+        return None
+
     def _generate_chain(self, depend_nodes):
         r_chain = chain.StorageChainForRead(srm.get_srm(), self.caller_name, self.timestamp)
         for node in depend_nodes:
             r_chain.insert_tail(node.storage)
         return r_chain
 
-    def _query_depend_nodes(self):
-        tree_ident = storage.query_by_ident(self.storage_ident).tree_ident
+    def _query_depend_nodes(self, tree_ident):
+        """指定时间戳时，打开 storage_ident 所在的CDP写入中包含该时间点的CDP快照存储，参考 cdp_index
+
+        未指定时间戳时，生成并发布快照存储树的当前版本，之后的打开无需持有存储锁
+        指定时间戳时，cdp_index 需要使用本次查询到的数据库对象校验时间区间，不使用缓存的版本
+        """
+        if self.timestamp is None:
+            storage_tree, _ = tree_versions.get_tree_versions().build(tree_ident)
+            return storage_tree.fetch_nodes_to_root(self.storage_ident)
         storage_tree = tree.generate(tree_ident)
-        return storage_tree.fetch_nodes_to_root(self.storage_ident)
+        return storage_tree.fetch_nodes_to_root(
+            cdp_index.get_cdp_index().resolve(storage_tree, self.storage_ident, self.timestamp))
+
+
+_background_closer = None
+_background_closer_locker = threading.Lock()
+
+
+class BackgroundCloser(object):
+    """在后台关闭句柄
+
+    :remark:
+        调用者无需等待镜像服务关闭原生句柄（写句柄可能需要刷新大量数据），也无需等待存储锁
+        句柄提交到线程池后从 pool 中移除，之后的调用无法再使用该句柄；已停止时同步关闭
+        写句柄关闭完成后更新快照存储状态，与同步关闭相同，参考 CloseStorage.execute
+        最近 max_results 个句柄的关闭结果可以通过 query_close_status 查询
+    """
+
+    def __init__(self, max_workers=4, max_results=4096):
+        self.max_results = max_results
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='closing')
+        self._results: typing.Dict[str, typing.Tuple[str, str]] = collections.OrderedDict()
+        self._locker = threading.Lock()
+
+    @staticmethod
+    def get_background_closer() -> 'BackgroundCloser':
+        global _background_closer
+
+        if _background_closer is None:
+            with _background_closer_locker:
+                if _background_closer is None:
+                    _background_closer = BackgroundCloser()
+        return _background_closer
+
+    def _set_result(self, handle: str, status: str, error=''):
+        with self._locker:
+            self._results.pop(handle, None)
+            self._results[handle] = (status, error,)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+
+    def submit(self, handle: pool.Handle) -> typing.Union[futures.Future, None]:
+        self._set_result(handle.handle, idd.CLOSE_STATUS_CLOSING)
+        try:
+            future = self._executor.submit(self._close, handle)
+        except RuntimeError as e:  # 线程池已停止（服务退出中），句柄仍在 pool 中
+            _logger.warning(f'close {handle} in background failed : {e}, close it now')
+            try:
+                CloseStorage(handle).execute()
+            except Exception as close_error:
+                self._set_result(handle.handle, idd.CLOSE_STATUS_FAILED, str(close_error))
+                raise
+            self._set_result(handle.handle, idd.CLOSE_STATUS_CLOSED)
+            return None
+        pool.HandlePool.get_handle_pool().remove(handle.handle)
+        return future
+
+    @s.scoped_session_thread
+    def _close(self, handle: pool.Handle):
+        try:
+            CloseStorage(handle, detached=True).execute()
+            self._set_result(handle.handle, idd.CLOSE_STATUS_CLOSED)
+        except Exception as e:
+            _logger.error(f'close {handle} in background failed\n{lg.format_exception(e)}')
+            self._set_result(handle.handle, idd.CLOSE_STATUS_FAILED, str(e))
+
+    def query(self, handle: str) -> typing.Tuple[str, str]:
+        with self._locker:
+            return self._results.get(handle, (idd.CLOSE_STATUS_UNKNOWN, '',))
+
+    @property
+    def closing_count(self) -> int:
+        with self._locker:
+            return sum(1 for status, _ in self._results.values() if status == idd.CLOSE_STATUS_CLOSING)
+
+    def stop(self):
+        """等待所有句柄关闭完成"""
+        self._executor.shutdown(wait=True)
+
+
+def get_background_closer() -> BackgroundCloser:
+    return BackgroundCloser.get_background_closer()
 
 
 def close_snapshot(params: idd.CloseSnapshotParams):
     handle = pool.get_handle(params.handle, True)
-    CloseStorage(handle).execute()
+    if params.background:
+        get_background_closer().submit(handle)
+    else:
+        CloseStorage(handle).execute()
+
+
+def query_close_status(params: idd.QueryCloseStatusParams) -> dict:
+    status, error = get_background_closer().query(params.handle)
+    return {'status': status, 'error': error}
 
 
 def open_snapshot(params: idd.OpenSnapshotParams) -> pool.Handle:
     return OpenStorage(params.handle, params.caller_trace, params.caller_pid, params.caller_pid_created,
-                       params.storage_ident, params.timestamp, params.open_raw_handle).execute()
+                       params.storage_ident, params.timestamp, params.open_raw_handle, params.share).execute()
 
 
 def get_raw_handle(params: idd.GetRawHandleParams) -> pool.Handle:
     handle = pool.get_handle(params.handle, True)
-    with handle.locker:
-        if (not handle.writing) and (not handle.raw_handle):
-            handle.raw_handle, handle.ice_endpoint = action.DiskSnapshotAction.open_disk_snapshot(
-                handle.storage_chain, handle.raw_flag)
+    if handle.shared:
+        handle.shared.open_raw_handle(handle)
+    elif not handle.writing:
+        handle.open_raw_handle()
     return handle
 
 
 def set_hash_mode(params: idd.SetHashModeParams):
     handle = pool.get_handle(params.handle, True)
-    # TODO set close mode
-    pass
+    assert handle.writing, ('仅写句柄支持设置hash模式', f'set hash mode {params.hash_mode} on reading {handle}', 0)
+    with handle.locker:
+        handle.hash_mode = params.hash_mode
+    _logger.info(f'set hash mode {params.hash_mode} on {handle}')
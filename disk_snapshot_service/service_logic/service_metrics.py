@@ -0,0 +1,87 @@
+"""服务统计数据中需要查询数据库的部分，参考 ice_service.metrics_exporter
+
+每次采集都分组统计全表的代价较高，查询结果缓存 ttl_seconds 秒：
+    1. 各状态与类型的快照存储数量
+    2. 各类型未消费日志的数量与最早的产生时间
+    3. 各类型合并作业的数量与进度
+    4. 预先创建的qcow文件中可用的数量
+同一时刻仅有一个线程刷新，其他线程等待刷新完成后使用新的结果
+"""
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+from data_access import journal as da_journal
+from data_access import merge_checkpoint as da_checkpoint
+from data_access import qcow_pool as da_pool
+from data_access import session as s
+from data_access import storage as da_storage
+
+_logger = lg.get_logger(__name__)
+
+
+class Aggregates(object):
+    """一次查询的结果"""
+
+    def __init__(self, storages: typing.Dict[typing.Tuple[str, str], int],
+                 journals: typing.Dict[str, typing.Tuple[int, typing.Any]],
+                 merges: typing.Dict[str, typing.Tuple[int, int, int]],
+                 qcow_pool_ready: int, seconds: float):
+        self.storages = storages  # (状态, 类型) -> 数量
+        self.journals = journals  # 类型 -> (数量, 最早的产生时间)
+        self.merges = merges  # 类型 -> (数量, 已搬迁的数据量, 总数据量)
+        self.qcow_pool_ready = qcow_pool_ready
+        self.seconds = seconds  # 查询耗时
+        self.collected_at = time.time()
+
+    def __str__(self):
+        return f'aggregates:<{sum(self.storages.values())} storages,{self.seconds:.6f}s>'
+
+    @staticmethod
+    def query() -> 'Aggregates':
+        begin = time.monotonic()
+        with s.readonly():
+            storages = da_storage.query_status_type_counts()
+            journals = da_journal.query_unconsumed_summary()
+            merges = da_checkpoint.query_progress_by_type()
+            qcow_pool_ready = sum(da_pool.query_ready_counts().values())
+        return Aggregates(storages, journals, merges, qcow_pool_ready, time.monotonic() - begin)
+
+
+class AggregateCache(object):
+    """缓存 Aggregates ，过期后在下次获取时重新查询"""
+
+    def __init__(self, ttl_seconds=15):
+        self.ttl_seconds = ttl_seconds
+        self._aggregates: typing.Union[Aggregates, None] = None
+        self._expire_at = 0.0
+        self._locker = threading.Lock()
+        self.refreshes = 0
+        self.failures = 0
+
+    def __str__(self):
+        return f'aggregate_cache:<{self.ttl_seconds}s,{self.refreshes} refreshes,{self.failures} failures>'
+
+    def get(self) -> typing.Union[Aggregates, None]:
+        """返回缓存的结果，查询失败时返回上一次的结果（没有时为 None）
+
+        :remark:
+            调用线程需要使用 scoped_session_thread
+        """
+        with self._locker:
+            if time.monotonic() >= self._expire_at:
+                try:
+                    self._aggregates = Aggregates.query()
+                    self.refreshes += 1
+                    _logger.debug(f'{self} refreshed : {self._aggregates}')
+                except Exception as e:
+                    self.failures += 1
+                    _logger.error(f'{self} refresh failed : {e}')
+                self._expire_at = time.monotonic() + self.ttl_seconds  # 失败时同样等待，避免持续查询
+            return self._aggregates
+
+    def invalidate(self):
+        with self._locker:
+            self._expire_at = 0.0
@@ -0,0 +1,92 @@
+"""服务启动时修正被中断的快照存储
+
+服务异常退出时，创建中（Creating）与写入中（Writing）的快照存储不会再被修改：
+读取时快照存储链不允许包含创建中的快照存储，回收逻辑也不会处理这些快照存储，所在的快照存储树无法回收
+    1. 在服务开始处理请求前，以一次查询获取这些快照存储（scan），此时不存在正在创建或写入的快照存储
+       新快照存储有合并进度时，由回收逻辑继续合并作业，不在此修正
+    2. 在后台线程中批量标记为 Abnormal 状态（recover），之后对所在的快照存储树执行回收逻辑（collect），
+       删除异常的叶子快照存储；不影响其他快照存储树的请求
+"""
+import threading
+import time
+import typing
+
+from cpkt.core import xlogging as lg
+
+from business_logic import locker_manager as lm
+from business_logic import storage
+from data_access import models as m
+from data_access import session as s
+from service_logic import storage_collection
+
+_logger = lg.get_logger(__name__)
+
+
+class StartupRecovery(threading.Thread):
+
+    def __init__(self, max_collect_rounds=64):
+        super(StartupRecovery, self).__init__(name='startup_recovery', daemon=True)
+        self.max_collect_rounds = max_collect_rounds  # 每棵快照存储树执行回收逻辑的轮数上限
+        self.interrupted: typing.List[typing.Tuple[str, str]] = list()  # [(ident, tree_ident), ...]
+        self.recovered = 0
+        self.collect_rounds = 0
+        self.failed_trees = 0
+        self._quit = threading.Event()
+
+    def __str__(self):
+        return (f'startup_recovery:<{len(self.interrupted)} interrupted,{self.recovered} recovered,'
+                f'{len(self.tree_idents)} trees>')
+
+    def trace_msg(self):
+        return self.name
+
+    @property
+    def tree_idents(self) -> typing.List[str]:
+        return sorted({tree_ident for _, tree_ident in self.interrupted})
+
+    def scan(self) -> typing.List[typing.Tuple[str, str]]:
+        """在服务开始处理请求前调用"""
+        with s.readonly():
+            self.interrupted = storage.query_interrupted_rows()
+        if self.interrupted:
+            _logger.warning(f'{self} found : {self.interrupted}')
+        return self.interrupted
+
+    def recover(self) -> int:
+        if not self.interrupted:
+            return 0
+        with lm.get_storage_locker(self.trace_msg), s.transaction():
+            self.recovered = storage.update_status_in_bulk(self.interrupted, m.SnapshotStorage.STATUS_ABNORMAL)
+        return self.recovered
+
+    def collect(self):
+        for tree_ident in self.tree_idents:
+            collection = storage_collection.StorageCollection(tree_ident)
+            try:
+                for _ in range(self.max_collect_rounds):
+                    if self._quit.is_set():
+                        return
+                    self.collect_rounds += 1
+                    if not collection.collect():
+                        break
+            except Exception as e:
+                self.failed_trees += 1
+                _logger.error(f'{self} collect {tree_ident} failed : {e}')
+                _logger.error(lg.format_exception(e))
+
+    def stop(self):
+        self._quit.set()
+        if self.is_alive():
+            self.join()
+
+    @s.scoped_session_thread
+    def run(self):
+        begin = time.monotonic()
+        try:
+            self.recover()
+            self.collect()
+        except Exception as e:
+            _logger.error(f'{self} failed : {e}')
+            _logger.error(lg.format_exception(e))
+        _logger.info(f'{self} finished in {time.monotonic() - begin:.3f}s, {self.collect_rounds} collect rounds, '
+                     f'{self.failed_trees} trees failed')
@@ -7,11 +7,14 @@ from cpkt.core import rt
 from cpkt.core import xlogging as lg
 
 from business_logic import locker_manager as lm
+from business_logic import merge_checkpoint
 from business_logic import storage
 from business_logic import storage_action as action
 from business_logic import storage_chain as chain
 from business_logic import storage_reference_manager as srm
+from business_logic import storage_space
 from business_logic import storage_tree as tree
+from business_logic import tree_versions
 from data_access import models as m
 from data_access import session as s
 
@@ -79,6 +82,7 @@ class DeleteWork(RecyclingWorkBase):
         super(DeleteWork, self).__init__()
         assert storage_obj.status in (m.SnapshotStorage.STATUS_RECYCLING, m.SnapshotStorage.STATUS_ABNORMAL,)
         self.duplicated = False
+        self.reference_shared = False
         self.w_chain = chain.StorageChainForWrite(srm.get_srm(), call_name).insert_tail(storage_obj)
 
     @property
@@ -102,6 +106,8 @@ class DeleteWork(RecyclingWorkBase):
         return self.storage_item.ident
 
     def alloc_resource(self):
+        if self.duplicated or self.reference_shared:
+            return  # 重复的作业不执行实际操作；同一文件已由其他作业持有写引用
         self.w_chain.acquire()
 
     def free_resource(self):
@@ -110,6 +116,10 @@ class DeleteWork(RecyclingWorkBase):
     def set_duplicated(self):
         self.duplicated = True
 
+    def set_reference_shared(self):
+        """同一文件中的多个快照点在同一轮中删除时，仅由第一个作业持有写引用"""
+        self.reference_shared = True
+
     def save_work_result(self):
         if self.work_successful:
             storage.query_by_ident(self.storage_item.ident).update_status(m.SnapshotStorage.STATUS_DELETED)
@@ -230,22 +240,121 @@ class MergeWork(RecyclingWorkBase):
             info_list.append(f'    {child_storage}')
 
 
-class MergeCdpWork(MergeWork):
+class ResumableMergeWork(MergeWork):
+    """可断点续作的合并作业基类
+
+    :remark:
+        新快照存储与合并进度在同一事务中创建，数据按区间分段搬迁，每完成一段就持久化一次进度
+        服务重启后，新快照存储保持 Creating 状态，回收逻辑根据进度重建作业，继续搬迁剩余的数据
+        搬迁数据时出现的异常（例如：镜像服务暂时不可用）同样保留进度与 Creating 状态，由下一轮回收继续
+        断言失败视为不可恢复，失败达到 MAX_RETRY 次后同样放弃，新快照存储标记为 Abnormal
+    """
+
+    WORK_TYPE = None
+    MAX_RETRY = 3
+
+    def __init__(self, parent_storage_obj: m.SnapshotStorage,
+                 children_snapshot_storage_objs: typing.List[m.SnapshotStorage],
+                 checkpoint: merge_checkpoint.MergeCheckpoint = None):
+        """
+        :param checkpoint: 合并进度，为 None 时创建新快照存储，否则继续该进度对应的作业
+        """
+        self.checkpoint: merge_checkpoint.MergeCheckpoint = checkpoint
+        self.new_storage_size = None
+        self.recoverable = True
+        super(ResumableMergeWork, self).__init__(parent_storage_obj, children_snapshot_storage_objs)
+
+    @property
+    @abc.abstractmethod
+    def merge_storages(self) -> typing.List[storage.Storage]:
+        """被合并的快照存储，顺序为从父到子"""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _create_new_storage(self) -> storage.Storage:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def _move_data(self, raw_flag, hash_version, begin_bytes, end_bytes):
+        """搬迁 [begin_bytes, end_bytes) 区间的数据"""
+        raise NotImplementedError()
+
+    def _create_write_chain(self, storage_tree, call_name) -> chain.StorageChainForWrite:
+        write_chain = chain.StorageChainForWrite(srm.get_srm(), call_name)
+        depend_nodes = storage_tree.fetch_nodes_to_root(self.parent_storage.ident)
+        for node in depend_nodes:
+            write_chain.insert_tail(node.storage)
+        write_chain.insert_tail(self.new_storage.storage_obj)
+        return write_chain
+
+    def _create_or_get_new_storage(self) -> storage.Storage:
+        if self.checkpoint:
+            new_storage = storage.query_by_ident(self.checkpoint.storage_ident)
+            assert new_storage.status == m.SnapshotStorage.STATUS_CREATING
+            return new_storage
+
+        new_storage = self._create_new_storage()
+        self.checkpoint = merge_checkpoint.create(
+            new_storage.ident, self.WORK_TYPE, [st.ident for st in self.merge_storages], new_storage.disk_bytes)
+        return new_storage
+
+    def work(self):
+        try:
+            raw_flag = action.DiskSnapshotAction.generate_flag(f'{self}')
+            hash_version = 0  # TODO hash version
+
+            if self.checkpoint.is_resumed:
+                _logger.info(f'{self} resume from {self.checkpoint}')
+
+            for begin_bytes, end_bytes in self.checkpoint.pending_ranges():
+                self._move_data(raw_flag, hash_version, begin_bytes, end_bytes)
+                with s.transaction():
+                    self.checkpoint.update_finished(end_bytes)
+
+            self.new_storage_size = storage_space.read_written_bytes_or_none(
+                self.new_storage.image_path, self.new_storage.ident, self.new_storage.disk_bytes, f'{self}')
+            self.work_successful = True
+        except Exception as e:
+            self.work_successful = False
+            self.recoverable = not isinstance(e, AssertionError)
+            _logger.warning(self.msg_when_exception(f'{e}'))
+            _logger.warning(lg.format_exception(e))
+
+    def save_work_result(self):
+        if self.work_successful:
+            if self.new_storage_size is not None:
+                self.new_storage.update_new_storage_size(self.new_storage_size)
+            self.new_storage.update_status(m.SnapshotStorage.STATUS_STORAGE)
+            self._update_children_storage_objs()
+        elif self.recoverable and self.checkpoint.failed_count + 1 < self.MAX_RETRY:
+            self.checkpoint.update_failed()
+            _logger.warning(f'{self} failed {self.checkpoint.failed_count} times, resume later from {self.checkpoint}')
+            return False
+        else:
+            self.new_storage.update_status(m.SnapshotStorage.STATUS_ABNORMAL)
+        self.checkpoint.remove()
+        return self.work_successful
+
+
+class MergeCdpWork(ResumableMergeWork):
     """合并CDP快照存储到新快照点作业"""
 
+    WORK_TYPE = m.MergeCheckpoint.TYPE_CDP
+
     def __init__(self, parent_storage_obj: m.SnapshotStorage,
                  merge_cdp_snapshot_storage_objs: typing.List[m.SnapshotStorage],
                  children_snapshot_storage_objs: typing.List[m.SnapshotStorage],
-                 storage_tree: tree.DiskSnapshotStorageTree, call_name: str):
+                 storage_tree: tree.DiskSnapshotStorageTree, call_name: str,
+                 checkpoint: merge_checkpoint.MergeCheckpoint = None):
         # 校验入参数据
         assert len(merge_cdp_snapshot_storage_objs) > 0
         assert merge_cdp_snapshot_storage_objs[0].parent_ident == parent_storage_obj.ident
         for child in children_snapshot_storage_objs:
             assert child.parent_ident == children_snapshot_storage_objs[-1].parent_ident
         # 构造
-        super(MergeCdpWork, self).__init__(parent_storage_obj, children_snapshot_storage_objs)
         self.merge_cdp_snapshot_storages: typing.List[storage.Storage] = [storage.Storage(_)
                                                                           for _ in merge_cdp_snapshot_storage_objs]
+        super(MergeCdpWork, self).__init__(parent_storage_obj, children_snapshot_storage_objs, checkpoint)
         call_name += f' MergeCdpWork {self.new_storage.ident}'
         self.rw_chain: chain.StorageChainForRW = self._create_rw_chain(storage_tree, call_name)
 
@@ -257,14 +366,18 @@ class MergeCdpWork(MergeWork):
         rw_chain.insert_tail(self.new_storage.storage_obj)
         return rw_chain
 
-    def _create_or_get_new_storage(self) -> storage.Storage:
+    @property
+    def merge_storages(self) -> typing.List[storage.Storage]:
+        return self.merge_cdp_snapshot_storages
+
+    def _create_new_storage(self) -> storage.Storage:
         assert self.parent_storage
         assert len(self.children_snapshot_storage) > 0
         assert len(self.merge_cdp_snapshot_storages) > 0
 
         if self.parent_storage.is_cdp:  # 如果父节点为cdp，那么就需要创建新的qcow来存放合并后的数据
             new_image_path = action.ImagePathGenerator.generate_new_qcow(
-                os.path.dirname(self.parent_storage.image_path))
+                os.path.dirname(self.parent_storage.image_path), self.parent_storage.disk_bytes)
         else:  # 如果父节点为qcow，那么就直接将合并后的数据存放到父节点qcow中
             new_image_path = self.parent_storage.image_path
 
@@ -281,28 +394,12 @@ class MergeCdpWork(MergeWork):
     def free_resource(self):
         self.rw_chain.release()
 
-    def work(self):
-        try:
-            raw_flag = action.DiskSnapshotAction.generate_flag(f'{self}')
-            hash_version = 0  # TODO hash version
-            action.DiskSnapshotAction.merge_cdp_to_qcow(
-                self.rw_chain, self.merge_cdp_snapshot_storages, raw_flag, hash_version)
-
-            self.work_successful = True
-        except Exception as e:
-            self.work_successful = False
-            _logger.warning(self.msg_when_exception(f'{e}'))
-            _logger.warning(lg.format_exception(e))
-
-    def save_work_result(self):
-        if self.work_successful:
-            self.new_storage.update_status(m.SnapshotStorage.STATUS_STORAGE)
-            self._update_children_storage_objs()
-        else:
-            self.new_storage.update_status(m.SnapshotStorage.STATUS_ABNORMAL)
-        return self.work_successful
+    def _move_data(self, raw_flag, hash_version, begin_bytes, end_bytes):
+        action.DiskSnapshotAction.merge_cdp_to_qcow(
+            self.rw_chain, self.merge_cdp_snapshot_storages, raw_flag, hash_version, begin_bytes, end_bytes)
 
     def _fill_more_detail_info(self, info_list):
+        info_list.append(f'  checkpoint     : {self.checkpoint}')
         info_list.append(f'  merge_cdp_snapshot_storages:')
         for merge_cdp_storage in self.merge_cdp_snapshot_storages:
             info_list.append(f'    {merge_cdp_storage}')
@@ -325,9 +422,12 @@ class MergeQcowSnapshotTypeAWork(MergeWork):
         else:
             assert merge_storage_obj.parent_ident == parent_storage_obj.ident
         for child in children_snapshot_storage_objs:
-            assert child.parent_ident == merge_storage_obj.parent_ident
+            assert child.parent_ident == merge_storage_obj.ident
         # 构造
         self.merge_storage: storage.Storage = storage.Storage(merge_storage_obj)
+        self.merge_hash = storage.query_hash(merge_storage_obj.ident)
+        self.children_hash = [storage.query_hash(child.ident) for child in children_snapshot_storage_objs]
+        self.merged_hash_idents = list()
         super(MergeQcowSnapshotTypeAWork, self).__init__(parent_storage_obj, children_snapshot_storage_objs)
 
     @property
@@ -349,8 +449,8 @@ class MergeQcowSnapshotTypeAWork(MergeWork):
 
     def work(self):
         try:
-            hash_version = 0  # TODO hash version
-            action.DiskSnapshotAction.merge_qcow_hash(self.children_snapshot_storage, self.merge_storage, hash_version)
+            self.merged_hash_idents = action.DiskSnapshotAction.merge_qcow_hash(
+                self.children_hash, self.merge_hash, self.merge_storage.disk_bytes)
 
             self.work_successful = True
         except Exception as e:
@@ -364,16 +464,22 @@ class MergeQcowSnapshotTypeAWork(MergeWork):
                 # 被合并的快照是根节点，防止出现树分裂，将父与子颠倒
                 child_storage: storage.Storage = self.children_snapshot_storage[0]
                 child_storage.update_parent(None)
+                self.merge_storage.update_parent(child_storage)
             else:
                 self._update_children_storage_objs()
+            if self.merge_hash and self.merge_hash.is_full:
+                # 叠加全量hash后，子快照的hash数据也是全量的
+                for ident in self.merged_hash_idents:
+                    storage.update_hash_type(ident, m.Hash.TYPE_FULL)
 
         return self.work_successful
 
     def _fill_more_detail_info(self, info_list):
         info_list.append(f'  merge_storage  : {self.merge_storage}')
+        info_list.append(f'  merge_hash     : {self.merge_hash}')
 
 
-class MergeQcowSnapshotTypeBWork(MergeWork):
+class MergeQcowSnapshotTypeBWork(ResumableMergeWork):
     """跨qcow文件合并快照
 
     :remark:
@@ -381,30 +487,30 @@ class MergeQcowSnapshotTypeBWork(MergeWork):
         实体数据将从一个qcow文件搬迁到另一个qcow文件中
     """
 
+    WORK_TYPE = m.MergeCheckpoint.TYPE_QCOW_MOVE_DATA
+
     def __init__(self, parent_storage_obj: m.SnapshotStorage, merge_storage_obj: m.SnapshotStorage,
                  children_snapshot_storage_objs: typing.List[m.SnapshotStorage],
-                 storage_tree: tree.DiskSnapshotStorageTree, call_name: str):
+                 storage_tree: tree.DiskSnapshotStorageTree, call_name: str,
+                 checkpoint: merge_checkpoint.MergeCheckpoint = None):
         # 校验入参数据
         assert merge_storage_obj.parent_ident == parent_storage_obj.ident
         assert merge_storage_obj.image_path != parent_storage_obj.image_path
         for child in children_snapshot_storage_objs:
-            assert child.parent_ident == merge_storage_obj.parent_ident
+            assert child.parent_ident == merge_storage_obj.ident
             assert child.image_path != merge_storage_obj.image_path
         # 构造
         self.merge_storage: storage.Storage = storage.Storage(merge_storage_obj)
-        super(MergeQcowSnapshotTypeBWork, self).__init__(parent_storage_obj, children_snapshot_storage_objs)
+        super(MergeQcowSnapshotTypeBWork, self).__init__(
+            parent_storage_obj, children_snapshot_storage_objs, checkpoint)
         call_name += f' MergeQcowSnapshotTypeBWork {self.new_storage.ident}'
         self.write_chain: chain.StorageChainForWrite = self._create_write_chain(storage_tree, call_name)
 
-    def _create_write_chain(self, storage_tree, call_name) -> chain.StorageChainForWrite:
-        write_chain = chain.StorageChainForWrite(srm.get_srm(), call_name)
-        depend_nodes = storage_tree.fetch_nodes_to_root(self.parent_storage.ident)
-        for node in depend_nodes:
-            write_chain.insert_tail(node.storage)
-        write_chain.insert_tail(self.new_storage.storage_obj)
-        return write_chain
+    @property
+    def merge_storages(self) -> typing.List[storage.Storage]:
+        return [self.merge_storage, ]
 
-    def _create_or_get_new_storage(self):
+    def _create_new_storage(self) -> storage.Storage:
         assert self.parent_storage
         assert self.parent_storage.is_qcow
         assert self.merge_storage
@@ -425,29 +531,91 @@ class MergeQcowSnapshotTypeBWork(MergeWork):
     def free_resource(self):
         self.write_chain.release()
 
-    def work(self):
-        try:
-            raw_flag = action.DiskSnapshotAction.generate_flag(f'{self}')
-            hash_version = 0  # TODO hash version
+    def _move_data(self, raw_flag, hash_version, begin_bytes, end_bytes):
+        action.DiskSnapshotAction.move_data_from_qcow(
+            self.merge_storage, self.write_chain, raw_flag, hash_version, begin_bytes, end_bytes)
 
-            action.DiskSnapshotAction.move_data_from_qcow(self.merge_storage, self.write_chain, raw_flag, hash_version)
+    def _fill_more_detail_info(self, info_list):
+        info_list.append(f'  checkpoint     : {self.checkpoint}')
+        info_list.append(f'  merge_storage_obj  : {self.merge_storage}')
 
-            self.work_successful = True
-        except Exception as e:
-            self.work_successful = False
-            _logger.warning(self.msg_when_exception(f'{e}'))
-            _logger.warning(lg.format_exception(e))
 
-    def save_work_result(self):
-        if self.work_successful:
-            self.new_storage.update_status(m.SnapshotStorage.STATUS_STORAGE)
-            self._update_children_storage_objs()
-        else:
-            self.new_storage.update_status(m.SnapshotStorage.STATUS_ABNORMAL)
-        return self.work_successful
+class FlattenQcowChainWork(ResumableMergeWork):
+    """将长qcow快照链合成为全量快照
+
+    :remark:
+        目标快照存储到根的路径上，关键快照存储（打开时需要叠加的文件）过多时，读取速度随链长下降
+        在第一个关键快照存储（基础快照存储）上创建新qcow文件，依次从父到子搬迁其余关键快照存储的数据
+        完成后新快照存储与目标快照存储的数据一致，目标快照存储的子快照存储改为依赖新快照存储
+        被搬迁的快照存储保持存储状态，不做修改
+    """
+
+    WORK_TYPE = m.MergeCheckpoint.TYPE_QCOW_FLATTEN
+
+    def __init__(self, base_storage_obj: m.SnapshotStorage, source_storage_objs: typing.List[m.SnapshotStorage],
+                 children_snapshot_storage_objs: typing.List[m.SnapshotStorage],
+                 storage_tree: tree.DiskSnapshotStorageTree, call_name: str,
+                 checkpoint: merge_checkpoint.MergeCheckpoint = None):
+        # 校验入参数据
+        assert len(source_storage_objs) > 0
+        for source in source_storage_objs:
+            assert source.is_qcow and source.status == m.SnapshotStorage.STATUS_STORAGE
+        for child in children_snapshot_storage_objs:
+            assert child.parent_ident == source_storage_objs[-1].ident
+            assert child.image_path != source_storage_objs[-1].image_path
+        # 构造
+        self.source_storages: typing.List[storage.Storage] = [storage.Storage(_) for _ in source_storage_objs]
+        super(FlattenQcowChainWork, self).__init__(base_storage_obj, children_snapshot_storage_objs, checkpoint)
+        call_name += f' FlattenQcowChainWork {self.new_storage.ident}'
+        self.read_chain: chain.StorageChainForRead = self._create_read_chain(storage_tree, call_name)
+        self.write_chain: chain.StorageChainForWrite = self._create_write_chain(storage_tree, call_name)
+
+    def _create_read_chain(self, storage_tree, call_name) -> chain.StorageChainForRead:
+        read_chain = chain.StorageChainForRead(srm.get_srm(), call_name)
+        for node in storage_tree.fetch_nodes_to_root(self.target_storage.ident):
+            read_chain.insert_tail(node.storage)
+        return read_chain
+
+    @property
+    def target_storage(self) -> storage.Storage:
+        return self.source_storages[-1]
+
+    @property
+    def merge_storages(self) -> typing.List[storage.Storage]:
+        return self.source_storages
+
+    def _create_new_storage(self) -> storage.Storage:
+        assert self.parent_storage
+        assert self.parent_storage.is_qcow
+        assert len(self.children_snapshot_storage) > 0
+
+        new_image_path = action.ImagePathGenerator.generate_new_qcow(
+            os.path.dirname(self.target_storage.image_path), self.target_storage.disk_bytes)
+        return storage.create_new_storage(
+            self._generate_storage_ident(), self.parent_storage.ident, None, False, self.target_storage.disk_bytes,
+            new_image_path, self.parent_storage.tree_ident)
+
+    def __str__(self):
+        return f'flatten_qcow_chain_work:<{self.target_storage},{len(self.source_storages)} sources>'
+
+    def alloc_resource(self):
+        self.read_chain.acquire()
+        self.write_chain.acquire()
+
+    def free_resource(self):
+        self.write_chain.release()
+        self.read_chain.release()
+
+    def _move_data(self, raw_flag, hash_version, begin_bytes, end_bytes):
+        for source_storage in self.source_storages:  # 从父到子，子快照存储的数据覆盖父快照存储的数据
+            action.DiskSnapshotAction.move_data_from_qcow(
+                source_storage, self.write_chain, raw_flag, hash_version, begin_bytes, end_bytes)
 
     def _fill_more_detail_info(self, info_list):
-        info_list.append(f'  merge_storage_obj  : {self.merge_storage}')
+        info_list.append(f'  checkpoint     : {self.checkpoint}')
+        info_list.append(f'  source_storages:')
+        for source_storage in self.source_storages:
+            info_list.append(f'    {source_storage}')
 
 
 class StorageCollection(object):
@@ -457,6 +625,11 @@ class StorageCollection(object):
     TYPE_QCOW_MOVE_DATA = 2
     TYPE_QCOW_REMOVE = 3
 
+    # 异常的快照存储无法读取，与回收中的快照存储一样，在子快照存储均被删除后删除
+    DELETABLE_STATUS = (m.SnapshotStorage.STATUS_RECYCLING, m.SnapshotStorage.STATUS_ABNORMAL,)
+
+    flatten_min_key_items = 0  # 关键快照存储数量达到该值时合成全量快照，为 0 时不合成，参考 FlattenQcowChainWork
+
     def __init__(self, tree_ident):
         """
         :param tree_ident:
@@ -498,7 +671,10 @@ class StorageCollection(object):
 
         works = None
         try:
-            with lm.get_storage_locker(self.trace_msg), s.readonly():
+            # 合并作业会创建新快照存储与合并进度，需要提交
+            # 检查引用到分配资源期间，不持有存储锁的读取者校验版本号失败，参考 tree_versions
+            with lm.get_storage_locker(self.trace_msg), \
+                    tree_versions.get_tree_versions().writing(self.tree_ident), s.transaction():
                 works = self._analyze_storage_and_create_recycling_works()
                 _alloc_resource()
 
@@ -525,7 +701,7 @@ class StorageCollection(object):
         """分析存储快照并获取回收存储快照的作业
 
         1. 从叶子开始查找可直接删除的节点（可删除状态）
-            可删除状态： 在叶子且为 STATUS_RECYCLING 的节点意味着可直接删除
+            可删除状态： 在叶子且为 STATUS_RECYCLING 或 STATUS_ABNORMAL 的节点意味着可直接删除
             如果节点对应的文件正在使用中，那么就忽略，下次再扫描
             需要向根节点查找尽可能多的 deleting 状态节点，优化删除
 
@@ -552,14 +728,23 @@ class StorageCollection(object):
                 qcow节点没有子节点在其他文件中：
                 a. 该节点所在文件正在写入中
 
+        3. 没有可回收的节点时，查找关键快照存储过多的qcow快照链，合成全量快照，参考 FlattenQcowChainWork
+
+        0. 优先继续上次未完成的合并作业（服务重启前中断的作业）
+
         :remark:
             为了优化性能，禁止使用ORM对象去查找父与子，改为使用Node对象查找
+            调用者在快照存储树的写入中（tree_versions.writing）调用，不持有存储锁的读取者登记引用后校验失败
         """
 
         storage_tree = tree.generate(self.tree_ident)
         if storage_tree.is_empty:
             return None
 
+        resumable_works = self._create_resumable_merge_works(storage_tree)
+        if resumable_works is not None:
+            return resumable_works
+
         deleting_storage_objs = self._fetch_deleting_storage_objs(storage_tree)
         if deleting_storage_objs:
             return self._create_delete_works(deleting_storage_objs)  # 生成删除作业
@@ -574,15 +759,16 @@ class StorageCollection(object):
                 assert node.storage.is_cdp
                 merge_cdp_snapshot_storage_objs = self._fetch_merge_cdp_snapshot_storage_objs(node)
                 if merge_cdp_snapshot_storage_objs:
+                    last_merge_node = storage_tree.get_node_by_ident(merge_cdp_snapshot_storage_objs[-1].ident)
                     return [
                         MergeCdpWork(
                             node.parent.storage, merge_cdp_snapshot_storage_objs,
-                            [n.storage_obj for n in node.children], storage_tree, self.name),
+                            [n.storage for n in last_merge_node.children], storage_tree, self.name),
                     ]
             elif merge_type == self.TYPE_QCOW_MOVE_DATA:
                 return [
                     MergeQcowSnapshotTypeBWork(
-                        node.parent.storage_obj, node.storage, [n.storage for n in node.children],
+                        node.parent.storage, node.storage, [n.storage for n in node.children],
                         storage_tree, self.name),
                 ]
             else:
@@ -594,18 +780,176 @@ class StorageCollection(object):
                         [n.storage for n in node.children]),
                 ]
 
+        return self._create_flatten_works(storage_tree)
+
+    def _create_resumable_merge_works(
+            self, storage_tree: tree.DiskSnapshotStorageTree) -> typing.Union[typing.List[RecyclingWorkBase], None]:
+        """根据合并进度重建未完成的合并作业
+
+        :return: None 表示没有未完成的合并作业
+        """
+
+        ref_manager = srm.get_srm()
+        for checkpoint in merge_checkpoint.query_in_tree(self.tree_ident):
+            if ref_manager.is_storage_using(checkpoint.storage_ident):
+                return list()  # 合并作业正在执行中，本轮不再生成作业
+
+            if checkpoint.work_type == m.MergeCheckpoint.TYPE_QCOW_FLATTEN:
+                merge_nodes = self._fetch_flatten_nodes_by_checkpoint(storage_tree, checkpoint)
+            else:
+                merge_nodes = self._fetch_merge_nodes_by_checkpoint(storage_tree, checkpoint)
+            if not merge_nodes:
+                _logger.warning(f'{self} abandon {checkpoint}, merge storages changed')
+                storage.query_by_ident(checkpoint.storage_ident).update_status(m.SnapshotStorage.STATUS_ABNORMAL)
+                checkpoint.remove()
+                continue
+
+            new_node = storage_tree.get_node_by_ident(checkpoint.storage_ident)
+            if checkpoint.work_type == m.MergeCheckpoint.TYPE_QCOW_FLATTEN:
+                _logger.info(f'{self} resume flatten work by {checkpoint}')
+                return [
+                    FlattenQcowChainWork(
+                        new_node.parent.storage, [n.storage for n in merge_nodes],
+                        [n.storage for n in merge_nodes[-1].children], storage_tree, self.name, checkpoint),
+                ]
+
+            children_storage_objs = [n.storage for n in merge_nodes[-1].children]
+            _logger.info(f'{self} resume merge work by {checkpoint}')
+            if checkpoint.work_type == m.MergeCheckpoint.TYPE_CDP:
+                return [
+                    MergeCdpWork(
+                        new_node.parent.storage, [n.storage for n in merge_nodes], children_storage_objs,
+                        storage_tree, self.name, checkpoint),
+                ]
+            else:
+                assert checkpoint.work_type == m.MergeCheckpoint.TYPE_QCOW_MOVE_DATA
+                return [
+                    MergeQcowSnapshotTypeBWork(
+                        new_node.parent.storage, merge_nodes[0].storage, children_storage_objs,
+                        storage_tree, self.name, checkpoint),
+                ]
+
+        return None
+
+    @staticmethod
+    def _fetch_merge_nodes_by_checkpoint(
+            storage_tree: tree.DiskSnapshotStorageTree,
+            checkpoint: merge_checkpoint.MergeCheckpoint) -> typing.Union[typing.List[tree.StorageNode], None]:
+        """获取合并进度对应的被合并节点，当节点已经不满足合并条件时返回 None
+
+        被合并的节点需要仍为 Recycling 状态，且依赖关系与创建作业时一致：
+            首个被合并节点与新快照存储的父相同，其余被合并节点依次为前一节点的子，最后一个被合并节点有子
+        """
+
+        new_node = storage_tree.get_node_by_ident(checkpoint.storage_ident)
+        parent_node = new_node.parent
+        merge_nodes = list()
+        for ident in checkpoint.merge_idents:
+            node = storage_tree.node_dict.get(ident, None)
+            if node is None or node.storage.status != m.SnapshotStorage.STATUS_RECYCLING:
+                return None
+            if node.parent is not parent_node:
+                return None
+            merge_nodes.append(node)
+            parent_node = node
+
+        if merge_nodes[-1].is_leaf:
+            return None
+        return merge_nodes
+
+    def _fetch_flatten_nodes_by_checkpoint(
+            self, storage_tree: tree.DiskSnapshotStorageTree,
+            checkpoint: merge_checkpoint.MergeCheckpoint) -> typing.Union[typing.List[tree.StorageNode], None]:
+        """获取合成进度对应的被搬迁节点，当目标节点已经不满足合成条件、或关键快照存储发生变化时返回 None"""
+
+        target_node = storage_tree.node_dict.get(checkpoint.merge_idents[-1], None)
+        if target_node is None or not self._can_qcow_chain_flatten(target_node):
+            return None
+        if not all(self._is_flatten_source(n) for n in target_node.fetch_nodes_to_root()):
+            return None
+        base_node, source_nodes = self._fetch_flatten_nodes(target_node)
+        new_node = storage_tree.get_node_by_ident(checkpoint.storage_ident)
+        if new_node.parent is not base_node or [n.ident for n in source_nodes] != checkpoint.merge_idents:
+            return None
+        return source_nodes
+
+    def _create_flatten_works(self, storage_tree: tree.DiskSnapshotStorageTree) -> typing.List[RecyclingWorkBase]:
+        """从根向叶子做广度优先遍历，找到第一个关键快照存储数量达到阈值、且可以合成全量快照的节点
+
+        节点的关键快照存储数量为打开该节点的子快照存储时，到该节点为止需要叠加的文件数量
+        仅统计从根开始全部为存储状态的qcow节点（这些节点的数据不再变化），广度优先保证父节点先于子节点统计
+        """
+
+        if self.flatten_min_key_items <= 0:
+            return list()
+        min_key_items = max(self.flatten_min_key_items, 3)  # 合成后为 基础快照存储 + 新快照存储，至少需要减少一个文件
+
+        key_items_count = dict()  # ident -> 关键快照存储数量
+        for node in storage_tree.nodes_by_bfs:  # type: tree.StorageNode
+            if not self._is_flatten_source(node):
+                continue
+            if node.is_root:
+                count = 1
+            elif node.parent.ident in key_items_count:
+                count = key_items_count[node.parent.ident]
+                if node.parent.storage.image_path != node.storage.image_path:
+                    count += 1
+            else:
+                continue
+            key_items_count[node.ident] = count
+
+            if count >= min_key_items and self._can_qcow_chain_flatten(node):
+                base_node, source_nodes = self._fetch_flatten_nodes(node)
+                return [
+                    FlattenQcowChainWork(
+                        base_node.storage, [n.storage for n in source_nodes], [n.storage for n in node.children],
+                        storage_tree, self.name),
+                ]
+
         return list()
 
+    @staticmethod
+    def _is_flatten_source(node: tree.StorageNode) -> bool:
+        storage_obj = node.storage
+        if not storage_obj.is_qcow or storage_obj.status != m.SnapshotStorage.STATUS_STORAGE:
+            return False
+        if not node.is_root and node.parent.storage.disk_bytes != storage_obj.disk_bytes:
+            return False  # 不支持：磁盘大小发生变化
+        return not rt.PathInMount.is_in_not_mount(storage_obj.image_path)
+
+    @staticmethod
+    def _can_qcow_chain_flatten(node: tree.StorageNode) -> bool:
+        """子快照存储均在其他文件中、且不再写入数据"""
+
+        if node.is_leaf:
+            return False  # 没有依赖该节点的子快照存储，无需合成
+        for child in node.children:
+            if child.storage.image_path == node.storage.image_path:
+                return False  # 不支持：同一文件中的子快照点无法改为依赖其他文件
+            if child.storage.status not in (m.SnapshotStorage.STATUS_STORAGE, m.SnapshotStorage.STATUS_RECYCLING):
+                return False  # 不支持：子快照存储正在生成中
+        return True
+
+    @staticmethod
+    def _fetch_flatten_nodes(node: tree.StorageNode) -> (tree.StorageNode, typing.List[tree.StorageNode]):
+        """节点到根的路径上的关键节点，第一个为基础节点，其余为被搬迁的节点，顺序为从父到子"""
+
+        path = node.fetch_nodes_to_root()
+        key_nodes = [n for i, n in enumerate(path)
+                     if i == len(path) - 1 or n.storage.image_path != path[i + 1].storage.image_path]
+        return key_nodes[0], key_nodes[1:]
+
     def _fetch_deleting_storage_objs(
             self, storage_tree: tree.DiskSnapshotStorageTree) -> typing.List[m.SnapshotStorage]:
         delete_storage_objs = list()
-        for leaf in storage_tree.leaves:  # type: tree.StorageNode
-            # 从叶子向根深度优先遍历，找到可以直接删除的快照存储
-            for node in leaf.fetch_nodes_to_root(False):  # type: tree.StorageNode
-                if self._can_disk_snapshot_storage_delete(node):
-                    delete_storage_objs.append(node.storage)
-                else:
-                    break
+        deleting_idents = set()
+        # 从叶子向根遍历（逆广度优先），节点自身可删除、且所有子节点均被删除时，该节点才可删除
+        for node in reversed(list(storage_tree.nodes_by_bfs)):  # type: tree.StorageNode
+            if any(child.ident not in deleting_idents for child in node.children):
+                continue
+            if self._can_disk_snapshot_storage_delete(node):
+                deleting_idents.add(node.ident)
+                delete_storage_objs.append(node.storage)
         return delete_storage_objs
 
     def _fetch_merge_cdp_snapshot_storage_objs(self, node: tree.StorageNode) -> typing.List[m.SnapshotStorage]:
@@ -622,7 +966,7 @@ class StorageCollection(object):
                 break
 
             # remark： current_node 已经变更, 不可再使用 storage_item
-            can_merge, merge_type = self._can_disk_snapshot_storage_merge(node)
+            can_merge, merge_type = self._can_disk_snapshot_storage_merge(current_node)
             if not can_merge or merge_type != self.TYPE_CDP:
                 break
 
@@ -632,7 +976,7 @@ class StorageCollection(object):
     def _can_disk_snapshot_storage_delete(node: tree.StorageNode) -> bool:
         storage_obj: m.SnapshotStorage = node.storage
 
-        if storage_obj.status != m.SnapshotStorage.STATUS_RECYCLING:
+        if storage_obj.status not in StorageCollection.DELETABLE_STATUS:
             return False
 
         ref_manager = srm.get_srm()
@@ -647,7 +991,7 @@ class StorageCollection(object):
             return False
 
         for child_node in node.children:
-            if child_node.storage_obj.storage_status != m.SnapshotStorage.STATUS_RECYCLING:
+            if child_node.storage.status not in StorageCollection.DELETABLE_STATUS:
                 return False
 
         return True
@@ -671,10 +1015,14 @@ class StorageCollection(object):
 
     def _create_delete_works(self, deleting_storage_objs: typing.List[m.SnapshotStorage]) -> typing.List[DeleteWork]:
         works = list()
+        referenced_image_paths = set()
 
         def insert_work(_work):
             if _work in works:
                 _work.set_duplicated()
+            elif _work.file_path in referenced_image_paths:
+                _work.set_reference_shared()
+            referenced_image_paths.add(_work.file_path)
             works.append(_work)
 
         for storage_obj in deleting_storage_objs:
@@ -699,13 +1047,13 @@ class StorageCollection(object):
             return False, 0
 
         parent_storage_obj = self._get_parent_storage_obj_by_node(node)
-        if parent_storage_obj and parent_storage_obj in (
+        if parent_storage_obj and parent_storage_obj.status in (
                 m.SnapshotStorage.STATUS_CREATING, m.SnapshotStorage.STATUS_WRITING,
                 m.SnapshotStorage.STATUS_HASHING, m.SnapshotStorage.STATUS_ABNORMAL):
             return False, 0  # 不支持：父快照存储正在生成中
 
         if rt.PathInMount.is_in_not_mount(storage_obj.image_path):
-            return False
+            return False, 0
 
         if storage_obj.is_cdp:
             if node.is_root:
@@ -744,7 +1092,7 @@ class StorageCollection(object):
     @staticmethod
     def _is_child_depend_with_timestamp(node: tree.StorageNode):
         for child in node.children:
-            storage_obj = child.storage_obj
+            storage_obj = child.storage
             if storage_obj.parent_timestamp is not None:
                 return True
         else:
@@ -754,7 +1102,7 @@ class StorageCollection(object):
     def _is_children_in_other_file(node: tree.StorageNode):
         storage_obj = node.storage
         for child in node.children:
-            if storage_obj.image_path != child.storage_obj.image_path:
+            if storage_obj.image_path != child.storage.image_path:
                 return True
         else:
             return False
@@ -762,10 +1110,10 @@ class StorageCollection(object):
     @staticmethod
     def _is_multi_snapshot_in_the_qcow(node: tree.StorageNode):
         assert not node.is_root
-        if node.parent.storage_obj.image_path == node.storage.image_path:
+        if node.parent.storage.image_path == node.storage.image_path:
             return True
         for child in node.children:
-            if child.storage_obj.image_path == node.storage.image_path:
+            if child.storage.image_path == node.storage.image_path:
                 return True
         else:
             return False
@@ -0,0 +1,366 @@
+import collections
+import queue
+import threading
+import time
+import typing
+from concurrent import futures
+
+from cpkt.core import xlogging as lg
+
+from business_logic import dedup_index
+from business_logic import locker_manager as lm
+from business_logic import storage
+from business_logic import storage_action as action
+from business_logic import storage_chain as chain
+from business_logic import storage_reference_manager as srm
+from business_logic import storage_space
+from business_logic import storage_tree as tree
+from data_access import models as m
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+
+class HashingResult(object):
+    def __init__(self, storage_item: storage.StorageItem, hash_path: typing.Union[str, None], hash_type, successful):
+        self.storage_item = storage_item
+        self.hash_path = hash_path
+        self.hash_type = hash_type
+        self.successful = successful
+        self.hash_id = None
+        self.new_storage_size = None
+
+    @property
+    def ident(self):
+        return self.storage_item.ident
+
+
+class HashingTask(object):
+    """为单个 Hashing 状态的快照存储生成hash数据
+
+    :remark:
+        已经登记了写入者生成的hash文件时（HASH_MODE_FIXUP_HASH_FILE），仅增量修正该hash文件
+    """
+
+    def __init__(self, storage_item: storage.StorageItem, hash_version=m.Hash.VERSION_MD4_CRC32):
+        self.storage_item = storage_item
+        self.hash_version = hash_version
+        self.name = f'hashing storage : <{storage_item.ident}>'
+        self.r_chain: chain.StorageChainForRead = None
+        self.hash_type: str = None
+        self.writer_hash: storage.HashItem = None
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def hash_path(self) -> str:
+        if self.writer_hash:
+            return self.writer_hash.path
+        return action.ImagePathGenerator.generate_hash(self.storage_item.image_path, self.storage_item.ident)
+
+    def acquire(self):
+        """获取读取快照存储的链
+
+        :remark:
+            仅在生成链、添加引用时短暂持有存储锁，与打开快照的逻辑一致
+        """
+        with lm.get_storage_locker(self.name), s.readonly():
+            storage_obj = storage.query_by_ident(self.storage_item.ident)
+            if storage_obj is None or storage_obj.status != m.SnapshotStorage.STATUS_HASHING:
+                return False  # 进入锁空间前数据已经变更
+            self.hash_type = storage.generate_hash_type(storage_obj)
+            self.writer_hash = storage.query_hash(storage_obj.ident)
+            storage_tree = tree.generate(storage_obj.tree_ident)
+            r_chain = chain.StorageChainForRead(srm.get_srm(), self.name)
+            for node in storage_tree.fetch_nodes_to_root(self.storage_item.ident):
+                r_chain.insert_tail(node.storage)
+            self.r_chain = r_chain.acquire()
+            return True
+
+    def release(self):
+        if self.r_chain:
+            self.r_chain.release()
+            self.r_chain = None
+
+    def work(self) -> HashingResult:
+        """在工作线程中执行，不访问数据库"""
+        result = self._hash()
+        if result.successful:
+            result.new_storage_size = storage_space.read_written_bytes_or_none(
+                self.storage_item.image_path, self.storage_item.ident, self.storage_item.disk_bytes, f'{self}')
+        return result
+
+    def _hash(self) -> HashingResult:
+        try:
+            if self.storage_item.is_cdp:
+                return HashingResult(self.storage_item, None, None, True)  # CDP文件不生成hash数据
+
+            raw_flag = action.DiskSnapshotAction.generate_flag(self.name)
+            if self.writer_hash:
+                action.DiskSnapshotAction.fixup_qcow_hash(
+                    self.r_chain, raw_flag, self.writer_hash.path, self.writer_hash.version)
+                result = HashingResult(self.storage_item, self.writer_hash.path, self.writer_hash.type, True)
+                result.hash_id = self.writer_hash.id  # 已经登记，无需新建hash记录
+                return result
+
+            action.DiskSnapshotAction.hash_qcow_snapshot(self.r_chain, raw_flag, self.hash_path, self.hash_version)
+            return HashingResult(self.storage_item, self.hash_path, self.hash_type, True)
+        except Exception as e:
+            _logger.warning(f'{self} failed : {e}')
+            _logger.warning(lg.format_exception(e))
+            return HashingResult(self.storage_item, None, None, False)
+        finally:
+            self.release()
+
+
+_hashing_scheduler = None
+_hashing_scheduler_locker = threading.Lock()
+
+
+class HashingScheduler(threading.Thread):
+    """将 Hashing 状态的快照存储转换为 Storage 状态
+
+    :remark:
+        1. 扫描 Hashing 状态的快照存储，不持有存储锁；已经认领的快照存储记录在内存中，避免重复处理
+           已认领与等待重试的快照存储计入查询数量，避免其占满查询结果而饿死新的快照存储
+        2. 在有界的线程池中生成hash数据，排队中与执行中的任务数量不超过 max_queue
+        3. 批量保存结果，每批在存储锁内使用一个事务写入 hash 表并更新状态
+           与其他修改快照存储状态的逻辑一致：变化通知在提交前发出，持有存储锁才能避免缓存读到提交前的数据
+        4. 失败的快照存储在 retry_interval_seconds 后重试，超过 MAX_RETRY 次后标记为 Abnormal
+        5. 指定 dedup_index 时，保存结果后在线程池中将hash文件加入去重索引
+           加入索引的任务同样计入 max_queue ，优先于新的 Hashing 任务提交；退出时未提交的任务丢弃，可通过重建索引修复
+    """
+
+    MAX_RETRY = 3
+
+    def __init__(self, max_workers=4, max_queue=16, batch_size=32, interval_seconds=5, retry_interval_seconds=60,
+                 index: dedup_index.DedupIndex = None):
+        super(HashingScheduler, self).__init__(name='hashing_scheduler', daemon=True)
+        self.dedup_index = index
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.retry_interval_seconds = retry_interval_seconds
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hashing')
+        self._claimed: typing.Set[str] = set()
+        self._pending_count = 0
+        self._pending_locker = threading.Lock()
+        self._results: queue.Queue = queue.Queue()
+        self._index_waiting: typing.Deque[typing.Tuple[int, str]] = collections.deque()  # 等待加入去重索引的hash文件
+        self._retry_count: typing.Dict[str, int] = collections.defaultdict(int)
+        self._failed_time: typing.Dict[str, float] = dict()
+        self._quit = threading.Event()
+
+        self._started_time = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.hashed_bytes = 0
+
+    @staticmethod
+    def get_hashing_scheduler() -> 'HashingScheduler':
+        global _hashing_scheduler
+
+        if _hashing_scheduler is None:
+            with _hashing_scheduler_locker:
+                if _hashing_scheduler is None:
+                    _hashing_scheduler = HashingScheduler(index=dedup_index.get_dedup_index())
+        return _hashing_scheduler
+
+    @property
+    def queue_depth(self) -> int:
+        """排队中与执行中的任务数量"""
+        with self._pending_locker:
+            return self._pending_count
+
+    @property
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self._started_time, 0.001)
+        return {
+            'queue_depth': self.queue_depth,
+            'waiting_results': self._results.qsize(),
+            'completed': self.completed,
+            'failed': self.failed,
+            'storages_per_second': round(self.completed / elapsed, 3),
+            'bytes_per_second': round(self.hashed_bytes / elapsed, 3),
+        }
+
+    def stop(self):
+        self._quit.set()
+        self._executor.shutdown(wait=True)
+
+    @s.scoped_session_thread
+    def run(self):
+        _logger.info(f'{self.name} start')
+        while not self._quit.is_set():
+            try:
+                busy = self.schedule_once()
+            except Exception as e:
+                _logger.error(f'{self.name} schedule failed : {e}')
+                _logger.error(lg.format_exception(e))
+                busy = False
+            self._quit.wait(0.2 if busy else self.interval_seconds)
+
+    def schedule_once(self) -> bool:
+        """保存已完成的结果，并认领新的快照存储
+
+        :return: 是否仍有未完成的工作
+        """
+        self._save_results()
+        self._submit_index_tasks()
+        self._claim_and_submit()
+        if self.completed or self.failed:
+            _logger.debug(f'{self.name} stats : {self.stats}')
+        return self.queue_depth != 0 or not self._results.empty() or len(self._index_waiting) != 0
+
+    def _claim_and_submit(self):
+        capacity = self.max_queue - self.queue_depth
+        if capacity <= 0:
+            return
+
+        now = time.monotonic()
+        waiting_retry = sum(1 for failed_time in self._failed_time.values()
+                            if now - failed_time < self.retry_interval_seconds)
+        with s.readonly():
+            storage_items = storage.query_items_by_status(
+                m.SnapshotStorage.STATUS_HASHING, capacity + len(self._claimed) + waiting_retry)
+
+        for storage_item in storage_items:
+            if capacity <= 0:
+                break
+            if storage_item.ident in self._claimed:
+                continue
+            if (storage_item.ident in self._failed_time
+                    and now - self._failed_time[storage_item.ident] < self.retry_interval_seconds):
+                continue
+
+            task = HashingTask(storage_item)
+            try:
+                if not task.acquire():
+                    continue
+            except Exception as e:
+                _logger.warning(f'{task} acquire failed : {e}')
+                if self._on_failed(storage_item):
+                    self._mark_abnormal(storage_item)
+                continue
+
+            self._claimed.add(storage_item.ident)
+            with self._pending_locker:
+                self._pending_count += 1
+            capacity -= 1
+            self._executor.submit(self._work, task)
+
+    def _mark_abnormal(self, storage_item: storage.StorageItem):
+        """获取快照存储链失败超过重试次数"""
+        with lm.get_storage_locker(self.name), s.transaction():
+            st = storage.query_by_ident(storage_item.ident)
+            if st is not None and st.status == m.SnapshotStorage.STATUS_HASHING:
+                st.update_status(m.SnapshotStorage.STATUS_ABNORMAL)
+
+    def _work(self, task: HashingTask):
+        try:
+            result = task.work()
+        except BaseException:
+            result = HashingResult(task.storage_item, None, None, False)
+            raise
+        finally:
+            self._results.put(result)
+            with self._pending_locker:
+                self._pending_count -= 1
+        return result
+
+    def _fetch_results(self) -> typing.List[HashingResult]:
+        results = list()
+        while len(results) < self.batch_size:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+        return results
+
+    def _save_results(self):
+        while True:
+            results = self._fetch_results()
+            if not results:
+                return
+
+            try:
+                with lm.get_storage_locker(self.name), s.transaction():
+                    for result in results:
+                        self._save_result(result)
+            except Exception as e:
+                _logger.error(f'{self.name} save results failed : {e}')
+                _logger.error(lg.format_exception(e))
+                for result in results:
+                    self._claimed.discard(result.ident)  # 下次扫描时重试
+                return
+
+            for result in results:
+                self._claimed.discard(result.ident)
+                if result.successful:
+                    self.completed += 1
+                    self.hashed_bytes += result.storage_item.disk_bytes
+                    self._retry_count.pop(result.ident, None)
+                    self._failed_time.pop(result.ident, None)
+                if result.hash_id is not None:
+                    self.add_to_dedup_index(result.hash_id, result.hash_path)
+
+    def _save_result(self, result: HashingResult):
+        st = storage.query_by_ident(result.ident)
+        if st is None or st.status != m.SnapshotStorage.STATUS_HASHING:
+            _logger.warning(f'{self.name} ignore result of {result.ident}, status changed : {st}')
+            return
+
+        if result.successful:
+            if result.hash_path and result.hash_id is None:
+                result.hash_id = storage.create_hash(
+                    result.ident, m.Hash.VERSION_MD4_CRC32, result.hash_type, result.hash_path).id
+            if result.new_storage_size is not None:
+                st.update_new_storage_size(result.new_storage_size)
+            st.update_status(m.SnapshotStorage.STATUS_STORAGE)
+        elif self._on_failed(result.storage_item):
+            st.update_status(m.SnapshotStorage.STATUS_ABNORMAL)
+
+    def add_to_dedup_index(self, hash_id, hash_path):
+        """在线程池中将hash文件加入去重索引，参考 _submit_index_tasks"""
+        if self.dedup_index is not None:
+            self._index_waiting.append((hash_id, hash_path,))
+
+    def _submit_index_tasks(self):
+        while self._index_waiting and self.queue_depth < self.max_queue:
+            hash_id, hash_path = self._index_waiting.popleft()
+            with self._pending_locker:
+                self._pending_count += 1
+            self._executor.submit(self._add_to_dedup_index, hash_id, hash_path)
+
+    def _add_to_dedup_index(self, hash_id, hash_path):
+        """去重索引仅用于优化，失败时不影响快照存储的状态，可通过重建索引修复"""
+        try:
+            self.dedup_index.add_hash_file(hash_id, hash_path)
+        except Exception as e:
+            _logger.warning(f'{self.name} add {hash_path} to {self.dedup_index} failed : {e}')
+        finally:
+            with self._pending_locker:
+                self._pending_count -= 1
+
+    def _on_failed(self, storage_item: storage.StorageItem) -> bool:
+        """记录失败次数
+
+        :return: 是否超过重试次数
+        """
+        self.failed += 1
+        self._retry_count[storage_item.ident] += 1
+        if self._retry_count[storage_item.ident] < self.MAX_RETRY:
+            self._failed_time[storage_item.ident] = time.monotonic()
+            return False
+        _logger.error(f'{self.name} hashing {storage_item.ident} failed {self.MAX_RETRY} times')
+        self._retry_count.pop(storage_item.ident)
+        self._failed_time.pop(storage_item.ident, None)
+        return True
+
+
+def get_hashing_scheduler() -> HashingScheduler:
+    return HashingScheduler.get_hashing_scheduler()
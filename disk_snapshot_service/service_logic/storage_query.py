@@ -0,0 +1,109 @@
+"""快照存储的只读查询"""
+import typing
+
+from cpkt.core import xlogging as lg
+from cpkt.data import define as dd
+
+import interface_data_define as idd
+from business_logic import locker_manager as lm
+from business_logic import storage
+from business_logic import storage_space
+from business_logic import storage_timeline as timeline
+from data_access import models as m
+from data_access import session as s
+
+_logger = lg.get_logger(__name__)
+
+_TIMELINE_TYPE = {
+    m.SnapshotStorage.TYPE_QCOW: dd.DiskSnapshotService.STORAGE_TYPE_QCOW,
+    m.SnapshotStorage.TYPE_CDP: dd.DiskSnapshotService.STORAGE_TYPE_CDP,
+}
+
+
+def _query_tree_ident(params: typing.Union[idd.QueryTimelineParams, idd.QuerySpaceParams]) -> str:
+    if params.tree_ident:
+        return params.tree_ident
+
+    assert params.storage_ident, ('需要指定快照存储树或快照存储', 'query without tree_ident and storage_ident', 0)
+    with s.readonly():
+        storage_obj = storage.query_by_ident(params.storage_ident)
+        assert storage_obj, ('快照存储不存在', f'query tree of {params.storage_ident}, storage NOT exist', 0)
+        return storage_obj.tree_ident
+
+
+def _get_tree_timeline(tree_ident: str) -> timeline.TreeTimeline:
+    timelines = timeline.get_storage_timelines()
+    tree_timeline = timelines.get(tree_ident)
+    if tree_timeline is None:
+        with lm.get_storage_locker(f'query timeline {tree_ident}'), s.readonly():
+            tree_timeline = timelines.build(tree_ident)
+    return tree_timeline
+
+
+def _entry_to_dict(entry: timeline.TimelineEntry) -> dict:
+    return {
+        'ident': entry.ident,
+        'type': idd.TIMELINE_TYPE_GAP if entry.is_gap else _TIMELINE_TYPE[entry.type],
+        'status': None if entry.is_gap else m.SnapshotStorage.format_status(entry.status),
+        'parent_ident': entry.parent_ident,
+        'parent_timestamp': entry.parent_timestamp,
+        'start_timestamp': entry.start_timestamp,
+        'finish_timestamp': entry.finish_timestamp,
+    }
+
+
+def query_timeline(params: idd.QueryTimelineParams) -> dict:
+    """查询快照存储树的时间线，参考 business_logic.storage_timeline
+
+    指定 timestamps 时返回覆盖各时间点的快照存储，否则分页返回 [begin_timestamp, end_timestamp] 中的快照存储与间隙
+    """
+    tree_timeline = _get_tree_timeline(_query_tree_ident(params))
+    result = {
+        'tree_ident': tree_timeline.tree_ident,
+        'first_timestamp': tree_timeline.first_timestamp,
+        'last_timestamp': tree_timeline.last_timestamp,
+        'storage_count': len(tree_timeline.index),
+        'gap_count': tree_timeline.gap_count,
+        'entries': list(),
+        'next_page_token': None,
+        'covers': list(),
+    }
+    if params.timestamps is not None:
+        result['covers'] = [{'timestamp': timestamp, 'idents': [entry.ident for entry in tree_timeline.find(timestamp)]}
+                            for timestamp in params.timestamps]
+    else:
+        entries, result['next_page_token'] = tree_timeline.page(
+            params.begin_timestamp, params.end_timestamp, params.page_token, params.limit)
+        result['entries'] = [_entry_to_dict(entry) for entry in entries]
+    return result
+
+
+def _get_tree_space(tree_ident: str) -> storage_space.TreeSpace:
+    """在锁空间内复制快照存储树，在锁空间外读取位图文件"""
+    space = storage_space.get_storage_space()
+    tree_space = space.get(tree_ident)
+    if tree_space is None:
+        with lm.get_storage_locker(f'query space {tree_ident}'), s.readonly():
+            generation, nodes = space.query_nodes(tree_ident)
+        tree_space = space.build(tree_ident, generation, nodes)
+    return tree_space
+
+
+def _space_item_to_dict(item: storage_space.StorageSpaceItem) -> dict:
+    return {
+        'ident': item.ident,
+        'status': m.SnapshotStorage.format_status(item.status),
+        'written_bytes': item.written_bytes,
+        'unique_bytes': item.unique_bytes,
+        'reclaimable_bytes': item.reclaimable_bytes,
+    }
+
+
+def query_space(params: idd.QuerySpaceParams) -> dict:
+    """查询快照存储树的空间统计，参考 business_logic.storage_space"""
+    tree_space = _get_tree_space(_query_tree_ident(params))
+    result = tree_space.to_dict()
+    result['tree_ident'] = tree_space.tree_ident
+    result['storages'] = ([_space_item_to_dict(item) for item in tree_space.items.values()]
+                          if params.with_storages else list())
+    return result
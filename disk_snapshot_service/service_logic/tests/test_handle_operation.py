@@ -0,0 +1,346 @@
+import decimal
+import time
+from unittest.mock import patch
+
+import pytest
+
+import interface_data_define as idd
+from business_logic import cdp_index
+from business_logic import chain_metrics
+from business_logic import handle_pool as pool
+from business_logic import locker_manager as lm
+from business_logic import raw_handle_cache as rhc
+from business_logic import storage
+from business_logic import storage_action as action
+from business_logic import storage_chain as chain
+from business_logic import storage_reference_manager as srm
+from business_logic import tree_versions
+from data_access import hash as da_hash
+from data_access import models as m
+from data_access import session as s
+from data_access import storage as da_storage
+from ice_service import fake_img_service
+from service_logic import handle_operation
+from service_logic import storage_hashing as sh
+
+pytestmark = pytest.mark.usefixtures('db')
+
+TREE_IDENT = 'tree'
+
+
+@pytest.fixture()
+def scheduler(reset_singletons):
+    reset_singletons((sh, '_hashing_scheduler'))
+    sh._hashing_scheduler = sh.HashingScheduler()
+    yield sh._hashing_scheduler
+    sh._hashing_scheduler.stop()
+
+
+@pytest.fixture()
+def writing_handle(db, tmp_path, create_storage, reset_singletons):
+    reset_singletons((pool, '_handle_pool'))
+    image_path = str(tmp_path / 'a.qcow')
+    with s.transaction():
+        create_storage('q1', image_path=image_path)
+        storage_obj = create_storage('q2', 'q1', m.SnapshotStorage.STATUS_CREATING, image_path=image_path)
+        handle = pool.generate_handle('h', True, 'flag')
+        handle.storage_chain = chain.StorageChainForWrite(srm.get_srm(), 'test').insert_tail(storage_obj).acquire()
+        da_storage.update_obj_status(storage_obj, m.SnapshotStorage.STATUS_WRITING)
+    return handle
+
+
+def _query_status_and_hash(ident):
+    with s.readonly():
+        hash_obj = da_hash.get_last_obj_by_storage_ident(ident)
+        return da_storage.get_obj_by_ident(ident).status, (hash_obj.type, hash_obj.path) if hash_obj else None
+
+
+def _close(hash_mode=None, hash_file_exist=True):
+    if hash_mode:
+        handle_operation.set_hash_mode(idd.SetHashModeParams('h', hash_mode))
+    if hash_file_exist:
+        with open(action.ImagePathGenerator.generate_hash(pool.get_handle('h', True).storage_chain
+                                                          .last_storage_item.image_path, 'q2'), 'wb'):
+            pass
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('h'))
+    assert pool.get_handle('h', False) is None
+    assert not srm.get_srm().is_storage_using('q2')
+
+
+@pytest.mark.usefixtures('writing_handle', 'scheduler')
+def test_close_without_hash_mode():
+    _close()
+    assert _query_status_and_hash('q2') == (m.SnapshotStorage.STATUS_HASHING, None)
+
+
+@pytest.mark.usefixtures('scheduler')
+def test_close_use_writer_hash_file(writing_handle):
+    hash_path = action.ImagePathGenerator.generate_hash(writing_handle.storage_chain.last_storage_item.image_path, 'q2')
+    _close(idd.HASH_MODE_USE_HASH_FILE)
+    assert _query_status_and_hash('q2') == (m.SnapshotStorage.STATUS_STORAGE, (m.Hash.TYPE_INCREMENT, hash_path))
+
+
+@pytest.mark.usefixtures('writing_handle', 'scheduler')
+def test_close_use_writer_hash_file_not_exist():
+    _close(idd.HASH_MODE_USE_HASH_FILE, hash_file_exist=False)
+    assert _query_status_and_hash('q2') == (m.SnapshotStorage.STATUS_HASHING, None)
+
+
+@pytest.mark.usefixtures('writing_handle')
+def test_close_fixup_writer_hash_file(scheduler):
+    _close(idd.HASH_MODE_FIXUP_HASH_FILE)
+    status, hash_info = _query_status_and_hash('q2')
+    assert status == m.SnapshotStorage.STATUS_HASHING
+
+    with patch.object(action.DiskSnapshotAction, 'hash_qcow_snapshot') as hash_qcow_snapshot, \
+            patch.object(action.DiskSnapshotAction, 'fixup_qcow_hash') as fixup_qcow_hash:
+        while scheduler.schedule_once():
+            pass
+    hash_qcow_snapshot.assert_not_called()
+    assert fixup_qcow_hash.call_args[0][2] == hash_info[1]
+    assert _query_status_and_hash('q2') == (m.SnapshotStorage.STATUS_STORAGE, hash_info)
+    with s.readonly():
+        assert s.get_scoped_session().query(m.Hash).count() == 1
+
+
+@pytest.mark.usefixtures('writing_handle')
+def test_set_hash_mode_on_reading_handle():
+    pool.generate_handle('r', False, 'flag')
+    with pytest.raises(AssertionError):
+        handle_operation.set_hash_mode(idd.SetHashModeParams('r', idd.HASH_MODE_USE_HASH_FILE))
+    pool.get_handle('r', True).destroy()
+    assert idd.SetHashModeParamsSchema().loads('{"handle": "h", "hash_mode": "bad"}')[1]
+
+
+@pytest.fixture()
+def reading_storage(db, tmp_path, create_storage, reset_singletons):
+    with s.transaction():
+        create_storage('r1', image_path=str(tmp_path / 'r.qcow'))
+    reset_singletons((pool, '_handle_pool'))
+    return 'r1'
+
+
+def _open(handle, storage_ident, open_raw_handle=True, share=True):
+    return handle_operation.open_snapshot(
+        idd.OpenSnapshotParams(handle, None, 1, 1, storage_ident, None, open_raw_handle, share))
+
+
+def test_share_reading_handle(reading_storage, fake_img):
+    first = _open('s1', reading_storage)
+    second = _open('s2', reading_storage, open_raw_handle=False)
+    assert second.storage_chain is first.storage_chain
+    assert second.raw_handle == first.raw_handle
+    assert fake_img.read.stats['open'].calls == 1
+    assert pool.HandlePool.get_handle_pool().shared_count() == (1, 2,)
+
+    third = _open('s3', reading_storage, share=False)
+    assert third.raw_handle != first.raw_handle
+    assert fake_img.read.stats['open'].calls == 2
+
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('s1'))
+    assert fake_img.read.opened_handles == [first.raw_handle, third.raw_handle]
+    assert handle_operation.get_raw_handle(idd.GetRawHandleParams('s2')).raw_handle == first.raw_handle
+
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('s2'))
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('s3'))
+    assert fake_img.read.opened_handles == []
+    assert pool.HandlePool.get_handle_pool().shared_count() == (0, 0,)
+    assert not srm.get_srm().is_storage_using(reading_storage)
+
+
+def test_share_reading_handle_open_failed(reading_storage, fake_img):
+    with patch.object(action.DiskSnapshotAction, 'open_disk_snapshot', side_effect=ValueError()):
+        with pytest.raises(ValueError):
+            _open('s1', reading_storage)
+    assert pool.get_handle('s1', False) is None
+    assert pool.HandlePool.get_handle_pool().shared_count() == (0, 0,)
+    assert not srm.get_srm().is_storage_using(reading_storage)
+
+    assert _open('s2', reading_storage).raw_handle
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('s2'))
+
+
+def test_open_without_storage_locker(reading_storage):
+    """发布快照存储树的版本后，打开快照存储不持有存储锁；登记引用后版本已变化时，回退到在存储锁内打开"""
+    _open('s1', reading_storage, open_raw_handle=False, share=False)
+    with patch.object(lm, 'get_storage_locker', side_effect=AssertionError('storage locker')):
+        opened = _open('s2', reading_storage, open_raw_handle=False, share=False)
+    assert [item.ident for item in opened.storage_chain.key_storage_items] == [reading_storage]
+
+    versions = tree_versions.get_tree_versions()
+    get = versions.get
+
+    def _get_then_collect(tree_ident):
+        result = get(tree_ident)
+        versions.begin_write(tree_ident)  # 回收逻辑在读取者登记引用前检查引用
+        return result
+
+    with patch.object(versions, 'get', side_effect=_get_then_collect):
+        _open('s3', reading_storage, open_raw_handle=False, share=False)
+    assert (versions.builds, versions.conflicts) == (2, 1)
+    assert srm.get_srm().count_records() == (3, 3, 0)  # 校验失败的快照存储链已释放
+
+    def _collect_then_register(tree_ident):
+        with versions.writing(tree_ident):  # 回收逻辑检查引用后，读取者取得版本号
+            result = get(tree_ident)
+        return result  # 回收逻辑结束写入后，读取者才登记引用
+
+    with patch.object(versions, 'get', side_effect=_collect_then_register):
+        _open('s4', reading_storage, open_raw_handle=False, share=False)
+    assert (versions.builds, versions.conflicts) == (3, 2)
+    assert srm.get_srm().count_records() == (4, 4, 0)
+
+    for handle in ('s1', 's2', 's3', 's4',):
+        handle_operation.close_snapshot(idd.CloseSnapshotParams(handle))
+    assert not srm.get_srm().is_storage_using(reading_storage)
+
+
+def test_open_cdp_at_timestamp(reading_storage, fake_img, tmp_path, create_storage, reset_singletons):
+    begin = decimal.Decimal('1600000000.000000')
+    with s.transaction():
+        for ident, parent_ident, start, finish, status in (
+                ('c0', reading_storage, begin, begin + 10, m.SnapshotStorage.STATUS_STORAGE),
+                ('c1', 'c0', begin + 10, None, m.SnapshotStorage.STATUS_WRITING),):
+            create_storage(ident, parent_ident, status, m.SnapshotStorage.TYPE_CDP, str(tmp_path / f'{ident}.cdp'),
+                           start=start, finish=finish)
+    reset_singletons((cdp_index, '_cdp_index'), (chain_metrics, '_chain_metrics'))
+
+    opened = handle_operation.open_snapshot(
+        idd.OpenSnapshotParams('s1', None, 1, 1, 'c1', begin + decimal.Decimal('5.5'), True, False))
+    assert fake_img.read._handles[opened.raw_handle] == [
+        (str(tmp_path / 'r.qcow'), reading_storage), (str(tmp_path / 'c0.cdp'), '1600000005.500000')]
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('s1'))
+    assert chain_metrics.get_chain_metrics().query_tree(TREE_IDENT)['last'] == {
+        'depth': 2, 'key_items': 2, 'files': 2}
+
+    with pytest.raises(AssertionError, match='快照时间点不存在'):
+        handle_operation.open_snapshot(idd.OpenSnapshotParams('s2', None, 1, 1, 'c1', begin - 1, True, False))
+    assert pool.get_handle('s2', False) is None
+    assert chain_metrics.get_chain_metrics().total.opens == 1
+
+
+@pytest.fixture()
+def cache(reading_storage, tmp_path, create_storage, reset_singletons):
+    with s.transaction():
+        for ident in ('r2', 'r3',):
+            create_storage(ident, image_path=str(tmp_path / f'{ident}.qcow'), tree_ident=ident)
+    reset_singletons((rhc, '_raw_handle_cache'))
+    cache = rhc.configure(2, 300)
+    yield cache
+    cache.clear()
+
+
+def _open_and_close(handle, storage_ident) -> int:
+    raw_handle = _open(handle, storage_ident, share=False).raw_handle
+    handle_operation.close_snapshot(idd.CloseSnapshotParams(handle))
+    return raw_handle
+
+
+def test_raw_handle_cache_hit(cache, fake_img):
+    raw_handle = _open_and_close('c1', 'r1')
+    assert fake_img.read.opened_handles == [raw_handle]
+    assert srm.get_srm().is_storage_using('r1')  # 缓存的原生句柄保护快照存储
+
+    handle = _open('c2', 'r1', open_raw_handle=False, share=False)
+    assert handle_operation.get_raw_handle(idd.GetRawHandleParams('c2')).raw_handle == raw_handle
+    assert _open('c3', 'r1', share=False).raw_handle != raw_handle  # 缓存项正在使用中
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('c2'))
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('c3'))
+
+    assert fake_img.read.stats['open'].calls == 2
+    assert cache.to_dict()['hits'] == 1 and cache.to_dict()['hit_rate'] == 0.3333
+
+
+def test_raw_handle_cache_lru_and_idle(cache, fake_img):
+    first = _open_and_close('c1', 'r1')
+    _open_and_close('c2', 'r2')
+    _open_and_close('c3', 'r3')
+    assert first not in fake_img.read.opened_handles
+    assert cache.to_dict()['evictions'] == 1
+    assert not srm.get_srm().is_storage_using('r1')
+
+    cache.idle_seconds = 0
+    cache.evict_idle()
+    cache.close_pending()
+    assert fake_img.read.opened_handles == []
+    assert not srm.get_srm().is_storage_using('r2')
+
+
+def _set_status(ident, status):
+    with s.transaction():
+        storage.query_by_ident(ident).update_status(status)
+
+
+def test_raw_handle_cache_invalidate(cache, fake_img):
+    _open_and_close('c1', 'r1')
+    _set_status('r1', m.SnapshotStorage.STATUS_RECYCLING)
+    assert fake_img.read.opened_handles  # 锁空间内不关闭原生句柄
+    cache.close_pending()
+    assert fake_img.read.opened_handles == []
+    assert not srm.get_srm().is_storage_using('r1')
+
+    _open('c2', 'r2', share=False)
+    _set_status('r2', m.SnapshotStorage.STATUS_RECYCLING)
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('c2'))  # 使用中失效，归还时关闭
+    assert fake_img.read.opened_handles == []
+    assert cache.to_dict()['invalidations'] == 2
+
+
+@pytest.fixture()
+def closer(reset_singletons):
+    reset_singletons((handle_operation, '_background_closer'))
+    yield handle_operation.get_background_closer()
+    handle_operation.get_background_closer().stop()
+
+
+def _wait_closed(handle, timeout=5) -> dict:
+    end = time.monotonic() + timeout
+    while True:
+        result = handle_operation.query_close_status(idd.QueryCloseStatusParams(handle))
+        if result['status'] != idd.CLOSE_STATUS_CLOSING or time.monotonic() > end:
+            return result
+        time.sleep(0.01)
+
+
+def test_background_close_reading(reading_storage, fake_img, closer):
+    fake_img.read.profiles['close'].latency = fake_img_service.LatencyModel('fixed', 0.3)
+    _open('b1', reading_storage, share=False)
+
+    begin = time.monotonic()
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('b1', background=True))
+    assert time.monotonic() - begin < 0.3
+    assert pool.get_handle('b1', False) is None
+    assert handle_operation.query_close_status(idd.QueryCloseStatusParams('b1'))['status'] == idd.CLOSE_STATUS_CLOSING
+
+    assert _wait_closed('b1')['status'] == idd.CLOSE_STATUS_CLOSED
+    assert fake_img.read.opened_handles == []
+    assert not srm.get_srm().is_storage_using(reading_storage)
+    assert handle_operation.query_close_status(idd.QueryCloseStatusParams('x'))['status'] == idd.CLOSE_STATUS_UNKNOWN
+
+
+def test_background_close_after_stop(reading_storage, fake_img, closer):
+    _open('b1', reading_storage, share=False)
+    closer.stop()
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('b1', background=True))  # 已停止时同步关闭
+    assert handle_operation.query_close_status(idd.QueryCloseStatusParams('b1'))['status'] == idd.CLOSE_STATUS_CLOSED
+    assert pool.get_handle('b1', False) is None
+    assert fake_img.read.opened_handles == []
+    assert not srm.get_srm().is_storage_using(reading_storage)
+
+
+@pytest.mark.usefixtures('writing_handle', 'scheduler')
+def test_background_close_writing(closer):
+    handle_operation.close_snapshot(idd.CloseSnapshotParams('h', background=True))
+    assert _wait_closed('h')['status'] == idd.CLOSE_STATUS_CLOSED
+    assert _query_status_and_hash('q2') == (m.SnapshotStorage.STATUS_HASHING, None)
+    assert not srm.get_srm().is_storage_using('q2')
+
+
+@pytest.mark.usefixtures('scheduler')
+def test_background_close_writing_failed(writing_handle, closer):
+    writing_handle.raw_handle = 1
+    with patch.object(action.DiskSnapshotAction, 'close_disk_snapshot', side_effect=ValueError('flush failed')):
+        handle_operation.close_snapshot(idd.CloseSnapshotParams('h', background=True))
+        result = _wait_closed('h')
+    assert result == {'status': idd.CLOSE_STATUS_FAILED, 'error': 'flush failed'}
+    assert _query_status_and_hash('q2') == (m.SnapshotStorage.STATUS_ABNORMAL, None)
@@ -0,0 +1,53 @@
+from unittest.mock import patch
+
+import pytest
+
+from business_logic import storage_action as action
+from data_access import merge_checkpoint as da_checkpoint
+from data_access import models as m
+from data_access import session as s
+from data_access import storage as da_storage
+from service_logic import startup_recovery
+from service_logic import storage_collection as sc
+
+pytestmark = pytest.mark.usefixtures('db')
+
+GiB = 1024 * 1024 * 1024
+
+
+@pytest.fixture()
+def interrupted_trees(db, create_storage):
+    """tree 中 c1 与 q3 被中断；other 中 o2 有合并进度，由回收逻辑继续合并"""
+    with s.transaction():
+        for ident, parent_ident, storage_type, status, tree_ident in (
+                ('q1', None, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_STORAGE, 'tree'),
+                ('c1', 'q1', m.SnapshotStorage.TYPE_CDP, m.SnapshotStorage.STATUS_WRITING, 'tree'),
+                ('q2', 'q1', m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_RECYCLING, 'tree'),
+                ('q3', 'q2', m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_CREATING, 'tree'),
+                ('o1', None, m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_STORAGE, 'other'),
+                ('o2', 'o1', m.SnapshotStorage.TYPE_QCOW, m.SnapshotStorage.STATUS_CREATING, 'other'),):
+            create_storage(ident, parent_ident, status, storage_type, disk_bytes=10 * GiB, tree_ident=tree_ident)
+        da_checkpoint.create_obj('o2', m.MergeCheckpoint.TYPE_QCOW_MOVE_DATA, 'o0', 10 * GiB)
+
+
+def _query_status() -> dict:
+    with s.readonly():
+        return {o.ident: o.status for o in da_storage.query_valid_objs('tree') + da_storage.query_valid_objs('other')}
+
+
+@pytest.mark.usefixtures('interrupted_trees')
+def test_startup_recovery():
+    recovery = startup_recovery.StartupRecovery()
+    assert sorted(recovery.scan()) == [('c1', 'tree'), ('q3', 'tree')]
+    assert recovery.tree_idents == ['tree']
+
+    with patch.object(action.DiskSnapshotAction, 'remove_cdp_file', return_value=True), \
+            patch.object(action.DiskSnapshotAction, 'remove_qcow_file', return_value=True) as remove_qcow_file, \
+            patch.object(sc.rt.PathInMount, 'is_in_not_mount', return_value=False):
+        recovery.run()
+
+    assert (recovery.recovered, recovery.failed_trees) == (2, 0)
+    # 异常的叶子被删除后，回收中的 q2 成为叶子，一并删除
+    assert _query_status() == {'q1': m.SnapshotStorage.STATUS_STORAGE, 'o1': m.SnapshotStorage.STATUS_STORAGE,
+                               'o2': m.SnapshotStorage.STATUS_CREATING}
+    assert sorted(call.args[0] for call in remove_qcow_file.call_args_list) == ['/mnt/q2', '/mnt/q3']
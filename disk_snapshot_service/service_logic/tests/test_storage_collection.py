@@ -0,0 +1,275 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from benchmark import collection_simulator as simulator
+from business_logic import hash_file
+from business_logic import merge_checkpoint
+from business_logic import storage_action as action
+from business_logic import storage_reference_manager as srm
+from business_logic import storage_tree as tree
+from data_access import hash as da_hash
+from data_access import merge_checkpoint as da_checkpoint
+from data_access import models as m
+from data_access import session as s
+from data_access import storage as da_storage
+from service_logic import storage_collection as sc
+
+pytestmark = pytest.mark.usefixtures('db')
+
+GiB = 1024 * 1024 * 1024
+DISK_BYTES = 10 * GiB  # 合并作业按 4GiB 分段搬迁，共 3 段
+TREE_IDENT = 'tree'
+
+
+class ServiceCrash(BaseException):
+    """模拟服务进程中断，不会被作业逻辑捕获"""
+
+
+class FakeImageBackend(object):
+    """模拟底层镜像服务的数据搬迁接口，记录每次搬迁的区间"""
+
+    def __init__(self, crash_at=None, error_at=None, error=ConnectionError):
+        self.ranges = list()
+        self.crash_at = crash_at
+        self.error_at = error_at
+        self.error = error
+
+    def move_data(self, *args):
+        begin_bytes, end_bytes = args[-2:]
+        if self.crash_at is not None and len(self.ranges) == self.crash_at:
+            raise ServiceCrash()
+        if self.error_at is not None and len(self.ranges) == self.error_at:
+            raise self.error('image service unavailable')
+        self.ranges.append((begin_bytes, end_bytes))
+
+    def collect(self):
+        with patch.object(action.DiskSnapshotAction, 'merge_cdp_to_qcow', self.move_data), \
+                patch.object(action.DiskSnapshotAction, 'move_data_from_qcow', self.move_data), \
+                patch.object(sc.rt.PathInMount, 'is_in_not_mount', return_value=False):
+            return sc.StorageCollection(TREE_IDENT).collect()
+
+
+def _restart_service():
+    s.session_maker.remove()
+    srm._storage_reference_manager = None
+
+
+def _query_merged_storage(parent_ident):
+    with s.readonly():
+        return [(o.ident, o.status) for o in da_storage.query_valid_objs(TREE_IDENT)
+                if o.parent_ident == parent_ident and o.ident not in ('q1', 'q2', 'q3', 'c1',)]
+
+
+@pytest.fixture()
+def cdp_tree(db, create_storage):
+    with s.transaction():
+        create_storage('q1', disk_bytes=DISK_BYTES)
+        create_storage('c1', 'q1', m.SnapshotStorage.STATUS_RECYCLING, m.SnapshotStorage.TYPE_CDP,
+                       disk_bytes=DISK_BYTES)
+        create_storage('q2', 'c1', disk_bytes=DISK_BYTES)
+
+
+@pytest.fixture()
+def qcow_tree(db, create_storage):
+    with s.transaction():
+        create_storage('q1', disk_bytes=DISK_BYTES)
+        create_storage('q2', 'q1', m.SnapshotStorage.STATUS_RECYCLING, disk_bytes=DISK_BYTES)
+        create_storage('q3', 'q2', disk_bytes=DISK_BYTES)
+
+
+@pytest.fixture()
+def long_qcow_tree(db, create_storage):
+    """q1 -> q2 -> q3 -> q4 -> q5 ，均为存储状态，各自在不同的文件中"""
+    with s.transaction():
+        create_storage('q1', disk_bytes=DISK_BYTES)
+        for i in range(2, 6):
+            create_storage(f'q{i}', f'q{i - 1}', disk_bytes=DISK_BYTES)
+    with patch.object(sc.StorageCollection, 'flatten_min_key_items', 4):
+        yield
+
+
+@pytest.mark.usefixtures('cdp_tree')
+def test_merge_cdp_resume_from_checkpoint():
+    with pytest.raises(ServiceCrash):
+        FakeImageBackend(crash_at=1).collect()
+    _restart_service()
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_CREATING
+    with s.readonly():
+        assert da_checkpoint.get_obj_by_storage_ident(new_ident).finished_bytes == 4 * GiB
+
+    backend = FakeImageBackend()
+    assert backend.collect()
+    assert backend.ranges == [(4 * GiB, 8 * GiB), (8 * GiB, 10 * GiB)]
+
+    assert _query_merged_storage('q1') == [(new_ident, m.SnapshotStorage.STATUS_STORAGE)]
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('q2').parent_ident == new_ident
+        assert da_checkpoint.get_obj_by_storage_ident(new_ident) is None
+
+
+@pytest.mark.usefixtures('qcow_tree')
+def test_merge_qcow_move_data_resume_from_checkpoint():
+    with pytest.raises(ServiceCrash):
+        FakeImageBackend(crash_at=2).collect()
+    _restart_service()
+
+    backend = FakeImageBackend()
+    assert backend.collect()
+    assert backend.ranges == [(8 * GiB, 10 * GiB)]
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_STORAGE
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('q3').parent_ident == new_ident
+
+
+@pytest.mark.usefixtures('qcow_tree')
+def test_merge_without_crash_remove_checkpoint():
+    backend = FakeImageBackend()
+    assert backend.collect()
+    assert backend.ranges == [(0, 4 * GiB), (4 * GiB, 8 * GiB), (8 * GiB, 10 * GiB)]
+    with s.readonly():
+        assert s.get_scoped_session().query(m.MergeCheckpoint).count() == 0
+
+
+@pytest.mark.usefixtures('qcow_tree')
+def test_merge_resume_after_transient_error():
+    assert not FakeImageBackend(error_at=1).collect()
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_CREATING
+    with s.readonly():
+        checkpoint = da_checkpoint.get_obj_by_storage_ident(new_ident)
+        assert (checkpoint.finished_bytes, checkpoint.failed_count) == (4 * GiB, 1)
+
+    backend = FakeImageBackend()
+    assert backend.collect()
+    assert backend.ranges == [(4 * GiB, 8 * GiB), (8 * GiB, 10 * GiB)]
+    assert _query_merged_storage('q1') == [(new_ident, m.SnapshotStorage.STATUS_STORAGE)]
+    with s.readonly():
+        assert da_checkpoint.get_obj_by_storage_ident(new_ident) is None
+
+
+@pytest.mark.usefixtures('qcow_tree')
+def test_merge_abnormal_after_max_retry():
+    for _ in range(sc.ResumableMergeWork.MAX_RETRY - 1):
+        assert not FakeImageBackend(error_at=0).collect()
+        (new_ident, status), = _query_merged_storage('q1')
+        assert status == m.SnapshotStorage.STATUS_CREATING
+
+    assert not FakeImageBackend(error_at=0).collect()
+    assert _query_merged_storage('q1') == [(new_ident, m.SnapshotStorage.STATUS_ABNORMAL)]
+    with s.readonly():
+        assert da_checkpoint.get_obj_by_storage_ident(new_ident) is None
+
+
+@pytest.mark.usefixtures('qcow_tree')
+def test_merge_abnormal_when_not_recoverable():
+    assert not FakeImageBackend(error_at=1, error=AssertionError).collect()
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_ABNORMAL
+    with s.readonly():
+        assert da_checkpoint.get_obj_by_storage_ident(new_ident) is None
+
+
+@pytest.mark.usefixtures('qcow_tree')
+def test_abandon_checkpoint_when_merge_storage_changed():
+    with pytest.raises(ServiceCrash):
+        FakeImageBackend(crash_at=1).collect()
+    _restart_service()
+
+    with s.transaction():
+        da_storage.update_obj_values(da_storage.get_obj_by_ident('q3'), {'status': m.SnapshotStorage.STATUS_DELETED})
+
+    with s.transaction():
+        works = sc.StorageCollection(TREE_IDENT)._create_resumable_merge_works(tree.generate(TREE_IDENT))
+    assert works is None
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_ABNORMAL
+    with s.readonly():
+        assert merge_checkpoint.query_in_tree(TREE_IDENT) == list()
+        assert da_checkpoint.get_obj_by_storage_ident(new_ident) is None
+
+
+@pytest.mark.usefixtures('long_qcow_tree')
+def test_flatten_qcow_chain():
+    backend = FakeImageBackend()
+    assert backend.collect()
+    assert backend.ranges == [(0, 4 * GiB)] * 3 + [(4 * GiB, 8 * GiB)] * 3 + [(8 * GiB, 10 * GiB)] * 3
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_STORAGE
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('q5').parent_ident == new_ident
+        assert [da_storage.get_obj_by_ident(f'q{i}').status for i in range(1, 5)] == [
+            m.SnapshotStorage.STATUS_STORAGE] * 4
+        assert s.get_scoped_session().query(m.MergeCheckpoint).count() == 0
+
+    assert not FakeImageBackend().collect()  # q4 已经没有子快照存储，不再合成
+
+
+@pytest.mark.usefixtures('long_qcow_tree')
+def test_flatten_qcow_chain_resume_from_checkpoint():
+    with pytest.raises(ServiceCrash):
+        FakeImageBackend(crash_at=4).collect()
+    _restart_service()
+
+    (new_ident, status), = _query_merged_storage('q1')
+    assert status == m.SnapshotStorage.STATUS_CREATING
+    with s.readonly():
+        checkpoint = da_checkpoint.get_obj_by_storage_ident(new_ident)
+        assert (checkpoint.merge_idents, checkpoint.finished_bytes) == ('q2,q3,q4', 4 * GiB)
+
+    backend = FakeImageBackend()
+    assert backend.collect()
+    assert backend.ranges == [(4 * GiB, 8 * GiB)] * 3 + [(8 * GiB, 10 * GiB)] * 3
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('q5').parent_ident == new_ident
+
+
+@pytest.mark.usefixtures('long_qcow_tree')
+def test_flatten_qcow_chain_below_threshold():
+    with patch.object(sc.StorageCollection, 'flatten_min_key_items', 5):
+        assert not FakeImageBackend().collect()
+    with patch.object(sc.StorageCollection, 'flatten_min_key_items', 0):
+        assert not FakeImageBackend().collect()
+
+
+@pytest.mark.parametrize('shape', simulator.TreeBuilder.SHAPES)
+def test_collect_synthetic_tree_to_fixed_point(shape):
+    stats = simulator.simulate(shape, 120, max_rounds=1000)
+    assert stats.reached_fixed_point
+    assert stats.storages_remaining < 120
+
+
+def test_merge_qcow_in_file_overlay_hash(tmp_path, create_storage):
+    image_path = str(tmp_path / 'a.qcow')
+    count = hash_file.records_count(DISK_BYTES)
+    hash_values = {'q1': [1, 1, 1], 'q2': [0, 2, 0, 2], 'q3': [3]}
+    with s.transaction():
+        for ident, parent_ident, status, hash_type in (
+                ('q1', None, m.SnapshotStorage.STATUS_STORAGE, m.Hash.TYPE_FULL),
+                ('q2', 'q1', m.SnapshotStorage.STATUS_RECYCLING, m.Hash.TYPE_INCREMENT),
+                ('q3', 'q2', m.SnapshotStorage.STATUS_STORAGE, m.Hash.TYPE_INCREMENT),):
+            create_storage(ident, parent_ident, status, image_path=image_path, disk_bytes=DISK_BYTES)
+            hash_path = action.ImagePathGenerator.generate_hash(image_path, ident)
+            records = np.zeros((len(hash_values[ident]), hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)
+            records[:, 0] = hash_values[ident]
+            hash_file.write_records(hash_path, [records])
+            da_hash.create_obj(ident, m.Hash.VERSION_MD4_CRC32, hash_type, hash_path)
+
+    with patch.object(action.DiskSnapshotAction, 'delete_qcow_snapshot'):
+        assert sc.StorageCollection(TREE_IDENT).collect()
+
+    with s.readonly():
+        assert da_storage.get_obj_by_ident('q3').parent_ident == 'q1'
+        q3_hash = da_hash.get_last_obj_by_storage_ident('q3')
+        assert q3_hash.type == m.Hash.TYPE_INCREMENT
+        assert hash_file.open_records(q3_hash.path)[:4, 0].tolist() == [3, 2, 0, 2]
+        assert len(hash_file.open_records(q3_hash.path)) == count
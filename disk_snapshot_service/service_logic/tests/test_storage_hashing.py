@@ -0,0 +1,194 @@
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from business_logic import dedup_index
+from business_logic import hash_file
+from business_logic import space_bitmap
+from business_logic import storage_action as action
+from business_logic import storage_reference_manager as srm
+from data_access import models as m
+from data_access import session as s
+from data_access import storage as da_storage
+from service_logic import dedup_index_rebuild
+from service_logic import storage_hashing as sh
+
+pytestmark = pytest.mark.usefixtures('db')
+
+TREE_IDENT = 'tree'
+
+
+class FakeHashBackend(object):
+    """模拟底层镜像服务的生成hash接口"""
+
+    def __init__(self, failed_idents=(), hash_records=None):
+        self.hash_paths = list()
+        self.failed_idents = failed_idents
+        self.reading = list()
+        self.hash_records = hash_records
+
+    def hash_qcow_snapshot(self, acquired_chain, raw_flag, hash_path, hash_version):
+        _ = raw_flag
+        _ = hash_version
+        ident = acquired_chain.last_storage_item.ident
+        self.reading.append(srm.get_srm().is_storage_using(ident))
+        if ident in self.failed_idents:
+            raise Exception(f'hash {ident} failed')
+        self.hash_paths.append(hash_path)
+        if self.hash_records:
+            hash_file.write_records(hash_path, [self.hash_records[ident]])
+
+    def run(self, scheduler: sh.HashingScheduler, timeout=10):
+        with patch.object(action.DiskSnapshotAction, 'hash_qcow_snapshot', self.hash_qcow_snapshot):
+            end = time.monotonic() + timeout
+            while scheduler.schedule_once():
+                assert time.monotonic() < end
+                time.sleep(0.01)
+
+
+def _query_status():
+    with s.readonly():
+        return {o.ident: o.status for o in da_storage.query_valid_objs(TREE_IDENT)}
+
+
+def _query_hashes():
+    with s.readonly():
+        return {o.storage_ident: o.type for o in s.get_scoped_session().query(m.Hash).all()}
+
+
+@pytest.fixture()
+def scheduler():
+    hashing_scheduler = sh.HashingScheduler(max_workers=2, max_queue=3, batch_size=2)
+    yield hashing_scheduler
+    hashing_scheduler.stop()
+
+
+@pytest.fixture()
+def hashing_tree(db, create_storage):
+    with s.transaction():
+        create_storage('q1', None, m.SnapshotStorage.STATUS_HASHING, image_path='/mnt/a.qcow')
+        create_storage('q2', 'q1', m.SnapshotStorage.STATUS_HASHING, image_path='/mnt/a.qcow')
+        create_storage('c1', 'q2', m.SnapshotStorage.STATUS_HASHING, m.SnapshotStorage.TYPE_CDP, '/mnt/c1.cdp')
+        create_storage('q3', 'c1', m.SnapshotStorage.STATUS_HASHING, image_path='/mnt/b.qcow')
+        create_storage('q4', 'q3', m.SnapshotStorage.STATUS_HASHING, image_path='/mnt/b.qcow')
+        create_storage('q5', 'q4', m.SnapshotStorage.STATUS_STORAGE, image_path='/mnt/b.qcow')
+
+
+@pytest.mark.usefixtures('hashing_tree')
+def test_hashing_storages_to_storage(scheduler):
+    backend = FakeHashBackend()
+    backend.run(scheduler)
+
+    assert set(_query_status().values()) == {m.SnapshotStorage.STATUS_STORAGE}
+    assert _query_hashes() == {
+        'q1': m.Hash.TYPE_FULL,
+        'q2': m.Hash.TYPE_INCREMENT,
+        'q3': m.Hash.TYPE_FULL,
+        'q4': m.Hash.TYPE_INCREMENT,
+    }
+    assert sorted(backend.hash_paths) == sorted(
+        action.ImagePathGenerator.generate_hash(p, i) for i, p in (
+            ('q1', '/mnt/a.qcow'), ('q2', '/mnt/a.qcow'), ('q3', '/mnt/b.qcow'), ('q4', '/mnt/b.qcow'),))
+    assert all(backend.reading)  # 生成hash期间持有读取引用
+    assert not srm.get_srm().is_storage_using('q4')
+    assert scheduler.stats['completed'] == 5
+    assert scheduler.queue_depth == 0
+
+
+@pytest.mark.usefixtures('hashing_tree')
+def test_hashing_failed_retry_then_abnormal(scheduler):
+    backend = FakeHashBackend(failed_idents=('q2',))
+    backend.run(scheduler)
+    assert _query_status()['q2'] == m.SnapshotStorage.STATUS_HASHING
+    assert scheduler.stats['failed'] == 1
+
+    scheduler.retry_interval_seconds = 0
+    backend.run(scheduler)
+    status = _query_status()
+    assert status['q2'] == m.SnapshotStorage.STATUS_ABNORMAL
+    assert status['q4'] == m.SnapshotStorage.STATUS_STORAGE
+    assert 'q2' not in _query_hashes()
+    assert scheduler.stats['failed'] == sh.HashingScheduler.MAX_RETRY
+
+
+@pytest.mark.usefixtures('hashing_tree')
+def test_hashing_acquire_failed_then_abnormal(scheduler):
+    acquire = sh.HashingTask.acquire
+
+    def _acquire(task):
+        if task.storage_item.ident == 'q2':
+            raise AssertionError('parent is abnormal')
+        return acquire(task)
+
+    scheduler.retry_interval_seconds = 0
+    with patch.object(sh.HashingTask, 'acquire', _acquire):
+        for _ in range(sh.HashingScheduler.MAX_RETRY):
+            FakeHashBackend().run(scheduler)
+    status = _query_status()
+    assert status['q2'] == m.SnapshotStorage.STATUS_ABNORMAL
+    assert status['q4'] == m.SnapshotStorage.STATUS_STORAGE
+    assert scheduler.stats['failed'] == sh.HashingScheduler.MAX_RETRY
+
+
+@pytest.mark.usefixtures('hashing_tree')
+def test_hashing_waiting_retry_not_starve_new_storages():
+    """等待重试的快照存储占满认领数量时，仍然认领新的快照存储"""
+    hashing_scheduler = sh.HashingScheduler(max_workers=2, max_queue=2, batch_size=2)
+    try:
+        FakeHashBackend(failed_idents=('q1', 'q2',)).run(hashing_scheduler)
+    finally:
+        hashing_scheduler.stop()
+    status = _query_status()
+    assert (status['q1'], status['q2']) == (m.SnapshotStorage.STATUS_HASHING,) * 2
+    assert {status[ident] for ident in ('c1', 'q3', 'q4')} == {m.SnapshotStorage.STATUS_STORAGE}
+
+
+def test_hashing_fill_new_storage_size(scheduler, tmp_path, create_storage):
+    with s.transaction():
+        create_storage('q1', None, m.SnapshotStorage.STATUS_HASHING, image_path=str(tmp_path / 'a.qcow'))
+        create_storage('c1', 'q1', m.SnapshotStorage.STATUS_HASHING, m.SnapshotStorage.TYPE_CDP,
+                       str(tmp_path / 'c1.cdp'))
+    for ident, image_path, count in (('q1', 'a.qcow', 10), ('c1', 'c1.cdp', 3)):
+        bits = np.zeros(16, bool)
+        bits[:count] = True
+        space_bitmap.write_bitmap(action.ImagePathGenerator.generate_map(str(tmp_path / image_path), ident), bits)
+
+    FakeHashBackend().run(scheduler)
+    with s.readonly():
+        assert {ident: da_storage.get_obj_by_ident(ident).new_storage_size for ident in ('q1', 'c1')} == {
+            'q1': 10 * space_bitmap.BLOCK_BYTES, 'c1': 3 * space_bitmap.BLOCK_BYTES}
+
+
+def test_hashing_add_to_dedup_index(tmp_path, create_storage):
+    rng = np.random.default_rng(0)
+    hash_records = {ident: rng.integers(1, 2 ** 32, (100, hash_file.RECORD_WORDS), hash_file.RECORD_DTYPE)
+                    for ident in ('q1', 'q2',)}
+    hash_records['q2'][:50] = hash_records['q1'][50:]
+    with s.transaction():
+        create_storage('q1', None, m.SnapshotStorage.STATUS_HASHING, image_path=str(tmp_path / 'a.qcow'))
+        create_storage('q2', 'q1', m.SnapshotStorage.STATUS_HASHING, image_path=str(tmp_path / 'b.qcow'))
+
+    index = dedup_index.DedupIndex(str(tmp_path / 'index'))
+    hashing_scheduler = sh.HashingScheduler(max_queue=1, index=index)
+    depths = list()
+    schedule_once = hashing_scheduler.schedule_once
+
+    def _schedule_once():
+        busy = schedule_once()
+        depths.append(hashing_scheduler.queue_depth)
+        return busy
+
+    with patch.object(hashing_scheduler, 'schedule_once', _schedule_once):
+        FakeHashBackend(hash_records=hash_records).run(hashing_scheduler)
+    hashing_scheduler.stop()
+    assert max(depths) == 1  # 加入索引的任务同样计入 max_queue
+
+    assert index.records_count == 150
+    assert index.lookup(hash_records['q2']).found.all()
+
+    rebuilt = dedup_index_rebuild.rebuild(str(tmp_path / 'index'))
+    assert rebuilt.records_count == 150
+    assert rebuilt.lookup(np.concatenate(list(hash_records.values()))).found.all()
+    assert not (tmp_path / 'index.rebuilding').exists()
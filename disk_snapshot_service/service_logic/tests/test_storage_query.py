@@ -0,0 +1,93 @@
+import decimal
+import json
+
+import numpy as np
+import pytest
+
+import interface_data_define as idd
+from business_logic import space_bitmap
+from business_logic import storage_action as action
+from business_logic import storage_space
+from business_logic import storage_timeline as timeline
+from data_access import models as m
+from data_access import session as s
+from service_logic import storage_query
+
+pytestmark = pytest.mark.usefixtures('db')
+
+TREE_IDENT = 'tree'
+
+
+@pytest.fixture()
+def tree(db, create_storage, reset_singletons):
+    with s.transaction():
+        for ident, parent_ident, storage_type, start, finish, status in (
+                ('q0', None, m.SnapshotStorage.TYPE_QCOW, '100', None, m.SnapshotStorage.STATUS_STORAGE),
+                ('c0', 'q0', m.SnapshotStorage.TYPE_CDP, '100', '200.5', m.SnapshotStorage.STATUS_STORAGE),
+                ('c1', 'c0', m.SnapshotStorage.TYPE_CDP, '300', None, m.SnapshotStorage.STATUS_WRITING),):
+            create_storage(ident, parent_ident, status, storage_type, start=decimal.Decimal(start),
+                           finish=decimal.Decimal(finish) if finish else None)
+    reset_singletons((timeline, '_storage_timelines'))
+
+
+def _query(params: dict, call=storage_query.query_timeline, params_schema=idd.QueryTimelineParamsSchema,
+           result_schema=idd.QueryTimelineResultSchema) -> dict:
+    params, errors = params_schema().loads(json.dumps(params))
+    assert not errors
+    result, errors = result_schema().dumps(call(params))
+    assert not errors
+    return json.loads(result)
+
+
+@pytest.mark.usefixtures('tree')
+def test_query_timeline():
+    result = _query({'storage_ident': 'c1', 'limit': 3})
+    assert (result['tree_ident'], result['first_timestamp'], result['last_timestamp']) == (
+        TREE_IDENT, '100.000000', None)
+    assert (result['storage_count'], result['gap_count'], result['covers']) == (3, 1, [])
+    assert [(entry['ident'], entry['type'], entry['status']) for entry in result['entries']] == [
+        ('c0', 'cdp', 'storage'), ('q0', 'qcow', 'storage'), (None, idd.TIMELINE_TYPE_GAP, None)]
+    assert (result['entries'][2]['start_timestamp'], result['entries'][2]['finish_timestamp']) == (
+        '200.500000', '300.000000')
+
+    result = _query({'tree_ident': TREE_IDENT, 'page_token': result['next_page_token']})
+    assert [entry['ident'] for entry in result['entries']] == ['c1'] and result['next_page_token'] is None
+    assert result['entries'][0]['finish_timestamp'] is None
+
+
+@pytest.mark.usefixtures('tree')
+def test_query_timeline_covers():
+    result = _query({'tree_ident': TREE_IDENT, 'timestamps': [100, '250', '400.25']})
+    assert result['covers'] == [{'timestamp': '100', 'idents': ['q0', 'c0']}, {'timestamp': '250', 'idents': []},
+                                {'timestamp': '400.25', 'idents': ['c1']}]
+    assert result['entries'] == []
+
+
+def test_query_timeline_invalid():
+    with pytest.raises(AssertionError, match='快照存储不存在'):
+        _query({'storage_ident': 'none'})
+    with pytest.raises(AssertionError, match='需要指定快照存储树或快照存储'):
+        _query({})
+    assert idd.QueryTimelineParamsSchema().loads('{"tree_ident": "t", "limit": 0}')[1]
+
+
+def test_query_space(db, tmp_path, create_storage, reset_singletons):
+    with s.transaction():
+        for ident, parent_ident, blocks in (('q0', None, range(8)), ('q1', 'q0', range(4)), ('q2', 'q0', None)):
+            image_path = str(tmp_path / f'{ident}.qcow')
+            create_storage(ident, parent_ident, image_path=image_path)
+            if blocks is not None:
+                bits = np.zeros(16, bool)
+                bits[list(blocks)] = True
+                space_bitmap.write_bitmap(action.ImagePathGenerator.generate_map(image_path, ident), bits)
+    reset_singletons((storage_space, '_storage_space'))
+
+    result = _query({'storage_ident': 'q1', 'with_storages': True}, storage_query.query_space,
+                    idd.QuerySpaceParamsSchema, idd.QuerySpaceResultSchema)
+    assert (result['tree_ident'], result['storage_count'], result['unknown_count']) == (TREE_IDENT, 3, 1)
+    block = space_bitmap.BLOCK_BYTES
+    assert result['written_bytes'] == 12 * block
+    assert {item['ident']: (item['written_bytes'], item['reclaimable_bytes']) for item in result['storages']} == {
+        'q0': (8 * block, 0), 'q1': (4 * block, 4 * block), 'q2': (None, None)}
+    assert _query({'tree_ident': TREE_IDENT}, storage_query.query_space, idd.QuerySpaceParamsSchema,
+                  idd.QuerySpaceResultSchema)['storages'] == []